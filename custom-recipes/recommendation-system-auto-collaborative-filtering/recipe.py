@@ -1,8 +1,9 @@
 from config_handler import create_dku_config
 from dataiku.customrecipe import get_recipe_config
-from dku_constants import RECIPE
+from dku_constants import RECIPE, COMPUTATION_ENGINE
 from dku_file_manager import DkuFileManager
-from query_handlers import AutoScoringHandler
+from query_handlers import AutoScoringHandler, IncrementalScoringHandler
+from sparse_handlers import SparseScoringHandler, ScoreStoreHandler
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -12,8 +13,15 @@ logger = logging.getLogger(__name__)
 def create_dku_file_manager():
     file_manager = DkuFileManager()
     file_manager.add_input_dataset("samples_dataset")
+    file_manager.add_input_dataset("samples_delta_dataset", required=False)
+    file_manager.add_input_dataset("previous_pair_statistics_dataset", required=False)
     file_manager.add_output_dataset("scored_samples_dataset")
     file_manager.add_output_dataset("similarity_scores_dataset", required=False)
+    file_manager.add_output_dataset("pair_statistics_dataset", required=False)
+    file_manager.add_output_folder("interaction_matrix_folder", required=False)
+    file_manager.add_output_folder("score_store_folder", required=False)
+    file_manager.add_output_dataset("metrics_dataset", required=False)
+    file_manager.add_output_folder("query_plans_folder", required=False)
     return file_manager
 
 
@@ -22,8 +30,23 @@ def run():
     recipe_config = get_recipe_config()
     file_manager = create_dku_file_manager()
     dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, recipe_config, file_manager=file_manager)
-    query_handler = AutoScoringHandler(dku_config, file_manager)
+    if dku_config.computation_engine == COMPUTATION_ENGINE.IN_MEMORY:
+        query_handler = SparseScoringHandler(dku_config, file_manager)
+    elif dku_config.computation_engine == COMPUTATION_ENGINE.SPARK:
+        # pyspark is only required by the Spark engine
+        from spark_handlers import SparkAutoScoringHandler
+
+        query_handler = SparkAutoScoringHandler(dku_config, file_manager)
+    elif dku_config.incremental_similarity:
+        query_handler = IncrementalScoringHandler(dku_config, file_manager)
+    else:
+        query_handler = AutoScoringHandler(dku_config, file_manager)
     query_handler.build()
+    if dku_config.computation_engine == COMPUTATION_ENGINE.SQL:
+        query_handler.write_metrics(file_manager.scored_samples_dataset)
+        query_handler.write_query_plans()
+    if file_manager.score_store_folder is not None:
+        ScoreStoreHandler(dku_config, file_manager).build()
     logger.info("Recipe done !")
 
 
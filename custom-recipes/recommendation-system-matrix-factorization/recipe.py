@@ -0,0 +1,34 @@
+from config_handler import create_dku_config
+from dataiku.customrecipe import get_recipe_config
+from dku_constants import RECIPE
+from dku_file_manager import DkuFileManager
+from sparse_handlers import MatrixFactorizationHandler, ScoreStoreHandler
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def create_dku_file_manager():
+    file_manager = DkuFileManager()
+    file_manager.add_input_dataset("samples_dataset")
+    file_manager.add_output_dataset("scored_samples_dataset")
+    file_manager.add_output_dataset("user_factors_dataset", required=False)
+    file_manager.add_output_dataset("item_factors_dataset", required=False)
+    file_manager.add_output_folder("score_store_folder", required=False)
+    return file_manager
+
+
+def run():
+    logger.info("Running recipe Matrix factorization (ALS)")
+    recipe_config = get_recipe_config()
+    file_manager = create_dku_file_manager()
+    dku_config = create_dku_config(RECIPE.MATRIX_FACTORIZATION, recipe_config, file_manager=file_manager)
+    query_handler = MatrixFactorizationHandler(dku_config, file_manager)
+    query_handler.build()
+    if file_manager.score_store_folder is not None:
+        ScoreStoreHandler(dku_config, file_manager).build()
+    logger.info("Recipe done !")
+
+
+run()
\ No newline at end of file
@@ -1,6 +1,6 @@
 from config_handler import create_dku_config
 from dataiku.customrecipe import get_recipe_config
-from dku_constants import RECIPE
+from dku_constants import RECIPE, COMPUTATION_ENGINE
 from dku_file_manager import DkuFileManager
 from query_handlers import SamplingHandler
 import logging
@@ -15,6 +15,8 @@ def create_dku_file_manager():
     dku_file_manager.add_input_dataset("training_samples_dataset")
     dku_file_manager.add_input_dataset("historical_samples_dataset", required=False)
     dku_file_manager.add_output_dataset("positive_negative_samples_dataset")
+    dku_file_manager.add_output_dataset("metrics_dataset", required=False)
+    dku_file_manager.add_output_folder("query_plans_folder", required=False)
     return dku_file_manager
 
 
@@ -23,8 +25,17 @@ def run():
     recipe_config = get_recipe_config()
     file_manager = create_dku_file_manager()
     dku_config = create_dku_config(RECIPE.SAMPLING, recipe_config, file_manager=file_manager)
-    query_handler = SamplingHandler(dku_config, file_manager)
+    if dku_config.computation_engine == COMPUTATION_ENGINE.SPARK:
+        # pyspark is only required by the Spark engine
+        from spark_handlers import SparkSamplingHandler
+
+        query_handler = SparkSamplingHandler(dku_config, file_manager)
+    else:
+        query_handler = SamplingHandler(dku_config, file_manager)
     query_handler.build()
+    if dku_config.computation_engine == COMPUTATION_ENGINE.SQL:
+        query_handler.write_metrics(file_manager.positive_negative_samples_dataset)
+        query_handler.write_query_plans()
     logger.info("Recipe done !")
 
 
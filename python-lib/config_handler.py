@@ -4,6 +4,19 @@ from dku_constants import (
     SIMILARITY_TYPE,
     SAMPLING_METHOD,
     CF_METHOD,
+    SIMILARITY_COMPUTATION,
+    MATERIALIZATION_MODE,
+    ENTITY_STATISTICS,
+    SCORING_STAGE,
+    EXECUTION_BUCKETING,
+    JOIN_BUDGET_ACTION,
+    COMPUTATION_ENGINE,
+    FEEDBACK_TYPE,
+    SCORES_OUTPUT,
+    OUTPUT_FORMAT,
+    RECENCY_FILTER,
+    DUPLICATES_REDUCER,
+    PROJECTION_SIMILARITY_COMPUTATIONS,
 )
 import logging
 
@@ -18,6 +31,8 @@ def create_dku_config(recipe_id, config, file_manager=None):
         add_sampling_config(dku_config, config, file_manager)
     elif recipe_id == RECIPE.COLLABORATIVE_FILTERING:
         add_auto_collaborative_filtering_config(dku_config, config, file_manager)
+    elif recipe_id == RECIPE.MATRIX_FACTORIZATION:
+        add_matrix_factorization_config(dku_config, config, file_manager)
     logger.info(f"Created dku_config:\n{dku_config}")
     return dku_config
 
@@ -142,9 +157,114 @@ def add_sampling_config(dku_config, config, file_manager):
         value=config.get("negative_samples_percentage"),
         checks=[{"type": "between", "op": [0, 100]}],
     )
+    add_id_encoding_config(dku_config, config)
+    add_concurrency_config(dku_config, config)
+    add_metrics_config(dku_config, config)
+    add_query_plans_config(dku_config, config, file_manager)
+    add_sql_or_spark_engine_config(dku_config, config, file_manager)
 
 
 def add_scoring_config(dku_config, config, file_manager):
+    add_samples_columns_config(dku_config, config, file_manager)
+
+    dku_config.add_param(
+        name="top_n_most_similar",
+        label="Nb. of most similar users/items",
+        value=config.get("top_n_most_similar"),
+        required=True,
+        checks=[{"type": "sup", "op": 0}],
+    )
+    dku_config.add_param(
+        name="user_visit_threshold",
+        label="Minimum visits per user",
+        value=config.get("user_visit_threshold"),
+        required=True,
+        checks=[{"type": "sup", "op": 0}],
+    )
+    dku_config.add_param(
+        name="item_visit_threshold",
+        label="Minimum visits per item",
+        value=config.get("item_visit_threshold"),
+        required=True,
+        checks=[{"type": "sup", "op": 0}],
+    )
+    dku_config.add_param(
+        name="user_visit_cap",
+        label="Maximum visits per user",
+        value=config.get("user_visit_cap"),
+        checks=[{"type": "sup", "op": 0}],
+    )
+    dku_config.add_param(
+        name="item_visit_cap",
+        label="Maximum visits per item",
+        value=config.get("item_visit_cap"),
+        checks=[{"type": "sup", "op": 0}],
+    )
+    dku_config.add_param(
+        name="downsampling_seed",
+        label="Downsampling seed",
+        value=config.get("downsampling_seed", 1337),
+        checks=[{"type": "is_type", "op": int}],
+    )
+    duplicates_reducer = config.get("duplicates_reducer", DUPLICATES_REDUCER.NONE.value)
+    dku_config.add_param(
+        name="duplicates_reducer",
+        label="Duplicated interactions",
+        value=duplicates_reducer,
+        checks=[
+            {
+                "type": "custom",
+                "op": duplicates_reducer in [DUPLICATES_REDUCER.NONE.value, DUPLICATES_REDUCER.PRESENCE.value]
+                or dku_config.ratings_column_name is not None,
+                "err_msg": f"Reducing duplicated interactions by {duplicates_reducer} requires a ratings column.",
+            },
+        ],
+        required=True,
+        cast_to=DUPLICATES_REDUCER,
+    )
+    dku_config.add_param(name="timestamp_filtering", value=config.get("timestamp_filtering", False), required=True)
+    dku_config.add_param(
+        name="scores_output",
+        label="Scores output",
+        value=config.get("scores_output", SCORES_OUTPUT.ALL_SCORES.value),
+        required=True,
+        cast_to=SCORES_OUTPUT,
+    )
+    output_format = config.get("output_format", OUTPUT_FORMAT.LONG.value)
+    dku_config.add_param(
+        name="output_format",
+        label="Output format",
+        value=output_format,
+        checks=[
+            {
+                "type": "custom",
+                "op": output_format == OUTPUT_FORMAT.LONG.value or file_manager.get("score_store_folder") is None,
+                "err_msg": "The score store can only be exported from scores in long format.",
+            },
+        ],
+        required=True,
+        cast_to=OUTPUT_FORMAT,
+    )
+    # nested arrays are bounded to the top K scores of each user
+    if dku_config.scores_output == SCORES_OUTPUT.TOP_K_UNSEEN or output_format == OUTPUT_FORMAT.NESTED_ARRAYS.value:
+        dku_config.add_param(
+            name="top_k",
+            label="Nb. of items per user",
+            value=config.get("top_k", 100),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+
+    add_materialization_config(dku_config, config)
+    add_entity_statistics_config(dku_config, config)
+    add_id_encoding_config(dku_config, config)
+    add_execution_bucketing_config(dku_config, config)
+    add_concurrency_config(dku_config, config)
+    add_metrics_config(dku_config, config)
+    add_query_plans_config(dku_config, config, file_manager)
+
+
+def add_samples_columns_config(dku_config, config, file_manager):
     samples_dataset_columns = get_column_names(file_manager.samples_dataset)
 
     dku_config.add_param(
@@ -190,41 +310,156 @@ def add_scoring_config(dku_config, config, file_manager):
         required=False,
     )
 
+
+def add_materialization_config(dku_config, config):
     dku_config.add_param(
-        name="top_n_most_similar",
-        label="Nb. of most similar users/items",
-        value=config.get("top_n_most_similar"),
+        name="materialization_mode",
+        label="Materialization of intermediate stages",
+        value=config.get("materialization_mode", MATERIALIZATION_MODE.AUTO.value),
         required=True,
-        checks=[{"type": "sup", "op": 0}],
+        cast_to=MATERIALIZATION_MODE,
     )
+    scoring_stages = [stage.value for stage in SCORING_STAGE]
     dku_config.add_param(
-        name="user_visit_threshold",
-        label="Minimum visits per user",
-        value=config.get("user_visit_threshold"),
+        name="materialized_stages",
+        label="Stages to materialize",
+        value=config.get("materialized_stages", scoring_stages),
+        checks=[
+            {"type": "is_type", "op": list},
+            {
+                "type": "is_subset",
+                "op": scoring_stages,
+                "err_msg": f"Invalid stages to materialize: {config.get('materialized_stages')}.",
+            },
+        ],
+    )
+
+
+def add_entity_statistics_config(dku_config, config):
+    dku_config.add_param(
+        name="entity_statistics",
+        label="Visit counts and normalization",
+        value=config.get("entity_statistics", ENTITY_STATISTICS.AUTO.value),
         required=True,
+        cast_to=ENTITY_STATISTICS,
+    )
+
+
+def add_id_encoding_config(dku_config, config):
+    dku_config.add_param(
+        name="encode_ids",
+        label="Integer encoding of the IDs",
+        value=config.get("encode_ids", False),
+        required=True,
+    )
+
+
+def add_execution_bucketing_config(dku_config, config):
+    dku_config.add_param(
+        name="execution_bucketing",
+        label="Execution in buckets",
+        value=config.get("execution_bucketing", EXECUTION_BUCKETING.NONE.value),
+        required=True,
+        cast_to=EXECUTION_BUCKETING,
+    )
+    if dku_config.execution_bucketing == EXECUTION_BUCKETING.FIXED:
+        dku_config.add_param(
+            name="nb_execution_buckets",
+            label="Nb. of buckets",
+            value=config.get("nb_execution_buckets"),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+    elif dku_config.execution_bucketing == EXECUTION_BUCKETING.AUTO:
+        dku_config.add_param(
+            name="max_joined_rows_per_bucket",
+            label="Max. joined rows per bucket",
+            value=config.get("max_joined_rows_per_bucket"),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+
+
+def add_join_budget_config(dku_config, config):
+    dku_config.add_param(
+        name="join_row_budget",
+        label="Joined rows budget",
+        value=config.get("join_row_budget"),
         checks=[{"type": "sup", "op": 0}],
     )
+    if dku_config.join_row_budget:
+        dku_config.add_param(
+            name="join_budget_action",
+            label="Action over budget",
+            value=config.get("join_budget_action", JOIN_BUDGET_ACTION.ABORT.value),
+            required=True,
+            cast_to=JOIN_BUDGET_ACTION,
+        )
+
+
+def add_metrics_config(dku_config, config):
     dku_config.add_param(
-        name="item_visit_threshold",
-        label="Minimum visits per item",
-        value=config.get("item_visit_threshold"),
+        name="profile_stages",
+        label="Profile the query stages",
+        value=config.get("profile_stages", False),
+        required=True,
+    )
+
+
+def add_query_plans_config(dku_config, config, file_manager):
+    explain_only = config.get("explain_only", False)
+    dku_config.add_param(
+        name="explain_only",
+        label="Only explain the queries",
+        value=explain_only,
+        checks=[
+            {
+                "type": "custom",
+                "op": not explain_only or file_manager.get("query_plans_folder") is not None,
+                "err_msg": "Only explaining the queries requires a query plans folder.",
+            },
+            {
+                "type": "custom",
+                "op": not explain_only or file_manager.get("score_store_folder") is None,
+                "err_msg": "The score store can't be exported when only explaining the queries.",
+            },
+        ],
         required=True,
+    )
+
+
+def add_concurrency_config(dku_config, config):
+    dku_config.add_param(
+        name="max_concurrency",
+        label="Max. concurrent queries",
+        value=config.get("max_concurrency", 1),
         checks=[{"type": "sup", "op": 0}],
+        required=True,
     )
-    dku_config.add_param(name="timestamp_filtering", value=config.get("timestamp_filtering", False), required=True)
 
 
 def add_timestamp_filtering(dku_config, config, file_manager):
     if dku_config.timestamp_filtering:
         dku_config.add_param(
-            name="top_n_most_recent",
-            label="Nb. of items to keep per user",
-            value=config.get("top_n_most_recent"),
-            checks=[
-                {"type": "sup", "op": 0},
-            ],
+            name="recency_filter",
+            label="Recency filter",
+            value=config.get("recency_filter", RECENCY_FILTER.TOP_N_MOST_RECENT.value),
             required=True,
+            cast_to=RECENCY_FILTER,
         )
+        if dku_config.recency_filter == RECENCY_FILTER.TOP_N_MOST_RECENT:
+            dku_config.add_param(
+                name="top_n_most_recent",
+                label="Nb. of items to keep per user",
+                value=config.get("top_n_most_recent"),
+                checks=[
+                    {"type": "sup", "op": 0},
+                ],
+                required=True,
+            )
+
+    # the last rating of duplicated interactions is the one of their most recent timestamp
+    if dku_config.timestamp_filtering or dku_config.get("duplicates_reducer") == DUPLICATES_REDUCER.LAST:
         samples_dataset_columns = get_column_names(file_manager.samples_dataset)
 
         dku_config.add_param(
@@ -242,6 +477,36 @@ def add_timestamp_filtering(dku_config, config, file_manager):
             required=True,
         )
 
+    if dku_config.timestamp_filtering:
+        if dku_config.recency_filter == RECENCY_FILTER.DATE_WINDOW:
+            add_date_window_config(dku_config, config, file_manager)
+        dku_config.add_param(
+            name="recency_filter_first",
+            label="Filter recent samples first",
+            value=config.get("recency_filter_first", True),
+            required=True,
+        )
+
+
+def add_date_window_config(dku_config, config, file_manager):
+    # the bounds are compared to the timestamps as dates or as numbers, depending on the type of the column
+    is_date_column = get_column_type(file_manager.samples_dataset, dku_config.timestamps_column_name) == "date"
+    dku_config.add_param(
+        name="recency_window_start",
+        label="Window start",
+        value=config.get("recency_window_start"),
+        checks=[{"type": "is_type", "op": str}] if is_date_column else [],
+        required=True,
+        cast_to=None if is_date_column else float,
+    )
+    dku_config.add_param(
+        name="recency_window_end",
+        label="Window end",
+        value=config.get("recency_window_end") or None,
+        checks=[{"type": "is_type", "op": str}] if is_date_column else [],
+        cast_to=None if is_date_column else float,
+    )
+
 
 def add_custom_collaborative_filtering_config(dku_config, config, file_manager):
     add_scoring_config(dku_config, config, file_manager)
@@ -300,8 +565,14 @@ def add_custom_collaborative_filtering_config(dku_config, config, file_manager):
         ],
         required=True,
     )
+    dku_config.add_param(
+        name="half_similarity_matrix", value=config.get("half_similarity_matrix", False), required=True
+    )
 
     add_timestamp_filtering(dku_config, config, file_manager)
+    add_sql_or_spark_engine_config(dku_config, config, file_manager)
+    if dku_config.computation_engine == COMPUTATION_ENGINE.SPARK:
+        add_spark_joins_config(dku_config, config)
 
 
 def add_auto_collaborative_filtering_config(dku_config, config, file_manager):
@@ -311,10 +582,366 @@ def add_auto_collaborative_filtering_config(dku_config, config, file_manager):
         value=config.get("collaborative_filtering_method"),
         cast_to=CF_METHOD,
     )
+    dku_config.add_param(
+        name="similarity_computation",
+        label="Similarity computation",
+        value=config.get("similarity_computation", SIMILARITY_COMPUTATION.EXACT.value),
+        required=True,
+        cast_to=SIMILARITY_COMPUTATION,
+    )
+    if dku_config.similarity_computation == SIMILARITY_COMPUTATION.MINHASH_LSH:
+        add_minhash_lsh_config(dku_config, config)
+    elif dku_config.similarity_computation in PROJECTION_SIMILARITY_COMPUTATIONS:
+        add_projection_config(dku_config, config)
+    dku_config.add_param(
+        name="full_similarity_matrix", value=config.get("full_similarity_matrix", False), required=True
+    )
 
     add_timestamp_filtering(dku_config, config, file_manager)
+    add_incremental_similarity_config(dku_config, config, file_manager)
+    add_join_budget_config(dku_config, config)
+    add_computation_engine_config(dku_config, config, file_manager)
+
+
+def add_incremental_similarity_config(dku_config, config, file_manager):
+    incremental_similarity = config.get("incremental_similarity", False)
+    dku_config.add_param(
+        name="incremental_similarity",
+        label="Incremental similarity",
+        value=incremental_similarity,
+        checks=[
+            {
+                "type": "custom",
+                "op": not incremental_similarity or file_manager.pair_statistics_dataset is not None,
+                "err_msg": "An output pair statistics dataset is required to update the similarity incrementally.",
+            },
+            {
+                "type": "custom",
+                "op": not incremental_similarity
+                or dku_config.similarity_computation == SIMILARITY_COMPUTATION.EXACT,
+                "err_msg": "The incremental similarity can't be used with approximate similarity computation.",
+            },
+            {
+                "type": "custom",
+                "op": not incremental_similarity
+                or not (dku_config.timestamp_filtering or dku_config.user_visit_cap or dku_config.item_visit_cap),
+                "err_msg": "The incremental similarity can't be used with timestamp filtering or visit caps.",
+            },
+            {
+                "type": "custom",
+                "op": not incremental_similarity or dku_config.duplicates_reducer == DUPLICATES_REDUCER.NONE,
+                "err_msg": "The incremental similarity can't be used with reduced duplicated interactions.",
+            },
+            {
+                "type": "custom",
+                "op": not incremental_similarity or not dku_config.encode_ids,
+                "err_msg": "The incremental similarity can't be used with the integer encoding of the IDs.",
+            },
+        ],
+        required=True,
+    )
+
+
+def add_computation_engine_config(dku_config, config, file_manager):
+    computation_engine = config.get("computation_engine", COMPUTATION_ENGINE.SQL.value)
+    is_in_memory = computation_engine == COMPUTATION_ENGINE.IN_MEMORY.value
+    is_spark = computation_engine == COMPUTATION_ENGINE.SPARK.value
+    dku_config.add_param(
+        name="computation_engine",
+        label="Computation engine",
+        value=computation_engine,
+        checks=[
+            {
+                "type": "custom",
+                "op": not is_in_memory or dku_config.similarity_computation != SIMILARITY_COMPUTATION.MINHASH_LSH,
+                "err_msg": "The in-memory engine can't be used with MinHash LSH similarity computation.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or dku_config.similarity_computation != SIMILARITY_COMPUTATION.MINHASH_LSH,
+                "err_msg": "The Spark engine can't be used with MinHash LSH similarity computation.",
+            },
+            {
+                "type": "custom",
+                "op": is_in_memory or dku_config.similarity_computation not in PROJECTION_SIMILARITY_COMPUTATIONS,
+                "err_msg": "Randomized SVD and random projection similarity computations require the in-memory engine.",
+            },
+            {
+                "type": "custom",
+                "op": not is_in_memory or dku_config.scores_output == SCORES_OUTPUT.ALL_SCORES,
+                "err_msg": "The in-memory engine can't output only the top K unseen items of each user.",
+            },
+            {
+                "type": "custom",
+                "op": not is_in_memory or dku_config.output_format == OUTPUT_FORMAT.LONG,
+                "err_msg": "The in-memory engine can only write outputs in long format.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or dku_config.output_format == OUTPUT_FORMAT.LONG,
+                "err_msg": "The Spark engine can only write outputs in long format.",
+            },
+            {
+                "type": "custom",
+                "op": not (is_in_memory or is_spark) or file_manager.get("metrics_dataset") is None,
+                "err_msg": "The stage metrics are only computed by the SQL engine.",
+            },
+            {
+                "type": "custom",
+                "op": not (is_in_memory or is_spark) or file_manager.get("query_plans_folder") is None,
+                "err_msg": "The query plans are only captured by the SQL engine.",
+            },
+            {
+                "type": "custom",
+                "op": not is_in_memory or dku_config.duplicates_reducer == DUPLICATES_REDUCER.NONE,
+                "err_msg": "The in-memory engine can't reduce duplicated interactions.",
+            },
+            {
+                "type": "custom",
+                "op": not (is_in_memory or is_spark) or not dku_config.encode_ids,
+                "err_msg": "The IDs are only encoded as integers by the SQL engine.",
+            },
+            {
+                "type": "custom",
+                "op": not is_in_memory or not dku_config.incremental_similarity,
+                "err_msg": "The in-memory engine can't be used with incremental similarity.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or not dku_config.incremental_similarity,
+                "err_msg": "The Spark engine can't be used with incremental similarity.",
+            },
+            {
+                "type": "custom",
+                "op": file_manager.interaction_matrix_folder is None
+                or (is_in_memory and config.get("out_of_core", False)),
+                "err_msg": "An interaction matrix folder can only be written by the out-of-core in-memory engine.",
+            },
+        ],
+        required=True,
+        cast_to=COMPUTATION_ENGINE,
+    )
+    if is_in_memory:
+        add_in_memory_engine_config(dku_config, config)
+    elif is_spark:
+        add_spark_engine_config(dku_config, config)
+        add_spark_joins_config(dku_config, config, salt_skewed_pivots=True)
+
+
+def add_sql_or_spark_engine_config(dku_config, config, file_manager):
+    """Computation engine of the recipes which run either in the database of the datasets or with Spark"""
+    computation_engine = config.get("computation_engine", COMPUTATION_ENGINE.SQL.value)
+    is_spark = computation_engine == COMPUTATION_ENGINE.SPARK.value
+    dku_config.add_param(
+        name="computation_engine",
+        label="Computation engine",
+        value=computation_engine,
+        checks=[
+            {
+                "type": "in",
+                "op": [COMPUTATION_ENGINE.SQL, COMPUTATION_ENGINE.SPARK],
+                "err_msg": f"Invalid computation engine for this recipe: {computation_engine}.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or dku_config.get("output_format") != OUTPUT_FORMAT.NESTED_ARRAYS,
+                "err_msg": "The Spark engine can only write outputs in long format.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or file_manager.get("metrics_dataset") is None,
+                "err_msg": "The stage metrics are only computed by the SQL engine.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or file_manager.get("query_plans_folder") is None,
+                "err_msg": "The query plans are only captured by the SQL engine.",
+            },
+            {
+                "type": "custom",
+                "op": not is_spark or not dku_config.encode_ids,
+                "err_msg": "The IDs are only encoded as integers by the SQL engine.",
+            },
+        ],
+        required=True,
+        cast_to=COMPUTATION_ENGINE,
+    )
+    if is_spark:
+        add_spark_engine_config(dku_config, config)
+
+
+def add_spark_engine_config(dku_config, config):
+    dku_config.add_param(name="spark_master", label="Spark master", value=config.get("spark_master"))
+
+
+def add_spark_joins_config(dku_config, config, salt_skewed_pivots=False):
+    dku_config.add_param(
+        name="broadcast_max_rows",
+        label="Max. rows of broadcast neighbours",
+        value=config.get("broadcast_max_rows", 1000000),
+        checks=[{"type": "sup_eq", "op": 0}],
+        required=True,
+    )
+    if salt_skewed_pivots:
+        dku_config.add_param(
+            name="skewed_pivot_threshold",
+            label="Skewed join key threshold",
+            value=config.get("skewed_pivot_threshold", 10000),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+        dku_config.add_param(
+            name="nb_salts",
+            label="Nb. of salts of skewed join keys",
+            value=config.get("nb_salts", 8),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+
+
+def add_in_memory_engine_config(dku_config, config):
+    dku_config.add_param(
+        name="block_size",
+        label="Block size",
+        value=config.get("block_size", 10000),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="nb_workers",
+        label="Nb. of worker processes",
+        value=config.get("nb_workers", 1),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="out_of_core", label="Out-of-core", value=config.get("out_of_core", False), required=True
+    )
+    if dku_config.out_of_core:
+        dku_config.add_param(
+            name="max_memory_mb",
+            label="Max. memory (MB)",
+            value=config.get("max_memory_mb", 1024),
+            checks=[{"type": "sup", "op": 0}],
+            required=True,
+        )
+
+
+def add_matrix_factorization_config(dku_config, config, file_manager):
+    add_samples_columns_config(dku_config, config, file_manager)
+    feedback_type = config.get("feedback_type", FEEDBACK_TYPE.IMPLICIT.value)
+    dku_config.add_param(
+        name="feedback_type",
+        label="Feedback type",
+        value=feedback_type,
+        checks=[
+            {
+                "type": "custom",
+                "op": feedback_type != FEEDBACK_TYPE.EXPLICIT.value or bool(dku_config.ratings_column_name),
+                "err_msg": "A ratings column is required with explicit feedbacks.",
+            }
+        ],
+        required=True,
+        cast_to=FEEDBACK_TYPE,
+    )
+    dku_config.add_param(
+        name="nb_factors",
+        label="Nb. of factors",
+        value=config.get("nb_factors", 32),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="regularization",
+        label="Regularization",
+        value=config.get("regularization", 0.01),
+        checks=[{"type": "sup_eq", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="nb_iterations",
+        label="Nb. of iterations",
+        value=config.get("nb_iterations", 15),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="cg_steps",
+        label="Conjugate gradient steps",
+        value=config.get("cg_steps", 3),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="confidence_alpha",
+        label="Confidence scaling",
+        value=config.get("confidence_alpha", 1.0),
+        checks=[{"type": "sup_eq", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="top_k",
+        label="Nb. of items per user",
+        value=config.get("top_k", 100),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="seed",
+        label="Random seed",
+        value=config.get("seed", 1337),
+        checks=[{"type": "is_type", "op": int}],
+        required=True,
+    )
+    add_in_memory_engine_config(dku_config, config)
+
+
+def add_projection_config(dku_config, config):
+    dku_config.add_param(
+        name="projection_dimension",
+        label="Projection dimension",
+        value=config.get("projection_dimension", 64),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    dku_config.add_param(
+        name="recall_sample_size",
+        label="Recall sample size",
+        value=config.get("recall_sample_size", 1000),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+
+
+def add_minhash_lsh_config(dku_config, config):
+    dku_config.add_param(
+        name="minhash_nb_hashes",
+        label="Nb. of MinHash functions",
+        value=config.get("minhash_nb_hashes"),
+        checks=[{"type": "sup", "op": 0}],
+        required=True,
+    )
+    lsh_nb_bands = config.get("lsh_nb_bands")
+    dku_config.add_param(
+        name="lsh_nb_bands",
+        label="Nb. of LSH bands",
+        value=lsh_nb_bands,
+        checks=[
+            {"type": "sup", "op": 0},
+            {
+                "type": "custom",
+                "op": bool(lsh_nb_bands) and dku_config.minhash_nb_hashes % lsh_nb_bands == 0,
+                "err_msg": "The number of MinHash functions must be a multiple of the number of LSH bands.",
+            },
+        ],
+        required=True,
+    )
 
 
 def get_column_names(dataset):
     dataset_columns = [column["name"] for column in dataset.read_schema()]
-    return dataset_columns
\ No newline at end of file
+    return dataset_columns
+
+
+def get_column_type(dataset, column_name):
+    return next((column["type"] for column in dataset.read_schema() if column["name"] == column_name), "string")
\ No newline at end of file
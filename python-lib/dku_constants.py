@@ -5,6 +5,7 @@ class RECIPE(Enum):
     AFFINITY_SCORE = "affinity_score"
     COLLABORATIVE_FILTERING = "collaborative_filtering"
     SAMPLING = "sampling"
+    MATRIX_FACTORIZATION = "matrix_factorization"
 
 
 class SIMILARITY_TYPE(Enum):
@@ -22,6 +23,138 @@ class CF_METHOD(Enum):
     ITEM_BASED = "item_based"
 
 
+class FEEDBACK_TYPE(Enum):
+    IMPLICIT = "implicit"
+    EXPLICIT = "explicit"
+
+
+class MATERIALIZATION_MODE(Enum):
+    AUTO = "auto"
+    INLINE = "inline"
+    CTE = "cte"
+    TEMP_TABLE = "temp_table"
+
+
+class ENTITY_STATISTICS(Enum):
+    AUTO = "auto"
+    WINDOWS = "windows"
+    GROUPED = "grouped"
+
+
+class EXECUTION_BUCKETING(Enum):
+    NONE = "none"
+    FIXED = "fixed"
+    AUTO = "auto"
+
+
+class JOIN_BUDGET_ACTION(Enum):
+    ABORT = "abort"
+    EXECUTION_BUCKETS = "execution_buckets"
+
+
+class PLAN_FORMAT(Enum):
+    POSTGRES_JSON = "postgres_json"
+    SNOWFLAKE_JSON = "snowflake_json"
+    SHOWPLAN_XML = "showplan_xml"
+    DSQL_XML = "dsql_xml"
+
+
+class PLAN_ANTI_PATTERN(Enum):
+    NULL_SAFE_NESTED_LOOP = "null_safe_nested_loop"
+    REPEATED_SCAN = "repeated_scan"
+    FULL_MATRIX_SORT = "full_matrix_sort"
+    CARTESIAN_PRODUCT = "cartesian_product"
+
+
+class DUPLICATES_REDUCER(Enum):
+    NONE = "none"
+    PRESENCE = "presence"
+    COUNT = "count"
+    SUM = "sum"
+    MEAN = "mean"
+    LAST = "last"
+
+
+class RECENCY_FILTER(Enum):
+    TOP_N_MOST_RECENT = "top_n_most_recent"
+    DATE_WINDOW = "date_window"
+
+
+class COMPUTATION_ENGINE(Enum):
+    SQL = "sql"
+    IN_MEMORY = "in_memory"
+    SPARK = "spark"
+
+
+class SCORES_OUTPUT(Enum):
+    ALL_SCORES = "all_scores"
+    TOP_K_UNSEEN = "top_k_unseen"
+
+
+class OUTPUT_FORMAT(Enum):
+    LONG = "long"
+    NESTED_ARRAYS = "nested_arrays"
+
+
+class SCORING_STAGE(Enum):
+    PREPARED_SAMPLES = "prepared_samples"
+    NORMALIZATION_FACTOR = "normalization_factor"
+    TOP_N = "top_n"
+
+
+class SAMPLING_STAGE(Enum):
+    TRAINING_SAMPLES = "training_samples"
+    HISTORICAL_SAMPLES = "historical_samples"
+
+
+class SIMILARITY_STAGE(Enum):
+    HALF_MATRIX = "half_similarity_matrix"
+    FULL_MATRIX = "full_similarity_matrix"
+
+
+class SIMILARITY_COMPUTATION(Enum):
+    EXACT = "exact"
+    MINHASH_LSH = "minhash_lsh"
+    RANDOMIZED_SVD = "randomized_svd"
+    RANDOM_PROJECTION = "random_projection"
+
+
+class MINHASH_STAGE(Enum):
+    SIGNATURES = "minhash_signatures"
+    BUCKETS = "lsh_buckets"
+
+
+class INCREMENTAL_STAGE(Enum):
+    ALL_SAMPLES = "all_samples"
+    VISITED_SAMPLES = "visited_samples"
+    PAIR_STATISTICS = "pair_statistics"
+    ENTITY_STATISTICS = "entity_statistics"
+
+
+class ENTITY_STATISTICS_STAGE(Enum):
+    REDUCED_SAMPLES = "reduced_samples"
+    THRESHOLDED_SAMPLES = "thresholded_samples"
+
+
+class ENCODING_STAGE(Enum):
+    USER_IDS = "user_ids"
+    ITEM_IDS = "item_ids"
+    USERS_DICTIONARY = "users_dictionary"
+    ITEMS_DICTIONARY = "items_dictionary"
+
+
+class STAGING_STAGE(Enum):
+    PREPARED_SAMPLES = "staged_prepared_samples"
+
+
+class QUALIFIED_STAGE(Enum):
+    MOST_RECENT_SAMPLES = "most_recent_samples"
+    LAST_RATED_SAMPLES = "last_rated_samples"
+    TOP_N_SIMILAR = "top_n_similar"
+    TOP_K_SCORES = "top_k_scores"
+    NEGATIVE_SAMPLES = "negative_samples"
+
+
 USER_ID_COLUMN_NAME = "user_id"
 ITEM_ID_COLUMN_NAME = "item_id"
 RATING_COLUMN_NAME = "rating"
@@ -29,6 +162,8 @@ SCORE_COLUMN_NAME = "score"
 SIMILARITY_COLUMN_NAME = "similarity"
 TARGET_COLUMN_NAME = "target"
 
+PROJECTION_SIMILARITY_COMPUTATIONS = (SIMILARITY_COMPUTATION.RANDOMIZED_SVD, SIMILARITY_COMPUTATION.RANDOM_PROJECTION)
+
 DSS_TO_SQL_TYPES = {
     "date": "date",
     "tinyint": "int",
@@ -38,3 +173,23 @@ DSS_TO_SQL_TYPES = {
     "float": "double",
     "double": "double",
 }
+
+DSS_TO_SPARK_TYPES = {
+    "date": "timestamp",
+    "tinyint": "bigint",
+    "smallint": "bigint",
+    "int": "bigint",
+    "bigint": "bigint",
+    "float": "double",
+    "double": "double",
+}
+
+SPARK_TO_DSS_TYPES = {
+    "string": "string",
+    "int": "int",
+    "bigint": "bigint",
+    "float": "float",
+    "double": "double",
+    "boolean": "boolean",
+    "timestamp": "date",
+}
@@ -1,13 +1,178 @@
 from dataiku.sql import Dialects
+from dku_constants import MATERIALIZATION_MODE, ENTITY_STATISTICS, PLAN_FORMAT
 
 SUPPORTS_FULL_OUTER_JOIN = "supports_full_outer_join"
 SUPPORTS_WITH_CLAUSE = "supports_with_clause"
+SUPPORTS_UNION_ALL = "supports_union_all"
+DEFAULT_MATERIALIZATION = "default_materialization"
+IDENTIFIER_QUOTES = "identifier_quotes"
+TEMP_TABLE_PREFIX = "temp_table_prefix"
+CREATE_TEMP_TABLE = "create_temp_table"
+DROP_TEMP_TABLE = "drop_temp_table"
+HASH_FUNCTION = "hash_function"
+MODULO = "modulo"
+CREATE_TABLE = "create_table"
+DROP_TABLE = "drop_table"
+COMMIT = "commit"
+JSON_ARRAY_AGG_STRINGS = "json_array_agg_strings"
+JSON_ARRAY_AGG_NUMBERS = "json_array_agg_numbers"
+TABLE_BYTES = "table_bytes"
+EXPLAIN = "explain"
+EXPLAIN_SESSION = "explain_session"
+QUERY_PLAN_FORMAT = "query_plan_format"
+QUALIFY = "qualify"
+CREATE_CLUSTERED_TEMP_TABLE = "create_clustered_temp_table"
+DEFAULT_ENTITY_STATISTICS = "default_entity_statistics"
+
+# {table} is the quoted table name, {name} the raw one and {query} the SELECT statement to materialize
+_SQLSERVER_DROP_TEMP_TABLE = "IF OBJECT_ID('tempdb..{name}') IS NOT NULL DROP TABLE {table}"
+_SQLSERVER_DROP_TABLE = "IF OBJECT_ID('{name}') IS NOT NULL DROP TABLE {table}"
+# {expression} is a string or integer (encoded ID) expression and {seed} an integer, hash functions return an integer
+_SQLSERVER_HASH_FUNCTION = "CAST(HASHBYTES('MD5', CONCAT({expression}, {seed})) AS BIGINT)"
+# {expression} is an integer expression and {divisor} a positive integer, the remainder has the sign of the expression
+_SQLSERVER_MODULO = "({expression}) % {divisor}"
+# {table} is the quoted table name, the query returns its size in bytes
+_SQLSERVER_TABLE_BYTES = (
+    "SELECT SUM(reserved_page_count) * 8192 FROM sys.dm_db_partition_stats WHERE object_id = OBJECT_ID('{table}')"
+)
+# {column} is the quoted column to cluster (or distribute) a temporary table by, read by a join or window on it
+_BIGQUERY_CREATE_CLUSTERED_TEMP_TABLE = "CREATE TEMP TABLE {table} CLUSTER BY {column} AS {query}"
+_SYNAPSE_CREATE_CLUSTERED_TEMP_TABLE = "CREATE TABLE {table} WITH (DISTRIBUTION = HASH({column})) AS {query}"
+# {query} is a SELECT statement without ORDER BY and {condition} a condition on its window functions (select aliases)
+_QUALIFY = "{query} QUALIFY {condition}"
+# {query} is the SELECT statement to explain, the session statements switch the session to returning plans and back
+_SQLSERVER_EXPLAIN_SESSION = ("SET SHOWPLAN_XML ON", "SET SHOWPLAN_XML OFF")
+# {expression} is the aggregated column and {order} the ORDER BY list, the aggregate is a JSON array as a string
+_POSTGRES_JSON_ARRAY_AGG = "CAST(JSON_AGG({expression} ORDER BY {order}) AS TEXT)"
+_SQLSERVER_JSON_ARRAY_AGG_STRINGS = (
+    "'[' + STRING_AGG(CAST('\"' + STRING_ESCAPE({expression}, 'json') + '\"' AS NVARCHAR(MAX)), ',')"
+    " WITHIN GROUP (ORDER BY {order}) + ']'"
+)
+_SQLSERVER_JSON_ARRAY_AGG_NUMBERS = (
+    "'[' + STRING_AGG(CAST(CONVERT(VARCHAR(32), {expression}, 3) AS NVARCHAR(MAX)), ',')"
+    " WITHIN GROUP (ORDER BY {order}) + ']'"
+)
 
 
 SUPPORTED_DIALECTS = {
-    Dialects.POSTGRES: {SUPPORTS_FULL_OUTER_JOIN: True, SUPPORTS_WITH_CLAUSE: True},
-    Dialects.SNOWFLAKE: {SUPPORTS_FULL_OUTER_JOIN: True, SUPPORTS_WITH_CLAUSE: True},
-    Dialects.BIGQUERY: {SUPPORTS_FULL_OUTER_JOIN: True, SUPPORTS_WITH_CLAUSE: True},
-    Dialects.SQLSERVER: {SUPPORTS_FULL_OUTER_JOIN: True, SUPPORTS_WITH_CLAUSE: False},
-    Dialects.SYNAPSE: {SUPPORTS_FULL_OUTER_JOIN: True, SUPPORTS_WITH_CLAUSE: False},
+    Dialects.POSTGRES: {
+        SUPPORTS_FULL_OUTER_JOIN: True,
+        SUPPORTS_WITH_CLAUSE: True,
+        SUPPORTS_UNION_ALL: True,
+        DEFAULT_MATERIALIZATION: MATERIALIZATION_MODE.TEMP_TABLE,
+        IDENTIFIER_QUOTES: ('"', '"'),
+        TEMP_TABLE_PREFIX: "",
+        CREATE_TEMP_TABLE: "CREATE TEMPORARY TABLE {table} AS {query}",
+        DROP_TEMP_TABLE: "DROP TABLE IF EXISTS {table}",
+        HASH_FUNCTION: "hashtextextended(CAST({expression} AS TEXT), {seed})",
+        MODULO: "MOD({expression}, {divisor})",
+        CREATE_TABLE: "CREATE TABLE {table} AS {query}",
+        DROP_TABLE: "DROP TABLE IF EXISTS {table}",
+        COMMIT: "COMMIT",
+        JSON_ARRAY_AGG_STRINGS: _POSTGRES_JSON_ARRAY_AGG,
+        JSON_ARRAY_AGG_NUMBERS: _POSTGRES_JSON_ARRAY_AGG,
+        TABLE_BYTES: "SELECT pg_total_relation_size('{table}')",
+        EXPLAIN: "EXPLAIN (FORMAT JSON) {query}",
+        EXPLAIN_SESSION: None,
+        QUERY_PLAN_FORMAT: PLAN_FORMAT.POSTGRES_JSON,
+        QUALIFY: None,
+        CREATE_CLUSTERED_TEMP_TABLE: None,
+        DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.WINDOWS,
+    },
+    Dialects.SNOWFLAKE: {
+        SUPPORTS_FULL_OUTER_JOIN: True,
+        SUPPORTS_WITH_CLAUSE: True,
+        SUPPORTS_UNION_ALL: True,
+        DEFAULT_MATERIALIZATION: MATERIALIZATION_MODE.CTE,
+        IDENTIFIER_QUOTES: ('"', '"'),
+        TEMP_TABLE_PREFIX: "",
+        CREATE_TEMP_TABLE: "CREATE TEMPORARY TABLE {table} AS {query}",
+        DROP_TEMP_TABLE: "DROP TABLE IF EXISTS {table}",
+        HASH_FUNCTION: "HASH({expression}, {seed})",
+        MODULO: "MOD({expression}, {divisor})",
+        CREATE_TABLE: "CREATE TABLE {table} AS {query}",
+        DROP_TABLE: "DROP TABLE IF EXISTS {table}",
+        COMMIT: "COMMIT",
+        JSON_ARRAY_AGG_STRINGS: "TO_JSON(ARRAY_AGG({expression}) WITHIN GROUP (ORDER BY {order}))",
+        JSON_ARRAY_AGG_NUMBERS: "TO_JSON(ARRAY_AGG({expression}) WITHIN GROUP (ORDER BY {order}))",
+        TABLE_BYTES: None,  # not exposed without the unquoted names
+        EXPLAIN: "EXPLAIN USING JSON {query}",
+        EXPLAIN_SESSION: None,
+        QUERY_PLAN_FORMAT: PLAN_FORMAT.SNOWFLAKE_JSON,
+        QUALIFY: _QUALIFY,
+        CREATE_CLUSTERED_TEMP_TABLE: None,  # clustering keys are maintained in the background, after the table is read
+        DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.GROUPED,  # each window partitioning redistributes all samples
+    },
+    Dialects.BIGQUERY: {
+        SUPPORTS_FULL_OUTER_JOIN: True,
+        SUPPORTS_WITH_CLAUSE: True,
+        SUPPORTS_UNION_ALL: True,
+        DEFAULT_MATERIALIZATION: MATERIALIZATION_MODE.CTE,
+        IDENTIFIER_QUOTES: ("`", "`"),
+        TEMP_TABLE_PREFIX: "",
+        CREATE_TEMP_TABLE: "CREATE TEMP TABLE {table} AS {query}",
+        DROP_TEMP_TABLE: "DROP TABLE IF EXISTS {table}",
+        HASH_FUNCTION: "FARM_FINGERPRINT(CONCAT(CAST({expression} AS STRING), CAST({seed} AS STRING)))",
+        MODULO: "MOD({expression}, {divisor})",
+        CREATE_TABLE: "CREATE TABLE {table} AS {query}",
+        DROP_TABLE: "DROP TABLE IF EXISTS {table}",
+        COMMIT: None,  # statements are auto-committed
+        JSON_ARRAY_AGG_STRINGS: "TO_JSON_STRING(ARRAY_AGG({expression} ORDER BY {order}))",
+        JSON_ARRAY_AGG_NUMBERS: "TO_JSON_STRING(ARRAY_AGG({expression} ORDER BY {order}))",
+        TABLE_BYTES: None,  # not exposed without the unquoted names
+        EXPLAIN: None,  # dry runs are only exposed by the BigQuery client, not by SQL statements
+        EXPLAIN_SESSION: None,
+        QUERY_PLAN_FORMAT: None,
+        QUALIFY: _QUALIFY,
+        CREATE_CLUSTERED_TEMP_TABLE: _BIGQUERY_CREATE_CLUSTERED_TEMP_TABLE,
+        DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.GROUPED,  # each window partitioning redistributes all samples
+    },
+    Dialects.SQLSERVER: {
+        SUPPORTS_FULL_OUTER_JOIN: True,
+        SUPPORTS_WITH_CLAUSE: False,
+        SUPPORTS_UNION_ALL: True,
+        DEFAULT_MATERIALIZATION: MATERIALIZATION_MODE.TEMP_TABLE,
+        IDENTIFIER_QUOTES: ("[", "]"),
+        TEMP_TABLE_PREFIX: "#",
+        CREATE_TEMP_TABLE: "SELECT * INTO {table} FROM ({query}) AS _materialized",
+        DROP_TEMP_TABLE: _SQLSERVER_DROP_TEMP_TABLE,
+        HASH_FUNCTION: _SQLSERVER_HASH_FUNCTION,
+        MODULO: _SQLSERVER_MODULO,
+        CREATE_TABLE: "SELECT * INTO {table} FROM ({query}) AS _materialized",
+        DROP_TABLE: _SQLSERVER_DROP_TABLE,
+        COMMIT: "COMMIT",
+        JSON_ARRAY_AGG_STRINGS: _SQLSERVER_JSON_ARRAY_AGG_STRINGS,
+        JSON_ARRAY_AGG_NUMBERS: _SQLSERVER_JSON_ARRAY_AGG_NUMBERS,
+        TABLE_BYTES: _SQLSERVER_TABLE_BYTES,
+        EXPLAIN: "{query}",
+        EXPLAIN_SESSION: _SQLSERVER_EXPLAIN_SESSION,
+        QUERY_PLAN_FORMAT: PLAN_FORMAT.SHOWPLAN_XML,
+        QUALIFY: None,
+        CREATE_CLUSTERED_TEMP_TABLE: None,
+        DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.WINDOWS,
+    },
+    Dialects.SYNAPSE: {
+        SUPPORTS_FULL_OUTER_JOIN: True,
+        SUPPORTS_WITH_CLAUSE: False,
+        SUPPORTS_UNION_ALL: True,
+        DEFAULT_MATERIALIZATION: MATERIALIZATION_MODE.TEMP_TABLE,
+        IDENTIFIER_QUOTES: ("[", "]"),
+        TEMP_TABLE_PREFIX: "#",
+        CREATE_TEMP_TABLE: "CREATE TABLE {table} WITH (DISTRIBUTION = ROUND_ROBIN) AS {query}",
+        DROP_TEMP_TABLE: _SQLSERVER_DROP_TEMP_TABLE,
+        HASH_FUNCTION: _SQLSERVER_HASH_FUNCTION,
+        MODULO: _SQLSERVER_MODULO,
+        CREATE_TABLE: "CREATE TABLE {table} WITH (DISTRIBUTION = ROUND_ROBIN) AS {query}",
+        DROP_TABLE: _SQLSERVER_DROP_TABLE,
+        COMMIT: "COMMIT",
+        JSON_ARRAY_AGG_STRINGS: _SQLSERVER_JSON_ARRAY_AGG_STRINGS,
+        JSON_ARRAY_AGG_NUMBERS: _SQLSERVER_JSON_ARRAY_AGG_NUMBERS,
+        TABLE_BYTES: None,  # distributed tables are spread over the nodes
+        EXPLAIN: "EXPLAIN {query}",
+        EXPLAIN_SESSION: None,
+        QUERY_PLAN_FORMAT: PLAN_FORMAT.DSQL_XML,
+        QUALIFY: None,
+        CREATE_CLUSTERED_TEMP_TABLE: _SYNAPSE_CREATE_CLUSTERED_TEMP_TABLE,
+        DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.GROUPED,  # each window partitioning redistributes all samples
+    },
 }
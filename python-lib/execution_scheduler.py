@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import OrderedDict, namedtuple
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+Fragment = namedtuple("Fragment", ["name", "function", "dependencies"])
+
+
+class FragmentExecutionError(Exception):
+    """Exception raised when at least one fragment of an ExecutionScheduler failed
+
+    Attributes:
+        errors (dict): Exception raised by each failed fragment (value) by fragment name (key)
+        cancelled (list): Names of the fragments which were not run because of the failures
+    """
+
+    def __init__(self, errors, cancelled):
+        self.errors = errors
+        self.cancelled = cancelled
+        failures = "\n".join(f"- {name}: {error}" for name, error in errors.items())
+        message = f"{len(errors)} fragment(s) failed:\n{failures}"
+        if cancelled:
+            message += f"\nCancelled fragments: {cancelled}"
+        super().__init__(message)
+
+
+class ExecutionScheduler:
+    """Run fragments of work (typically SQL statements) in a pool of threads, with at most max_concurrency at a time
+
+    A fragment only starts once all its dependencies succeeded. On the first failure, the fragments which have not
+    started yet are cancelled, the running ones are waited for, and a FragmentExecutionError listing all the
+    failures is raised.
+    """
+
+    def __init__(self, max_concurrency=1):
+        if max_concurrency < 1:
+            raise ValueError(f"The maximum concurrency should be at least 1 (currently {max_concurrency})")
+        self.max_concurrency = max_concurrency
+        self.fragments = OrderedDict()
+        self.durations = OrderedDict()
+
+    def add_fragment(self, name, function, dependencies=()):
+        """Add a fragment calling function() once the fragments named in dependencies are done"""
+        if name in self.fragments:
+            raise ValueError(f"Fragment '{name}' was already added")
+        unknown_dependencies = [dependency for dependency in dependencies if dependency not in self.fragments]
+        if unknown_dependencies:
+            raise ValueError(f"Fragment '{name}' depends on unknown fragments: {unknown_dependencies}")
+        self.fragments[name] = Fragment(name, function, tuple(dependencies))
+
+    def run(self):
+        """Run all fragments and return their results by fragment name"""
+        results, errors = OrderedDict(), OrderedDict()
+        pending = OrderedDict(self.fragments)
+        running = {}
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while pending or running:
+                if not errors:
+                    for fragment in list(pending.values()):
+                        if len(running) >= self.max_concurrency:
+                            break
+                        if all(dependency in results for dependency in fragment.dependencies):
+                            logger.debug(f"Starting fragment '{fragment.name}'")
+                            running[executor.submit(self._run_fragment, fragment)] = fragment.name
+                            del pending[fragment.name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as error:
+                        logger.error(f"Fragment '{name}' failed: {error}")
+                        errors[name] = error
+        self._log_durations(time.perf_counter() - start_time)
+        if errors:
+            raise FragmentExecutionError(errors, cancelled=list(pending))
+        return results
+
+    def _run_fragment(self, fragment):
+        start_time = time.perf_counter()
+        try:
+            return fragment.function()
+        finally:
+            self.durations[fragment.name] = time.perf_counter() - start_time
+
+    def _log_durations(self, wall_time):
+        total_fragment_time = sum(self.durations.values())
+        logger.info(
+            f"Ran {len(self.durations)} fragment(s) with max. concurrency {self.max_concurrency} "
+            f"in {wall_time:.2f}s of wall time for {total_fragment_time:.2f}s of total fragment time"
+        )
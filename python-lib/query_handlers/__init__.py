@@ -5,3 +5,4 @@ from query_handlers.scoring_handler import ScoringHandler
 
 from query_handlers.custom_scoring_handler import CustomScoringHandler
 from query_handlers.auto_scoring_handler import AutoScoringHandler
+from query_handlers.incremental_scoring_handler import IncrementalScoringHandler
@@ -1,35 +1,203 @@
 from query_handlers import ScoringHandler
+from dataiku.sql import JoinTypes, Column, Constant, SelectQuery
 import dku_constants as constants
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 
 
 class AutoScoringHandler(ScoringHandler):
+    MINHASH_AS = "_minhash"
+    BAND_AS = "_band"
+    BAND_HASH_AS = "_band_hash"
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.is_user_based = self.dku_config.collaborative_filtering_method == constants.CF_METHOD.USER_BASED
         self._assign_scoring_mode(self.is_user_based)
         self.output_similarity_matrix = self.file_manager.similarity_scores_dataset is not None
+        self.use_minhash_lsh = self.dku_config.similarity_computation == constants.SIMILARITY_COMPUTATION.MINHASH_LSH
 
     def build(self):
+        try:
+            self._build()
+        finally:
+            self._drop_staging_tables(self.file_manager.scored_samples_dataset)
+
+    def _build(self):
         normalization_factor = self._prepare_samples()
-        similarity = self._build_similarity(normalization_factor)
+        if self._estimates_join_cost():
+            # the join cost is estimated on the same prepared samples as the ones the joins read
+            normalization_factor = self._stage_prepared_samples(normalization_factor)
+        nb_buckets = self._get_nb_execution_buckets(normalization_factor)
+        if self.dku_config.get("join_row_budget"):
+            nb_buckets = self._apply_join_budget(normalization_factor, nb_buckets)
+        nb_scoring_buckets = self._get_nb_scoring_buckets(nb_buckets)
+        if self.output_nested_arrays:
+            # the neighbour lists and the scores of a bucket are computed from the similarity of its users/items only
+            reads_partial_similarity = nb_buckets > 1
+        else:
+            computes_scoring_similarity = not self.output_similarity_matrix or self.explain_only
+            reads_partial_similarity = nb_scoring_buckets > 1 and computes_scoring_similarity
+        if reads_partial_similarity:
+            # the scores of a bucket need all the neighbours of its users/items, including the mirrored pairs
+            self.use_half_matrix = False
+        if self.use_minhash_lsh:
+            logger.debug("Using MinHash LSH candidate pairs")
+            candidate_pairs = self._build_lsh_candidate_pairs(normalization_factor)
+        else:
+            candidate_pairs = None
+        is_half_matrix = self.use_half_matrix
 
         if self.output_similarity_matrix:
             logger.info("About to compute similarity matrix ...")
-            self._execute(similarity, self.file_manager.similarity_scores_dataset)
+            # the nested neighbour lists can't be read back, the scoring computes the similarity again, as when only
+            # explaining the queries (the similarity output is not written)
+            reads_similarity_output = not (self.output_nested_arrays or self.explain_only)
+            if self.dku_config.full_similarity_matrix and reads_similarity_output:
+                is_half_matrix = False
+            self._execute_in_buckets(
+                lambda: self._build_output_similarity(normalization_factor, candidate_pairs),
+                self.file_manager.similarity_scores_dataset,
+                nb_buckets,
+            )
             self._set_column_description(self.file_manager.similarity_scores_dataset, constants.SIMILARITY_COLUMN_NAME)
-            similarity = self.file_manager.similarity_scores_dataset
+            similarity = self.file_manager.similarity_scores_dataset if reads_similarity_output else None
+            if similarity is not None and self.encode_ids:
+                similarity = self._encode_similarity(similarity)
+        else:
+            similarity = None
 
-        cf_scores = self._build_collaborative_filtering(similarity, normalization_factor)
-        self._execute(cf_scores, self.file_manager.scored_samples_dataset)
+        self._execute_in_buckets(
+            lambda: self._build_collaborative_filtering(
+                similarity or self._build_similarity(normalization_factor, candidate_pairs),
+                normalization_factor,
+                is_half_matrix,
+            ),
+            self.file_manager.scored_samples_dataset,
+            nb_scoring_buckets,
+        )
         self._set_column_description(self.file_manager.scored_samples_dataset, constants.SCORE_COLUMN_NAME)
 
+    def _build_output_similarity(self, normalization_factor, candidate_pairs):
+        similarity = self._build_similarity(normalization_factor, candidate_pairs)
+        if self.output_nested_arrays:
+            return self._build_nested_neighbours(similarity, is_half_matrix=self.use_half_matrix)
+        if self.dku_config.full_similarity_matrix:
+            similarity = self._build_full_similarity(similarity)
+        if self.encode_ids:
+            similarity = self._decode_similarity(similarity)
+        return similarity
+
+    def _estimates_join_cost(self):
+        execution_bucketing = self.dku_config.get("execution_bucketing") or constants.EXECUTION_BUCKETING.NONE
+        return execution_bucketing == constants.EXECUTION_BUCKETING.AUTO or bool(self.dku_config.get("join_row_budget"))
+
+    def _apply_join_budget(self, normalization_factor, nb_buckets):
+        """Number of buckets after checking the cost of the joins of the thresholded samples against the budget
+
+        Over budget, the recipe either aborts before running the joins or uses enough buckets for each bucket to
+        join at most join_row_budget rows.
+        """
+        join_cost = self._get_join_cost(normalization_factor)
+        join_row_budget = self.dku_config.join_row_budget
+        max_joined_rows = self._estimate_joined_rows(normalization_factor)
+        if max_joined_rows <= join_row_budget * nb_buckets:
+            return nb_buckets
+        if self.dku_config.join_budget_action == constants.JOIN_BUDGET_ACTION.ABORT:
+            raise ValueError(
+                f"The similarity and scoring joins of the thresholded samples would read up to {max_joined_rows} "
+                f"rows in {nb_buckets} bucket(s), over the budget of {join_row_budget} joined rows per bucket. "
+                "Increase the minimum visits per user/item, set maximum visits per user/item, use MinHash LSH "
+                "similarity computation, execution buckets or a higher budget."
+            )
+        budget_nb_buckets = math.ceil(max_joined_rows / join_row_budget)
+        logger.warning(f"Over the joined rows budget, using {budget_nb_buckets} execution buckets")
+        if join_cost.scoring_rows > join_row_budget * self._get_nb_scoring_buckets(budget_nb_buckets):
+            logger.warning("The scoring join stays over budget, it runs in a single bucket")
+        return budget_nb_buckets
+
+    def _build_lsh_candidate_pairs(self, select_from):
+        """Pairs of based entities sharing at least one LSH bucket of their MinHash signatures"""
+        signatures = self._materialize(
+            self._build_minhash_signatures(select_from), constants.MINHASH_STAGE.SIGNATURES, required=True
+        )
+        buckets = self._materialize(self._build_lsh_buckets(signatures), constants.MINHASH_STAGE.BUCKETS)
+        return self._build_candidate_pairs(buckets)
+
+    def _build_minhash_signatures(self, select_from, select_from_as="_samples_to_sign"):
+        signatures = SelectQuery()
+        signatures.select_from(select_from, alias=select_from_as)
+        signatures.select(Column(self.based_column, table_name=select_from_as))
+        for hash_index in range(self.dku_config.minhash_nb_hashes):
+            signatures.select(
+                self._get_hash_expression(self.pivot_column, table_name=select_from_as, seed=hash_index).min(),
+                alias=f"{self.MINHASH_AS}_{hash_index}",
+            )
+        signatures.group_by(Column(self.based_column, table_name=select_from_as))
+        return signatures
+
+    def _build_lsh_buckets(self, select_from, select_from_as="_minhash_signatures"):
+        """One row per based entity and band, holding the band's MinHash values (UNION ALL of one query per band)"""
+        rows_per_band = self.dku_config.minhash_nb_hashes // self.dku_config.lsh_nb_bands
+        bands = []
+        for band_index in range(self.dku_config.lsh_nb_bands):
+            band = SelectQuery()
+            band.select_from(select_from, alias=select_from_as)
+            band.select(Column(self.based_column, table_name=select_from_as))
+            band.select(Constant(band_index), alias=self.BAND_AS)
+            for row_index in range(rows_per_band):
+                hash_index = band_index * rows_per_band + row_index
+                band.select(
+                    Column(f"{self.MINHASH_AS}_{hash_index}", table_name=select_from_as),
+                    alias=f"{self.BAND_HASH_AS}_{row_index}",
+                )
+            bands.append(band)
+        return bands
+
+    def _build_candidate_pairs(
+        self, select_from, left_select_from_as="_left_lsh_bucket", right_select_from_as="_right_lsh_bucket"
+    ):
+        rows_per_band = self.dku_config.minhash_nb_hashes // self.dku_config.lsh_nb_bands
+        candidate_pairs = SelectQuery()
+        candidate_pairs.select_from(select_from, alias=left_select_from_as)
+
+        join_conditions = [
+            Column(self.BAND_AS, left_select_from_as).eq(Column(self.BAND_AS, right_select_from_as)),
+            self._get_pair_condition(
+                Column(self.based_column, left_select_from_as), Column(self.based_column, right_select_from_as)
+            ),
+        ]
+        join_conditions += [
+            Column(f"{self.BAND_HASH_AS}_{row_index}", left_select_from_as).eq(
+                Column(f"{self.BAND_HASH_AS}_{row_index}", right_select_from_as)
+            )
+            for row_index in range(rows_per_band)
+        ]
+        candidate_pairs.join(select_from, JoinTypes.INNER, join_conditions, alias=right_select_from_as)
+
+        # pairs sharing several buckets are kept once
+        candidate_pairs.group_by(Column(self.based_column, table_name=left_select_from_as))
+        candidate_pairs.group_by(Column(self.based_column, table_name=right_select_from_as))
+        candidate_pairs.select(
+            Column(self.based_column, table_name=left_select_from_as), alias=f"{self.based_column}_1"
+        )
+        candidate_pairs.select(
+            Column(self.based_column, table_name=right_select_from_as), alias=f"{self.based_column}_2"
+        )
+        return candidate_pairs
+
     def _get_column_descriptions(self, column_name):
         cf_based_on = "user" if self.is_user_based else "item"
         if column_name == constants.SCORE_COLUMN_NAME:
             description = f"User-item affinity scores (using {cf_based_on}-based collaborative filtering)"
+            if self.output_nested_arrays:
+                description = f"JSON array of the top K affinity scores of each user ({cf_based_on}-based), descending"
         elif column_name == constants.SIMILARITY_COLUMN_NAME:
             description = f"Similarity between {cf_based_on}s (higher means more similar)"
-        return {column_name: description}
\ No newline at end of file
+            if self.output_nested_arrays:
+                description = f"JSON array of the similarities of the top N most similar {cf_based_on}s"
+            elif not self.dku_config.full_similarity_matrix:
+                description += f", each pair is stored once with {cf_based_on} 1 < {cf_based_on} 2"
+        return {column_name: description}
@@ -1,4 +1,6 @@
 from query_handlers import ScoringHandler
+from dataiku.sql import Column, SelectQuery, toSQL
+from dataiku.core.sql import SQLExecutor2
 import dku_constants as constants
 import logging
 
@@ -10,8 +12,9 @@ class CustomScoringHandler(ScoringHandler):
         super().__init__(*args, **kwargs)
         self.is_user_based = self.dku_config.similarity_scores_type == constants.SIMILARITY_TYPE.USER_SIMILARITY
         self._assign_scoring_mode(self.is_user_based)
+        self.is_half_matrix = None  # whether each pair of the similarity is stored once, see _is_half_similarity_matrix
 
-    def _prepare_similarity_input(self):
+    def _build_similarity_cast(self):
         similarity = self.file_manager.similarity_scores_dataset
 
         renaming_mapping = {
@@ -28,17 +31,68 @@ class CustomScoringHandler(ScoringHandler):
         similarity_cast = self._cast_table(similarity_renamed, cast_mapping, alias="_similarity_matrix_renamed")
         return similarity_cast
 
+    def _prepare_similarity_input(self):
+        similarity_cast = self._build_similarity_cast()
+        if self.encode_ids:
+            return self._encode_similarity(similarity_cast)
+        return similarity_cast
+
+    def _get_id_sources(self, samples_cast):
+        """The similar entities without samples are scored as well, their IDs are encoded with the samples' ones"""
+        users_sources, items_sources = super()._get_id_sources(samples_cast)
+        similarity_cast = self._build_similarity_cast()
+        based_sources = users_sources if self.is_user_based else items_sources
+        based_sources += [(similarity_cast, f"{self.based_column}_1"), (similarity_cast, f"{self.based_column}_2")]
+        return users_sources, items_sources
+
     def build(self):
         normalization_factor = self._prepare_samples()
         similarity = self._prepare_similarity_input()
-        cf_scores = self._build_collaborative_filtering(similarity, normalization_factor)
-        self._execute(cf_scores, self.file_manager.scored_samples_dataset)
+        self.is_half_matrix = self._is_half_similarity_matrix()
+        self._execute_in_buckets(
+            lambda: self._build_collaborative_filtering(similarity, normalization_factor, self.is_half_matrix),
+            self.file_manager.scored_samples_dataset,
+            self._get_nb_scoring_buckets(self._get_nb_execution_buckets(normalization_factor)),
+        )
         self._set_column_description(self.file_manager.scored_samples_dataset)
 
+    def _is_half_similarity_matrix(self, select_from_as="_similarity_matrix"):
+        """Whether each pair is stored once: when checked, or when no pair has column 1 > column 2
+
+        A full matrix has both (a, b) and (b, a), the auto collaborative filtering recipe writes each pair once by
+        default, with column 1 < column 2.
+        """
+        if self.dku_config.half_similarity_matrix:
+            return True
+        column_1 = Column(f"{self.based_column}_1", table_name=select_from_as)
+        column_2 = Column(f"{self.based_column}_2", table_name=select_from_as)
+        mirrored_pairs = SelectQuery()
+        mirrored_pairs.select_from(self._build_similarity_cast(), alias=select_from_as)
+        mirrored_pairs.select(Column("*").count(), alias=self.NB_VISIT_AS)
+        mirrored_pairs.where(column_1.gt(column_2))
+        mirrored_pairs_df = self._query_to_df(mirrored_pairs, self.file_manager.similarity_scores_dataset)
+        is_half_matrix = int(mirrored_pairs_df.iloc[0, 0] or 0) == 0
+        if is_half_matrix:
+            logger.info("No pair of the similarity has column 1 > column 2, each pair is read as stored once")
+        return is_half_matrix
+
+    def _estimate_joined_rows(self, prepared_samples, select_from_as="_similarity_matrix"):
+        """Number of rows of the full similarity matrix, sorted by the top N window"""
+        similarity_dataset = self.file_manager.similarity_scores_dataset
+        similarity_count = SelectQuery()
+        similarity_count.select_from(similarity_dataset, alias=select_from_as)
+        similarity_count.select(Column("*").count(), alias=self.NB_VISIT_AS)
+        sql_executor = SQLExecutor2(dataset=similarity_dataset)
+        similarity_count_df = sql_executor.query_to_df(toSQL(similarity_count, dataset=similarity_dataset))
+        nb_similarity_rows = int(similarity_count_df.iloc[0, 0] or 0)
+        return 2 * nb_similarity_rows if self.is_half_matrix else nb_similarity_rows
+
     def _get_column_descriptions(self, column_name=None):
         column_name = constants.SCORE_COLUMN_NAME
         cf_based_on = "user" if self.is_user_based else "item"
         description = (
             f"User-item affinity scores (using {cf_based_on}-based collaborative filtering with custom similarity)"
         )
+        if self.output_nested_arrays:
+            description = f"JSON array of the top K affinity scores of each user ({cf_based_on}-based), descending"
         return {column_name: description}
\ No newline at end of file
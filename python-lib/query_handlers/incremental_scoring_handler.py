@@ -0,0 +1,352 @@
+from query_handlers import AutoScoringHandler
+from dataiku.sql import JoinTypes, Column, Constant, SelectQuery
+import dku_constants as constants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalScoringHandler(AutoScoringHandler):
+    """Auto collaborative filtering keeping pair statistics up to date from a delta of new samples
+
+    Only the pairs with a pivot in the delta are joined, the similarity is then derived from the updated pair
+    statistics and from entity statistics (visits, sum and sum of squares of ratings) aggregated on all samples.
+
+    As in the full computation, only the samples whose user and item have enough visits are joined. The visits only
+    grow with the deltas, so the samples of a user or item reaching its threshold join the pairs as new samples. The
+    thresholds must be the same as in the run which output the previous pair statistics.
+    """
+
+    IS_DELTA_AS = "_is_delta"
+    NB_HISTORY_VISIT_USER_AS = "_nb_history_visit_user"
+    NB_HISTORY_VISIT_ITEM_AS = "_nb_history_visit_item"
+    CO_OCCURRENCE_AS = "_co_occurrence"
+    RATING_PRODUCT_SUM_AS = "_rating_product_sum"
+    RATING_SUM_AS = "_rating_sum"
+    RATING_SQUARE_SUM_AS = "_rating_square_sum"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.has_delta = self.file_manager.samples_delta_dataset is not None
+        self.has_previous_statistics = self.file_manager.previous_pair_statistics_dataset is not None
+        self.all_samples = None
+        # (entity column, minimum visits, visits alias, visits before the delta alias) of the users and of the items
+        self.visit_thresholds = [
+            (
+                self.dku_config.users_column_name,
+                self.dku_config.user_visit_threshold,
+                self.NB_VISIT_USER_AS,
+                self.NB_HISTORY_VISIT_USER_AS,
+            ),
+            (
+                self.dku_config.items_column_name,
+                self.dku_config.item_visit_threshold,
+                self.NB_VISIT_ITEM_AS,
+                self.NB_HISTORY_VISIT_ITEM_AS,
+            ),
+        ]
+        self.applies_visit_thresholds = any(threshold > 1 for _, threshold, _, _ in self.visit_thresholds)
+        self.statistics_columns = [self.CO_OCCURRENCE_AS]
+        if self.use_explicit:
+            self.statistics_columns += [
+                self.RATING_PRODUCT_SUM_AS,
+                f"{self.RATING_SUM_AS}_1",
+                f"{self.RATING_SUM_AS}_2",
+            ]
+
+    def _build(self):
+        all_samples = self._build_samples_cast()
+        visited_samples = self._build_visited_samples(all_samples)
+        if self.has_previous_statistics:
+            logger.info("Updating previous pair statistics with the delta samples ...")
+            pair_statistics_delta = self._build_pair_statistics_delta(visited_samples, only_delta=True)
+            pair_statistics = self._build_merged_pair_statistics(
+                [self._build_previous_pair_statistics(), pair_statistics_delta]
+            )
+        else:
+            logger.info("No previous pair statistics, computing them from all samples ...")
+            pair_statistics = self._build_pair_statistics_delta(visited_samples, only_delta=False)
+        self._execute(pair_statistics, self.file_manager.pair_statistics_dataset)
+
+        entity_statistics = self._build_entity_statistics(visited_samples, all_samples)
+        if not self.explain_only:
+            pair_statistics = self.file_manager.pair_statistics_dataset
+        # when only explaining the queries, the outputs are not written and the next plans compute them inline
+        similarity = self._build_similarity_from_statistics(pair_statistics, entity_statistics)
+
+        is_half_matrix = True
+        if self.output_similarity_matrix and self.output_nested_arrays:
+            logger.info("About to compute the neighbour lists ...")
+            nested_neighbours = self._build_nested_neighbours(similarity, is_half_matrix=True)
+            self._execute(nested_neighbours, self.file_manager.similarity_scores_dataset)
+            self._set_column_description(self.file_manager.similarity_scores_dataset, constants.SIMILARITY_COLUMN_NAME)
+        elif self.output_similarity_matrix:
+            logger.info("About to compute similarity matrix ...")
+            if self.dku_config.full_similarity_matrix:
+                similarity = self._build_full_similarity(similarity)
+                is_half_matrix = False
+            self._execute(similarity, self.file_manager.similarity_scores_dataset)
+            self._set_column_description(self.file_manager.similarity_scores_dataset, constants.SIMILARITY_COLUMN_NAME)
+            if not self.explain_only:
+                similarity = self.file_manager.similarity_scores_dataset
+
+        normalization_factor = self._prepare_samples()
+        if self._estimates_join_cost():
+            normalization_factor = self._stage_prepared_samples(normalization_factor)
+        self._execute_in_buckets(
+            lambda: self._build_collaborative_filtering(similarity, normalization_factor, is_half_matrix),
+            self.file_manager.scored_samples_dataset,
+            self._get_nb_scoring_buckets(self._get_nb_execution_buckets(normalization_factor)),
+        )
+        self._set_column_description(self.file_manager.scored_samples_dataset, constants.SCORE_COLUMN_NAME)
+
+    def _estimates_join_cost(self):
+        """Only the auto execution buckets are sized from the join cost, the join row budget isn't applied"""
+        execution_bucketing = self.dku_config.get("execution_bucketing") or constants.EXECUTION_BUCKETING.NONE
+        return execution_bucketing == constants.EXECUTION_BUCKETING.AUTO
+
+    def _estimate_joined_rows(self, prepared_samples):
+        """Number of rows read by the scoring join, the similarity being computed from the pair statistics"""
+        return self._get_join_cost(prepared_samples).scoring_rows
+
+    def _build_samples_cast(self):
+        """All samples (history and delta) with a flag telling whether they come from the delta"""
+        if self.all_samples is not None:
+            return self.all_samples
+        cast_mapping = self._get_samples_cast_mapping()
+        samples_parts = [(self.file_manager.samples_dataset, 0, "_raw_input_dataset")]
+        if self.has_delta:
+            samples_parts += [(self.file_manager.samples_delta_dataset, 1, "_raw_delta_dataset")]
+        flagged_samples = []
+        for samples_dataset, is_delta, alias in samples_parts:
+            samples_cast = self._cast_table(samples_dataset, cast_mapping, alias=alias)
+            samples_cast.select(Constant(is_delta), alias=self.IS_DELTA_AS)
+            flagged_samples.append(samples_cast)
+        self.all_samples = self._materialize(flagged_samples, constants.INCREMENTAL_STAGE.ALL_SAMPLES, required=True)
+        return self.all_samples
+
+    def _build_visited_samples(self, select_from, select_from_as="_all_samples"):
+        """Samples whose user and item have enough visits, with the visits of their user and item before the delta
+
+        Without visit thresholds, all the samples are kept.
+        """
+        if not self.applies_visit_thresholds:
+            return select_from
+        visited_samples = SelectQuery()
+        visited_samples.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(
+            visited_samples,
+            column_names=list(self._get_samples_cast_mapping()) + [self.IS_DELTA_AS],
+            table_name=select_from_as,
+        )
+        for entity_column, threshold, nb_visit_as, nb_history_visit_as in self.visit_thresholds:
+            entity_visits_as = f"{nb_visit_as}_statistics"
+            entity_visits = self._build_entity_visits(select_from, entity_column, nb_visit_as, nb_history_visit_as)
+            join_condition = Column(entity_column, table_name=select_from_as).eq(
+                Column(self.STATISTICS_KEY_AS, table_name=entity_visits_as)
+            )
+            visited_samples.join(entity_visits, JoinTypes.INNER, join_condition, alias=entity_visits_as)
+            visited_samples.where(Column(nb_visit_as, table_name=entity_visits_as).ge(Constant(threshold)))
+            visited_samples.select(Column(nb_history_visit_as, table_name=entity_visits_as), alias=nb_history_visit_as)
+        return self._materialize(visited_samples, constants.INCREMENTAL_STAGE.VISITED_SAMPLES, required=True)
+
+    def _build_entity_visits(
+        self, select_from, entity_column, nb_visit_as, nb_history_visit_as, select_from_as="_samples"
+    ):
+        entity_visits = SelectQuery()
+        entity_visits.select_from(select_from, alias=select_from_as)
+        entity_visits.select(Column(entity_column, table_name=select_from_as), alias=self.STATISTICS_KEY_AS)
+        entity_visits.select(Column("*").count(), alias=nb_visit_as)
+        entity_visits.select(
+            Column("*").count().minus(Column(self.IS_DELTA_AS, table_name=select_from_as).sum()),
+            alias=nb_history_visit_as,
+        )
+        entity_visits.group_by(Column(entity_column, table_name=select_from_as))
+        return entity_visits
+
+    def _get_new_sample_condition(self, select_from_as):
+        """Condition on the samples which are not in the previous pair statistics
+
+        They are the delta samples and, with visit thresholds, the history samples of the users or items which did not
+        have enough visits before the delta.
+        """
+        new_sample_condition = Column(self.IS_DELTA_AS, table_name=select_from_as).eq(Constant(1))
+        if self.applies_visit_thresholds:
+            for _, threshold, _, nb_history_visit_as in self.visit_thresholds:
+                new_sample_condition = new_sample_condition.or_(
+                    Column(nb_history_visit_as, table_name=select_from_as).lt(Constant(threshold))
+                )
+        return new_sample_condition
+
+    def _build_delta_pivots(self, select_from, select_from_as="_delta_samples"):
+        delta_pivots = SelectQuery()
+        delta_pivots.select_from(select_from, alias=select_from_as)
+        delta_pivots.select(Column(self.pivot_column, table_name=select_from_as))
+        delta_pivots.where(self._get_new_sample_condition(select_from_as))
+        delta_pivots.group_by(Column(self.pivot_column, table_name=select_from_as))
+        return delta_pivots
+
+    def _build_pair_statistics_delta(
+        self,
+        select_from,
+        only_delta,
+        left_select_from_as="_left_samples",
+        right_select_from_as="_right_samples",
+        delta_pivots_as="_delta_pivots",
+    ):
+        """Sufficient statistics of the pairs col_1 < col_2, only from joined samples with at least one new sample
+
+        The join is restricted to the pivots of the new samples, so its cost depends on the delta size
+        """
+        pair_statistics = SelectQuery()
+        pair_statistics.select_from(select_from, alias=left_select_from_as)
+
+        if only_delta:
+            delta_pivots = self._build_delta_pivots(select_from)
+            pivot_condition = Column(self.pivot_column, left_select_from_as).eq(
+                Column(self.pivot_column, delta_pivots_as)
+            )
+            pair_statistics.join(delta_pivots, JoinTypes.INNER, pivot_condition, alias=delta_pivots_as)
+
+        join_conditions = [
+            Column(self.pivot_column, left_select_from_as).eq(Column(self.pivot_column, right_select_from_as)),
+            self._get_pair_condition(
+                Column(self.based_column, left_select_from_as), Column(self.based_column, right_select_from_as)
+            ),
+        ]
+        pair_statistics.join(select_from, JoinTypes.INNER, join_conditions, alias=right_select_from_as)
+
+        if only_delta:
+            # pairs of history samples are already counted in the previous statistics
+            pair_statistics.where(
+                self._get_new_sample_condition(left_select_from_as).or_(
+                    self._get_new_sample_condition(right_select_from_as)
+                )
+            )
+
+        pair_statistics.group_by(Column(self.based_column, table_name=left_select_from_as))
+        pair_statistics.group_by(Column(self.based_column, table_name=right_select_from_as))
+        pair_statistics.select(
+            Column(self.based_column, table_name=left_select_from_as), alias=f"{self.based_column}_1"
+        )
+        pair_statistics.select(
+            Column(self.based_column, table_name=right_select_from_as), alias=f"{self.based_column}_2"
+        )
+        pair_statistics.select(Column("*").count(), alias=self.CO_OCCURRENCE_AS)
+        if self.use_explicit:
+            left_rating = Column(self.dku_config.ratings_column_name, table_name=left_select_from_as)
+            right_rating = Column(self.dku_config.ratings_column_name, table_name=right_select_from_as)
+            pair_statistics.select(left_rating.times(right_rating).sum(), alias=self.RATING_PRODUCT_SUM_AS)
+            pair_statistics.select(left_rating.sum(), alias=f"{self.RATING_SUM_AS}_1")
+            pair_statistics.select(right_rating.sum(), alias=f"{self.RATING_SUM_AS}_2")
+        return pair_statistics
+
+    def _build_previous_pair_statistics(self, select_from_as="_previous_pair_statistics"):
+        previous_pair_statistics = SelectQuery()
+        previous_pair_statistics.select_from(self.file_manager.previous_pair_statistics_dataset, alias=select_from_as)
+        self._select_columns_list(
+            previous_pair_statistics,
+            [f"{self.based_column}_1", f"{self.based_column}_2"] + self.statistics_columns,
+            table_name=select_from_as,
+        )
+        return previous_pair_statistics
+
+    def _build_merged_pair_statistics(self, pair_statistics_parts, select_from_as="_pair_statistics_parts"):
+        all_pair_statistics = self._materialize(pair_statistics_parts, constants.INCREMENTAL_STAGE.PAIR_STATISTICS)
+        merged_pair_statistics = SelectQuery()
+        merged_pair_statistics.select_from(all_pair_statistics, alias=select_from_as)
+        for based_column in [f"{self.based_column}_1", f"{self.based_column}_2"]:
+            merged_pair_statistics.select(Column(based_column, table_name=select_from_as))
+            merged_pair_statistics.group_by(Column(based_column, table_name=select_from_as))
+        for statistics_column in self.statistics_columns:
+            merged_pair_statistics.select(
+                Column(statistics_column, table_name=select_from_as).sum(), alias=statistics_column
+            )
+        return merged_pair_statistics
+
+    def _build_entity_statistics(
+        self,
+        select_from,
+        all_samples,
+        select_from_as="_samples_to_aggregate",
+        rating_average_as="_rating_average_statistics",
+    ):
+        """Visits, sum and sum of squares of the ratings of the visited samples of each based entity
+
+        As in the full computation, the rating average of an entity is the one of all its samples, including the
+        samples whose pivot has too few visits.
+        """
+        entity_statistics = SelectQuery()
+        entity_statistics.select_from(select_from, alias=select_from_as)
+        entity_statistics.select(Column(self.based_column, table_name=select_from_as))
+        entity_statistics.select(Column("*").count(), alias=self.NB_VISIT_AS)
+        entity_statistics.group_by(Column(self.based_column, table_name=select_from_as))
+        if self.use_explicit:
+            rating = Column(self.dku_config.ratings_column_name, table_name=select_from_as)
+            entity_statistics.select(rating.sum(), alias=self.RATING_SUM_AS)
+            entity_statistics.select(rating.times(rating).sum(), alias=self.RATING_SQUARE_SUM_AS)
+            rating_average = self._build_entity_visit_statistics(all_samples, self.based_column, self.NB_VISIT_AS)
+            join_condition = Column(self.based_column, table_name=select_from_as).eq(
+                Column(self.STATISTICS_KEY_AS, table_name=rating_average_as)
+            )
+            entity_statistics.join(rating_average, JoinTypes.INNER, join_condition, alias=rating_average_as)
+            entity_statistics.select(Column(self.RATING_AVERAGE, table_name=rating_average_as))
+            entity_statistics.group_by(Column(self.RATING_AVERAGE, table_name=rating_average_as))
+        return self._materialize(entity_statistics, constants.INCREMENTAL_STAGE.ENTITY_STATISTICS, required=True)
+
+    def _build_similarity_from_statistics(
+        self,
+        pair_statistics,
+        entity_statistics,
+        pair_statistics_as="_pair_statistics",
+        left_entity_as="_left_entity_statistics",
+        right_entity_as="_right_entity_statistics",
+    ):
+        similarity = SelectQuery()
+        similarity.select_from(pair_statistics, alias=pair_statistics_as)
+        for entity_as, suffix in [(left_entity_as, 1), (right_entity_as, 2)]:
+            join_condition = Column(f"{self.based_column}_{suffix}", pair_statistics_as).eq(
+                Column(self.based_column, entity_as)
+            )
+            similarity.join(entity_statistics, JoinTypes.INNER, join_condition, alias=entity_as)
+
+        similarity.select(Column(f"{self.based_column}_1", table_name=pair_statistics_as))
+        similarity.select(Column(f"{self.based_column}_2", table_name=pair_statistics_as))
+        similarity.select(
+            self._get_similarity_from_statistics_formula(pair_statistics_as, left_entity_as, right_entity_as),
+            alias=constants.SIMILARITY_COLUMN_NAME,
+        )
+        return similarity
+
+    def _get_similarity_from_statistics_formula(self, pair_statistics_as, left_entity_as, right_entity_as):
+        """Same L2 normalized similarity as _get_similarity_formula, expanded on the sufficient statistics"""
+        co_occurrence = Column(self.CO_OCCURRENCE_AS, table_name=pair_statistics_as)
+        if not self.use_explicit:
+            left_squared_norm = Column(self.NB_VISIT_AS, table_name=left_entity_as)
+            right_squared_norm = Column(self.NB_VISIT_AS, table_name=right_entity_as)
+            return self._round_similarity(co_occurrence.div(left_squared_norm.times(right_squared_norm).sqrt()))
+
+        left_average, left_squared_norm = self._get_rating_average_and_squared_norm(left_entity_as)
+        right_average, right_squared_norm = self._get_rating_average_and_squared_norm(right_entity_as)
+        # sum((r_1 - avg_1) * (r_2 - avg_2)) over the joined samples
+        centered_rating_product_sum = (
+            Column(self.RATING_PRODUCT_SUM_AS, table_name=pair_statistics_as)
+            .minus(right_average.times(Column(f"{self.RATING_SUM_AS}_1", table_name=pair_statistics_as)))
+            .minus(left_average.times(Column(f"{self.RATING_SUM_AS}_2", table_name=pair_statistics_as)))
+            .plus(co_occurrence.times(left_average).times(right_average))
+        )
+        return self._round_similarity(
+            centered_rating_product_sum.div(left_squared_norm.sqrt().times(right_squared_norm.sqrt()))
+        )
+
+    def _get_rating_average_and_squared_norm(self, entity_as):
+        nb_visit = Column(self.NB_VISIT_AS, table_name=entity_as)
+        rating_sum = Column(self.RATING_SUM_AS, table_name=entity_as)
+        rating_average = Column(self.RATING_AVERAGE, table_name=entity_as)
+        # sum((r - avg)^2) = sum(r^2) - 2 * avg * sum(r) + n * avg^2, avg being the average of all the samples
+        squared_norm = (
+            Column(self.RATING_SQUARE_SUM_AS, table_name=entity_as)
+            .minus(Constant(2).times(rating_average).times(rating_sum))
+            .plus(nb_visit.times(rating_average).times(rating_average))
+        )
+        return rating_average, squared_norm
@@ -1,30 +1,577 @@
-from dataiku.sql import Column, Constant, SelectQuery, toSQL, Window
+from dataiku.sql import JoinTypes, Expression, Column, Constant, InlineSQL, SelectQuery, toSQL, Window
 from dataiku.core.sql import SQLExecutor2
+import dataiku
+from collections import OrderedDict, namedtuple
+from functools import partial
 import dku_constants as constants
-from dku_dialects import SUPPORTED_DIALECTS, SUPPORTS_FULL_OUTER_JOIN, SUPPORTS_WITH_CLAUSE
+from dku_dialects import (
+    SUPPORTED_DIALECTS,
+    SUPPORTS_FULL_OUTER_JOIN,
+    SUPPORTS_WITH_CLAUSE,
+    SUPPORTS_UNION_ALL,
+    DEFAULT_MATERIALIZATION,
+    IDENTIFIER_QUOTES,
+    TEMP_TABLE_PREFIX,
+    CREATE_TEMP_TABLE,
+    DROP_TEMP_TABLE,
+    HASH_FUNCTION,
+    MODULO,
+    CREATE_TABLE,
+    DROP_TABLE,
+    COMMIT,
+    JSON_ARRAY_AGG_STRINGS,
+    JSON_ARRAY_AGG_NUMBERS,
+    TABLE_BYTES,
+    EXPLAIN,
+    EXPLAIN_SESSION,
+    QUERY_PLAN_FORMAT,
+    QUALIFY,
+    CREATE_CLUSTERED_TEMP_TABLE,
+)
+from execution_scheduler import ExecutionScheduler
+from run_metrics import RunMetrics, METRICS_SCHEMA
+from query_plans import QueryPlans
+from dku_file_manager import DkuFileManager
 from dku_utils import set_column_description
+import hashlib
+import json
 import logging
+import re
+import time
 
 logger = logging.getLogger(__name__)
 
+MaterializedStage = namedtuple("MaterializedStage", ["name", "mode", "query", "cluster_by"])
+QualifiedQuery = namedtuple("QualifiedQuery", ["query", "condition"])
+ExecutionBucket = namedtuple("ExecutionBucket", ["index", "nb_buckets"])
+
 
 class QueryHandler:
+    NB_ROWS_AS = "_nb_rows"
+    ID_AS = "_id"
+    CODE_AS = "_code"
+    METRICS_DATASET_ROLE = "metrics_dataset"
+    QUERY_PLANS_FOLDER_ROLE = "query_plans_folder"
+
     def __init__(self, dku_config, file_manager):
         self.dku_config = dku_config
         self.file_manager = file_manager
         self.query = None
+        self.materialized_stages = OrderedDict()
+        self.execution_bucket = None  # bucket of the query being built by _execute_in_buckets
+        self.staging_tables = OrderedDict()  # regular tables shared by several sessions, see _build_staging_tables
+        self.max_concurrency = self.dku_config.get("max_concurrency") or 1
+        self.run_metrics = RunMetrics(type(self).__name__, self.dku_config)
+        self.profile_stages = bool(self.dku_config.get("profile_stages"))
+        self.profiled_stages = OrderedDict()  # stages to profile before the next execution, see _profile_stage
+        # the outputs are only counted and sized when their metrics are written, see _add_output_metrics
+        self.collects_metrics = self.profile_stages or self.file_manager.get(self.METRICS_DATASET_ROLE) is not None
+        self.stage_labels = {}  # label of the profiled queries and of the materialized stages computing them
         self._check_supported_dialect()
+        self.stage_name_suffix = self._get_stage_name_suffix()
+        self.explain_only = bool(self.dku_config.get("explain_only"))
+        self.query_plans = None  # plans of the executed queries, captured when a query plans folder is set
+        if self.file_manager.get(self.QUERY_PLANS_FOLDER_ROLE) is not None:
+            self.query_plans = QueryPlans(
+                self.run_metrics.run_id, self.run_metrics.config_hash, self.dialect_capabilities[QUERY_PLAN_FORMAT]
+            )
 
     def build(self):
         pass
 
     def _execute(self, table, output_dataset):
-        query = toSQL(table, dataset=output_dataset)
+        self._capture_plan(table, output_dataset)
+        if self.explain_only:
+            self.profiled_stages = OrderedDict()
+            return
+        self._profile_pending_stages(output_dataset)
+        start_time = time.perf_counter()
+        query, pre_queries, post_queries = self._build_statements(table, output_dataset)
+        self._execute_statements(output_dataset, query, pre_queries, post_queries)
+        self._add_output_metrics(output_dataset, time.perf_counter() - start_time)
+
+    def _execute_in_buckets(self, build_table, output_dataset, nb_buckets):
+        """Execute the query returned by build_table once per hash bucket, appending all buckets into output_dataset
+
+        build_table is called once per bucket with self.execution_bucket set, so that the query builders can filter
+        their based entities on it. The first bucket creates the output table. When running sequentially, the next
+        buckets are inserted by the post-queries of the same session: stages materialized before the buckets are
+        computed only once, while the stages of a bucket are created just before its insert and dropped right after.
+        When running concurrently, each bucket is inserted in its own session and creates all the temporary tables it
+        depends on.
+        """
+        if nb_buckets <= 1:
+            self._execute(build_table(), output_dataset)
+            return
+        logger.info(f"Executing the query in {nb_buckets} buckets")
+        created_stages = list(self.materialized_stages) if self.max_concurrency == 1 else []
+        output_table = output_dataset.get_location_info()["info"]["quotedResolvedTableName"]
+        bucket_statements = []
+        for bucket_index in range(nb_buckets):
+            self.execution_bucket = ExecutionBucket(bucket_index, nb_buckets)
+            table = build_table()
+            self._capture_plan(table, output_dataset)
+            if bucket_index == 0:
+                query, pre_queries, post_queries = self._build_statements(table, output_dataset)
+            else:
+                bucket_statements.append(self._build_statements(table, output_dataset, created_stages=created_stages))
+        self.execution_bucket = None
+        if self.explain_only:
+            self.profiled_stages = OrderedDict()
+            return
+        self._profile_pending_stages(output_dataset)
+        start_time = time.perf_counter()
+
+        bucket_statements = [
+            bucket_pre_queries + [f"INSERT INTO {output_table} {bucket_query}"] + bucket_post_queries
+            for bucket_query, bucket_pre_queries, bucket_post_queries in bucket_statements
+        ]
+        if self.max_concurrency == 1:
+            post_queries = [statement for statements in bucket_statements for statement in statements] + post_queries
+            self._execute_statements(output_dataset, query, pre_queries, post_queries)
+        else:
+            self._execute_statements(output_dataset, query, pre_queries, post_queries)
+            scheduler = ExecutionScheduler(self.max_concurrency)
+            for bucket_index, statements in enumerate(bucket_statements, start=1):
+                bucket_fragment = partial(self._execute_in_session, statements, output_dataset)
+                scheduler.add_fragment(f"bucket_{bucket_index}", bucket_fragment)
+            scheduler.run()
+        self._add_output_metrics(output_dataset, time.perf_counter() - start_time)
+
+    def _query_to_df(self, table, dataset):
+        """Run a SELECT query and return its rows, creating and dropping the temporary stages it depends on"""
+        query, pre_queries, post_queries = self._build_statements(table, dataset)
+        logger.info(f"Executing query:\n{query}")
+        sql_executor = SQLExecutor2(dataset=dataset)
+        return sql_executor.query_to_df(query, pre_queries=pre_queries, post_queries=post_queries)
+
+    def _execute_statements(self, output_dataset, query, pre_queries, post_queries):
+        for pre_query in pre_queries:
+            logger.info(f"Executing pre-query:\n{pre_query}")
         logger.info(f"Executing query:\n{query}")
         sql_executor = SQLExecutor2(dataset=output_dataset)
-        sql_executor.exec_recipe_fragment(output_dataset, query)
+        sql_executor.exec_recipe_fragment(output_dataset, query, pre_queries=pre_queries, post_queries=post_queries)
         logger.info("Done executing query !")
 
+    def _execute_in_session(self, statements, dataset):
+        """Execute and commit statements which do not return rows (DDL, INSERT) in a new session"""
+        for statement in statements:
+            logger.info(f"Executing statement:\n{statement}")
+        commit_statement = self.dialect_capabilities[COMMIT]
+        sql_executor = SQLExecutor2(dataset=dataset)
+        sql_executor.query_to_df(
+            "SELECT 1", pre_queries=statements, post_queries=[commit_statement] if commit_statement else []
+        )
+
+    def _build_staging_tables(self, stages, dataset):
+        """Create one regular table per stage (name: SelectQuery), concurrently, and return their names to select from
+
+        Unlike temporary tables, staging tables are visible to all sessions so independent stages can be computed in
+        parallel. They are created next to the given dataset, with the materialized stages they depend on, and must be
+        dropped by _drop_staging_tables. When only explaining the queries, no table is created and the stages are
+        returned unchanged.
+        """
+        if self.explain_only:
+            return list(stages.values())
+        scheduler = ExecutionScheduler(self.max_concurrency)
+        stage_names = []
+        for stage, select_query in stages.items():
+            stage_name = f"_reco_{stage.value}_{self.stage_name_suffix}"
+            staging_table = self._get_staging_table_name(stage_name, dataset)
+            self.staging_tables[stage_name] = staging_table
+            query, pre_queries, post_queries = self._build_statements(select_query, dataset)
+            statements = [
+                self._format_table_statement(DROP_TABLE, staging_table),
+                *pre_queries,
+                self._format_table_statement(CREATE_TABLE, staging_table, query=query),
+                *post_queries,
+            ]
+            scheduler.add_fragment(stage.value, partial(self._execute_in_session, statements, dataset))
+            stage_names.append(stage_name)
+            self._capture_plan(select_query, dataset, stage=f"staging_{stage.value}")
+        scheduler.run()
+        for stage in stages:
+            self.run_metrics.add_stage(f"staging_{stage.value}", scheduler.durations[stage.value])
+        return stage_names
+
+    def _drop_staging_tables(self, dataset):
+        if not self.staging_tables:
+            return
+        statements = [
+            self._format_table_statement(DROP_TABLE, staging_table) for staging_table in self.staging_tables.values()
+        ]
+        self._execute_in_session(statements, dataset)
+        self.staging_tables = OrderedDict()
+
+    def _get_staging_table_name(self, stage_name, dataset):
+        """Quoted name of a staging table in the same database and schema as the dataset"""
+        location_info = dataset.get_location_info()["info"]
+        resolved_table_name = location_info["quotedResolvedTableName"]
+        quoted_table_name = self._quote_identifier(location_info["table"])
+        if resolved_table_name.endswith(quoted_table_name):
+            return resolved_table_name[: -len(quoted_table_name)] + self._quote_identifier(stage_name)
+        return self._quote_identifier(stage_name)
+
+    def _format_table_statement(self, statement, quoted_table_name, query=None):
+        return self.dialect_capabilities[statement].format(table=quoted_table_name, name=quoted_table_name, query=query)
+
+    def _build_statements(self, table, dataset, created_stages=()):
+        """Render the query and the pre/post queries creating and dropping the materialized stages it depends on
+
+        Temporary tables are session-scoped: they are dropped by the post-queries on success and by the end of the
+        session otherwise. Stages listed in created_stages are assumed to exist already.
+        """
+        query = toSQL(table, dataset=dataset)
+        rendered_stages = OrderedDict(
+            (stage.name, self._render_stage(stage, dataset)) for stage in self.materialized_stages.values()
+        )
+        pre_queries, post_queries = [], []
+        for stage in self._get_required_stages(query, rendered_stages):
+            if stage.mode != constants.MATERIALIZATION_MODE.TEMP_TABLE or stage.name in created_stages:
+                continue
+            stage_query = self._add_with_clause(rendered_stages[stage.name], rendered_stages)
+            pre_queries += [
+                self._format_temp_table_statement(DROP_TEMP_TABLE, stage.name),
+                self._format_create_temp_table_statement(stage, stage_query),
+            ]
+            post_queries.insert(0, self._format_temp_table_statement(DROP_TEMP_TABLE, stage.name))
+        query = self._resolve_staging_tables(self._add_with_clause(query, rendered_stages))
+        pre_queries = [self._resolve_staging_tables(pre_query) for pre_query in pre_queries]
+        return query, pre_queries, post_queries
+
+    def _resolve_staging_tables(self, query):
+        """Replace the staging table names selected from by their fully qualified names"""
+        for stage_name, staging_table in self.staging_tables.items():
+            query = query.replace(self._quote_identifier(stage_name), staging_table)
+        return query
+
+    def _profile_stage(self, label, select_query, select_from=None):
+        """Register select_query to be profiled before the next execution when profiling stages, returns it unchanged
+
+        A profiled stage is computed by a COUNT query recording its wall time and number of rows, its input stage
+        is select_from when it was profiled as well.
+        """
+        if self.profile_stages:
+            bucket = self.execution_bucket.index if self.execution_bucket is not None else None
+            input_label = self.stage_labels.get(self._get_stage_key(select_from))
+            self.profiled_stages[(label, bucket)] = (select_query, input_label)
+            self.stage_labels[self._get_stage_key(select_query)] = label
+        return select_query
+
+    def _profile_pending_stages(self, dataset, select_from_as="_profiled_stage"):
+        for (label, bucket), (select_query, input_label) in self.profiled_stages.items():
+            nb_rows = SelectQuery()
+            nb_rows.select_from(select_query, alias=select_from_as)
+            nb_rows.select(Column("*").count(), alias=self.NB_ROWS_AS)
+            start_time = time.perf_counter()
+            nb_rows_df = self._query_to_df(nb_rows, dataset)
+            self.run_metrics.add_stage(
+                label,
+                time.perf_counter() - start_time,
+                rows_out=int(nb_rows_df.iloc[0, 0]),
+                bucket=bucket,
+                input_stage=input_label,
+            )
+        self.profiled_stages = OrderedDict()
+
+    @staticmethod
+    def _get_stage_key(select_from):
+        """Materialized stages are selected from by name, query stages by object (qualified ones by their query)"""
+        if isinstance(select_from, QualifiedQuery):
+            select_from = select_from.query
+        return select_from if isinstance(select_from, str) else id(select_from)
+
+    def _capture_plan(self, table, dataset, stage=None):
+        """Explain the query computing table before it executes and look for anti-patterns, with a query plans folder
+
+        The stage defaults to the role of the dataset. With WITH clauses, the materialized stages the query depends on
+        are explained inline in the same plan. Otherwise the temporary tables are created in the session of the
+        EXPLAIN, so that the plan reads them as the executed query does.
+        """
+        if self.query_plans is None:
+            return
+        stage = stage or self._get_role(dataset)
+        bucket = self.execution_bucket.index if self.execution_bucket is not None else None
+        query, pre_queries, post_queries = self._build_explained_statements(table, dataset)
+        plan, error = None, None
+        if self.dialect_capabilities[EXPLAIN] is None:
+            logger.info(f"Query plans are not available on this connection, only storing the {stage} query")
+        else:
+            if self.dialect_capabilities[EXPLAIN_SESSION]:
+                session_on, session_off = self.dialect_capabilities[EXPLAIN_SESSION]
+                pre_queries, post_queries = pre_queries + [session_on], [session_off] + post_queries
+            explain_query = self.dialect_capabilities[EXPLAIN].format(query=query)
+            logger.info(f"Explaining query:\n{explain_query}")
+            try:
+                sql_executor = SQLExecutor2(dataset=dataset)
+                plan_df = sql_executor.query_to_df(explain_query, pre_queries=pre_queries, post_queries=post_queries)
+                plan = "\n".join(
+                    value if isinstance(value, str) else json.dumps(value) for value in plan_df.iloc[:, 0]
+                )
+            except Exception as explain_error:
+                logger.warning(f"Could not explain the {stage} query: {explain_error}")
+                error = str(explain_error)
+        self.query_plans.add_plan(stage, query, plan=plan, bucket=bucket, error=error)
+
+    def _build_explained_statements(self, table, dataset):
+        """Statements to explain the query computing table, see _capture_plan"""
+        if not self.supports_with_clause:
+            return self._build_statements(table, dataset)
+        query = toSQL(table, dataset=dataset)
+        rendered_stages = OrderedDict(
+            (stage.name, self._render_stage(stage, dataset)) for stage in self.materialized_stages.values()
+        )
+        return self._resolve_staging_tables(self._add_with_clause(query, rendered_stages, all_stages=True)), [], []
+
+    def write_query_plans(self):
+        """Write the captured query plans and the summary of their anti-patterns to the query plans folder"""
+        if self.query_plans is None:
+            return
+        query_plans_folder = self.file_manager.get(self.QUERY_PLANS_FOLDER_ROLE)
+        for file_path, content in self.query_plans.get_files().items():
+            DkuFileManager.write_to_folder(query_plans_folder, file_path, content)
+        nb_findings = sum(len(plan["findings"]) for plan in self.query_plans.plans)
+        logger.info(f"Wrote {len(self.query_plans.plans)} query plans with {nb_findings} anti-pattern(s)")
+
+    def _get_role(self, dataset):
+        return next(role for role, file in self.file_manager.items() if file is dataset)
+
+    def _add_output_metrics(self, output_dataset, wall_time):
+        """Record the wall time of the queries writing an output dataset, with its number of rows and bytes
+
+        Counting the rows and reading the size of the output take extra queries, only run when the metrics are written
+        to the metrics dataset or the stages are profiled.
+        """
+        stage = self._get_role(output_dataset)
+        if not self.collects_metrics:
+            self.run_metrics.add_stage(stage, wall_time)
+            return
+        output_table = output_dataset.get_location_info()["info"]["quotedResolvedTableName"]
+        sql_executor = SQLExecutor2(dataset=output_dataset)
+        nb_rows, nb_bytes = None, None
+        try:
+            nb_rows_df = sql_executor.query_to_df(f"SELECT COUNT(*) AS {self.NB_ROWS_AS} FROM {output_table}")
+            nb_rows = int(nb_rows_df.iloc[0, 0])
+            if self.dialect_capabilities[TABLE_BYTES]:
+                table_bytes_query = self.dialect_capabilities[TABLE_BYTES].format(table=output_table)
+                nb_bytes = int(sql_executor.query_to_df(table_bytes_query).iloc[0, 0])
+        except Exception as error:
+            logger.warning(f"Could not compute the size of the {stage} output: {error}")
+        self.run_metrics.add_stage(stage, wall_time, rows_out=nb_rows, nb_bytes=nb_bytes)
+
+    def write_metrics(self, output_dataset):
+        """Save the run metrics as DSS metrics of the output dataset and write them to the optional metrics dataset
+
+        Nothing is saved when there is no metrics dataset and the stages are not profiled.
+        """
+        if not self.collects_metrics:
+            return
+        output_dataset.save_external_metric_values(self.run_metrics.get_metric_values())
+        metrics_dataset = self.file_manager.get(self.METRICS_DATASET_ROLE)
+        if metrics_dataset is not None:
+            metrics_dataset.write_schema(METRICS_SCHEMA)
+            with metrics_dataset.get_writer() as writer:
+                writer.write_dataframe(self.run_metrics.to_dataframe())
+
+    def _materialize(self, select_query, *stages, required=False, mode=None, cluster_by=None):
+        """Register select_query as a named stage if one of the given stages is configured to be materialized
+
+        select_query can also be a list of queries to concatenate with UNION ALL, such stages are always materialized
+        as they cannot be expressed as a subquery. Returns the table name to select from when the stage is
+        materialized, the unchanged select_query otherwise. The mode overrides the configured materialization mode,
+        and temporary tables are clustered by the cluster_by column when the dialect allows it.
+        """
+        required = required or isinstance(select_query, list)
+        mode = mode or self._get_materialization_mode(*stages, required=required)
+        if mode == constants.MATERIALIZATION_MODE.INLINE:
+            return select_query
+        stage_name = f"_reco_{stages[0].value}_{self.stage_name_suffix}"
+        if self.execution_bucket is not None:
+            stage_name = f"_reco_{stages[0].value}_b{self.execution_bucket.index}_{self.stage_name_suffix}"
+        if mode == constants.MATERIALIZATION_MODE.TEMP_TABLE:
+            stage_name = self.dialect_capabilities[TEMP_TABLE_PREFIX] + stage_name
+        if self._get_stage_key(select_query) in self.stage_labels:
+            self.stage_labels[stage_name] = self.stage_labels[self._get_stage_key(select_query)]
+        logger.debug(f"Materializing stage '{stages[0].value}' as {mode.value} '{stage_name}'")
+        self.materialized_stages[stage_name] = MaterializedStage(stage_name, mode, select_query, cluster_by)
+        return stage_name
+
+    def _qualify(self, select_query, condition, stage):
+        """Stage of the rows of select_query meeting a condition on its window functions, selected from by name
+
+        QUALIFY filters on the window functions in the query computing them, instead of a filter in an enclosing
+        query. The builders can't express it, the stage is always rendered in a WITH clause, see _render_stage. The
+        condition is SQL on the select aliases of select_query, which must not have an ORDER BY.
+        """
+        return self._materialize(
+            QualifiedQuery(select_query, condition), stage, required=True, mode=constants.MATERIALIZATION_MODE.CTE
+        )
+
+    def _get_materialization_mode(self, *stages, required=False):
+        mode = self.dku_config.get("materialization_mode") or constants.MATERIALIZATION_MODE.AUTO
+        materialized_stages = self.dku_config.get("materialized_stages") or []
+        if not required and not any(stage.value in materialized_stages for stage in stages):
+            return constants.MATERIALIZATION_MODE.INLINE
+        if mode == constants.MATERIALIZATION_MODE.AUTO or (required and mode == constants.MATERIALIZATION_MODE.INLINE):
+            mode = self.dialect_capabilities[DEFAULT_MATERIALIZATION]
+        if mode == constants.MATERIALIZATION_MODE.CTE and not self.supports_with_clause:
+            logger.warning("WITH clauses are not supported by this connection, using temporary tables instead")
+            mode = constants.MATERIALIZATION_MODE.TEMP_TABLE
+        return mode
+
+    def _render_stage(self, stage, dataset):
+        if isinstance(stage.query, list):
+            return " UNION ALL ".join(toSQL(select_query, dataset=dataset) for select_query in stage.query)
+        if isinstance(stage.query, QualifiedQuery):
+            return self.dialect_capabilities[QUALIFY].format(
+                query=toSQL(stage.query.query, dataset=dataset), condition=stage.query.condition
+            )
+        return toSQL(stage.query, dataset=dataset)
+
+    def _get_required_stages(self, query, rendered_stages):
+        """List the materialized stages referenced by the query (directly or not), dependencies first"""
+        referencing_queries = [query]
+        required_stages = []
+        for stage in reversed(self.materialized_stages.values()):
+            stage_reference = re.compile(rf"(?<![\w#]){re.escape(stage.name)}(?!\w)")
+            if any(stage_reference.search(referencing_query) for referencing_query in referencing_queries):
+                required_stages.insert(0, stage)
+                referencing_queries.append(rendered_stages[stage.name])
+        return required_stages
+
+    def _add_with_clause(self, query, rendered_stages, all_stages=False):
+        """Prepend the WITH clause of the CTE stages required by the query, or of all of them with all_stages
+
+        The query builders never render a WITH clause themselves: the common table expressions are all registered as
+        materialized stages, so the whole clause is built here from the stages, dependencies first.
+        """
+        cte_stages = [
+            stage
+            for stage in self._get_required_stages(query, rendered_stages)
+            if all_stages or stage.mode == constants.MATERIALIZATION_MODE.CTE
+        ]
+        if not cte_stages:
+            return query
+        with_clause = ", ".join(
+            f"{self._quote_identifier(stage.name)} AS ({rendered_stages[stage.name]})" for stage in cte_stages
+        )
+        return f"WITH {with_clause} {query}"
+
+    def _format_temp_table_statement(self, statement, table_name, query=None):
+        return self.dialect_capabilities[statement].format(
+            table=self._quote_identifier(table_name), name=table_name, query=query
+        )
+
+    def _format_create_temp_table_statement(self, stage, query):
+        if stage.cluster_by and self.dialect_capabilities[CREATE_CLUSTERED_TEMP_TABLE]:
+            return self.dialect_capabilities[CREATE_CLUSTERED_TEMP_TABLE].format(
+                table=self._quote_identifier(stage.name), column=self._quote_identifier(stage.cluster_by), query=query
+            )
+        return self._format_temp_table_statement(CREATE_TEMP_TABLE, stage.name, query=query)
+
+    def _build_id_dictionaries(self, users_sources, items_sources):
+        """Dictionaries of the users and items columns, built from the (query, column name) sources of their IDs"""
+        return {
+            self.dku_config.users_column_name: self._build_dictionary(
+                users_sources, constants.ENCODING_STAGE.USER_IDS, constants.ENCODING_STAGE.USERS_DICTIONARY
+            ),
+            self.dku_config.items_column_name: self._build_dictionary(
+                items_sources, constants.ENCODING_STAGE.ITEM_IDS, constants.ENCODING_STAGE.ITEMS_DICTIONARY
+            ),
+        }
+
+    def _build_dictionary(self, sources, ids_stage, dictionary_stage, select_from_as="_ids"):
+        """Dense integer code of each distinct non-null ID of the (query, column name) sources, numbered in ID order
+
+        The codes are ordered like the IDs, so the comparisons, orders and ties of the stages are the same on the
+        codes as on the IDs. The dictionary is read by the encoding of each input and the decoding of the outputs.
+        """
+        source_ids = []
+        for source, column_name in sources:
+            ids = SelectQuery()
+            ids.select_from(source, alias=select_from_as)
+            ids.select(Column(column_name, table_name=select_from_as), alias=self.ID_AS)
+            ids.where(Column(column_name, table_name=select_from_as).is_not_null())
+            ids.group_by(Column(column_name, table_name=select_from_as))
+            source_ids.append(ids)
+        if len(source_ids) == 1:
+            distinct_ids = source_ids[0]
+        else:
+            distinct_ids = SelectQuery()
+            distinct_ids.select_from(self._materialize(source_ids, ids_stage), alias=select_from_as)
+            distinct_ids.select(Column(self.ID_AS, table_name=select_from_as))
+            distinct_ids.group_by(Column(self.ID_AS, table_name=select_from_as))
+
+        distinct_ids_as = "_distinct_ids"
+        dictionary = SelectQuery()
+        dictionary.select_from(distinct_ids, alias=distinct_ids_as)
+        dictionary.select(Column(self.ID_AS, table_name=distinct_ids_as))
+        code_expression = (
+            Expression()
+            .rowNumber()
+            .over(Window(order_by=[Column(self.ID_AS, table_name=distinct_ids_as)], order_types=["ASC"], mode=None))
+        )
+        dictionary.select(code_expression, alias=self.CODE_AS)
+        return self._materialize(dictionary, dictionary_stage, required=True, cluster_by=self.ID_AS)
+
+    def _encode_ids(self, select_from, column_names, dictionaries, select_from_as="_ids_to_encode"):
+        """Columns of select_from, the IDs of the columns of dictionaries replaced by their codes (NULL for NULL)"""
+        return self._translate_ids(select_from, column_names, dictionaries, self.ID_AS, self.CODE_AS, select_from_as)
+
+    def _decode_ids(self, select_from, column_names, dictionaries, select_from_as="_codes_to_decode"):
+        """Columns of select_from, the codes of the columns of dictionaries replaced by their IDs"""
+        return self._translate_ids(select_from, column_names, dictionaries, self.CODE_AS, self.ID_AS, select_from_as)
+
+    def _translate_ids(self, select_from, column_names, dictionaries, from_column, to_column, select_from_as):
+        translated = SelectQuery()
+        translated.select_from(select_from, alias=select_from_as)
+        for index, column_name in enumerate(column_names):
+            if column_name not in dictionaries:
+                translated.select(Column(column_name, table_name=select_from_as))
+                continue
+            dictionary_as = f"_dictionary_{index}"
+            join_condition = Column(column_name, table_name=select_from_as).eq(
+                Column(from_column, table_name=dictionary_as)
+            )
+            translated.join(dictionaries[column_name], JoinTypes.LEFT, join_condition, alias=dictionary_as)
+            translated.select(Column(to_column, table_name=dictionary_as), alias=column_name)
+        return translated
+
+    def _get_hash_expression(self, column_name, table_name=None, seed=0):
+        """Deterministic integer hash of a string column, the seed allows to draw different pseudo-random orders"""
+        return InlineSQL(self._get_hash_sql(column_name, table_name=table_name, seed=seed))
+
+    def _get_bucket_condition(self, column_name, table_name=None):
+        """Condition keeping the rows whose column falls in the hash bucket being built"""
+        bucket_expression = self.dialect_capabilities[MODULO].format(
+            expression=self._get_hash_sql(column_name, table_name=table_name),
+            divisor=self.execution_bucket.nb_buckets,
+        )
+        return InlineSQL(bucket_expression).abs().eq(Constant(self.execution_bucket.index))
+
+    def _get_json_array_expression(self, column_name, table_name, order_by, numeric=False):
+        """Aggregate of a column into a JSON array (string) ordered by the order_by column, one per group"""
+        column, order_column = [
+            f"{self._quote_identifier(table_name)}.{self._quote_identifier(name)}" for name in (column_name, order_by)
+        ]
+        json_array_aggregate = self.dialect_capabilities[JSON_ARRAY_AGG_NUMBERS if numeric else JSON_ARRAY_AGG_STRINGS]
+        return InlineSQL(json_array_aggregate.format(expression=column, order=order_column))
+
+    def _get_hash_sql(self, column_name, table_name=None, seed=0):
+        column = self._quote_identifier(column_name)
+        if table_name:
+            column = f"{self._quote_identifier(table_name)}.{column}"
+        return self.dialect_capabilities[HASH_FUNCTION].format(expression=column, seed=int(seed))
+
+    def _quote_identifier(self, identifier):
+        opening_quote, closing_quote = self.dialect_capabilities[IDENTIFIER_QUOTES]
+        return f"{opening_quote}{identifier}{closing_quote}"
+
+    def _get_stage_name_suffix(self):
+        """Deterministic suffix shared by the materialized stages of a recipe run"""
+        dataset_names = sorted(dataset.full_name for dataset in self._get_datasets())
+        return hashlib.sha1(",".join(dataset_names).encode()).hexdigest()[:8]
+
     def _rename_table(self, to_rename, renaming_mapping):
         renamed_table = SelectQuery()
         renamed_table.select_from(to_rename, alias="_renamed")
@@ -60,6 +607,8 @@ class QueryHandler:
         return select_query
 
     def _set_column_description(self, output_dataset, column_name=None):
+        if self.explain_only:
+            return  # the output was not written
         column_descriptions = self._get_column_descriptions(column_name)
         set_column_description(output_dataset, column_descriptions)
         pass
@@ -73,18 +622,29 @@ class QueryHandler:
             raise ValueError(
                 f"""
                 Connection type '{connection_type}' is not supported by the plugin.
-                Supported connection types are {list(SUPPORTED_DIALECTS.keys())}
+                Supported connection types are {list(SUPPORTED_DIALECTS.keys())}.
+                The auto collaborative filtering recipe can use the in-memory engine on other connection types.
                 """
             )
-        self.supports_full_outer_join = SUPPORTED_DIALECTS[connection_type].get(SUPPORTS_FULL_OUTER_JOIN, False)
-        self.supports_with_clause = SUPPORTED_DIALECTS[connection_type].get(SUPPORTS_WITH_CLAUSE, False)
+        self.dialect_capabilities = SUPPORTED_DIALECTS[connection_type]
+        self.supports_full_outer_join = self.dialect_capabilities.get(SUPPORTS_FULL_OUTER_JOIN, False)
+        self.supports_with_clause = self.dialect_capabilities.get(SUPPORTS_WITH_CLAUSE, False)
+        self.supports_union_all = self.dialect_capabilities.get(SUPPORTS_UNION_ALL, False)
+        self.supports_qualify = bool(self.dialect_capabilities.get(QUALIFY))
+
+    def _get_datasets(self):
+        """Input and output datasets queried by the recipe, without its optional managed folders and metrics dataset"""
+        return [
+            file
+            for role, file in self.file_manager.items()
+            if isinstance(file, dataiku.Dataset) and role != self.METRICS_DATASET_ROLE
+        ]
 
     def _get_unique_dialect(self):
         connection_types, connection_names = [], []
-        for dataset in self.file_manager.values():
-            if dataset is not None:
-                connection_types += [dataset.get_config().get("type")]
-                connection_names += [dataset.get_config().get("params").get("connection")]
+        for dataset in self._get_datasets():
+            connection_types += [dataset.get_config().get("type")]
+            connection_names += [dataset.get_config().get("params").get("connection")]
         if len(set(connection_types)) != 1 or len(set(connection_names)) != 1:
             raise ValueError("All inputs and outputs datasets must be in the same connection.")
         return connection_types[0]
\ No newline at end of file
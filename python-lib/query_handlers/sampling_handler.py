@@ -1,5 +1,6 @@
 from query_handlers import QueryHandler
 from dataiku.sql import JoinTypes, Expression, Column, Constant, SelectQuery, Window
+from collections import OrderedDict
 import dku_constants as constants
 import logging
 
@@ -19,6 +20,9 @@ class SamplingHandler(QueryHandler):
             self.file_manager.historical_samples_dataset and self.dku_config.historical_samples
         )
         self.sample_keys = [self.dku_config.users_column_name, self.dku_config.items_column_name]
+        # the samples are joined with the scores and ranked on integer codes, decoded in the output only
+        self.encode_ids = bool(self.dku_config.get("encode_ids"))
+        self.dictionaries = {}  # dictionary of the users and items columns, when their IDs are encoded
         self._set_negative_samples_generation_function()
         self._set_postfilter_function()
 
@@ -81,7 +85,7 @@ class SamplingHandler(QueryHandler):
 
         columns_to_select = self.sample_keys + self.dku_config.score_column_names
         self._select_columns_list(all_cf_scores, columns_to_select, table_name=select_from_as)
-        return all_cf_scores
+        return self._profile_stage("scores_with_samples", all_cf_scores, select_from)
 
     def _build_all_cf_scores_with_target(self, select_from, select_from_as="_all_cf_scores_with_target"):
         all_cf_scores_with_target = SelectQuery()
@@ -166,12 +170,22 @@ class SamplingHandler(QueryHandler):
             )
             return samples_with_all_infos
 
+        def _get_qualify_condition():
+            ratio = float(self.dku_config.negative_samples_percentage / 100.0)
+            target, row_number, nb_positive = [
+                self._quote_identifier(name)
+                for name in (constants.TARGET_COLUMN_NAME, self.ROW_NUMBER_AS, NB_POSITIVE_PER_USER)
+            ]
+            return f"({target} = 1 OR {row_number} <= CEIL({nb_positive} * {ratio} / (1 - {ratio})))"
+
         def _build_filtered_samples(inner_select_from, inner_select_from_as):
             ratio = float(self.dku_config.negative_samples_percentage / 100.0)
             filtered_samples = SelectQuery()
             filtered_samples.select_from(inner_select_from, inner_select_from_as)
             columns_to_select = self.sample_keys + self.dku_config.score_column_names + [constants.TARGET_COLUMN_NAME]
             self._select_columns_list(filtered_samples, columns_to_select)
+            if self.supports_qualify:
+                return filtered_samples
 
             nb_negative_threshold_expr = (
                 Column(NB_POSITIVE_PER_USER, table_name=select_from_as)
@@ -187,10 +201,18 @@ class SamplingHandler(QueryHandler):
             return filtered_samples
 
         samples_with_only_positives = _build_samples_with_only_positives(select_from)
-        samples_with_all_infos = _build_samples_with_all_infos(select_from, samples_with_only_positives)
+        samples_with_all_infos = self._profile_stage(
+            "samples_with_positive_counts",
+            _build_samples_with_all_infos(select_from, samples_with_only_positives),
+            select_from,
+        )
+        if self.supports_qualify:
+            samples_with_all_infos = self._qualify(
+                samples_with_all_infos, _get_qualify_condition(), constants.QUALIFIED_STAGE.NEGATIVE_SAMPLES
+            )
         filtered_samples = _build_filtered_samples(samples_with_all_infos, select_from_as)
 
-        return filtered_samples
+        return self._profile_stage("negative_sampling", filtered_samples, samples_with_all_infos)
 
     def _build_not_sampled(self, select_from):
         return self._build_identity(select_from)
@@ -205,6 +227,12 @@ class SamplingHandler(QueryHandler):
         return cast_samples
 
     def build(self):
+        try:
+            self._build()
+        finally:
+            self._drop_staging_tables(self.file_manager.positive_negative_samples_dataset)
+
+    def _build(self):
         cast_mapping = {self.dku_config.users_column_name: "string", self.dku_config.items_column_name: "string"}
         prepared_training_samples = self._prepare_samples(
             query_to_prepare=self.file_manager.training_samples_dataset,
@@ -214,8 +242,6 @@ class SamplingHandler(QueryHandler):
             alias="_training_samples",
         )
 
-        samples_for_training = self._build_samples_for_training(prepared_training_samples)
-
         if self.has_historical_data:
             prepared_historical_samples = self._prepare_samples(
                 query_to_prepare=self.file_manager.historical_samples_dataset,
@@ -224,25 +250,74 @@ class SamplingHandler(QueryHandler):
                 cast_mapping=cast_mapping,
                 alias="_historical_samples",
             )
-            samples_for_scores = self._build_samples_for_scoring(prepared_historical_samples)
+            if self.max_concurrency > 1:
+                logger.info("Staging training and historical samples concurrently")
+                prepared_training_samples, prepared_historical_samples = self._build_staging_tables(
+                    OrderedDict(
+                        [
+                            (constants.SAMPLING_STAGE.TRAINING_SAMPLES, prepared_training_samples),
+                            (constants.SAMPLING_STAGE.HISTORICAL_SAMPLES, prepared_historical_samples),
+                        ]
+                    ),
+                    self.file_manager.positive_negative_samples_dataset,
+                )
         else:
-            samples_for_scores = None
+            prepared_historical_samples = None
 
         cast_mapping.update({col: "double" for col in self.dku_config.score_column_names})
         scored_samples_cast = self._cast_table(
             self.file_manager.scored_samples_dataset, cast_mapping, alias="_scored_samples"
         )
 
-        null_scores_filtered = self._build_cf_scores_without_null(scored_samples_cast)
+        if self.encode_ids:
+            logger.debug("Encoding the users and items as integers")
+            prepared_samples = [scored_samples_cast, prepared_training_samples, prepared_historical_samples]
+            prepared_samples = [samples for samples in prepared_samples if samples is not None]
+            self.dictionaries = self._build_id_dictionaries(
+                [(samples, self.dku_config.users_column_name) for samples in prepared_samples],
+                [(samples, self.dku_config.items_column_name) for samples in prepared_samples],
+            )
+            scored_samples_cast = self._encode_ids(scored_samples_cast, list(cast_mapping), self.dictionaries)
+            prepared_training_samples = self._encode_ids(
+                prepared_training_samples, self.sample_keys, self.dictionaries
+            )
+            if self.has_historical_data:
+                prepared_historical_samples = self._encode_ids(
+                    prepared_historical_samples, self.sample_keys, self.dictionaries
+                )
+
+        if self.has_historical_data:
+            samples_for_scores = self._build_samples_for_scoring(prepared_historical_samples)
+        else:
+            samples_for_scores = None
+        samples_for_training = self._build_samples_for_training(prepared_training_samples)
+
+        null_scores_filtered = self._profile_stage(
+            "scores_without_null", self._build_cf_scores_without_null(scored_samples_cast)
+        )
         all_cf_scores = self._build_all_cf_scores(null_scores_filtered, samples_for_training, samples_for_scores)
-        all_cf_scores_with_target = self._build_all_cf_scores_with_target(all_cf_scores)
+        all_cf_scores_with_target = self._profile_stage(
+            "scores_with_target", self._build_all_cf_scores_with_target(all_cf_scores), all_cf_scores
+        )
 
         scores_with_negative_samples = self.negative_samples_generation_func(all_cf_scores_with_target)
         negative_samples_filtered = self.postfiltering_func(scores_with_negative_samples)
+        if self.encode_ids:
+            negative_samples_filtered = self._decode_ids(
+                negative_samples_filtered, self._get_output_column_names(), self.dictionaries
+            )
 
         self._execute(negative_samples_filtered, self.file_manager.positive_negative_samples_dataset)
         self._set_column_description(self.file_manager.positive_negative_samples_dataset)
 
+    def _get_output_column_names(self):
+        """Columns of the positive and negative samples, in the order selected by the sampling stages"""
+        if self.dku_config.sampling_method == constants.SAMPLING_METHOD.NEGATIVE_SAMPLING_PERC:
+            return self.sample_keys + self.dku_config.score_column_names + [constants.TARGET_COLUMN_NAME]
+        if self.has_historical_data:
+            return self.sample_keys + [constants.TARGET_COLUMN_NAME] + self.dku_config.score_column_names
+        return self.sample_keys + self.dku_config.score_column_names + [constants.TARGET_COLUMN_NAME]
+
     def _get_column_descriptions(self, column_name=None):
         column_name = constants.TARGET_COLUMN_NAME
         return {column_name: "Positive or negative samples"}
\ No newline at end of file
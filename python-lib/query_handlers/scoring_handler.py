@@ -1,29 +1,60 @@
 from query_handlers import QueryHandler
+from dku_dialects import DEFAULT_ENTITY_STATISTICS
 from dataiku.sql import JoinTypes, Expression, Column, Constant, SelectQuery, Window
+from collections import OrderedDict, namedtuple
 import dku_constants as constants
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 
+JoinCost = namedtuple("JoinCost", ["joined_rows", "similarity_rows", "scoring_rows"])
+
 
 class ScoringHandler(QueryHandler):
     # VISIT_COUNT_TABLE_ALIAS = "visit_count"
     NB_VISIT_USER_AS = "_nb_visit_user"
     NB_VISIT_ITEM_AS = "_nb_visit_item"
+    USER_VISIT_RANK_AS = "_user_visit_rank"
+    ITEM_VISIT_RANK_AS = "_item_visit_rank"
     RATING_AVERAGE = "_rating_average"
     NORMALIZATION_FACTOR_AS = "_normalization_factor"
     LEFT_NORMALIZATION_FACTOR_AS = "_left_normalization_factor"
     RIGHT_NORMALIZATION_FACTOR_AS = "_right_normalization_factor"
     ROW_NUMBER_AS = "_row_number"
+    NB_VISIT_AS = "_nb_visit"
     TIMESTAMP_FILTERED_ROW_NB = "_timestamp_filtered_row_nb"
+    LAST_RATED_ROW_NB = "_last_rated_row_nb"
+    SCORE_RANK_AS = "_score_rank"
+    STATISTICS_KEY_AS = "_statistics_key"
+    JOINED_ROWS_AS = "_joined_rows"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sample_keys = [self.dku_config.users_column_name, self.dku_config.items_column_name]
         self.similarity_computation_columns = self.sample_keys.copy()  # columns to keep to compute similarity
         self.filtering_columns = []  # columns to keep for filtering
-        self.use_explicit = bool(self.dku_config.ratings_column_name)
+        self.duplicates_reducer = self.dku_config.get("duplicates_reducer") or constants.DUPLICATES_REDUCER.NONE
+        # the presence of distinct user-item pairs is implicit feedback, whatever the ratings of their samples
+        self.use_explicit = bool(
+            self.dku_config.ratings_column_name and self.duplicates_reducer != constants.DUPLICATES_REDUCER.PRESENCE
+        )
         self.timestamp_filtering = bool(self.dku_config.timestamp_filtering and self.dku_config.timestamps_column_name)
+        self.read_timestamps = self.timestamp_filtering or self.duplicates_reducer == constants.DUPLICATES_REDUCER.LAST
+        # visit counts, rating averages and normalization factors computed on the most recent samples only
+        self.recency_filter_first = bool(self.timestamp_filtering and self.dku_config.get("recency_filter_first"))
+        self.output_top_k_unseen = self.dku_config.get("scores_output") == constants.SCORES_OUTPUT.TOP_K_UNSEEN
+        self.output_nested_arrays = self.dku_config.get("output_format") == constants.OUTPUT_FORMAT.NESTED_ARRAYS
+        # only the top K scores of each user are kept
+        self.output_top_k = self.output_top_k_unseen or self.output_nested_arrays
+        # each pair is computed once (col_1 < col_2) and mirrored when needed
+        self.use_half_matrix = self.supports_union_all
+        # visit counts, rating averages and normalization factors grouped by entity and joined back, or windows
+        self.use_grouped_statistics = self._get_entity_statistics() == constants.ENTITY_STATISTICS.GROUPED
+        # the users and items are joined, grouped and ranked on integer codes, decoded in the outputs only
+        self.encode_ids = bool(self.dku_config.get("encode_ids"))
+        self.dictionaries = {}  # dictionary of the users and items columns, when their IDs are encoded
+        self.join_cost = None  # cost of the joins of the prepared samples, see _get_join_cost
 
         if self.use_explicit:
             logger.debug("Using explicit feedbacks")
@@ -31,7 +62,107 @@ class ScoringHandler(QueryHandler):
 
         if self.timestamp_filtering:
             logger.debug("Using timestamp filtering")
-            self.filtering_columns += [self.dku_config.timestamps_column_name]
+            if not self.recency_filter_first:
+                self.filtering_columns += [self.dku_config.timestamps_column_name]
+
+    def _build_deduplicated(self, select_from, select_from_as="_samples_cast"):
+        """One sample per user and item, rated with the ratings of its duplicates reduced by duplicates_reducer
+
+        The timestamp of a deduplicated sample is the most recent of its duplicates.
+        """
+        if self.duplicates_reducer == constants.DUPLICATES_REDUCER.LAST:
+            return self._build_last_rated(select_from)
+        deduplicated = SelectQuery()
+        deduplicated.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(deduplicated, column_names=self.sample_keys, table_name=select_from_as)
+        if self.use_explicit:
+            ratings_column = Column(self.dku_config.ratings_column_name, table_name=select_from_as)
+            reduced_ratings = {
+                constants.DUPLICATES_REDUCER.COUNT: Column("*").count().cast("double"),
+                constants.DUPLICATES_REDUCER.SUM: ratings_column.sum(),
+                constants.DUPLICATES_REDUCER.MEAN: ratings_column.avg(),
+            }
+            deduplicated.select(reduced_ratings[self.duplicates_reducer], alias=self.dku_config.ratings_column_name)
+        if self.timestamp_filtering:
+            deduplicated.select(
+                Column(self.dku_config.timestamps_column_name, table_name=select_from_as).max(),
+                alias=self.dku_config.timestamps_column_name,
+            )
+        for column_name in self.sample_keys:
+            deduplicated.group_by(Column(column_name, table_name=select_from_as))
+        return deduplicated
+
+    def _build_last_rated(self, select_from, select_from_as="_samples_cast"):
+        """The most recent sample of each user and item, the highest rating breaking the ties"""
+        last_rated_row_numbers = SelectQuery()
+        last_rated_row_numbers.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(
+            last_rated_row_numbers, column_names=self._get_deduplicated_columns(), table_name=select_from_as
+        )
+        last_rated_row_number_expression = (
+            Expression()
+            .rowNumber()
+            .over(
+                Window(
+                    partition_by=[Column(column_name, table_name=select_from_as) for column_name in self.sample_keys],
+                    order_by=[
+                        Column(self.dku_config.timestamps_column_name, table_name=select_from_as),
+                        Column(self.dku_config.ratings_column_name, table_name=select_from_as),
+                    ],
+                    order_types=["DESC", "DESC"],
+                    mode=None,
+                )
+            )
+        )
+        last_rated_row_numbers.select(last_rated_row_number_expression, alias=self.LAST_RATED_ROW_NB)
+        if self.supports_qualify:
+            last_rated_row_numbers = self._qualify(
+                last_rated_row_numbers,
+                f"{self._quote_identifier(self.LAST_RATED_ROW_NB)} = 1",
+                constants.QUALIFIED_STAGE.LAST_RATED_SAMPLES,
+            )
+
+        row_numbers_alias = "_last_rated_row_numbers"
+        last_rated = SelectQuery()
+        last_rated.select_from(last_rated_row_numbers, alias=row_numbers_alias)
+        self._select_columns_list(
+            last_rated, column_names=self._get_deduplicated_columns(), table_name=row_numbers_alias
+        )
+        if not self.supports_qualify:
+            last_rated.where(Column(self.LAST_RATED_ROW_NB, table_name=row_numbers_alias).eq(Constant(1)))
+        return last_rated
+
+    def _get_deduplicated_columns(self):
+        deduplicated_columns = self.similarity_computation_columns.copy()
+        if self.timestamp_filtering:
+            deduplicated_columns += [self.dku_config.timestamps_column_name]
+        return deduplicated_columns
+
+    def _build_recency_filtered(self, select_from):
+        if self.dku_config.get("recency_filter") == constants.RECENCY_FILTER.DATE_WINDOW:
+            return self._build_date_window_filtered(select_from)
+        return self._build_timestamp_filtered(select_from)
+
+    def _build_date_window_filtered(self, select_from, select_from_as="_prepared_input_dataset"):
+        """Samples whose timestamp is in the window [recency_window_start, recency_window_end)"""
+        date_window_filtered = SelectQuery()
+        date_window_filtered.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(
+            date_window_filtered, column_names=self.similarity_computation_columns, table_name=select_from_as
+        )
+        timestamps_column = Column(self.dku_config.timestamps_column_name, table_name=select_from_as)
+        date_window_filtered.where(
+            timestamps_column.ge(self._get_timestamp_constant(self.dku_config.recency_window_start))
+        )
+        if self.dku_config.get("recency_window_end") is not None:
+            date_window_filtered.where(
+                timestamps_column.lt(self._get_timestamp_constant(self.dku_config.recency_window_end))
+            )
+        return date_window_filtered
+
+    def _get_timestamp_constant(self, value):
+        timestamps_type = self._get_cast_type(self.dku_config.timestamps_column_name, self.file_manager.samples_dataset)
+        return Constant(value).cast(timestamps_type) if timestamps_type == "date" else Constant(value)
 
     def _build_timestamp_filtered(self, select_from, select_from_as="_prepared_input_dataset"):
         def _build_timestamp_filtered_row_number(select_from_inner, select_from_as_inner):
@@ -61,6 +192,12 @@ class ScoringHandler(QueryHandler):
             return ts_row_numbers
 
         built_ts_row_numbers = _build_timestamp_filtered_row_number(select_from, select_from_as)
+        if self.supports_qualify:
+            built_ts_row_numbers = self._qualify(
+                built_ts_row_numbers,
+                f"{self._quote_identifier(self.TIMESTAMP_FILTERED_ROW_NB)} <= {int(self.dku_config.top_n_most_recent)}",
+                constants.QUALIFIED_STAGE.MOST_RECENT_SAMPLES,
+            )
 
         ts_row_numbers_alias = "_ts_row_numbers"
         timestamp_filtered = SelectQuery()
@@ -70,15 +207,25 @@ class ScoringHandler(QueryHandler):
             timestamp_filtered, column_names=self.similarity_computation_columns, table_name=ts_row_numbers_alias
         )
 
-        timestamp_filtered.where(
-            Column(self.TIMESTAMP_FILTERED_ROW_NB, table_name=ts_row_numbers_alias).le(
-                Constant(self.dku_config.top_n_most_recent)
+        if not self.supports_qualify:
+            timestamp_filtered.where(
+                Column(self.TIMESTAMP_FILTERED_ROW_NB, table_name=ts_row_numbers_alias).le(
+                    Constant(self.dku_config.top_n_most_recent)
+                )
             )
-        )
 
         return timestamp_filtered
 
+    def _get_entity_statistics(self):
+        entity_statistics = self.dku_config.get("entity_statistics") or constants.ENTITY_STATISTICS.AUTO
+        if entity_statistics == constants.ENTITY_STATISTICS.AUTO:
+            entity_statistics = self.dialect_capabilities[DEFAULT_ENTITY_STATISTICS]
+        logger.debug(f"Computing the visit counts and normalization factors with {entity_statistics.value}")
+        return entity_statistics
+
     def _build_visit_count(self, select_from, select_from_as="_filtered_input_dataset"):
+        if self.use_grouped_statistics:
+            return self._build_grouped_visit_count(select_from)
         # total user and item visits
         visit_count = SelectQuery()
         visit_count.select_from(select_from, alias=select_from_as)
@@ -111,6 +258,17 @@ class ScoringHandler(QueryHandler):
             ),
             alias=self.NB_VISIT_ITEM_AS,
         )
+        # pseudo-random but deterministic rank of each visit, used to downsample users and items above the caps
+        if self.dku_config.user_visit_cap:
+            visit_count.select(
+                self._get_visit_rank_expression(self.dku_config.users_column_name, self.dku_config.items_column_name),
+                alias=self.USER_VISIT_RANK_AS,
+            )
+        if self.dku_config.item_visit_cap:
+            visit_count.select(
+                self._get_visit_rank_expression(self.dku_config.items_column_name, self.dku_config.users_column_name),
+                alias=self.ITEM_VISIT_RANK_AS,
+            )
         if self.use_explicit:
             visit_count.select(
                 Column(self.dku_config.ratings_column_name)
@@ -125,9 +283,66 @@ class ScoringHandler(QueryHandler):
             )
             self.similarity_computation_columns += [self.RATING_AVERAGE]
 
-        return visit_count
+        return self._profile_stage("visit_count", visit_count, select_from)
+
+    def _build_grouped_visit_count(self, select_from, select_from_as="_filtered_input_dataset"):
+        """Same columns as _build_visit_count, the visits and rating averages being joined from per entity tables
+
+        Samples without user or item are dropped by the joins, as they could not be joined in the similarity.
+        """
+        visit_count = SelectQuery()
+        visit_count.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(
+            visit_count,
+            column_names=self.similarity_computation_columns + self.filtering_columns,
+            table_name=select_from_as,
+        )
+        for entity_column, nb_visit_as in [
+            (self.dku_config.users_column_name, self.NB_VISIT_USER_AS),
+            (self.dku_config.items_column_name, self.NB_VISIT_ITEM_AS),
+        ]:
+            entity_statistics_as = f"{nb_visit_as}_statistics"
+            entity_statistics = self._build_entity_visit_statistics(select_from, entity_column, nb_visit_as)
+            join_condition = Column(entity_column, table_name=select_from_as).eq(
+                Column(self.STATISTICS_KEY_AS, table_name=entity_statistics_as)
+            )
+            visit_count.join(entity_statistics, JoinTypes.INNER, join_condition, alias=entity_statistics_as)
+            visit_count.select(Column(nb_visit_as, table_name=entity_statistics_as), alias=nb_visit_as)
+            if self.use_explicit and entity_column == self.based_column:
+                visit_count.select(
+                    Column(self.RATING_AVERAGE, table_name=entity_statistics_as), alias=self.RATING_AVERAGE
+                )
+        # pseudo-random but deterministic rank of each visit, used to downsample users and items above the caps
+        if self.dku_config.user_visit_cap:
+            visit_count.select(
+                self._get_visit_rank_expression(self.dku_config.users_column_name, self.dku_config.items_column_name),
+                alias=self.USER_VISIT_RANK_AS,
+            )
+        if self.dku_config.item_visit_cap:
+            visit_count.select(
+                self._get_visit_rank_expression(self.dku_config.items_column_name, self.dku_config.users_column_name),
+                alias=self.ITEM_VISIT_RANK_AS,
+            )
+        if self.use_explicit:
+            self.similarity_computation_columns += [self.RATING_AVERAGE]
+
+        return self._profile_stage("visit_count", visit_count, select_from)
+
+    def _build_entity_visit_statistics(self, select_from, entity_column, nb_visit_as, select_from_as="_samples"):
+        entity_statistics = SelectQuery()
+        entity_statistics.select_from(select_from, alias=select_from_as)
+        entity_statistics.select(Column(entity_column, table_name=select_from_as), alias=self.STATISTICS_KEY_AS)
+        entity_statistics.select(Column("*").count(), alias=nb_visit_as)
+        if self.use_explicit and entity_column == self.based_column:
+            entity_statistics.select(
+                Column(self.dku_config.ratings_column_name, table_name=select_from_as).avg(), alias=self.RATING_AVERAGE
+            )
+        entity_statistics.group_by(Column(entity_column, table_name=select_from_as))
+        return entity_statistics
 
     def _build_normalization_factor(self, select_from, select_from_as="_visit_count"):
+        if self.use_grouped_statistics:
+            return self._build_grouped_normalization_factor(select_from)
         # compute normalization factor
         normalization_factor = SelectQuery()
         normalization_factor.select_from(select_from, alias=select_from_as)
@@ -151,89 +366,175 @@ class ScoringHandler(QueryHandler):
 
         self.similarity_computation_columns += [self.NORMALIZATION_FACTOR_AS]
 
-        # keep only items and users with enough visits
-        normalization_factor.where(
-            Column(self.NB_VISIT_USER_AS, table_name=select_from_as).ge(Constant(self.dku_config.user_visit_threshold))
-        )
-        normalization_factor.where(
-            Column(self.NB_VISIT_ITEM_AS, table_name=select_from_as).ge(Constant(self.dku_config.item_visit_threshold))
-        )
-        return normalization_factor
+        for condition in self._get_visit_conditions(select_from_as):
+            normalization_factor.where(condition)
+        return self._profile_stage("normalization_factor", normalization_factor, select_from)
 
-    def _build_similarity(self, select_from):
-        similarity = self._build_ordered_similarity(select_from)
-        if self.supports_full_outer_join:
-            return self._build_unordered_similarity(similarity)
-        else:
-            return similarity
-
-    def _build_unordered_similarity(
-        self,
-        select_from,
-        left_select_from_as="_left_ordered_similarity",
-        right_select_from_as="_right_ordered_similarity",
-        with_clause_as="_with_clause_ordered_similarity",
+    def _build_grouped_normalization_factor(
+        self, select_from, select_from_as="_visit_count", thresholded_as="_thresholded_samples"
     ):
-        """Retrieve both pairs (when col_1 < col_2 and col_1 > col_2) from the ordered similarity table"""
-        similarity = SelectQuery()
-
-        if self.supports_with_clause:
-            similarity.with_cte(select_from, alias=with_clause_as)
-            select_from = with_clause_as
-
-        similarity.select_from(select_from, alias=left_select_from_as)
-
-        join_condition = Constant(1).eq_null_unsafe(Constant(0))
+        """Same columns as _build_normalization_factor, the factors being joined from a table grouped by entity"""
+        thresholded_samples = SelectQuery()
+        thresholded_samples.select_from(select_from, alias=select_from_as)
+        self._select_columns_list(
+            thresholded_samples,
+            column_names=self.similarity_computation_columns + self.filtering_columns,
+            table_name=select_from_as,
+        )
+        for condition in self._get_visit_conditions(select_from_as):
+            thresholded_samples.where(condition)
+        # the thresholded samples are read by the normalization factors of the entities and joined back with them
+        thresholded_samples = self._materialize(
+            thresholded_samples,
+            constants.ENTITY_STATISTICS_STAGE.THRESHOLDED_SAMPLES,
+            required=True,
+            cluster_by=self.based_column,
+        )
 
-        similarity.join(select_from, JoinTypes.FULL, join_condition, alias=right_select_from_as)
+        normalization_statistics_as = "_normalization_statistics"
+        normalization_statistics = SelectQuery()
+        normalization_statistics.select_from(thresholded_samples, alias=thresholded_as)
+        normalization_statistics.select(
+            Column(self.based_column, table_name=thresholded_as), alias=self.STATISTICS_KEY_AS
+        )
+        rating_column = (
+            Column(self.dku_config.ratings_column_name, table_name=thresholded_as).minus(
+                Column(self.RATING_AVERAGE, table_name=thresholded_as)
+            )
+            if self.use_explicit
+            else Constant(1)
+        )
+        normalization_statistics.select(
+            Constant(1).div(rating_column.times(rating_column).sum().sqrt()), alias=self.NORMALIZATION_FACTOR_AS
+        )
+        normalization_statistics.group_by(Column(self.based_column, table_name=thresholded_as))
 
-        similarity.select(
-            Column(f"{self.based_column}_1", table_name=left_select_from_as).coalesce(
-                Column(f"{self.based_column}_2", table_name=right_select_from_as)
-            ),
-            alias=f"{self.based_column}_1",
+        normalization_factor = SelectQuery()
+        normalization_factor.select_from(thresholded_samples, alias=thresholded_as)
+        self._select_columns_list(
+            normalization_factor,
+            column_names=self.similarity_computation_columns + self.filtering_columns,
+            table_name=thresholded_as,
         )
-        similarity.select(
-            Column(f"{self.based_column}_2", table_name=left_select_from_as).coalesce(
-                Column(f"{self.based_column}_1", table_name=right_select_from_as)
-            ),
-            alias=f"{self.based_column}_2",
+        join_condition = Column(self.based_column, table_name=thresholded_as).eq(
+            Column(self.STATISTICS_KEY_AS, table_name=normalization_statistics_as)
         )
-        similarity.select(
-            Column("similarity", table_name=left_select_from_as).coalesce(
-                Column("similarity", table_name=right_select_from_as)
-            ),
-            alias=constants.SIMILARITY_COLUMN_NAME,
+        normalization_factor.join(
+            normalization_statistics, JoinTypes.INNER, join_condition, alias=normalization_statistics_as
+        )
+        normalization_factor.select(
+            Column(self.NORMALIZATION_FACTOR_AS, table_name=normalization_statistics_as),
+            alias=self.NORMALIZATION_FACTOR_AS,
         )
+        self.similarity_computation_columns += [self.NORMALIZATION_FACTOR_AS]
+        return self._profile_stage("normalization_factor", normalization_factor, select_from)
 
-        return similarity
+    def _get_visit_conditions(self, select_from_as):
+        """Conditions keeping only items and users with enough visits, and at most the cap of visits of each"""
+        conditions = [
+            Column(self.NB_VISIT_USER_AS, table_name=select_from_as).ge(Constant(self.dku_config.user_visit_threshold)),
+            Column(self.NB_VISIT_ITEM_AS, table_name=select_from_as).ge(Constant(self.dku_config.item_visit_threshold)),
+        ]
+        if self.dku_config.user_visit_cap:
+            conditions.append(
+                Column(self.USER_VISIT_RANK_AS, table_name=select_from_as).le(Constant(self.dku_config.user_visit_cap))
+            )
+        if self.dku_config.item_visit_cap:
+            conditions.append(
+                Column(self.ITEM_VISIT_RANK_AS, table_name=select_from_as).le(Constant(self.dku_config.item_visit_cap))
+            )
+        return conditions
+
+    def _get_visit_rank_expression(self, partition_column, sampled_column):
+        """Rank in a pseudo-random order of the sampled column, duplicated samples ranked by timestamp then rating
+
+        Without duplicates reducer, the samples of a user-item pair share the hash and the sampled column: the most
+        recent one, then the highest rated one, is kept when the cap falls between them.
+        """
+        hash_expression = self._get_hash_expression(sampled_column, seed=self.dku_config.downsampling_seed)
+        order_by = [hash_expression, Column(sampled_column)]
+        order_types = ["ASC", "ASC"]
+        if self.timestamp_filtering and not self.recency_filter_first:
+            order_by.append(Column(self.dku_config.timestamps_column_name))
+            order_types.append("DESC")
+        if self.use_explicit:
+            order_by.append(Column(self.dku_config.ratings_column_name))
+            order_types.append("DESC")
+        return (
+            Expression()
+            .rowNumber()
+            .over(
+                Window(partition_by=[Column(partition_column)], order_by=order_by, order_types=order_types, mode=None)
+            )
+        )
 
-    def _build_ordered_similarity(self, select_from, with_clause_as="_with_clause_normalization_factor"):
-        """Build a similarity table col_1, col_2, similarity where col_1 < col_2 """
+    def _build_similarity(self, select_from, candidate_pairs=None):
+        """Build the half similarity matrix (col_1 < col_2) when it can be mirrored, the full matrix otherwise"""
+        return self._build_ordered_similarity(select_from, candidate_pairs)
+
+    def _build_full_similarity(self, select_from):
+        """Complete the half similarity matrix with its mirrored pairs (col_2, col_1) using UNION ALL"""
+        if not self.supports_union_all:
+            return select_from
+        if isinstance(select_from, SelectQuery):
+            # both parts of the union read the half matrix, it must be computed only once
+            select_from = self._materialize(select_from, constants.SIMILARITY_STAGE.HALF_MATRIX, required=True)
+        full_similarity = self._materialize(
+            [self._build_similarity_pairs(select_from), self._build_similarity_pairs(select_from, mirrored=True)],
+            constants.SIMILARITY_STAGE.FULL_MATRIX,
+            cluster_by=f"{self.based_column}_1",
+        )
+        return self._build_similarity_pairs(full_similarity)
+
+    def _build_similarity_pairs(self, select_from, mirrored=False, select_from_as="_similarity_pairs"):
+        similarity_pairs = SelectQuery()
+        similarity_pairs.select_from(select_from, alias=select_from_as)
+        based_columns = [f"{self.based_column}_1", f"{self.based_column}_2"]
+        for based_column, selected_column in zip(based_columns, reversed(based_columns) if mirrored else based_columns):
+            similarity_pairs.select(Column(selected_column, table_name=select_from_as), alias=based_column)
+        similarity_pairs.select(Column(constants.SIMILARITY_COLUMN_NAME, table_name=select_from_as))
+        return similarity_pairs
+
+    def _build_ordered_similarity(self, select_from, candidate_pairs=None, candidate_pairs_as="_candidate_pairs"):
+        """Build a similarity table col_1, col_2, similarity where col_1 < col_2 (col_1 != col_2 without half matrix)
+
+        When candidate_pairs (col_1, col_2) are given, the similarity is only computed for these pairs. When executed
+        in buckets, only the rows whose col_1 falls in the current bucket are computed.
+        """
         similarity = SelectQuery()
-
-        if self.supports_with_clause:
-            similarity.with_cte(select_from, alias=with_clause_as)
-            select_from = with_clause_as
+        normalization_factor = select_from
+
+        if self.supports_with_clause and not isinstance(select_from, str):
+            # both sides of the self-join read the prepared samples, they are computed once in a WITH clause
+            select_from = self._materialize(
+                select_from,
+                constants.SCORING_STAGE.PREPARED_SAMPLES,
+                required=True,
+                mode=constants.MATERIALIZATION_MODE.CTE,
+            )
 
         similarity.select_from(select_from, alias=self.LEFT_NORMALIZATION_FACTOR_AS)
 
         join_conditions = [
             Column(self.pivot_column, self.LEFT_NORMALIZATION_FACTOR_AS).eq_null_unsafe(
                 Column(self.pivot_column, self.RIGHT_NORMALIZATION_FACTOR_AS)
-            )
+            ),
+            self._get_pair_condition(
+                Column(self.based_column, self.LEFT_NORMALIZATION_FACTOR_AS),
+                Column(self.based_column, self.RIGHT_NORMALIZATION_FACTOR_AS),
+            ),
         ]
 
-        if self.supports_full_outer_join:
-            join_conditions += [
-                Column(self.based_column, self.LEFT_NORMALIZATION_FACTOR_AS).lt(
-                    Column(self.based_column, self.RIGHT_NORMALIZATION_FACTOR_AS)
+        if candidate_pairs is not None:
+            candidate_join_conditions = [
+                Column(self.based_column, self.LEFT_NORMALIZATION_FACTOR_AS).eq(
+                    Column(f"{self.based_column}_1", candidate_pairs_as)
                 )
             ]
-        else:
+            similarity.join(candidate_pairs, JoinTypes.INNER, candidate_join_conditions, alias=candidate_pairs_as)
             join_conditions += [
-                Column(self.based_column, self.LEFT_NORMALIZATION_FACTOR_AS).ne(
-                    Column(self.based_column, self.RIGHT_NORMALIZATION_FACTOR_AS)
+                Column(self.based_column, self.RIGHT_NORMALIZATION_FACTOR_AS).eq(
+                    Column(f"{self.based_column}_2", candidate_pairs_as)
                 )
             ]
 
@@ -251,7 +552,16 @@ class ScoringHandler(QueryHandler):
 
         similarity.select(self._get_similarity_formula(), alias=constants.SIMILARITY_COLUMN_NAME)
 
-        return similarity
+        if self.execution_bucket is not None:
+            similarity.where(self._get_bucket_condition(self.based_column, self.LEFT_NORMALIZATION_FACTOR_AS))
+        return self._profile_stage("similarity", similarity, normalization_factor)
+
+    def _get_pair_condition(self, left_column, right_column):
+        """Condition on the based columns of a pair, keeping each unordered pair once when the matrix can be mirrored"""
+        if self.use_half_matrix:
+            return left_column.lt(right_column)
+        else:
+            return left_column.ne(right_column)
 
     def _build_row_numbers(self, select_from, select_from_as="_similarity_matrix"):
         row_numbers = SelectQuery()
@@ -276,19 +586,32 @@ class ScoringHandler(QueryHandler):
             )
         )
         row_numbers.select(row_number_expression, alias=self.ROW_NUMBER_AS)
-        return row_numbers
 
-    def _build_top_n(self, select_from, select_from_as="_row_number_table"):
+        if self.execution_bucket is not None:
+            # the row numbers are partitioned by col_1, filtering it before the window keeps them unchanged
+            row_numbers.where(self._get_bucket_condition(f"{self.based_column}_1", select_from_as))
+        return self._profile_stage("row_numbers", row_numbers, select_from)
+
+    def _build_top_n(self, select_from, with_row_number=False, select_from_as="_row_number_table"):
+        if self.supports_qualify:
+            select_from = self._qualify(
+                select_from,
+                f"{self._quote_identifier(self.ROW_NUMBER_AS)} <= {int(self.dku_config.top_n_most_similar)}",
+                constants.QUALIFIED_STAGE.TOP_N_SIMILAR,
+            )
         top_n = SelectQuery()
         top_n.select_from(select_from, alias=select_from_as)
 
         columns_to_select = [f"{self.based_column}_1", f"{self.based_column}_2", constants.SIMILARITY_COLUMN_NAME]
+        if with_row_number:
+            columns_to_select += [self.ROW_NUMBER_AS]
         self._select_columns_list(top_n, column_names=columns_to_select, table_name=select_from_as)
 
-        top_n.where(
-            Column(self.ROW_NUMBER_AS, table_name=select_from_as).le(Constant(self.dku_config.top_n_most_similar))
-        )
-        return top_n
+        if not self.supports_qualify:
+            top_n.where(
+                Column(self.ROW_NUMBER_AS, table_name=select_from_as).le(Constant(self.dku_config.top_n_most_similar))
+            )
+        return self._profile_stage("top_n", top_n, select_from)
 
     def _build_sum_of_similarity_scores(
         self, top_n, normalization_factor, top_n_as="_top_n", normalization_factor_as="_normalization_factor"
@@ -311,45 +634,299 @@ class ScoringHandler(QueryHandler):
             self._get_user_item_similarity_formula(top_n_as, normalization_factor_as), alias=constants.SCORE_COLUMN_NAME
         )
 
-        cf_scores.order_by(Column(self.based_column))
-        cf_scores.order_by(Column(constants.SCORE_COLUMN_NAME), direction="DESC")
-        return cf_scores
+        if not (self.output_top_k or self.encode_ids):
+            cf_scores.order_by(Column(self.based_column))
+            cf_scores.order_by(Column(constants.SCORE_COLUMN_NAME), direction="DESC")
+        return self._profile_stage("scores", cf_scores, top_n)
+
+    def _build_ranked_scores(self, select_from, select_from_as="_cf_scores", samples_as="_seen_samples"):
+        """Non-null scores with their rank for the user, without the items the user has samples of in top K unseen mode
+
+        The seen items are removed by an anti-join on all the samples.
+        """
+        users_column, items_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+        ranked_scores = SelectQuery()
+        ranked_scores.select_from(select_from, alias=select_from_as)
+        if self.output_top_k_unseen:
+            join_conditions = [
+                Column(users_column, select_from_as).eq(Column(users_column, samples_as)),
+                Column(items_column, select_from_as).eq(Column(items_column, samples_as)),
+            ]
+            ranked_scores.join(self._build_samples_cast(), JoinTypes.LEFT, join_conditions, alias=samples_as)
+            ranked_scores.where(Column(users_column, table_name=samples_as).is_null())
+        ranked_scores.where(Column(constants.SCORE_COLUMN_NAME, table_name=select_from_as).is_not_null())
 
-    def _prepare_samples(self):
-        samples_dataset = self.file_manager.samples_dataset
+        self._select_columns_list(
+            ranked_scores,
+            column_names=[self.based_column, self.pivot_column, constants.SCORE_COLUMN_NAME],
+            table_name=select_from_as,
+        )
+        score_rank_expression = (
+            Expression()
+            .rowNumber()
+            .over(
+                Window(
+                    partition_by=[Column(users_column, table_name=select_from_as)],
+                    order_by=[
+                        Column(constants.SCORE_COLUMN_NAME, table_name=select_from_as),
+                        Column(items_column, table_name=select_from_as),
+                    ],
+                    order_types=["DESC", "ASC"],
+                    mode=None,
+                )
+            )
+        )
+        ranked_scores.select(score_rank_expression, alias=self.SCORE_RANK_AS)
+        return ranked_scores
+
+    def _build_top_k_scores(self, select_from, with_rank=False, select_from_as="_ranked_scores"):
+        if self.supports_qualify:
+            select_from = self._qualify(
+                select_from,
+                f"{self._quote_identifier(self.SCORE_RANK_AS)} <= {int(self.dku_config.top_k)}",
+                constants.QUALIFIED_STAGE.TOP_K_SCORES,
+            )
+        top_k_scores = SelectQuery()
+        top_k_scores.select_from(select_from, alias=select_from_as)
+        columns_to_select = [self.based_column, self.pivot_column, constants.SCORE_COLUMN_NAME]
+        if with_rank:
+            columns_to_select += [self.SCORE_RANK_AS]
+        self._select_columns_list(top_k_scores, column_names=columns_to_select, table_name=select_from_as)
+        if not self.supports_qualify:
+            top_k_scores.where(
+                Column(self.SCORE_RANK_AS, table_name=select_from_as).le(Constant(self.dku_config.top_k))
+            )
+        return top_k_scores
+
+    def _build_nested_arrays(
+        self, select_from, group_column, id_column, value_column, rank_column, select_from_as="_ranked_rows"
+    ):
+        """One row per group_column with the ids and values of its rows as two JSON arrays aligned by rank
+
+        Rows with a NULL id or value are skipped, as they can't be kept in the arrays of every dialect.
+        """
+        nested_arrays = SelectQuery()
+        nested_arrays.select_from(select_from, alias=select_from_as)
+        nested_arrays.select(Column(group_column, table_name=select_from_as))
+        nested_arrays.select(self._get_json_array_expression(id_column, select_from_as, rank_column), alias=id_column)
+        nested_arrays.select(
+            self._get_json_array_expression(value_column, select_from_as, rank_column, numeric=True),
+            alias=value_column,
+        )
+        nested_arrays.where(Column(id_column, table_name=select_from_as).is_not_null())
+        nested_arrays.where(Column(value_column, table_name=select_from_as).is_not_null())
+        nested_arrays.group_by(Column(group_column, table_name=select_from_as))
+        return nested_arrays
+
+    def _build_nested_neighbours(self, similarity, is_half_matrix=False):
+        """Top N most similar entities of each based entity as JSON arrays of neighbours and similarities"""
+        if is_half_matrix:
+            similarity = self._build_full_similarity(similarity)
+        top_n = self._build_top_n(self._build_row_numbers(similarity), with_row_number=True)
+        if self.encode_ids:
+            top_n = self._decode_similarity(top_n, with_row_number=True)
+        return self._build_nested_arrays(
+            top_n,
+            f"{self.based_column}_1",
+            f"{self.based_column}_2",
+            constants.SIMILARITY_COLUMN_NAME,
+            self.ROW_NUMBER_AS,
+        )
+
+    def _get_samples_cast_mapping(self):
         cast_mapping = {self.dku_config.users_column_name: "string", self.dku_config.items_column_name: "string"}
         if self.use_explicit:
             cast_mapping[self.dku_config.ratings_column_name] = "double"
-        if self.timestamp_filtering:
+        if self.read_timestamps:
             cast_mapping[self.dku_config.timestamps_column_name] = self._get_cast_type(
-                self.dku_config.timestamps_column_name, samples_dataset
+                self.dku_config.timestamps_column_name, self.file_manager.samples_dataset
+            )
+        return cast_mapping
+
+    def _build_samples_cast(self):
+        samples_cast = self._cast_table(
+            self.file_manager.samples_dataset, self._get_samples_cast_mapping(), alias="_raw_input_dataset"
+        )
+        if not self.encode_ids:
+            return samples_cast
+        if not self.dictionaries:
+            logger.debug("Encoding the users and items as integers")
+            self.dictionaries = self._build_id_dictionaries(*self._get_id_sources(samples_cast))
+        return self._encode_ids(samples_cast, list(self._get_samples_cast_mapping()), self.dictionaries)
+
+    def _get_id_sources(self, samples_cast):
+        """Sources (query, column name) of all the users and all the items IDs to encode"""
+        return [(samples_cast, self.dku_config.users_column_name)], [(samples_cast, self.dku_config.items_column_name)]
+
+    def _get_similarity_dictionaries(self):
+        based_dictionary = self.dictionaries[self.based_column]
+        return {f"{self.based_column}_1": based_dictionary, f"{self.based_column}_2": based_dictionary}
+
+    def _encode_similarity(self, similarity):
+        """Similarity of IDs (col_1, col_2, similarity) with the IDs replaced by their codes"""
+        similarity_columns = [f"{self.based_column}_1", f"{self.based_column}_2", constants.SIMILARITY_COLUMN_NAME]
+        return self._encode_ids(similarity, similarity_columns, self._get_similarity_dictionaries())
+
+    def _decode_similarity(self, similarity, with_row_number=False):
+        similarity_columns = [f"{self.based_column}_1", f"{self.based_column}_2", constants.SIMILARITY_COLUMN_NAME]
+        if with_row_number:
+            similarity_columns += [self.ROW_NUMBER_AS]
+        return self._decode_ids(similarity, similarity_columns, self._get_similarity_dictionaries())
+
+    def _decode_scores(self, cf_scores, with_rank=False, select_from_as="_encoded_scores"):
+        """Scores with the codes replaced by the IDs, sorted by user and score when all the scores are output"""
+        scores_columns = [self.based_column, self.pivot_column, constants.SCORE_COLUMN_NAME]
+        if with_rank:
+            scores_columns += [self.SCORE_RANK_AS]
+        decoded_scores = self._decode_ids(cf_scores, scores_columns, self.dictionaries, select_from_as=select_from_as)
+        if not self.output_top_k:
+            # sorted by the codes, ordered like the IDs
+            decoded_scores.order_by(Column(self.based_column, table_name=select_from_as))
+            decoded_scores.order_by(Column(constants.SCORE_COLUMN_NAME, table_name=select_from_as), direction="DESC")
+        return decoded_scores
+
+    def _prepare_samples(self):
+        samples_cast = self._build_samples_cast()
+        if self.duplicates_reducer != constants.DUPLICATES_REDUCER.NONE:
+            logger.debug(f"Reducing duplicated samples with {self.duplicates_reducer.value}")
+            samples_cast = self._build_deduplicated(samples_cast)
+        if self.recency_filter_first:
+            samples_cast = self._build_recency_filtered(samples_cast)
+        if self.use_grouped_statistics and (
+            self.duplicates_reducer != constants.DUPLICATES_REDUCER.NONE or self.recency_filter_first
+        ):
+            # the reduced samples are read by the visits of the users and of the items, and joined back with them
+            samples_cast = self._materialize(
+                samples_cast, constants.ENTITY_STATISTICS_STAGE.REDUCED_SAMPLES, required=True
             )
-        samples_cast = self._cast_table(samples_dataset, cast_mapping, alias="_raw_input_dataset")
         visit_count = self._build_visit_count(samples_cast)
         normalization_factor = self._build_normalization_factor(visit_count)
-        if self.timestamp_filtering:
-            timestamp_filtered = self._build_timestamp_filtered(normalization_factor)
+        # the prepared samples are self-joined on the pivot column, their most recent samples are ranked by based column
+        if self.timestamp_filtering and not self.recency_filter_first:
+            normalization_factor = self._materialize(
+                normalization_factor, constants.SCORING_STAGE.NORMALIZATION_FACTOR, cluster_by=self.based_column
+            )
+            recency_filtered = self._build_recency_filtered(normalization_factor)
+            return self._materialize(
+                recency_filtered, constants.SCORING_STAGE.PREPARED_SAMPLES, cluster_by=self.pivot_column
+            )
         else:
-            timestamp_filtered = normalization_factor
-        return timestamp_filtered
+            return self._materialize(
+                normalization_factor,
+                constants.SCORING_STAGE.PREPARED_SAMPLES,
+                constants.SCORING_STAGE.NORMALIZATION_FACTOR,
+                cluster_by=self.pivot_column,
+            )
 
-    def _build_collaborative_filtering(self, similarity, normalization_factor):
+    def _build_collaborative_filtering(self, similarity, normalization_factor, is_half_matrix=False):
+        if is_half_matrix:
+            similarity = self._build_full_similarity(similarity)
         row_numbers = self._build_row_numbers(similarity)
-        top_n = self._build_top_n(row_numbers)
+        top_n = self._materialize(
+            self._build_top_n(row_numbers), constants.SCORING_STAGE.TOP_N, cluster_by=f"{self.based_column}_2"
+        )
         cf_scores = self._build_sum_of_similarity_scores(top_n, normalization_factor)
+        if self.output_top_k:
+            ranked_scores = self._build_ranked_scores(cf_scores)
+            cf_scores = self._build_top_k_scores(ranked_scores, with_rank=self.output_nested_arrays)
+        if self.encode_ids:
+            cf_scores = self._decode_scores(cf_scores, with_rank=self.output_nested_arrays)
+        if self.output_nested_arrays:
+            cf_scores = self._build_nested_arrays(
+                cf_scores,
+                self.dku_config.users_column_name,
+                self.dku_config.items_column_name,
+                constants.SCORE_COLUMN_NAME,
+                self.SCORE_RANK_AS,
+            )
         return cf_scores
 
+    def _get_nb_scoring_buckets(self, nb_buckets):
+        """Number of buckets of the scoring query, the top K of a user needs all its scores in the same bucket"""
+        if self.output_top_k and not self.is_user_based and nb_buckets > 1:
+            logger.info("Scoring in a single bucket: the top K items of a user span all the item buckets")
+            return 1
+        return nb_buckets
+
+    def _stage_prepared_samples(self, prepared_samples):
+        """Staging table of the prepared samples, computed once for the join cost estimate and the joins reading them"""
+        if isinstance(prepared_samples, str):
+            staged_samples = SelectQuery()
+            staged_samples.select_from(prepared_samples)
+            staged_samples.select(Column("*"))
+            prepared_samples = staged_samples
+        logger.info("Staging the prepared samples")
+        return self._build_staging_tables(
+            OrderedDict([(constants.STAGING_STAGE.PREPARED_SAMPLES, prepared_samples)]),
+            self.file_manager.scored_samples_dataset,
+        )[0]
+
+    def _get_nb_execution_buckets(self, prepared_samples):
+        """Number of hash buckets of based entities to split the similarity and scoring queries into"""
+        execution_bucketing = self.dku_config.get("execution_bucketing") or constants.EXECUTION_BUCKETING.NONE
+        if execution_bucketing == constants.EXECUTION_BUCKETING.NONE:
+            return 1
+        if execution_bucketing == constants.EXECUTION_BUCKETING.FIXED:
+            return self.dku_config.nb_execution_buckets
+        estimated_joined_rows = self._estimate_joined_rows(prepared_samples)
+        nb_buckets = max(1, math.ceil(estimated_joined_rows / self.dku_config.max_joined_rows_per_bucket))
+        logger.info(f"Estimated {estimated_joined_rows} joined rows, using {nb_buckets} execution buckets")
+        return nb_buckets
+
+    def _estimate_joined_rows(self, prepared_samples):
+        """Number of rows read by the largest join of the similarity and scoring queries"""
+        join_cost = self._get_join_cost(prepared_samples)
+        return max(join_cost.joined_rows, join_cost.scoring_rows)
+
+    def _get_join_cost(self, prepared_samples):
+        """Cost of the joins of the prepared samples, estimated once and shared by the execution buckets and budget"""
+        if self.join_cost is None:
+            self.join_cost = self._estimate_join_cost(prepared_samples)
+            logger.info(
+                f"Prepared samples: {self.join_cost.joined_rows} joined rows, at most "
+                f"{self.join_cost.similarity_rows} similarity rows, about {self.join_cost.scoring_rows} scoring rows"
+            )
+        return self.join_cost
+
+    def _estimate_join_cost(self, select_from, select_from_as="_prepared_samples", pivot_count_as="_pivot_count"):
+        """Exact size of the self-join of the prepared samples on the pivot column, from a GROUP BY on the pivots
+
+        The prepared samples are the ones left after the recency filter, the visit thresholds and the caps. The
+        similarity has at most one row per joined pair of distinct based entities (kept once with the half matrix),
+        and the scoring joins the top N neighbours of each based entity with their samples, which is about N rows per
+        sample.
+        """
+        pivot_count = SelectQuery()
+        pivot_count.select_from(select_from, alias=select_from_as)
+        pivot_count.select(Column("*").count(), alias=self.NB_VISIT_AS)
+        pivot_count.group_by(Column(self.pivot_column, table_name=select_from_as))
+
+        join_cost = SelectQuery()
+        join_cost.select_from(pivot_count, alias=pivot_count_as)
+        nb_visit = Column(self.NB_VISIT_AS, table_name=pivot_count_as)
+        join_cost.select(nb_visit.times(nb_visit).sum(), alias=self.JOINED_ROWS_AS)
+        join_cost.select(nb_visit.sum(), alias=self.NB_VISIT_AS)
+
+        join_cost_df = self._query_to_df(join_cost, self.file_manager.scored_samples_dataset)
+        joined_rows, nb_samples = [int(value or 0) for value in join_cost_df.iloc[0]]
+        similarity_rows = joined_rows - nb_samples
+        if self.use_half_matrix:
+            similarity_rows //= 2
+        return JoinCost(joined_rows, similarity_rows, self.dku_config.top_n_most_similar * nb_samples)
+
     def _get_normalization_factor_formula(self, partition_column, rating_column):
         logger.debug("Using L2 normalization")
         return Constant(1).div(
             rating_column.times(rating_column).sum().over(Window(partition_by=[partition_column], mode=None)).sqrt()
         )
 
-    def _get_similarity_formula(self):
+    def _round_similarity(self, similarity):
         rounding_decimals = 15
         rounding_expression = Constant(10 ** rounding_decimals)
         logger.debug(f"Rounding similarity to {rounding_decimals} decimals")
+        return similarity.times(rounding_expression).round().div(rounding_expression)
 
+    def _get_similarity_formula(self):
         if self.use_explicit:
             # compute Pearson correlation
             rating_product = (
@@ -364,13 +941,10 @@ class ScoringHandler(QueryHandler):
         else:
             rating_product = Constant(1)
 
-        return (
+        return self._round_similarity(
             rating_product.times(Column(self.NORMALIZATION_FACTOR_AS, table_name=self.LEFT_NORMALIZATION_FACTOR_AS))
             .times(Column(self.NORMALIZATION_FACTOR_AS, table_name=self.RIGHT_NORMALIZATION_FACTOR_AS))
             .sum()
-            .times(rounding_expression)
-            .round()
-            .div(rounding_expression)
         )
 
     def _get_user_item_similarity_formula(self, similarity_table, samples_table):
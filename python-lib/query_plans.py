@@ -0,0 +1,261 @@
+from collections import Counter, namedtuple
+from dku_constants import PLAN_FORMAT, PLAN_ANTI_PATTERN
+import xml.etree.ElementTree as ElementTree
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# operations of the plan nodes, shared by all plan formats
+SCAN = "scan"
+NESTED_LOOP = "nested_loop"
+JOIN = "join"
+CARTESIAN_JOIN = "cartesian_join"
+SORT = "sort"
+OTHER = "other"
+
+# a relation scanned more often than this is flagged, the similarity self-join reads its samples twice by design
+MAX_SCANS_PER_RELATION = 2
+
+# how the null-safe equality of Column.eq_null_unsafe shows in the join conditions of the plans
+NULL_SAFE_CONDITION = re.compile(r"DISTINCT FROM|IS NULL|EQUAL_NULL", flags=re.IGNORECASE)
+
+PlanNode = namedtuple("PlanNode", ["operation", "name", "relation", "rows", "condition", "children"])
+PlanFinding = namedtuple("PlanFinding", ["anti_pattern", "detail"])
+
+_SHOWPLAN_NAMESPACE = {"s": "http://schemas.microsoft.com/sqlserver/2004/07/showplan"}
+
+_POSTGRES_OPERATIONS = {
+    "Seq Scan": SCAN,
+    "Index Scan": SCAN,
+    "Index Only Scan": SCAN,
+    "Bitmap Heap Scan": SCAN,
+    "Nested Loop": NESTED_LOOP,
+    "Hash Join": JOIN,
+    "Merge Join": JOIN,
+    "Sort": SORT,
+    "Incremental Sort": SORT,
+}
+_SNOWFLAKE_OPERATIONS = {
+    "TableScan": SCAN,
+    "InnerJoin": JOIN,
+    "LeftOuterJoin": JOIN,
+    "RightOuterJoin": JOIN,
+    "FullOuterJoin": JOIN,
+    "LeftSemiJoin": JOIN,
+    "LeftAntiJoin": JOIN,
+    "CartesianJoin": CARTESIAN_JOIN,
+    "Sort": SORT,
+}
+_SHOWPLAN_OPERATIONS = {
+    "Table Scan": SCAN,
+    "Index Scan": SCAN,
+    "Clustered Index Scan": SCAN,
+    "Index Seek": SCAN,
+    "Clustered Index Seek": SCAN,
+    "Nested Loops": NESTED_LOOP,
+    "Merge Join": JOIN,
+    "Sort": SORT,
+}
+
+
+class QueryPlans:
+    """Plans of the queries of a recipe run and the anti-patterns found in them
+
+    Each plan is kept with the SQL it explains, as returned by the dialect's EXPLAIN (or the error raised by it), and
+    is parsed into PlanNode trees when its format is known. get_files lists the files to write in the query plans
+    folder: the SQL and plan of each query and a summary.json of the findings, under a directory per run.
+    """
+
+    def __init__(self, run_id, config_hash, plan_format=None):
+        self.run_id = run_id
+        self.config_hash = config_hash
+        self.plan_format = plan_format
+        self.plans = []
+
+    def add_plan(self, stage, query, plan=None, bucket=None, error=None):
+        """Record the plan of a query and return the anti-patterns found in it"""
+        findings = []
+        if plan is not None and self.plan_format is not None:
+            try:
+                findings = find_anti_patterns(parse_plan(plan, self.plan_format))
+            except (ValueError, KeyError, ElementTree.ParseError) as parse_error:
+                logger.warning(f"Could not analyze the plan of the {stage} query: {parse_error}")
+        for finding in findings:
+            logger.warning(f"Plan of the {stage} query: {finding.anti_pattern.value}, {finding.detail}")
+        self.plans.append(
+            {"stage": stage, "bucket": bucket, "query": query, "plan": plan, "error": error, "findings": findings}
+        )
+        return findings
+
+    def get_files(self):
+        """Dict of the content of the files to write by path in the folder"""
+        files = {}
+        summary = {"run_id": self.run_id, "config_hash": self.config_hash, "queries": []}
+        is_json = self.plan_format in (PLAN_FORMAT.POSTGRES_JSON, PLAN_FORMAT.SNOWFLAKE_JSON)
+        plan_extension = "json" if is_json else "xml"
+        for index, plan in enumerate(self.plans):
+            name = f"{index:03d}_{plan['stage']}"
+            if plan["bucket"] is not None:
+                name += f"_b{plan['bucket']}"
+            files[f"{self.run_id}/{name}.sql"] = plan["query"]
+            if plan["plan"] is not None:
+                files[f"{self.run_id}/{name}.plan.{plan_extension}"] = plan["plan"]
+            summary["queries"].append(
+                {
+                    "name": name,
+                    "stage": plan["stage"],
+                    "bucket": plan["bucket"],
+                    "error": plan["error"],
+                    "findings": [
+                        {"anti_pattern": finding.anti_pattern.value, "detail": finding.detail}
+                        for finding in plan["findings"]
+                    ],
+                }
+            )
+        files[f"{self.run_id}/summary.json"] = json.dumps(summary, indent=2)
+        return files
+
+
+def parse_plan(plan, plan_format):
+    """List of the root PlanNode of a plan returned by EXPLAIN, empty for the formats which are only stored"""
+    if plan_format == PLAN_FORMAT.POSTGRES_JSON:
+        return [_parse_postgres_node(statement["Plan"]) for statement in json.loads(plan)]
+    if plan_format == PLAN_FORMAT.SNOWFLAKE_JSON:
+        return _parse_snowflake_operations(json.loads(plan))
+    if plan_format == PLAN_FORMAT.SHOWPLAN_XML:
+        root = ElementTree.fromstring(plan)
+        return [
+            _parse_showplan_node(rel_op)
+            for query_plan in root.iterfind(".//s:QueryPlan", _SHOWPLAN_NAMESPACE)
+            for rel_op in query_plan.iterfind("s:RelOp", _SHOWPLAN_NAMESPACE)
+        ]
+    return []
+
+
+def find_anti_patterns(roots):
+    """List of the PlanFinding of the plan trees
+
+    - nested loops (or cartesian joins) whose condition is a null-safe equality, which prevents hash and merge joins
+    - relations scanned more than MAX_SCANS_PER_RELATION times, a subquery repeated instead of computed once
+    - sorts of as many rows as the largest join of the plan, such as a window over the whole similarity matrix
+    - joins without condition between inputs of more than one row
+    """
+    nodes = list(_iter_nodes(roots))
+    findings = []
+    for node in nodes:
+        is_null_safe = node.condition is not None and NULL_SAFE_CONDITION.search(node.condition)
+        if node.operation in (NESTED_LOOP, CARTESIAN_JOIN) and is_null_safe:
+            findings.append(
+                PlanFinding(
+                    PLAN_ANTI_PATTERN.NULL_SAFE_NESTED_LOOP,
+                    f"{node.name} on the null-safe condition {node.condition}",
+                )
+            )
+        elif node.operation == CARTESIAN_JOIN or (node.operation == NESTED_LOOP and node.condition is None):
+            if not any(child.rows is not None and child.rows <= 1 for child in node.children):
+                findings.append(
+                    PlanFinding(PLAN_ANTI_PATTERN.CARTESIAN_PRODUCT, f"{node.name} of {_format_rows(node)} rows")
+                )
+
+    scans = Counter(node.relation for node in nodes if node.operation == SCAN and node.relation)
+    for relation, nb_scans in scans.items():
+        if nb_scans > MAX_SCANS_PER_RELATION:
+            findings.append(PlanFinding(PLAN_ANTI_PATTERN.REPEATED_SCAN, f"{relation} is scanned {nb_scans} times"))
+
+    join_rows = [node.rows for node in nodes if node.operation in (JOIN, NESTED_LOOP, CARTESIAN_JOIN) and node.rows]
+    if join_rows:
+        largest_join_rows = max(join_rows)
+        for node in nodes:
+            if node.operation == SORT and node.rows is not None and node.rows >= largest_join_rows:
+                findings.append(
+                    PlanFinding(
+                        PLAN_ANTI_PATTERN.FULL_MATRIX_SORT,
+                        f"{node.name} of {_format_rows(node)} rows, the whole output of the largest join",
+                    )
+                )
+    return findings
+
+
+def _iter_nodes(nodes):
+    for node in nodes:
+        yield node
+        yield from _iter_nodes(node.children)
+
+
+def _format_rows(node):
+    return "an unknown number of" if node.rows is None else f"about {node.rows:.0f}"
+
+
+def _parse_postgres_node(node):
+    children = [_parse_postgres_node(child) for child in node.get("Plans", [])]
+    operation = _POSTGRES_OPERATIONS.get(node["Node Type"], OTHER)
+    condition = node.get("Hash Cond") or node.get("Merge Cond") or node.get("Join Filter")
+    if operation == NESTED_LOOP and condition is None and len(node.get("Plans", [])) == 2:
+        # the condition of a parameterized nested loop is the index condition of its inner side
+        condition = _find_postgres_index_condition(node["Plans"][1])
+    relation = node.get("Relation Name")
+    if relation and node.get("Schema"):
+        relation = f"{node['Schema']}.{relation}"
+    return PlanNode(operation, node["Node Type"], relation, node.get("Plan Rows"), condition, children)
+
+
+def _find_postgres_index_condition(node):
+    if node.get("Index Cond") or node.get("Recheck Cond"):
+        return node.get("Index Cond") or node.get("Recheck Cond")
+    for child in node.get("Plans", []):
+        condition = _find_postgres_index_condition(child)
+        if condition:
+            return condition
+    return None
+
+
+def _parse_snowflake_operations(plan):
+    """Operations of a Snowflake EXPLAIN USING JSON, linked to their parent by parentOperators (no row estimates)"""
+    operations = [operation for step in plan.get("Operations", []) for operation in step]
+    children_ids = {}
+    roots = []
+    for operation in operations:
+        parents = operation.get("parentOperators") or ([operation["parent"]] if "parent" in operation else [])
+        for parent in parents:
+            children_ids.setdefault(parent, []).append(operation["id"])
+        if not parents:
+            roots.append(operation["id"])
+    operations_by_id = {operation["id"]: operation for operation in operations}
+
+    def parse_operation(operation_id):
+        operation = operations_by_id[operation_id]
+        children = [parse_operation(child_id) for child_id in children_ids.get(operation_id, [])]
+        expressions = operation.get("expressions") or []
+        join_expressions = [expression for expression in expressions if expression.startswith("join")]
+        condition = "; ".join(join_expressions) or None
+        objects = operation.get("objects") or []
+        relation = objects[0] if objects else None
+        name = operation["operation"]
+        return PlanNode(_SNOWFLAKE_OPERATIONS.get(name, OTHER), name, relation, None, condition, children)
+
+    return [parse_operation(root_id) for root_id in roots]
+
+
+def _parse_showplan_node(rel_op):
+    """RelOp element of a SQL Server XML showplan, its children are the RelOp of its operator element"""
+    physical_op = rel_op.get("PhysicalOp")
+    operation = _SHOWPLAN_OPERATIONS.get(physical_op, OTHER)
+    if physical_op == "Hash Match" and "Join" in rel_op.get("LogicalOp", ""):
+        operation = JOIN
+    if rel_op.find("s:Warnings[@NoJoinPredicate='true']", _SHOWPLAN_NAMESPACE) is not None:
+        operation = CARTESIAN_JOIN
+    children = [_parse_showplan_node(child) for child in rel_op.iterfind("*/s:RelOp", _SHOWPLAN_NAMESPACE)]
+    condition = None
+    for path in ("*/s:Predicate//s:ScalarOperator", "*/s:ProbeResidual//s:ScalarOperator", "*/s:OuterReferences"):
+        element = rel_op.find(path, _SHOWPLAN_NAMESPACE)
+        if element is not None:
+            condition = element.get("ScalarString") or "outer references"
+            break
+    relation = None
+    table = rel_op.find("*/s:Object", _SHOWPLAN_NAMESPACE)
+    if operation == SCAN and table is not None:
+        relation = ".".join(filter(None, [table.get("Schema"), table.get("Table")]))
+    rows = float(rel_op.get("EstimateRows")) if rel_op.get("EstimateRows") else None
+    return PlanNode(operation, physical_op, relation, rows, condition, children)
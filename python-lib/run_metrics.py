@@ -0,0 +1,103 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+import pandas as pd
+import hashlib
+import json
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+StageMetrics = namedtuple(
+    "StageMetrics", ["stage", "bucket", "input_stage", "wall_time", "rows_in", "rows_out", "bytes"]
+)
+
+METRICS_SCHEMA = [
+    {"name": "run_id", "type": "string"},
+    {"name": "config_hash", "type": "string"},
+    {"name": "recipe", "type": "string"},
+    {"name": "run_start", "type": "string"},
+    {"name": "stage", "type": "string"},
+    {"name": "bucket", "type": "bigint"},
+    {"name": "wall_time_s", "type": "double"},
+    {"name": "stage_wall_time_s", "type": "double"},
+    {"name": "rows_in", "type": "bigint"},
+    {"name": "rows_out", "type": "bigint"},
+    {"name": "bytes", "type": "bigint"},
+]
+
+
+def get_config_hash(config):
+    """Short deterministic hash of the parameters of a recipe (dict of parameter values by name)"""
+    serialized_config = json.dumps({name: str(value) for name, value in config.items()}, sort_keys=True)
+    return hashlib.sha1(serialized_config.encode()).hexdigest()[:12]
+
+
+class RunMetrics:
+    """Wall time, number of rows and bytes of the stages of a recipe run, keyed by run ID and config hash
+
+    Stages are either executed queries (whose rows out and bytes are those of the output table) or profiled query
+    stages. A profiled stage is computed with the stages it reads from, stage_wall_time_s subtracts the wall time of
+    its input stage (when it was profiled) to isolate its own cost.
+    """
+
+    def __init__(self, recipe, config):
+        self.recipe = recipe
+        self.run_id = uuid.uuid4().hex
+        self.config_hash = get_config_hash(config)
+        self.run_start = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.stages = []
+
+    def add_stage(self, stage, wall_time, rows_out=None, nb_bytes=None, bucket=None, input_stage=None):
+        """Record the metrics of a stage, its rows in are the rows out of its input stage when it was recorded"""
+        input_metrics = self._get_input_metrics(input_stage, bucket)
+        rows_in = input_metrics.rows_out if input_metrics is not None else None
+        logger.info(f"Stage '{stage}' (bucket {bucket}): {wall_time:.2f}s, {rows_in} rows in, {rows_out} rows out")
+        self.stages.append(StageMetrics(stage, bucket, input_stage, wall_time, rows_in, rows_out, nb_bytes))
+
+    def to_dataframe(self):
+        """One row per stage with the METRICS_SCHEMA columns"""
+        rows = []
+        for metrics in self.stages:
+            input_metrics = self._get_input_metrics(metrics.input_stage, metrics.bucket)
+            stage_wall_time = metrics.wall_time
+            if input_metrics is not None:
+                stage_wall_time = max(metrics.wall_time - input_metrics.wall_time, 0.0)
+            rows.append(
+                {
+                    "run_id": self.run_id,
+                    "config_hash": self.config_hash,
+                    "recipe": self.recipe,
+                    "run_start": self.run_start,
+                    "stage": metrics.stage,
+                    "bucket": metrics.bucket,
+                    "wall_time_s": metrics.wall_time,
+                    "stage_wall_time_s": stage_wall_time,
+                    "rows_in": metrics.rows_in,
+                    "rows_out": metrics.rows_out,
+                    "bytes": metrics.bytes,
+                }
+            )
+        metrics_df = pd.DataFrame(rows, columns=[column["name"] for column in METRICS_SCHEMA])
+        for column in ["bucket", "rows_in", "rows_out", "bytes"]:
+            metrics_df[column] = metrics_df[column].astype("Int64")
+        return metrics_df
+
+    def get_metric_values(self):
+        """Flat dict of the metrics summed over the buckets of each stage, to save as DSS metrics"""
+        metric_values = {"reco_run_id": self.run_id, "reco_config_hash": self.config_hash}
+        for metrics in self.stages:
+            values = {"wall_time_s": metrics.wall_time, "rows_out": metrics.rows_out, "bytes": metrics.bytes}
+            for name, value in values.items():
+                if value is not None:
+                    key = f"reco_{metrics.stage}_{name}"
+                    metric_values[key] = metric_values.get(key, 0) + value
+        return metric_values
+
+    def _get_input_metrics(self, input_stage, bucket):
+        """Metrics of the input stage in the same bucket, or computed once for all buckets"""
+        for input_bucket in (bucket, None):
+            for metrics in self.stages:
+                if input_stage is not None and metrics.stage == input_stage and metrics.bucket == input_bucket:
+                    return metrics
+        return None
@@ -0,0 +1,5 @@
+from spark_handlers.spark_handler import SparkHandler
+from spark_handlers.spark_scoring_handler import SparkScoringHandler
+from spark_handlers.spark_auto_scoring_handler import SparkAutoScoringHandler
+from spark_handlers.spark_custom_scoring_handler import SparkCustomScoringHandler
+from spark_handlers.spark_sampling_handler import SparkSamplingHandler
@@ -0,0 +1,49 @@
+from spark_handlers.spark_scoring_handler import SparkScoringHandler
+import dku_constants as constants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SparkAutoScoringHandler(SparkScoringHandler):
+    """Auto collaborative filtering computed with Spark, producing the same outputs as the AutoScoringHandler"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_user_based = self.dku_config.collaborative_filtering_method == constants.CF_METHOD.USER_BASED
+        self._assign_scoring_mode(self.is_user_based)
+        self.output_similarity_matrix = self.file_manager.similarity_scores_dataset is not None
+
+    def build(self):
+        samples = self._read_samples()
+        prepared_samples = self._prepare_samples(samples)
+        similarity = self._build_similarity(prepared_samples)
+        if self.output_similarity_matrix:
+            logger.info("About to compute similarity matrix ...")
+            # the similarity is both written and read by the scoring, it is computed once
+            similarity = similarity.persist()
+            self._write_similarity(similarity)
+        cf_scores = self._build_collaborative_filtering(similarity, prepared_samples, samples, is_half_matrix=True)
+        self._write_scores(cf_scores)
+
+    def _write_similarity(self, similarity):
+        similarity_dataset = self.file_manager.similarity_scores_dataset
+        if self.dku_config.full_similarity_matrix:
+            similarity = self._build_full_similarity(similarity)
+        renaming_mapping = {
+            self.based_1: f"{self.based_column}_1",
+            self.based_2: f"{self.based_column}_2",
+            constants.SIMILARITY_COLUMN_NAME: constants.SIMILARITY_COLUMN_NAME,
+        }
+        self._write_dataset(similarity, similarity_dataset, renaming_mapping)
+        self._set_column_description(similarity_dataset, constants.SIMILARITY_COLUMN_NAME)
+
+    def _get_column_descriptions(self, column_name):
+        cf_based_on = "user" if self.is_user_based else "item"
+        if column_name == constants.SCORE_COLUMN_NAME:
+            description = f"User-item affinity scores (using {cf_based_on}-based collaborative filtering)"
+        else:
+            description = f"Similarity between {cf_based_on}s (higher means more similar)"
+            if not self.dku_config.full_similarity_matrix:
+                description += f", each pair is stored once with {cf_based_on} 1 < {cf_based_on} 2"
+        return {column_name: description}
@@ -0,0 +1,56 @@
+from spark_handlers.spark_scoring_handler import SparkScoringHandler
+from pyspark.sql import functions as F
+import dku_constants as constants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SparkCustomScoringHandler(SparkScoringHandler):
+    """Custom collaborative filtering computed with Spark, producing the same outputs as the CustomScoringHandler"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_user_based = self.dku_config.similarity_scores_type == constants.SIMILARITY_TYPE.USER_SIMILARITY
+        self._assign_scoring_mode(self.is_user_based)
+
+    def _read_similarity(self):
+        cast_mapping = {
+            self.dku_config.similarity_column_1_name: "string",
+            self.dku_config.similarity_column_2_name: "string",
+            self.dku_config.similarity_score_column_name: "double",
+        }
+        renaming_mapping = {
+            self.dku_config.similarity_column_1_name: self.based_1,
+            self.dku_config.similarity_column_2_name: self.based_2,
+            self.dku_config.similarity_score_column_name: constants.SIMILARITY_COLUMN_NAME,
+        }
+        return self._read_dataset(self.file_manager.similarity_scores_dataset, cast_mapping, renaming_mapping)
+
+    def build(self):
+        samples = self._read_samples()
+        prepared_samples = self._prepare_samples(samples)
+        similarity = self._read_similarity()
+        cf_scores = self._build_collaborative_filtering(
+            similarity,
+            prepared_samples,
+            samples,
+            is_half_matrix=self._is_half_similarity_matrix(similarity),
+        )
+        self._write_scores(cf_scores)
+
+    def _is_half_similarity_matrix(self, similarity):
+        """Whether each pair is stored once: when checked, or when no pair has column 1 > column 2"""
+        if self.dku_config.half_similarity_matrix:
+            return True
+        is_half_matrix = similarity.filter(F.col(self.based_1) > F.col(self.based_2)).limit(1).count() == 0
+        if is_half_matrix:
+            logger.info("No pair of the similarity has column 1 > column 2, each pair is read as stored once")
+        return is_half_matrix
+
+    def _get_column_descriptions(self, column_name=None):
+        cf_based_on = "user" if self.is_user_based else "item"
+        description = (
+            f"User-item affinity scores (using {cf_based_on}-based collaborative filtering with custom similarity)"
+        )
+        return {constants.SCORE_COLUMN_NAME: description}
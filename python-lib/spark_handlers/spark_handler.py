@@ -0,0 +1,113 @@
+from pyspark.sql import SparkSession, Window, functions as F
+from pyspark.sql.types import StructType, StructField, StringType
+from dku_utils import set_column_description
+import dku_constants as constants
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def quote_column(column_name):
+    """Column of a DataFrame by its exact name, dataset column names can hold dots"""
+    return F.col("`" + column_name.replace("`", "``") + "`")
+
+
+class SparkHandler:
+    """Base of the handlers computing the stages of the SQL recipes with Spark DataFrames, for datasets of any type
+
+    Parquet datasets located by a URI of a file system of the Spark session (hdfs://, s3a://...) are read by Spark
+    directly, the other datasets through the dataset API. The columns are renamed to internal names when read, and
+    back to the names of the recipe's columns when written. The outputs are written through the dataset API, by
+    chunks of rows collected from one Spark partition at a time.
+    """
+
+    APP_NAME = "recommendation-system"
+    CHUNK_SIZE = 100000
+    USERS_AS = "_users"
+    ITEMS_AS = "_items"
+
+    def __init__(self, dku_config, file_manager):
+        self.dku_config = dku_config
+        self.file_manager = file_manager
+        self.spark = self._get_spark_session()
+
+    def build(self):
+        raise NotImplementedError()
+
+    def _get_spark_session(self):
+        builder = SparkSession.builder.appName(self.APP_NAME)
+        if self.dku_config.get("spark_master"):
+            builder = builder.master(self.dku_config.spark_master)
+        return builder.getOrCreate()
+
+    def _read_dataset(self, dataset, cast_mapping, renaming_mapping):
+        """Columns of cast_mapping of the dataset, cast to their Spark type and renamed with renaming_mapping"""
+        location_info = dataset.get_location_info().get("info", {})
+        path = location_info.get("path") or ""
+        if dataset.get_config().get("formatType") == "parquet" and "://" in path:
+            logger.info(f"Reading dataset {dataset.name} with Spark from {path}")
+            df = self.spark.read.parquet(path)
+        else:
+            logger.info(f"Reading dataset {dataset.name} through the dataset API")
+            df = self._create_dataframe(dataset.get_dataframe(columns=list(cast_mapping)))
+        return df.select(
+            [
+                quote_column(column_name).cast(spark_type).alias(renaming_mapping[column_name])
+                for column_name, spark_type in cast_mapping.items()
+            ]
+        )
+
+    def _create_dataframe(self, df):
+        """Spark DataFrame of the pandas DataFrame df, with all values as strings to be cast in Spark like in SQL"""
+        schema = StructType([StructField(str(column_name), StringType()) for column_name in df.columns])
+        rows = [
+            [None if pd.isna(value) else str(value) for value in row] for row in df.itertuples(index=False, name=None)
+        ]
+        return self.spark.createDataFrame(rows, schema=schema)
+
+    def _get_spark_type(self, dataset, column_name):
+        dss_type = next((column["type"] for column in dataset.read_schema() if column["name"] == column_name), "string")
+        return constants.DSS_TO_SPARK_TYPES.get(dss_type, "string")
+
+    def _write_dataset(self, df, output_dataset, renaming_mapping):
+        """Write the DataFrame df in output_dataset, its columns renamed with renaming_mapping"""
+        df = df.select([F.col(column_name).alias(renaming_mapping[column_name]) for column_name in df.columns])
+        output_dataset.write_schema(
+            [
+                {"name": field.name, "type": constants.SPARK_TO_DSS_TYPES.get(field.dataType.simpleString(), "string")}
+                for field in df.schema.fields
+            ]
+        )
+        nb_rows = 0
+        with output_dataset.get_writer() as writer:
+            for chunk in self._iter_chunks(df):
+                writer.write_dataframe(chunk)
+                nb_rows += len(chunk)
+        logger.info(f"Wrote {nb_rows} rows to dataset {output_dataset.name}")
+
+    def _iter_chunks(self, df):
+        """pandas DataFrames of at most CHUNK_SIZE rows of df, holding one Spark partition at a time in the driver"""
+        rows = []
+        for row in df.toLocalIterator():
+            rows.append(tuple(row))
+            if len(rows) == self.CHUNK_SIZE:
+                yield pd.DataFrame.from_records(rows, columns=df.columns)
+                rows = []
+        if rows:
+            yield pd.DataFrame.from_records(rows, columns=df.columns)
+
+    def _add_row_number(self, df, alias, partition_columns, order_columns):
+        """Add the row number of each row in the window of partition_columns, ordered by order_columns
+
+        df is repartitioned by partition_columns first, so that the window and the stages after it reuse the same
+        partitioning instead of shuffling the rows again.
+        """
+        window = Window.partitionBy(*partition_columns).orderBy(*order_columns)
+        return df.repartition(*partition_columns).withColumn(alias, F.row_number().over(window))
+
+    def _set_column_description(self, output_dataset, column_name=None):
+        set_column_description(output_dataset, self._get_column_descriptions(column_name))
+
+    def _get_column_descriptions(self, column_name):
+        raise NotImplementedError()
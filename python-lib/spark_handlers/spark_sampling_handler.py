@@ -0,0 +1,142 @@
+from spark_handlers.spark_handler import SparkHandler
+from pyspark.sql import functions as F
+from functools import reduce
+import dku_constants as constants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SparkSamplingHandler(SparkHandler):
+    """Sampling computed with Spark, producing the same outputs as the SamplingHandler"""
+
+    IS_TRAINING_SAMPLE = "_is_training_sample"
+    IS_SCORE_SAMPLE = "_is_score_sample"
+    SCORE_SAMPLE = "score_sample"
+    ROW_NUMBER_AS = "_row_number"
+    NB_POSITIVE_PER_USER = "nb_positive_per_user"
+    JOINED_USERS_AS = "_joined_users"
+    JOINED_ITEMS_AS = "_joined_items"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.has_historical_data = bool(
+            self.file_manager.historical_samples_dataset and self.dku_config.historical_samples
+        )
+        self.sample_keys = [self.USERS_AS, self.ITEMS_AS]
+        self.score_columns = [f"_score_{index}" for index in range(len(self.dku_config.score_column_names))]
+
+    def _read_samples(self, dataset, users_column_name, items_column_name):
+        cast_mapping = {users_column_name: "string", items_column_name: "string"}
+        renaming_mapping = {users_column_name: self.USERS_AS, items_column_name: self.ITEMS_AS}
+        return self._read_dataset(dataset, cast_mapping, renaming_mapping)
+
+    def _read_scored_samples(self):
+        cast_mapping = {self.dku_config.users_column_name: "string", self.dku_config.items_column_name: "string"}
+        renaming_mapping = {
+            self.dku_config.users_column_name: self.USERS_AS,
+            self.dku_config.items_column_name: self.ITEMS_AS,
+        }
+        for score_column_name, score_column in zip(self.dku_config.score_column_names, self.score_columns):
+            cast_mapping[score_column_name] = "double"
+            renaming_mapping[score_column_name] = score_column
+        return self._read_dataset(self.file_manager.scored_samples_dataset, cast_mapping, renaming_mapping)
+
+    def _left_join_samples(self, scores, samples, flag_column):
+        """Left join of the samples on the sample keys (null-safe), flagging the scores of a sample with 1"""
+        samples = samples.select(
+            F.col(self.USERS_AS).alias(self.JOINED_USERS_AS),
+            F.col(self.ITEMS_AS).alias(self.JOINED_ITEMS_AS),
+            F.lit(1).alias(flag_column),
+        )
+        same_users = F.col(self.USERS_AS).eqNullSafe(F.col(self.JOINED_USERS_AS))
+        same_items = F.col(self.ITEMS_AS).eqNullSafe(F.col(self.JOINED_ITEMS_AS))
+        join_condition = same_users & same_items
+        return scores.join(samples, join_condition, "left").drop(self.JOINED_USERS_AS, self.JOINED_ITEMS_AS)
+
+    def _build_all_cf_scores_with_target(self, scored_samples, training_samples, historical_samples=None):
+        not_null_condition = reduce(
+            lambda left, right: left | right, [F.col(score_column).isNotNull() for score_column in self.score_columns]
+        )
+        all_cf_scores = self._left_join_samples(
+            scored_samples.where(not_null_condition), training_samples, self.IS_TRAINING_SAMPLE
+        )
+        columns_to_select = self.sample_keys + self.score_columns
+        columns_to_select.append(
+            F.coalesce(F.col(self.IS_TRAINING_SAMPLE), F.lit(0)).cast("int").alias(constants.TARGET_COLUMN_NAME)
+        )
+        if historical_samples is not None:
+            all_cf_scores = self._left_join_samples(all_cf_scores, historical_samples, self.IS_SCORE_SAMPLE)
+            columns_to_select.append(
+                F.coalesce(F.col(self.IS_SCORE_SAMPLE), F.lit(0)).cast("int").alias(self.SCORE_SAMPLE)
+            )
+        return all_cf_scores.select(columns_to_select)
+
+    def _build_remove_historical_samples(self, all_cf_scores_with_target):
+        unseen_samples_condition = (F.col(constants.TARGET_COLUMN_NAME) == 1) | (F.col(self.SCORE_SAMPLE) == 0)
+        columns_to_select = self.sample_keys + [constants.TARGET_COLUMN_NAME] + self.score_columns
+        return all_cf_scores_with_target.where(unseen_samples_condition).select(columns_to_select)
+
+    def _build_filtered_with_perc(self, samples):
+        """All the positive samples and, for each user, enough negative samples to make up the negative percentage"""
+        ratio = float(self.dku_config.negative_samples_percentage / 100.0)
+        nb_positive_per_user = (
+            samples.where(F.col(constants.TARGET_COLUMN_NAME) == 1)
+            .groupBy(self.USERS_AS)
+            .agg(F.count(F.lit(1)).alias(self.NB_POSITIVE_PER_USER))
+            .withColumnRenamed(self.USERS_AS, self.JOINED_USERS_AS)
+        )
+        samples_with_all_infos = samples.join(
+            nb_positive_per_user, F.col(self.USERS_AS).eqNullSafe(F.col(self.JOINED_USERS_AS)), "left"
+        ).drop(self.JOINED_USERS_AS)
+        samples_with_all_infos = self._add_row_number(
+            samples_with_all_infos,
+            self.ROW_NUMBER_AS,
+            [self.USERS_AS, constants.TARGET_COLUMN_NAME],
+            [F.col(constants.TARGET_COLUMN_NAME).desc()],
+        )
+        nb_negative_threshold = F.ceil(F.col(self.NB_POSITIVE_PER_USER) * ratio / (1 - ratio))
+        filtered_samples = samples_with_all_infos.where(
+            (F.col(constants.TARGET_COLUMN_NAME) == 1) | (F.col(self.ROW_NUMBER_AS) <= nb_negative_threshold)
+        )
+        return filtered_samples.select(self.sample_keys + self.score_columns + [constants.TARGET_COLUMN_NAME])
+
+    def build(self):
+        training_samples = self._read_samples(
+            self.file_manager.training_samples_dataset,
+            self.dku_config.training_samples_users_column_name,
+            self.dku_config.training_samples_items_column_name,
+        )
+        if self.has_historical_data:
+            historical_samples = self._read_samples(
+                self.file_manager.historical_samples_dataset,
+                self.dku_config.historical_samples_users_column_name,
+                self.dku_config.historical_samples_items_column_name,
+            )
+        else:
+            historical_samples = None
+
+        samples = self._build_all_cf_scores_with_target(
+            self._read_scored_samples(), training_samples, historical_samples
+        )
+        if self.has_historical_data:
+            samples = self._build_remove_historical_samples(samples)
+        if self.dku_config.sampling_method == constants.SAMPLING_METHOD.NEGATIVE_SAMPLING_PERC:
+            logger.debug("Using stratified negative sampling method")
+            samples = self._build_filtered_with_perc(samples)
+        else:
+            logger.debug("Using no sampling method")
+
+        renaming_mapping = {
+            self.USERS_AS: self.dku_config.users_column_name,
+            self.ITEMS_AS: self.dku_config.items_column_name,
+            constants.TARGET_COLUMN_NAME: constants.TARGET_COLUMN_NAME,
+            self.SCORE_SAMPLE: self.SCORE_SAMPLE,
+        }
+        renaming_mapping.update(zip(self.score_columns, self.dku_config.score_column_names))
+        positive_negative_samples_dataset = self.file_manager.positive_negative_samples_dataset
+        self._write_dataset(samples, positive_negative_samples_dataset, renaming_mapping)
+        self._set_column_description(positive_negative_samples_dataset)
+
+    def _get_column_descriptions(self, column_name=None):
+        return {constants.TARGET_COLUMN_NAME: "Positive or negative samples"}
@@ -0,0 +1,330 @@
+from spark_handlers.spark_handler import SparkHandler
+from pyspark.sql import Window, functions as F
+from functools import reduce
+import dku_constants as constants
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SparkScoringHandler(SparkHandler):
+    """Base of the Spark collaborative filtering handlers, computing the stages of the ScoringHandler with DataFrames
+
+    Same semantics as the SQL stages: visit counts and rating averages on all the samples, visit thresholds and caps,
+    L2 normalization, most recent samples, similarity as the sum over the pivots joined null-safely, top N most
+    similar entities and their scores. The similarity is computed once per pair (col_1 < col_2) and mirrored when
+    needed, the rows of the skewed pivots are salted in the self-join, the top N neighbours are broadcast when joined
+    with the samples if small enough, and the DataFrames are repartitioned by the partition of each window rank.
+    Above the visit caps, the samples are downsampled by xxhash64 instead of the hash function of the SQL dialect,
+    so each engine keeps a different sample of the same size.
+    """
+
+    RATINGS_AS = "_ratings"
+    TIMESTAMPS_AS = "_timestamps"
+    NB_VISIT_USER_AS = "_nb_visit_user"
+    NB_VISIT_ITEM_AS = "_nb_visit_item"
+    USER_VISIT_RANK_AS = "_user_visit_rank"
+    ITEM_VISIT_RANK_AS = "_item_visit_rank"
+    RATING_AVERAGE = "_rating_average"
+    NORMALIZATION_FACTOR_AS = "_normalization_factor"
+    TIMESTAMP_FILTERED_ROW_NB = "_timestamp_filtered_row_nb"
+    LAST_RATED_ROW_NB = "_last_rated_row_nb"
+    ROW_NUMBER_AS = "_row_number"
+    SCORE_RANK_AS = "_score_rank"
+    IS_SKEWED_AS = "_is_skewed"
+    SALT_AS = "_salt"
+    NB_VISIT_AS = "_nb_visit"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.duplicates_reducer = self.dku_config.get("duplicates_reducer") or constants.DUPLICATES_REDUCER.NONE
+        # the presence of distinct user-item pairs is implicit feedback, whatever the ratings of their samples
+        self.use_explicit = bool(
+            self.dku_config.ratings_column_name and self.duplicates_reducer != constants.DUPLICATES_REDUCER.PRESENCE
+        )
+        self.timestamp_filtering = bool(
+            self.dku_config.get("timestamp_filtering") and self.dku_config.get("timestamps_column_name")
+        )
+        self.read_timestamps = self.timestamp_filtering or self.duplicates_reducer == constants.DUPLICATES_REDUCER.LAST
+        # visit counts, rating averages and normalization factors computed on the most recent samples only
+        self.recency_filter_first = bool(self.timestamp_filtering and self.dku_config.get("recency_filter_first"))
+        self.output_top_k_unseen = self.dku_config.get("scores_output") == constants.SCORES_OUTPUT.TOP_K_UNSEEN
+        self.similarity_computation_columns = [self.USERS_AS, self.ITEMS_AS]
+        if self.use_explicit:
+            logger.debug("Using explicit feedbacks")
+            self.similarity_computation_columns += [self.RATINGS_AS, self.RATING_AVERAGE]
+
+    def _assign_scoring_mode(self, is_user_based):
+        if is_user_based:
+            logger.debug("Using user-based collaborative filtering")
+            self.based_column, self.pivot_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+            self.based, self.pivot = self.USERS_AS, self.ITEMS_AS
+        else:
+            logger.debug("Using item-based collaborative filtering")
+            self.based_column, self.pivot_column = self.dku_config.items_column_name, self.dku_config.users_column_name
+            self.based, self.pivot = self.ITEMS_AS, self.USERS_AS
+        self.based_1, self.based_2 = f"{self.based}_1", f"{self.based}_2"
+
+    def _read_samples(self):
+        samples_dataset = self.file_manager.samples_dataset
+        users_column, items_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+        cast_mapping = {users_column: "string", items_column: "string"}
+        renaming_mapping = {users_column: self.USERS_AS, items_column: self.ITEMS_AS}
+        if self.use_explicit:
+            cast_mapping[self.dku_config.ratings_column_name] = "double"
+            renaming_mapping[self.dku_config.ratings_column_name] = self.RATINGS_AS
+        if self.read_timestamps:
+            timestamps_column = self.dku_config.timestamps_column_name
+            cast_mapping[timestamps_column] = self._get_spark_type(samples_dataset, timestamps_column)
+            renaming_mapping[timestamps_column] = self.TIMESTAMPS_AS
+        return self._read_dataset(samples_dataset, cast_mapping, renaming_mapping)
+
+    def _prepare_samples(self, samples):
+        """Thresholded and normalized samples, self-joined on the pivot column and joined with the top N neighbours"""
+        if self.timestamp_filtering:
+            logger.debug("Using timestamp filtering")
+        if self.duplicates_reducer != constants.DUPLICATES_REDUCER.NONE:
+            logger.debug(f"Reducing duplicated samples with {self.duplicates_reducer.value}")
+            samples = self._build_deduplicated(samples)
+        if self.recency_filter_first:
+            samples = self._build_recency_filtered(samples)
+        visit_count = self._build_visit_count(samples)
+        prepared_samples = self._build_normalization_factor(visit_count)
+        if self.timestamp_filtering and not self.recency_filter_first:
+            prepared_samples = self._build_recency_filtered(prepared_samples)
+        return prepared_samples.persist()
+
+    def _build_deduplicated(self, samples):
+        """One sample per user and item, rated with the ratings of its duplicates reduced by duplicates_reducer
+
+        The timestamp of a deduplicated sample is the most recent of its duplicates.
+        """
+        if self.duplicates_reducer == constants.DUPLICATES_REDUCER.LAST:
+            last_rated = self._add_row_number(
+                samples,
+                self.LAST_RATED_ROW_NB,
+                [self.USERS_AS, self.ITEMS_AS],
+                [F.col(self.TIMESTAMPS_AS).desc(), F.col(self.RATINGS_AS).desc()],
+            ).where(F.col(self.LAST_RATED_ROW_NB) == 1)
+            columns_to_select = [self.USERS_AS, self.ITEMS_AS, self.RATINGS_AS]
+            if self.timestamp_filtering:
+                columns_to_select.append(self.TIMESTAMPS_AS)
+            return last_rated.select(columns_to_select)
+        aggregations = []
+        if self.use_explicit:
+            reduced_ratings = {
+                constants.DUPLICATES_REDUCER.COUNT: F.count(F.lit(1)).cast("double"),
+                constants.DUPLICATES_REDUCER.SUM: F.sum(self.RATINGS_AS),
+                constants.DUPLICATES_REDUCER.MEAN: F.avg(self.RATINGS_AS),
+            }
+            aggregations.append(reduced_ratings[self.duplicates_reducer].alias(self.RATINGS_AS))
+        if self.timestamp_filtering:
+            aggregations.append(F.max(self.TIMESTAMPS_AS).alias(self.TIMESTAMPS_AS))
+        if not aggregations:
+            return samples.select(self.USERS_AS, self.ITEMS_AS).distinct()
+        return samples.groupBy(self.USERS_AS, self.ITEMS_AS).agg(*aggregations)
+
+    def _build_visit_count(self, samples):
+        visit_count = samples.withColumn(
+            self.NB_VISIT_USER_AS, F.count(F.lit(1)).over(Window.partitionBy(self.USERS_AS))
+        ).withColumn(self.NB_VISIT_ITEM_AS, F.count(F.lit(1)).over(Window.partitionBy(self.ITEMS_AS)))
+        # pseudo-random but deterministic rank of each visit, used to downsample users and items above the caps
+        if self.dku_config.user_visit_cap:
+            visit_count = self._add_visit_rank(visit_count, self.USER_VISIT_RANK_AS, self.USERS_AS, self.ITEMS_AS)
+        if self.dku_config.item_visit_cap:
+            visit_count = self._add_visit_rank(visit_count, self.ITEM_VISIT_RANK_AS, self.ITEMS_AS, self.USERS_AS)
+        if self.use_explicit:
+            visit_count = visit_count.withColumn(
+                self.RATING_AVERAGE, F.avg(self.RATINGS_AS).over(Window.partitionBy(self.based))
+            )
+        return visit_count
+
+    def _add_visit_rank(self, visit_count, alias, partition_column, sampled_column):
+        hash_expression = F.xxhash64(F.col(sampled_column), F.lit(self.dku_config.downsampling_seed))
+        order_columns = [hash_expression, F.col(sampled_column)]
+        # duplicated samples share the hash and the sampled column, the most recent then highest rated one ranks first
+        if self.TIMESTAMPS_AS in visit_count.columns:
+            order_columns.append(F.col(self.TIMESTAMPS_AS).desc())
+        if self.use_explicit:
+            order_columns.append(F.col(self.RATINGS_AS).desc())
+        return self._add_row_number(visit_count, alias, [partition_column], order_columns)
+
+    def _build_normalization_factor(self, visit_count):
+        # keep only items and users with enough visits, and at most the cap of visits per user and per item
+        conditions = [
+            F.col(self.NB_VISIT_USER_AS) >= self.dku_config.user_visit_threshold,
+            F.col(self.NB_VISIT_ITEM_AS) >= self.dku_config.item_visit_threshold,
+        ]
+        if self.dku_config.user_visit_cap:
+            conditions.append(F.col(self.USER_VISIT_RANK_AS) <= self.dku_config.user_visit_cap)
+        if self.dku_config.item_visit_cap:
+            conditions.append(F.col(self.ITEM_VISIT_RANK_AS) <= self.dku_config.item_visit_cap)
+        thresholded_samples = visit_count.where(reduce(lambda left, right: left & right, conditions))
+
+        if self.use_explicit:
+            rating = F.col(self.RATINGS_AS) - F.col(self.RATING_AVERAGE)
+        else:
+            rating = F.lit(1.0)
+        normalization_factor = F.lit(1.0) / F.sqrt(F.sum(rating * rating).over(Window.partitionBy(self.based)))
+        columns_to_select = self.similarity_computation_columns + [self.NORMALIZATION_FACTOR_AS]
+        if self.timestamp_filtering and not self.recency_filter_first:
+            columns_to_select.append(self.TIMESTAMPS_AS)
+        return thresholded_samples.withColumn(self.NORMALIZATION_FACTOR_AS, normalization_factor).select(
+            columns_to_select
+        )
+
+    def _build_recency_filtered(self, samples):
+        if self.dku_config.get("recency_filter") == constants.RECENCY_FILTER.DATE_WINDOW:
+            return self._build_date_window_filtered(samples)
+        return self._build_timestamp_filtered(samples)
+
+    def _build_date_window_filtered(self, samples):
+        """Samples whose timestamp is in the window [recency_window_start, recency_window_end)"""
+        in_window = F.col(self.TIMESTAMPS_AS) >= self._get_timestamp_literal(self.dku_config.recency_window_start)
+        if self.dku_config.get("recency_window_end") is not None:
+            in_window &= F.col(self.TIMESTAMPS_AS) < self._get_timestamp_literal(self.dku_config.recency_window_end)
+        return samples.where(in_window).drop(self.TIMESTAMPS_AS)
+
+    def _get_timestamp_literal(self, value):
+        samples_dataset, timestamps_column = self.file_manager.samples_dataset, self.dku_config.timestamps_column_name
+        timestamps_type = self._get_spark_type(samples_dataset, timestamps_column)
+        return F.lit(value).cast(timestamps_type) if timestamps_type == "timestamp" else F.lit(value)
+
+    def _build_timestamp_filtered(self, normalization_factor):
+        ts_row_numbers = self._add_row_number(
+            normalization_factor,
+            self.TIMESTAMP_FILTERED_ROW_NB,
+            [self.based],
+            [F.col(self.TIMESTAMPS_AS).desc(), F.col(self.pivot).desc()],
+        )
+        return ts_row_numbers.where(F.col(self.TIMESTAMP_FILTERED_ROW_NB) <= self.dku_config.top_n_most_recent).drop(
+            self.TIMESTAMP_FILTERED_ROW_NB, self.TIMESTAMPS_AS
+        )
+
+    def _build_similarity(self, prepared_samples):
+        """Half similarity matrix (col_1 < col_2), from the self-join of the prepared samples on the pivot column"""
+        left_samples, right_samples = self._salt_skewed_pivots(prepared_samples)
+        left_samples = self._add_suffix(left_samples, "_1")
+        right_samples = self._add_suffix(right_samples, "_2")
+        join_condition = (
+            F.col(f"{self.pivot}_1").eqNullSafe(F.col(f"{self.pivot}_2"))
+            & (F.col(f"{self.SALT_AS}_1") == F.col(f"{self.SALT_AS}_2"))
+            & (F.col(self.based_1) < F.col(self.based_2))
+        )
+        pairs = left_samples.join(right_samples, join_condition, "inner")
+
+        if self.use_explicit:
+            rating_product = (F.col(f"{self.RATINGS_AS}_1") - F.col(f"{self.RATING_AVERAGE}_1")) * (
+                F.col(f"{self.RATINGS_AS}_2") - F.col(f"{self.RATING_AVERAGE}_2")
+            )
+        else:
+            rating_product = F.lit(1)
+        similarity = F.sum(
+            rating_product * F.col(f"{self.NORMALIZATION_FACTOR_AS}_1") * F.col(f"{self.NORMALIZATION_FACTOR_AS}_2")
+        )
+        return pairs.groupBy(self.based_1, self.based_2).agg(
+            self._round_similarity(similarity).alias(constants.SIMILARITY_COLUMN_NAME)
+        )
+
+    def _salt_skewed_pivots(self, prepared_samples):
+        """Both sides of the self-join on the pivot column, joined on the pivot and a salt
+
+        The samples of the pivots with more than skewed_pivot_threshold samples are spread over nb_salts salts on the
+        left side, by a hash of their based entity, and replicated for each salt on the right side. The other samples
+        have the salt 0 on both sides, so that each pair of samples of a pivot is still joined exactly once.
+        """
+        nb_salts = self.dku_config.nb_salts
+        if nb_salts == 1:
+            salted_samples = prepared_samples.withColumn(self.SALT_AS, F.lit(0))
+            return salted_samples, salted_samples
+        skewed_pivots = (
+            prepared_samples.groupBy(self.pivot)
+            .agg(F.count(F.lit(1)).alias(self.NB_VISIT_AS))
+            .where(F.col(self.NB_VISIT_AS) > self.dku_config.skewed_pivot_threshold)
+            .select(self.pivot, F.lit(True).alias(self.IS_SKEWED_AS))
+        )
+        flagged_samples = prepared_samples.join(F.broadcast(skewed_pivots), self.pivot, "left")
+        is_skewed = F.col(self.IS_SKEWED_AS).isNotNull()
+        left_salt = F.when(is_skewed, F.abs(F.xxhash64(F.col(self.based)) % nb_salts)).otherwise(F.lit(0))
+        right_salts = F.when(is_skewed, F.sequence(F.lit(0), F.lit(nb_salts - 1))).otherwise(F.array(F.lit(0)))
+        left_samples = flagged_samples.withColumn(self.SALT_AS, left_salt.cast("int")).drop(self.IS_SKEWED_AS)
+        right_samples = flagged_samples.withColumn(self.SALT_AS, F.explode(right_salts)).drop(self.IS_SKEWED_AS)
+        return left_samples, right_samples
+
+    @staticmethod
+    def _add_suffix(df, suffix):
+        return df.select([F.col(column_name).alias(f"{column_name}{suffix}") for column_name in df.columns])
+
+    @staticmethod
+    def _round_similarity(similarity):
+        rounding_decimals = 15
+        logger.debug(f"Rounding similarity to {rounding_decimals} decimals")
+        return F.round(similarity * 10 ** rounding_decimals) / 10 ** rounding_decimals
+
+    def _build_full_similarity(self, similarity):
+        """Complete the half similarity matrix with its mirrored pairs (col_2, col_1)"""
+        mirrored_similarity = similarity.select(
+            F.col(self.based_2).alias(self.based_1),
+            F.col(self.based_1).alias(self.based_2),
+            F.col(constants.SIMILARITY_COLUMN_NAME),
+        )
+        return similarity.unionByName(mirrored_similarity)
+
+    def _build_top_n(self, similarity):
+        row_numbers = self._add_row_number(
+            similarity,
+            self.ROW_NUMBER_AS,
+            [self.based_1],
+            [F.col(constants.SIMILARITY_COLUMN_NAME).desc(), F.col(self.based_2).desc()],
+        )
+        top_n = row_numbers.where(F.col(self.ROW_NUMBER_AS) <= self.dku_config.top_n_most_similar)
+        return top_n.drop(self.ROW_NUMBER_AS).persist()
+
+    def _build_collaborative_filtering(self, similarity, prepared_samples, samples, is_half_matrix=False):
+        if is_half_matrix:
+            similarity = self._build_full_similarity(similarity)
+        top_n = self._build_top_n(similarity)
+        cf_scores = self._build_sum_of_similarity_scores(top_n, prepared_samples)
+        if self.output_top_k_unseen:
+            return self._build_top_k_unseen_scores(cf_scores, samples)
+        return cf_scores.orderBy(F.col(self.based).asc_nulls_last(), F.col(constants.SCORE_COLUMN_NAME).desc())
+
+    def _build_sum_of_similarity_scores(self, top_n, prepared_samples):
+        nb_top_n_rows = top_n.count()
+        if nb_top_n_rows <= self.dku_config.broadcast_max_rows:
+            logger.info(f"Broadcasting the {nb_top_n_rows} top N neighbours")
+            top_n = F.broadcast(top_n)
+        cf_scores = top_n.join(prepared_samples, F.col(self.based_2).eqNullSafe(F.col(self.based)), "inner")
+
+        if self.use_explicit:
+            score = F.sum(
+                F.col(constants.SIMILARITY_COLUMN_NAME) * (F.col(self.RATINGS_AS) - F.col(self.RATING_AVERAGE))
+            ) / F.sum(F.abs(F.col(constants.SIMILARITY_COLUMN_NAME)))
+        else:
+            score = F.sum(F.col(constants.SIMILARITY_COLUMN_NAME)) / F.lit(self.dku_config.top_n_most_similar)
+        cf_scores = cf_scores.groupBy(self.based_1, self.pivot).agg(score.alias(constants.SCORE_COLUMN_NAME))
+        return cf_scores.select(F.col(self.based_1).alias(self.based), self.pivot, constants.SCORE_COLUMN_NAME)
+
+    def _build_top_k_unseen_scores(self, cf_scores, samples):
+        """Top K non-null scores of each user, without the items the user has samples of"""
+        seen_samples = samples.select(self.USERS_AS, self.ITEMS_AS)
+        unseen_scores = cf_scores.join(seen_samples, [self.USERS_AS, self.ITEMS_AS], "left_anti").where(
+            F.col(constants.SCORE_COLUMN_NAME).isNotNull()
+        )
+        ranked_scores = self._add_row_number(
+            unseen_scores,
+            self.SCORE_RANK_AS,
+            [self.USERS_AS],
+            [F.col(constants.SCORE_COLUMN_NAME).desc(), F.col(self.ITEMS_AS).asc_nulls_last()],
+        )
+        return ranked_scores.where(F.col(self.SCORE_RANK_AS) <= self.dku_config.top_k).drop(self.SCORE_RANK_AS)
+
+    def _write_scores(self, cf_scores):
+        scored_samples_dataset = self.file_manager.scored_samples_dataset
+        renaming_mapping = {
+            self.based: self.based_column,
+            self.pivot: self.pivot_column,
+            constants.SCORE_COLUMN_NAME: constants.SCORE_COLUMN_NAME,
+        }
+        self._write_dataset(cf_scores, scored_samples_dataset, renaming_mapping)
+        self._set_column_description(scored_samples_dataset, constants.SCORE_COLUMN_NAME)
@@ -0,0 +1,8 @@
+from sparse_handlers.sparse_collaborative_filtering import SparseCollaborativeFiltering
+from sparse_handlers.alternating_least_squares import AlternatingLeastSquares
+from sparse_handlers.sparse_handler import SparseHandler
+from sparse_handlers.sparse_scoring_handler import SparseScoringHandler
+from sparse_handlers.matrix_factorization_handler import MatrixFactorizationHandler
+from sparse_handlers.score_store import ScoreStore, ScoreStoreWriter
+from sparse_handlers.score_store_handler import ScoreStoreHandler
+from sparse_handlers.fold_in_scorer import FoldInScorer
@@ -0,0 +1,194 @@
+from sparse_handlers.shared_memory import share_matrices, attach_matrices
+from sparse_handlers.sparse_collaborative_filtering import ScoresBlock
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import scipy.sparse as sp
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# maximum number of user-item scores computed at once when selecting the top K items of a block of users
+MAX_SCORES_PER_BLOCK = 2 ** 25
+
+# matrices used by _solve_block and _compute_top_k, set in each worker of the process pool (or in the main process)
+_ALS_MATRICES = {}
+
+
+class AlternatingLeastSquares:
+    """Factorization of the user x item matrix into float32 user and item factors by alternating least squares
+
+    Each half iteration solves the least squares problems of all users (then of all items) given the factors of the
+    other side. The problems of a block of users are solved together by a few steps of conjugate gradient, warm
+    started from the previous factors, with vectorized sparse products; blocks are spread over nb_workers processes.
+
+    With implicit feedbacks (Hu, Koren and Volinsky), every user-item pair is a preference of 1 (sample) or 0 (no
+    sample) weighted by a confidence of 1 + confidence_alpha * (sum of the ratings, or number of samples). With
+    explicit feedbacks, only the samples are fitted, to the average rating of each user-item pair.
+    """
+
+    def __init__(
+        self,
+        nb_factors=32,
+        regularization=0.01,
+        nb_iterations=15,
+        cg_steps=3,
+        use_explicit=False,
+        confidence_alpha=1.0,
+        block_size=10000,
+        nb_workers=1,
+        seed=1337,
+    ):
+        self.nb_factors = nb_factors
+        self.regularization = regularization
+        self.nb_iterations = nb_iterations
+        self.cg_steps = cg_steps
+        self.use_explicit = use_explicit
+        self.confidence_alpha = confidence_alpha
+        self.block_size = block_size
+        self.nb_workers = nb_workers
+        self.seed = seed
+        self.user_factors = None
+        self.item_factors = None
+
+    def fit(self, user_codes, item_codes, ratings=None, nb_users=None, nb_items=None):
+        """Compute the user and item factors from the samples (one value per sample in each array)"""
+        user_codes = np.asarray(user_codes, dtype=np.int64)
+        item_codes = np.asarray(item_codes, dtype=np.int64)
+        nb_users = int(user_codes.max(initial=-1)) + 1 if nb_users is None else nb_users
+        nb_items = int(item_codes.max(initial=-1)) + 1 if nb_items is None else nb_items
+        shape = (nb_users, nb_items)
+        ratings = np.ones(len(user_codes)) if ratings is None else np.asarray(ratings, dtype=np.float64)
+        user_item = sp.csr_matrix((ratings, (user_codes, item_codes)), shape=shape)  # duplicates are summed
+        if self.use_explicit:
+            nb_samples = sp.csr_matrix((np.ones(len(user_codes)), (user_codes, item_codes)), shape=shape)
+            user_item.data /= nb_samples.data
+        user_item = user_item.astype(np.float32)
+
+        rng = np.random.default_rng(self.seed)
+        matrices = {
+            "user_item": user_item,
+            "item_user": user_item.T.tocsr(),
+            "user_factors": (rng.standard_normal((nb_users, self.nb_factors)) * 0.01).astype(np.float32),
+            "item_factors": (rng.standard_normal((nb_items, self.nb_factors)) * 0.01).astype(np.float32),
+        }
+        logger.info(f"Factorizing a {nb_users} x {nb_items} matrix with {user_item.nnz} non-zero values")
+        with self._get_executor(matrices) as executor:
+            for iteration in range(self.nb_iterations):
+                start_time = time.perf_counter()
+                self._solve_side(executor, "user_item", "user_factors", "item_factors")
+                self._solve_side(executor, "item_user", "item_factors", "user_factors")
+                logger.info(f"ALS iteration {iteration + 1} done in {time.perf_counter() - start_time:.2f}s")
+            self.user_factors = np.array(_ALS_MATRICES["user_factors"])
+            self.item_factors = np.array(_ALS_MATRICES["item_factors"])
+        return self
+
+    def iter_top_k(self, top_k):
+        """Yield a ScoresBlock of the top_k items (by score descending then item) of each block of users"""
+        nb_users, nb_items = len(self.user_factors), len(self.item_factors)
+        block_size = max(min(self.block_size, MAX_SCORES_PER_BLOCK // max(nb_items, 1)), 1)
+        block_starts = list(range(0, nb_users, block_size))
+        block_stops = [min(start + block_size, nb_users) for start in block_starts]
+        matrices = {"user_factors": self.user_factors, "item_factors": self.item_factors}
+        with self._get_executor(matrices) as executor:
+            map_function = map if executor is None else executor.map
+            for block in map_function(_compute_top_k, block_starts, block_stops, [top_k] * len(block_starts)):
+                yield block
+
+    def _solve_side(self, executor, matrix_name, factors_name, other_factors_name):
+        """Update the factors of one side (users or items) block by block, given the factors of the other side"""
+        factors, other_factors = _ALS_MATRICES[factors_name], _ALS_MATRICES[other_factors_name]
+        gram = None if self.use_explicit else other_factors.T @ other_factors
+        block_starts = list(range(0, len(factors), self.block_size))
+        block_stops = [min(start + self.block_size, len(factors)) for start in block_starts]
+        arguments = [matrix_name, factors_name, other_factors_name, gram]
+        map_function = map if executor is None else executor.map
+        solved_blocks = map_function(
+            _solve_block, block_starts, block_stops, *[[argument] * len(block_starts) for argument in arguments]
+        )
+        # a block only reads its own rows and the factors of the other side, it can be written as soon as it is solved
+        for start, solved_block in zip(block_starts, solved_blocks):
+            factors[start : start + len(solved_block)] = solved_block
+
+    @contextmanager
+    def _get_executor(self, matrices):
+        """Process pool sharing the matrices with its workers (None when computing in the main process)"""
+        parameters = {
+            "regularization": np.float32(self.regularization),
+            "cg_steps": self.cg_steps,
+            "use_explicit": self.use_explicit,
+            "confidence_alpha": np.float32(self.confidence_alpha),
+        }
+        if self.nb_workers <= 1:
+            _init_als_matrices(matrices, parameters)
+            yield None
+            return
+        shared_matrices = share_matrices(matrices)
+        with ProcessPoolExecutor(
+            self.nb_workers, initializer=_init_shared_als_matrices, initargs=(shared_matrices, parameters)
+        ) as executor:
+            # the main process reads and writes the factors in the same shared memory as the workers
+            _init_shared_als_matrices(shared_matrices, parameters)
+            yield executor
+
+
+def _solve_block(start, stop, matrix_name, factors_name, other_factors_name, gram):
+    """Conjugate gradient steps on the least squares problems of the rows [start, stop) of one side"""
+    block = _ALS_MATRICES[matrix_name][start:stop]
+    other_factors = _ALS_MATRICES[other_factors_name]
+    factors = np.array(_ALS_MATRICES[factors_name][start:stop])
+    if _ALS_MATRICES["use_explicit"]:
+        weights, targets = np.ones_like(block.data), block.data
+    else:
+        weights = _ALS_MATRICES["confidence_alpha"] * block.data
+        targets = weights + 1
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    block_other_factors = other_factors[block.indices]
+
+    def apply_normal_matrix(vectors):
+        dots = np.einsum("ij,ij->i", block_other_factors, vectors[rows])
+        product = sp.csr_matrix((weights * dots, block.indices, block.indptr), shape=block.shape) @ other_factors
+        if gram is not None:
+            product += vectors @ gram
+        return product + _ALS_MATRICES["regularization"] * vectors
+
+    right_hand_side = sp.csr_matrix((targets, block.indices, block.indptr), shape=block.shape) @ other_factors
+    residuals = right_hand_side - apply_normal_matrix(factors)
+    directions = residuals.copy()
+    squared_norms = np.einsum("ij,ij->i", residuals, residuals)
+    for _ in range(_ALS_MATRICES["cg_steps"]):
+        normal_directions = apply_normal_matrix(directions)
+        curvatures = np.einsum("ij,ij->i", directions, normal_directions)
+        step = np.divide(squared_norms, curvatures, out=np.zeros_like(squared_norms), where=curvatures > 0)
+        factors += step[:, None] * directions
+        residuals -= step[:, None] * normal_directions
+        new_squared_norms = np.einsum("ij,ij->i", residuals, residuals)
+        ratio = np.divide(new_squared_norms, squared_norms, out=np.zeros_like(squared_norms), where=squared_norms > 0)
+        directions = residuals + ratio[:, None] * directions
+        squared_norms = new_squared_norms
+    return factors
+
+
+def _compute_top_k(start, stop, top_k):
+    scores = _ALS_MATRICES["user_factors"][start:stop] @ _ALS_MATRICES["item_factors"].T
+    top_k = min(top_k, scores.shape[1])
+    if top_k < scores.shape[1]:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    rows = np.repeat(np.arange(stop - start), candidates.shape[1])
+    items = candidates.reshape(-1)
+    values = scores[rows, items]
+    order = np.lexsort((items, -values, rows))
+    return ScoresBlock(rows[order] + start, items[order], values[order].astype(np.float64))
+
+
+def _init_shared_als_matrices(shared_matrices, parameters):
+    _init_als_matrices(attach_matrices(shared_matrices), parameters)
+
+
+def _init_als_matrices(matrices, parameters):
+    _ALS_MATRICES.clear()
+    _ALS_MATRICES.update(matrices)
+    _ALS_MATRICES.update(parameters)
@@ -0,0 +1,121 @@
+from sparse_handlers.sparse_collaborative_filtering import (
+    _get_aligned_product,
+    _get_ranks_in_sorted_groups,
+    _get_rows,
+    _with_data,
+)
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FoldInScorer:
+    """Item-based affinity scores of new or updated users, computed on the fly from their items
+
+    The item neighbours table (item 1, item 2, similarity), such as the top N table of the auto collaborative
+    filtering or a custom item similarity dataset, is kept as a sparse item 2 x item 1 matrix of the top N neighbours
+    of each item 1, with int32 indices and float64 similarities (about 12 bytes per pair). The scores of a batch of
+    users are then two sparse products with the same formulas as the SQL scoring: the sum of the similarities of the
+    user's items in the top N of each item divided by N, or with explicit feedbacks the sum of the similarities times
+    the ratings centered on the item averages divided by the sum of the absolute similarities.
+
+    The samples of the scored users are used as given, without visit thresholds, caps nor timestamp filtering.
+    """
+
+    def __init__(self, top_n_most_similar, use_explicit=False):
+        self.top_n_most_similar = top_n_most_similar
+        self.use_explicit = use_explicit
+        self.item_index = None
+        self.neighbours = None
+        self.item_rating_average = None
+
+    def fit(self, items_1, items_2, similarity, is_half_matrix=False, item_rating_average=None):
+        """Index the top N neighbours of each item from the pairs of the similarity table
+
+        With is_half_matrix, each pair is only stored once and is mirrored. With explicit feedbacks,
+        item_rating_average is a pandas Series of the average rating of each item id (over all its samples).
+        """
+        items_1, items_2 = pd.Series(items_1).astype(str), pd.Series(items_2).astype(str)
+        similarity = np.asarray(similarity, dtype=np.float64)
+        if is_half_matrix:
+            items_1, items_2 = pd.concat([items_1, items_2]), pd.concat([items_2, items_1])
+            similarity = np.concatenate([similarity, similarity])
+        codes, item_ids = pd.factorize(pd.concat([items_1, items_2]), sort=True)
+        codes_1, codes_2 = codes[: len(items_1)].astype(np.int64), codes[len(items_1) :].astype(np.int64)
+
+        # top N neighbours of each item by similarity then neighbour descending, NULL similarities last
+        order = np.lexsort((-codes_2, -np.nan_to_num(similarity), np.isnan(similarity), codes_1))
+        top_n = _get_ranks_in_sorted_groups(codes_1, order) <= self.top_n_most_similar
+        nb_items = len(item_ids)
+        self.neighbours = sp.csr_matrix(
+            (similarity[top_n], (codes_2[top_n], codes_1[top_n])), shape=(nb_items, nb_items)
+        )
+        self.neighbours.indices = self.neighbours.indices.astype(np.int32)
+        self.item_index = pd.Index(item_ids)
+        self.item_index.get_indexer(self.item_index[:1])  # builds the hash table of the ids before the first batch
+        if self.use_explicit:
+            self.item_rating_average = item_rating_average.reindex(self.item_index).to_numpy(dtype=np.float64)
+        logger.info(f"Indexed {self.neighbours.nnz} neighbour pairs of {nb_items} items ({self.nbytes} bytes)")
+        return self
+
+    @property
+    def nbytes(self):
+        """Memory of the neighbour arrays"""
+        arrays = [self.neighbours.data, self.neighbours.indices, self.neighbours.indptr]
+        if self.item_rating_average is not None:
+            arrays.append(self.item_rating_average)
+        return sum(array.nbytes for array in arrays)
+
+    def score(self, users, items, ratings=None):
+        """DataFrame of the (user, item, score) of a batch of users from their samples, by user then score descending
+
+        The samples are given as arrays of the same length of user ids, item ids and ratings (explicit feedbacks).
+        Items missing from the neighbours table are ignored.
+        """
+        users, items = pd.Series(users), pd.Series(items).astype(str)
+        item_codes = self.item_index.get_indexer(items)
+        known = item_codes >= 0
+        user_codes, user_ids = pd.factorize(users[known])
+        item_codes = item_codes[known]
+        # only the rows of the items of the batch and the columns of their neighbours are used
+        batch_items, batch_item_codes = np.unique(item_codes, return_inverse=True)
+        neighbours = self.neighbours[batch_items]
+        candidate_items, candidate_codes = np.unique(neighbours.indices, return_inverse=True)
+        neighbours = sp.csr_matrix(
+            (neighbours.data, candidate_codes.reshape(-1), neighbours.indptr),
+            shape=(len(batch_items), len(candidate_items)),
+        )
+        shape = (len(user_ids), len(batch_items))
+        samples_count = sp.csr_matrix((np.ones(len(user_codes)), (user_codes, batch_item_codes)), shape=shape)
+
+        null_similarity = np.isnan(neighbours.data)
+        non_null_similarity = _with_data(neighbours, np.where(null_similarity, 0.0, neighbours.data))
+        nb_non_null = _get_aligned_product(
+            samples_count, _with_data(neighbours, (~null_similarity).astype(np.float64)), samples_count, neighbours
+        )
+        if self.use_explicit:
+            centered_ratings = np.asarray(ratings, dtype=np.float64)[known] - self.item_rating_average[item_codes]
+            weights = sp.csr_matrix((centered_ratings, (user_codes, batch_item_codes)), shape=shape)
+            numerator = _get_aligned_product(weights, non_null_similarity, samples_count, neighbours)
+            denominator = _get_aligned_product(
+                samples_count, _with_data(neighbours, np.abs(non_null_similarity.data)), samples_count, neighbours
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = numerator.data / denominator.data
+        else:
+            numerator = _get_aligned_product(samples_count, non_null_similarity, samples_count, neighbours)
+            scores = numerator.data / self.top_n_most_similar
+        scores = np.where(nb_non_null.data > 0, scores, np.nan)
+
+        rows, cols = _get_rows(numerator), numerator.indices
+        order = np.lexsort((-scores, rows))
+        return pd.DataFrame(
+            {
+                "user": np.asarray(user_ids)[rows[order]],
+                "item": np.asarray(self.item_index)[candidate_items[cols[order]]],
+                "score": scores[order],
+            }
+        )
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+
+class IdEncoder:
+    """Map string ids read by chunks to integer codes
+
+    Codes are first given in order of appearance, then get_sorted_codes remaps them to the order of the ids so that
+    comparisons of codes behave as the comparisons of ids in SQL.
+    """
+
+    def __init__(self):
+        self.ids = pd.Index([], dtype=object)
+
+    def encode(self, ids):
+        """Codes of the ids (pandas Series of strings), adding the unknown ids to the index"""
+        codes = self.ids.get_indexer(ids)
+        unknown = codes < 0
+        if unknown.any():
+            self.ids = self.ids.append(pd.Index(pd.unique(ids[unknown])))
+            codes[unknown] = self.ids.get_indexer(ids[unknown])
+        return codes.astype(np.int64)
+
+    def get_sorted_codes(self, codes):
+        """Remap codes (from encode) to the order of the ids and return (sorted ids, remapped codes)"""
+        ids = self.ids.values
+        order = np.argsort(ids, kind="stable")
+        ranks = np.empty(len(ids), dtype=np.int64)
+        ranks[order] = np.arange(len(ids))
+        return ids[order], ranks[codes]
+
+    def __len__(self):
+        return len(self.ids)
@@ -0,0 +1,273 @@
+from collections import namedtuple
+import numpy as np
+import json
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# rough peak memory of one sample while it is read in a pandas chunk, encoded, sorted and merged
+BYTES_PER_SAMPLE = 256
+# maximum number of sorted runs merged at once, bounding the number of open memory maps
+MAX_MERGE_FAN_IN = 64
+METADATA_FILE = "metadata.json"
+
+SortedRun = namedtuple("SortedRun", ["directory", "size"])
+
+
+class InteractionMatrix:
+    """User x item matrix of the samples, stored on disk in CSR format with memory-mapped arrays
+
+    Each sample is kept as its own entry (duplicated user-item pairs are not summed), so that the matrix holds the
+    same samples as the dataset it was built from: row i of the matrix holds the samples of the i-th user id in sorted
+    order, its indices are the codes of the items in sorted order, its data the ratings and timestamps (if any).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, METADATA_FILE)) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.nb_users, self.nb_items, self.nb_samples = [self.metadata[key] for key in ("nb_users", "nb_items", "nnz")]
+        self.user_ids = IdDictionary(os.path.join(directory, "user_ids.bin"), self.metadata["user_ids_width"])
+        self.item_ids = IdDictionary(os.path.join(directory, "item_ids.bin"), self.metadata["item_ids_width"])
+        self.indptr = self._load_array("indptr", self.nb_users + 1)
+        self.indices = self._load_array("indices", self.nb_samples)
+        self.ratings = self._load_array("ratings", self.nb_samples)
+        self.timestamps = self._load_array("timestamps", self.nb_samples)
+
+    def get_user_codes(self):
+        """Code of the user of each sample, the row of each entry of the CSR matrix"""
+        return np.repeat(np.arange(self.nb_users, dtype=np.int64), np.diff(self.indptr))
+
+    def _load_array(self, name, size):
+        dtype = self.metadata["dtypes"].get(name)
+        if dtype is None:
+            return None
+        path = os.path.join(self.directory, f"{name}.bin")
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(size,))
+
+
+class IdDictionary:
+    """Sorted ids stored as fixed width UTF-8 strings in a memory-mapped file, indexed by their integer codes"""
+
+    def __init__(self, path, width):
+        size = os.path.getsize(path) // width if os.path.exists(path) else 0
+        self.ids = np.memmap(path, dtype=f"S{width}", mode="r", shape=(size,)) if size else np.empty(0, f"S{width}")
+
+    def encode(self, ids):
+        """Codes of the ids (array of UTF-8 bytes), which must all be in the dictionary"""
+        return np.searchsorted(self.ids, ids).astype(np.int64)
+
+    def __getitem__(self, codes):
+        return np.char.decode(np.asarray(self.ids[codes]), "utf-8")
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class InteractionMatrixBuilder:
+    """Build an InteractionMatrix from chunks of samples, with a peak memory independent of the number of samples
+
+    The chunks are spilled to disk as they are added. The ids are then mapped to integer codes with dictionaries
+    merged from the sorted unique ids of each chunk, and the CSR matrix is written by an external sort (sorted runs
+    merged by blocks) of the samples by user code then item code.
+    """
+
+    def __init__(self, directory, max_memory_mb=1024, with_ratings=False, with_timestamps=False):
+        self.directory = directory
+        self.chunk_size = max(max_memory_mb * 2 ** 20 // BYTES_PER_SAMPLE, 1)
+        self.with_ratings = with_ratings
+        self.with_timestamps = with_timestamps
+        self.spill_directory = os.path.join(directory, "_spill")
+        self.sample_runs = []
+        self.user_id_runs, self.item_id_runs = [], []
+        self.user_ids_width, self.item_ids_width = 1, 1
+        self.timestamps_dtype = None
+        self.nb_runs = 0
+        os.makedirs(self.spill_directory, exist_ok=True)
+
+    def add_chunk(self, users, items, ratings=None, timestamps=None):
+        """Spill a chunk of samples (pandas Series of user and item ids, ratings and timestamps) to disk"""
+        users, items = _to_utf8(users), _to_utf8(items)
+        self.user_ids_width = max(self.user_ids_width, users.dtype.itemsize)
+        self.item_ids_width = max(self.item_ids_width, items.dtype.itemsize)
+        self.user_id_runs.append(self._write_run({"key": np.unique(users)}))
+        self.item_id_runs.append(self._write_run({"key": np.unique(items)}))
+        samples = {"users": users, "items": items}
+        if self.with_ratings:
+            samples["ratings"] = np.asarray(ratings, dtype=np.float64)
+        if self.with_timestamps:
+            timestamps = np.asarray(timestamps)
+            if np.issubdtype(timestamps.dtype, np.datetime64):
+                timestamps = timestamps.astype("datetime64[ns]").view(np.int64)
+            self.timestamps_dtype = timestamps.dtype if self.timestamps_dtype is None else self.timestamps_dtype
+            samples["timestamps"] = timestamps.astype(self.timestamps_dtype)
+        self.sample_runs.append(self._write_run(samples))
+
+    def build(self):
+        """Write the dictionaries and the CSR arrays, remove the spilled chunks and return the InteractionMatrix"""
+        nb_users = self._write_dictionary(self.user_id_runs, "user_ids.bin", self.user_ids_width)
+        nb_items = self._write_dictionary(self.item_id_runs, "item_ids.bin", self.item_ids_width)
+        user_ids = IdDictionary(os.path.join(self.directory, "user_ids.bin"), self.user_ids_width)
+        item_ids = IdDictionary(os.path.join(self.directory, "item_ids.bin"), self.item_ids_width)
+
+        encoded_runs = []
+        for sample_run in self.sample_runs:
+            samples = _load_run(sample_run)
+            keys = user_ids.encode(samples.pop("users")) * nb_items + item_ids.encode(samples.pop("items"))
+            order = np.argsort(keys, kind="stable")
+            encoded_samples = {name: samples[name][order] for name in samples}
+            encoded_runs.append(self._write_run({"key": keys[order], **encoded_samples}))
+            shutil.rmtree(sample_run.directory)
+        nb_samples = self._write_csr(encoded_runs, nb_users, nb_items)
+        shutil.rmtree(self.spill_directory)
+        logger.info(f"Built a {nb_users} x {nb_items} interaction matrix with {nb_samples} samples on disk")
+        return InteractionMatrix(self.directory)
+
+    def _write_dictionary(self, id_runs, file_name, width):
+        nb_ids, last_id = 0, None
+        with open(os.path.join(self.directory, file_name), "wb") as dictionary_file:
+            for block in self._merge_runs(id_runs):
+                ids = np.unique(block["key"]).astype(f"S{width}")
+                # an id repeated in a merged run can span two blocks
+                ids = ids[ids > last_id] if last_id is not None else ids
+                ids.tofile(dictionary_file)
+                nb_ids += len(ids)
+                last_id = ids[-1] if len(ids) else last_id
+        return nb_ids
+
+    def _write_csr(self, encoded_runs, nb_users, nb_items):
+        indices_dtype = np.int32 if nb_items < 2 ** 31 else np.int64
+        data_dtypes = {}
+        if self.with_ratings:
+            data_dtypes["ratings"] = np.float64
+        if self.with_timestamps:
+            data_dtypes["timestamps"] = self.timestamps_dtype or np.float64
+        dtypes = {"indptr": np.int64, "indices": indices_dtype, **data_dtypes}
+        files = {name: open(os.path.join(self.directory, f"{name}.bin"), "wb") for name in ["indices", *data_dtypes]}
+        indptr_path = os.path.join(self.directory, "indptr.bin")
+        indptr = np.memmap(indptr_path, dtype=np.int64, mode="w+", shape=(nb_users + 1,))
+        nb_samples = 0
+        try:
+            for block in self._merge_runs(encoded_runs):
+                rows, cols = np.divmod(block["key"], nb_items)
+                block_users, block_counts = np.unique(rows, return_counts=True)
+                indptr[block_users + 1] += block_counts
+                cols.astype(indices_dtype).tofile(files["indices"])
+                for name in data_dtypes:
+                    block[name].tofile(files[name])
+                nb_samples += len(rows)
+        finally:
+            for file in files.values():
+                file.close()
+        np.cumsum(indptr, out=indptr)
+        indptr.flush()
+        del indptr
+
+        metadata = {
+            "nb_users": nb_users,
+            "nb_items": nb_items,
+            "nnz": nb_samples,
+            "user_ids_width": self.user_ids_width,
+            "item_ids_width": self.item_ids_width,
+            "dtypes": {name: np.dtype(dtype).str for name, dtype in dtypes.items()},
+        }
+        with open(os.path.join(self.directory, METADATA_FILE), "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        return nb_samples
+
+    def _merge_runs(self, runs):
+        """Yield blocks of the union of the sorted runs, sorted by key, merging at most MAX_MERGE_FAN_IN at once"""
+        while len(runs) > MAX_MERGE_FAN_IN:
+            runs = [
+                self._write_merged_run(runs[start : start + MAX_MERGE_FAN_IN])
+                for start in range(0, len(runs), MAX_MERGE_FAN_IN)
+            ]
+        for block in self._merge_run_group(runs):
+            yield block
+        for run in runs:
+            shutil.rmtree(run.directory)
+
+    def _merge_run_group(self, runs):
+        """Block-wise k-way merge: all the values up to the smallest last key of the buffers can be output"""
+        loaded_runs = [_load_run(run) for run in runs]
+        positions = [0] * len(loaded_runs)
+        block_size = max(self.chunk_size // max(len(loaded_runs), 1), 1)
+        while any(position < len(run["key"]) for position, run in zip(positions, loaded_runs)):
+            buffers = [
+                {name: array[position : position + block_size] for name, array in run.items()}
+                for position, run in zip(positions, loaded_runs)
+            ]
+            unfinished_last_keys = [
+                buffer["key"][-1]
+                for buffer, position, run in zip(buffers, positions, loaded_runs)
+                if position + block_size < len(run["key"])
+            ]
+            bound = min(unfinished_last_keys) if unfinished_last_keys else None
+            block = []
+            for index, buffer in enumerate(buffers):
+                size = len(buffer["key"]) if bound is None else np.searchsorted(buffer["key"], bound, side="right")
+                block.append({name: np.asarray(array[:size]) for name, array in buffer.items()})
+                positions[index] += size
+            block = _concatenate(block)
+            order = np.argsort(block["key"], kind="stable")
+            yield {name: array[order] for name, array in block.items()}
+
+    def _write_merged_run(self, runs):
+        """Merge sorted runs into a new sorted run on disk, block by block, and remove them"""
+        loaded_runs = [_load_run(run) for run in runs]
+        size = sum(run.size for run in runs)
+        directory = self._create_run_directory()
+        merged_run = {
+            name: np.lib.format.open_memmap(
+                os.path.join(directory, f"{name}.npy"),
+                mode="w+",
+                dtype=np.result_type(*[run[name].dtype for run in loaded_runs]),
+                shape=(size,),
+            )
+            for name in loaded_runs[0]
+        }
+        position = 0
+        for block in self._merge_run_group(runs):
+            for name, array in block.items():
+                merged_run[name][position : position + len(array)] = array
+            position += len(block["key"])
+        for array in merged_run.values():
+            array.flush()
+        del loaded_runs, merged_run
+        for run in runs:
+            shutil.rmtree(run.directory)
+        return SortedRun(directory, size)
+
+    def _write_run(self, arrays):
+        """Write arrays of the same length as the .npy files of a new run"""
+        directory = self._create_run_directory()
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        return SortedRun(directory, len(next(iter(arrays.values()))))
+
+    def _create_run_directory(self):
+        self.nb_runs += 1
+        directory = os.path.join(self.spill_directory, f"run_{self.nb_runs}")
+        os.makedirs(directory)
+        return directory
+
+
+def _load_run(run):
+    return {
+        file_name[: -len(".npy")]: np.load(os.path.join(run.directory, file_name), mmap_mode="r")
+        for file_name in sorted(os.listdir(run.directory))
+    }
+
+
+def _concatenate(blocks):
+    return {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+
+
+def _to_utf8(ids):
+    """Fixed width UTF-8 bytes of the ids, whose byte order is the order of the strings"""
+    encoded = np.asarray(ids.astype(str).str.encode("utf-8").to_numpy(dtype=object))
+    return encoded.astype(bytes) if len(encoded) else np.empty(0, dtype="S1")
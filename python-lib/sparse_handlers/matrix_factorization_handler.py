@@ -0,0 +1,100 @@
+from sparse_handlers.sparse_handler import SparseHandler
+from sparse_handlers.alternating_least_squares import AlternatingLeastSquares
+from dku_utils import set_column_description
+import dku_constants as constants
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MatrixFactorizationHandler(SparseHandler):
+    """Matrix factorization of the samples by alternating least squares, writing the top K scores of each user
+
+    The scored samples have the same columns (users, items, score) as the outputs of the collaborative filtering
+    recipes, the optional factors datasets have one row per user (or item) with one column per factor.
+    """
+
+    FACTOR_COLUMN_PREFIX = "factor_"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.use_explicit_feedback = self.dku_config.feedback_type == constants.FEEDBACK_TYPE.EXPLICIT
+
+    def _compute(self, samples):
+        alternating_least_squares = AlternatingLeastSquares(
+            nb_factors=self.dku_config.nb_factors,
+            regularization=self.dku_config.regularization,
+            nb_iterations=self.dku_config.nb_iterations,
+            cg_steps=self.dku_config.cg_steps,
+            use_explicit=self.use_explicit_feedback,
+            confidence_alpha=self.dku_config.confidence_alpha,
+            block_size=self.dku_config.block_size,
+            nb_workers=self.dku_config.nb_workers,
+            seed=self.dku_config.seed,
+        ).fit(
+            samples.user_codes,
+            samples.item_codes,
+            ratings=samples.ratings,
+            nb_users=len(samples.user_ids),
+            nb_items=len(samples.item_ids),
+        )
+        self._write_factors(
+            self.file_manager.user_factors_dataset,
+            self.dku_config.users_column_name,
+            samples.user_ids,
+            alternating_least_squares.user_factors,
+        )
+        self._write_factors(
+            self.file_manager.item_factors_dataset,
+            self.dku_config.items_column_name,
+            samples.item_ids,
+            alternating_least_squares.item_factors,
+        )
+        self._write_scores(alternating_least_squares, samples.user_ids, samples.item_ids)
+
+    def _write_factors(self, factors_dataset, id_column, ids, factors):
+        if factors_dataset is None:
+            return
+        factor_columns = [f"{self.FACTOR_COLUMN_PREFIX}{index}" for index in range(factors.shape[1])]
+        factors_dataset.write_schema(
+            [{"name": id_column, "type": "string"}] + [{"name": column, "type": "float"} for column in factor_columns]
+        )
+        with factors_dataset.get_writer() as writer:
+            for start in range(0, len(factors), self.CHUNK_SIZE):
+                codes = np.arange(start, min(start + self.CHUNK_SIZE, len(factors)))
+                factors_df = pd.DataFrame(factors[codes], columns=factor_columns)
+                factors_df.insert(0, id_column, ids[codes])
+                writer.write_dataframe(factors_df)
+        set_column_description(
+            factors_dataset, {column: f"Latent factor {index}" for index, column in enumerate(factor_columns)}
+        )
+
+    def _write_scores(self, alternating_least_squares, user_ids, item_ids):
+        scored_samples_dataset = self.file_manager.scored_samples_dataset
+        users_column, items_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+        scored_samples_dataset.write_schema(
+            [
+                {"name": users_column, "type": "string"},
+                {"name": items_column, "type": "string"},
+                {"name": constants.SCORE_COLUMN_NAME, "type": "double"},
+            ]
+        )
+        nb_score_rows = 0
+        with scored_samples_dataset.get_writer() as writer:
+            for scores_block in alternating_least_squares.iter_top_k(self.dku_config.top_k):
+                scores_df = pd.DataFrame(
+                    {
+                        users_column: user_ids[scores_block.based],
+                        items_column: item_ids[scores_block.pivot],
+                        constants.SCORE_COLUMN_NAME: scores_block.score,
+                    }
+                )
+                writer.write_dataframe(scores_df)
+                nb_score_rows += len(scores_df)
+        logger.info(f"Wrote {nb_score_rows} scores")
+        set_column_description(
+            scored_samples_dataset,
+            {constants.SCORE_COLUMN_NAME: "User-item affinity scores (using ALS matrix factorization)"},
+        )
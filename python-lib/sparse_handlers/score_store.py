@@ -0,0 +1,170 @@
+from sparse_handlers.interaction_matrix import InteractionMatrix, InteractionMatrixBuilder, METADATA_FILE
+from collections import OrderedDict, namedtuple
+import numpy as np
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# file holding the name of the version directory read by the ScoreStore, replaced atomically by each export
+CURRENT_VERSION_FILE = "CURRENT"
+
+StoreVersion = namedtuple("StoreVersion", ["name", "user_ids", "item_ids", "indptr", "indices", "scores"])
+
+
+class ScoreStoreWriter:
+    """Write the scored samples into a folder as a new version of a memory-mapped score store
+
+    A version is an InteractionMatrix of users x items (sorted id dictionaries mapping the ids to integer codes, CSR
+    offsets per user) whose rows are sorted by score descending, with float32 scores. The version is built out of core
+    from chunks of scores, then published by atomically replacing the CURRENT file of the folder.
+    """
+
+    def __init__(self, directory, max_memory_mb=1024):
+        self.directory = directory
+        self.version = f"{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.version_directory = os.path.join(directory, self.version)
+        self.builder = InteractionMatrixBuilder(self.version_directory, max_memory_mb=max_memory_mb, with_ratings=True)
+        self.chunk_size = self.builder.chunk_size
+
+    def add_chunk(self, users, items, scores):
+        """Add a chunk of scores (pandas Series of user and item ids, scores), the NULL scores are skipped"""
+        scores = np.asarray(scores, dtype=np.float64)
+        not_null = ~np.isnan(scores)
+        self.builder.add_chunk(users[not_null], items[not_null], ratings=scores[not_null])
+
+    def build(self):
+        """Write the new version, publish it and remove the versions older than the previous one
+
+        The previous version is kept so that the readers which have not reloaded yet can still read it.
+        """
+        matrix = self.builder.build()
+        self._sort_rows_by_score(matrix)
+        current_path = os.path.join(self.directory, CURRENT_VERSION_FILE)
+        previous_version = None
+        if os.path.exists(current_path):
+            with open(current_path) as current_file:
+                previous_version = current_file.read().strip()
+        with open(f"{current_path}.tmp", "w") as current_file:
+            current_file.write(self.version)
+        os.replace(f"{current_path}.tmp", current_path)
+        logger.info(f"Published version {self.version} of the score store with {matrix.nb_samples} scores")
+        for name in os.listdir(self.directory):
+            if name not in (self.version, previous_version) and os.path.isdir(os.path.join(self.directory, name)):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return self.version
+
+    def _sort_rows_by_score(self, matrix):
+        """Sort the entries of each row by score descending then item: indices rewritten in place, float32 scores"""
+        scores_path = os.path.join(self.version_directory, "scores.bin")
+        if matrix.nb_samples == 0:
+            open(scores_path, "wb").close()
+        else:
+            indices_path = os.path.join(self.version_directory, "indices.bin")
+            indices = np.memmap(indices_path, dtype=matrix.indices.dtype, mode="r+", shape=(matrix.nb_samples,))
+            scores = np.memmap(scores_path, dtype=np.float32, mode="w+", shape=(matrix.nb_samples,))
+            row_start = 0
+            while row_start < matrix.nb_users:
+                # blocks of whole rows of about chunk_size entries, at least one row
+                row_stop = np.searchsorted(matrix.indptr, matrix.indptr[row_start] + self.chunk_size, side="right") - 1
+                row_stop = min(max(row_stop, row_start + 1), matrix.nb_users)
+                start, stop = matrix.indptr[row_start], matrix.indptr[row_stop]
+                rows = np.repeat(np.arange(row_stop - row_start), np.diff(matrix.indptr[row_start : row_stop + 1]))
+                block_indices, block_scores = np.array(indices[start:stop]), np.asarray(matrix.ratings[start:stop])
+                order = np.lexsort((block_indices, -block_scores, rows))
+                indices[start:stop] = block_indices[order]
+                scores[start:stop] = block_scores[order]
+                row_start = row_stop
+            indices.flush()
+            scores.flush()
+            del indices, scores
+        del matrix
+
+        os.remove(os.path.join(self.version_directory, "ratings.bin"))
+        metadata_path = os.path.join(self.version_directory, METADATA_FILE)
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+        del metadata["dtypes"]["ratings"]
+        metadata["dtypes"]["scores"] = np.dtype(np.float32).str
+        with open(metadata_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+
+
+class ScoreStore:
+    """Low-latency reader of the top K items of a user from the current version of a score store folder
+
+    The arrays are memory-mapped, a lookup is a binary search of the user id then a slice of its sorted row. The
+    decoded rows of the most recently used users are kept in a LRU cache of cache_size users. reload switches to the
+    version published since the last load: the version and its cache are replaced together, so that concurrent
+    lookups read either the previous or the new version, never a mix of both.
+    """
+
+    def __init__(self, directory, cache_size=10000):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._state = (self._load_version(self._read_current_version()), OrderedDict())
+
+    @property
+    def version(self):
+        return self._state[0].name
+
+    def top_k(self, user, k, exclude=None):
+        """List of the (item, score) of the top k items of the user, by score descending, without the excluded items
+
+        Unknown users have no scores and get an empty list.
+        """
+        version, cache = self._state
+        with self._lock:
+            row = cache.get(user)
+            if row is not None:
+                cache.move_to_end(user)
+        if row is None:
+            row = self._decode_row(version, user)
+            with self._lock:
+                cache[user] = row
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+        if not exclude:
+            return row[:k]
+        exclude = set(exclude)
+        return [item_score for item_score in row if item_score[0] not in exclude][:k]
+
+    def reload(self):
+        """Load the current version of the folder if it changed, return whether a new version was loaded"""
+        current_version = self._read_current_version()
+        if current_version == self.version:
+            return False
+        self._state = (self._load_version(current_version), OrderedDict())
+        logger.info(f"Loaded version {current_version} of the score store")
+        return True
+
+    def _decode_row(self, version, user):
+        encoded_user = np.array([str(user).encode("utf-8")])
+        if len(version.user_ids) == 0 or len(encoded_user[0]) > version.user_ids.ids.dtype.itemsize:
+            return []
+        code = min(version.user_ids.encode(encoded_user)[0], len(version.user_ids) - 1)
+        if version.user_ids.ids[code] != encoded_user[0]:
+            return []
+        start, stop = version.indptr[code], version.indptr[code + 1]
+        items = version.item_ids[np.asarray(version.indices[start:stop])]
+        return list(zip(items.tolist(), np.asarray(version.scores[start:stop]).tolist()))
+
+    def _read_current_version(self):
+        with open(os.path.join(self.directory, CURRENT_VERSION_FILE)) as current_file:
+            return current_file.read().strip()
+
+    def _load_version(self, name):
+        matrix = InteractionMatrix(os.path.join(self.directory, name))
+        scores_path = os.path.join(matrix.directory, "scores.bin")
+        scores = (
+            np.memmap(scores_path, dtype=np.float32, mode="r", shape=(matrix.nb_samples,))
+            if matrix.nb_samples
+            else np.empty(0, dtype=np.float32)
+        )
+        return StoreVersion(name, matrix.user_ids, matrix.item_ids, matrix.indptr, matrix.indices, scores)
@@ -0,0 +1,31 @@
+from sparse_handlers.score_store import ScoreStoreWriter
+import dku_constants as constants
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ScoreStoreHandler:
+    """Export the scored samples dataset of a recipe as a new version of the score store of its output folder
+
+    The store is read by the ScoreStore of online services, which answers the top K items of a user from
+    memory-mapped arrays instead of querying the scored samples table.
+    """
+
+    def __init__(self, dku_config, file_manager):
+        self.dku_config = dku_config
+        self.file_manager = file_manager
+
+    def build(self):
+        scored_samples_dataset = self.file_manager.scored_samples_dataset
+        users_column, items_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+        writer = ScoreStoreWriter(self.file_manager.score_store_folder.get_path())
+        dtypes = {users_column: str, items_column: str, constants.SCORE_COLUMN_NAME: np.float64}
+        for chunk in scored_samples_dataset.iter_dataframes_forced_types(
+            names=list(dtypes), dtypes=dtypes, parse_date_columns=[], chunksize=writer.chunk_size
+        ):
+            chunk = chunk.dropna(subset=[users_column, items_column])
+            writer.add_chunk(chunk[users_column], chunk[items_column], chunk[constants.SCORE_COLUMN_NAME].values)
+        version = writer.build()
+        logger.info(f"Exported the scored samples to version {version} of the score store")
@@ -0,0 +1,41 @@
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+
+
+def share_array(array):
+    """Copy a numpy array to shared memory, return a picklable handle to pass to the initializer of a process pool"""
+    shared_array = multiprocessing.RawArray("b", max(array.nbytes, 1))
+    attach_array((shared_array, array.dtype.str, array.shape))[...] = array
+    return shared_array, array.dtype.str, array.shape
+
+
+def attach_array(handle):
+    """Numpy array backed by the shared memory of a handle returned by share_array (without copy)"""
+    shared_array, dtype, shape = handle
+    return np.frombuffer(shared_array, dtype=np.dtype(dtype), count=int(np.prod(shape))).reshape(shape)
+
+
+def share_csr_matrix(matrix):
+    return [share_array(array) for array in (matrix.data, matrix.indices, matrix.indptr)], matrix.shape
+
+
+def attach_csr_matrix(handle):
+    array_handles, shape = handle
+    data, indices, indptr = [attach_array(array_handle) for array_handle in array_handles]
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def share_matrices(matrices):
+    """Handles of a dictionary of numpy arrays and scipy CSR matrices, see attach_matrices"""
+    return {
+        name: (share_csr_matrix(matrix), True) if sp.issparse(matrix) else (share_array(matrix), False)
+        for name, matrix in matrices.items()
+    }
+
+
+def attach_matrices(handles):
+    return {
+        name: attach_csr_matrix(handle) if is_sparse else attach_array(handle)
+        for name, (handle, is_sparse) in handles.items()
+    }
@@ -0,0 +1,422 @@
+from sparse_handlers.shared_memory import share_matrices, attach_matrices
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+import numpy as np
+import scipy.sparse as sp
+import logging
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_ROUNDING = 10 ** 15
+
+# approximate similarity: candidate neighbours kept per neighbour by the projected dot products, then re-ranked exactly
+CANDIDATES_PER_NEIGHBOUR = 2
+RANDOMIZED_SVD_OVERSAMPLING = 10
+RANDOMIZED_SVD_POWER_ITERATIONS = 2
+# maximum number of dense dot products computed at once by a block of based entities
+MAX_DENSE_PRODUCTS_PER_BLOCK = 2 ** 25
+
+SimilarityBlock = namedtuple("SimilarityBlock", ["based_1", "based_2", "similarity"])
+ScoresBlock = namedtuple("ScoresBlock", ["based", "pivot", "score"])
+
+# matrices used by _compute_block, set in each worker of the process pool (or in the main process)
+_BLOCK_MATRICES = {}
+
+
+class SparseCollaborativeFiltering:
+    """Auto collaborative filtering computed in memory with sparse matrices
+
+    Same semantics as the SQL AutoScoringHandler: visit thresholds and caps, L2 normalization (centered on the
+    average rating of each based entity with explicit feedbacks), timestamp filtering (the top N most recent samples
+    or a window of timestamps, applied before or after the visit counts), similarity rounded to 15
+    decimals, top N neighbours by similarity then neighbour descending, and implicit or explicit scoring formulas.
+    As with SQL NULLs, entities whose ratings all equal their average have a NaN similarity, ranked last and ignored
+    by the scores sums. The caps keep the samples of the lowest hashes of the sampled codes (splitmix64): the SQL
+    dialects and Spark hash the ids differently, so above the caps each engine keeps a different sample of the same
+    size.
+
+    Users and items are given as integer codes whose order is the order of their ids, so that "col_1 < col_2" and
+    the tie-breaking of neighbours behave as the string comparisons in SQL.
+
+    With a projection ("randomized_svd" or "random_projection"), the normalized matrix is first projected into a
+    dense space of projection_dimension columns. The candidate neighbours of each based entity are the best dense dot
+    products, their similarity is then computed exactly so that only the recall of the top N is approximate.
+    """
+
+    def __init__(
+        self,
+        top_n_most_similar,
+        user_visit_threshold=1,
+        item_visit_threshold=1,
+        is_user_based=True,
+        user_visit_cap=None,
+        item_visit_cap=None,
+        downsampling_seed=1337,
+        top_n_most_recent=None,
+        recency_window=None,
+        recency_filter_first=False,
+        block_size=10000,
+        nb_workers=1,
+        projection=None,
+        projection_dimension=64,
+        recall_sample_size=1000,
+    ):
+        self.top_n_most_similar = top_n_most_similar
+        self.user_visit_threshold = user_visit_threshold
+        self.item_visit_threshold = item_visit_threshold
+        self.is_user_based = is_user_based
+        self.user_visit_cap = user_visit_cap
+        self.item_visit_cap = item_visit_cap
+        self.downsampling_seed = downsampling_seed
+        self.top_n_most_recent = top_n_most_recent
+        self.recency_window = recency_window
+        self.recency_filter_first = recency_filter_first
+        self.block_size = block_size
+        self.nb_workers = nb_workers
+        self.projection = projection
+        self.projection_dimension = projection_dimension
+        self.recall_sample_size = recall_sample_size
+        self.matrices = None
+        self.estimated_recall = None
+
+    def fit(self, user_codes, item_codes, ratings=None, timestamps=None, nb_users=None, nb_items=None):
+        """Build the normalized based x pivot matrix from the samples (one value per sample in each array)"""
+        user_codes = np.asarray(user_codes, dtype=np.int64)
+        item_codes = np.asarray(item_codes, dtype=np.int64)
+        nb_users = int(user_codes.max(initial=-1)) + 1 if nb_users is None else nb_users
+        nb_items = int(item_codes.max(initial=-1)) + 1 if nb_items is None else nb_items
+        use_explicit = ratings is not None
+        if use_explicit:
+            ratings = np.asarray(ratings, dtype=np.float64)
+        filter_recent = bool(self.top_n_most_recent or self.recency_window)
+        if filter_recent:
+            timestamps = np.asarray(timestamps)
+            if np.issubdtype(timestamps.dtype, np.datetime64):
+                timestamps = timestamps.astype("datetime64[ns]").view(np.int64)
+        if filter_recent and self.recency_filter_first:
+            # visit counts, ranks, rating averages and norms are computed on the most recent samples only
+            if self.is_user_based:
+                recent = self._get_recent(user_codes, item_codes, timestamps)
+            else:
+                recent = self._get_recent(item_codes, user_codes, timestamps)
+            user_codes, item_codes = user_codes[recent], item_codes[recent]
+            if use_explicit:
+                ratings = ratings[recent]
+        if self.is_user_based:
+            based_codes, pivot_codes, nb_based, nb_pivots = user_codes, item_codes, nb_users, nb_items
+        else:
+            based_codes, pivot_codes, nb_based, nb_pivots = item_codes, user_codes, nb_items, nb_users
+
+        # visit counts, ranks and rating averages are computed before thresholds and caps
+        nb_visit_user = np.bincount(user_codes, minlength=nb_users)
+        nb_visit_item = np.bincount(item_codes, minlength=nb_items)
+        kept = (nb_visit_user[user_codes] >= self.user_visit_threshold) & (
+            nb_visit_item[item_codes] >= self.item_visit_threshold
+        )
+        # duplicated samples share their codes, the most recent then the highest rated one ranks first under the caps
+        duplicate_keys = []
+        if filter_recent and not self.recency_filter_first:
+            duplicate_keys.append(-np.unique(timestamps, return_inverse=True)[1].reshape(-1))
+        if use_explicit:
+            duplicate_keys.append(-ratings)
+        if self.user_visit_cap:
+            kept &= self._get_visit_ranks(user_codes, item_codes, duplicate_keys) <= self.user_visit_cap
+        if self.item_visit_cap:
+            kept &= self._get_visit_ranks(item_codes, user_codes, duplicate_keys) <= self.item_visit_cap
+
+        if use_explicit:
+            nb_visit_based = np.bincount(based_codes, minlength=nb_based)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rating_average = np.bincount(based_codes, weights=ratings, minlength=nb_based) / nb_visit_based
+            centered_ratings = ratings[kept] - rating_average[based_codes[kept]]
+        else:
+            centered_ratings = np.ones(np.count_nonzero(kept))
+        based_codes, pivot_codes = based_codes[kept], pivot_codes[kept]
+
+        squared_norm = np.bincount(based_codes, weights=centered_ratings ** 2, minlength=nb_based)
+        with np.errstate(divide="ignore"):
+            normalization_factor = np.where(squared_norm > 0, 1 / np.sqrt(squared_norm), np.nan)
+
+        if filter_recent and not self.recency_filter_first:
+            recent = self._get_recent(based_codes, pivot_codes, timestamps[kept])
+            based_codes, pivot_codes = based_codes[recent], pivot_codes[recent]
+            centered_ratings = centered_ratings[recent]
+
+        shape = (nb_based, nb_pivots)
+        normalized = sp.csr_matrix(
+            (centered_ratings * normalization_factor[based_codes], (based_codes, pivot_codes)), shape=shape
+        )
+        samples_count = sp.csr_matrix((np.ones(len(based_codes)), (based_codes, pivot_codes)), shape=shape)
+        self.matrices = {
+            "normalized": normalized,
+            "normalized_t": normalized.T.tocsr(),
+            "samples_count": samples_count,
+            "samples_count_t": samples_count.T.tocsr(),
+            "centered_ratings": sp.csr_matrix((centered_ratings, (based_codes, pivot_codes)), shape=shape),
+        }
+        self.use_explicit = use_explicit
+        logger.info(f"Prepared a {nb_based} x {nb_pivots} matrix with {samples_count.nnz} non-zero values")
+        if self.projection:
+            self.matrices["embedding"] = self._get_embedding(normalized)
+            logger.info(f"Projected the matrix on {self.matrices['embedding'].shape[1]} dimensions ({self.projection})")
+            self.estimated_recall = self._estimate_recall()
+            logger.info(f"Estimated recall of the top {self.top_n_most_similar} neighbours: {self.estimated_recall}")
+        return self
+
+    def iter_blocks(self, half_similarity_matrix=True):
+        """Yield (SimilarityBlock, ScoresBlock) for each block of based entities, in the order of their codes
+
+        The similarity block holds the pairs col_1 < col_2 when half_similarity_matrix, all the pairs otherwise.
+        With a projection, it holds the top N neighbours found for each based entity.
+        Blocks are computed by a pool of nb_workers processes reading the matrices from shared memory.
+        """
+        nb_based = self.matrices["normalized"].shape[0]
+        block_size = self.block_size
+        if self.projection:
+            block_size = max(min(self.block_size, MAX_DENSE_PRODUCTS_PER_BLOCK // max(nb_based, 1)), 1)
+        block_starts = list(range(0, nb_based, block_size))
+        block_stops = [min(start + block_size, nb_based) for start in block_starts]
+        block_parameters = self._get_block_parameters(half_similarity_matrix)
+        if self.nb_workers <= 1:
+            _init_block_matrices(self.matrices, block_parameters)
+            for start, stop in zip(block_starts, block_stops):
+                yield _compute_block(start, stop)
+            return
+        shared_matrices = share_matrices(self.matrices)
+        with ProcessPoolExecutor(
+            self.nb_workers, initializer=_init_shared_block_matrices, initargs=(shared_matrices, block_parameters)
+        ) as executor:
+            for blocks in executor.map(_compute_block, block_starts, block_stops):
+                yield blocks
+
+    def _get_block_parameters(self, half_similarity_matrix):
+        return {
+            "half_similarity_matrix": half_similarity_matrix,
+            "use_explicit": self.use_explicit,
+            "top_n_most_similar": self.top_n_most_similar,
+            "use_projection": bool(self.projection),
+        }
+
+    def _get_embedding(self, normalized):
+        """Dense float32 projection of the normalized matrix whose dot products approximate the similarities"""
+        matrix = _with_data(normalized, np.nan_to_num(normalized.data))
+        nb_pivots = matrix.shape[1]
+        dimension = max(min(self.projection_dimension, nb_pivots), 1)
+        rng = np.random.default_rng(self.downsampling_seed)
+        if self.projection == "randomized_svd":
+            # Halko, Martinsson and Tropp: range of the matrix sketched by gaussian vectors, refined by power iterations
+            sketch_dimension = min(dimension + RANDOMIZED_SVD_OVERSAMPLING, nb_pivots)
+            sketch = matrix @ rng.standard_normal((nb_pivots, sketch_dimension))
+            for _ in range(RANDOMIZED_SVD_POWER_ITERATIONS):
+                sketch = matrix @ (matrix.T @ np.linalg.qr(sketch)[0])
+            basis = np.linalg.qr(sketch)[0]
+            left_vectors, singular_values, _ = np.linalg.svd((matrix.T @ basis).T, full_matrices=False)
+            embedding = basis @ (left_vectors[:, :dimension] * singular_values[:dimension])
+        else:
+            # Li, Hastie and Church: very sparse random projection of density 1 / sqrt(nb_pivots)
+            density = 1 / np.sqrt(nb_pivots)
+            non_zero = rng.random((nb_pivots, dimension)) < density
+            signs = rng.choice([-1.0, 1.0], size=(nb_pivots, dimension))
+            projection = sp.csr_matrix(np.where(non_zero, signs, 0.0) / np.sqrt(density * dimension))
+            embedding = (matrix @ projection).toarray()
+        return np.ascontiguousarray(embedding, dtype=np.float32)
+
+    def _estimate_recall(self):
+        """Share of the exact top N neighbours of a sample of based entities found with the projection"""
+        nb_based = self.matrices["normalized"].shape[0]
+        rng = np.random.default_rng(self.downsampling_seed)
+        sample = np.sort(rng.choice(nb_based, size=min(self.recall_sample_size, nb_based), replace=False))
+        _init_block_matrices(self.matrices, self._get_block_parameters(half_similarity_matrix=False))
+        block_size = max(min(self.block_size, MAX_DENSE_PRODUCTS_PER_BLOCK // max(nb_based, 1)), 1)
+        nb_exact, nb_found = 0, 0
+        for start in range(0, len(sample), block_size):
+            based = sample[start : start + block_size]
+            exact_keys = _get_top_n_keys(*_get_exact_similarity(based), nb_based)
+            approximate_keys = _get_top_n_keys(*_get_projected_similarity(based), nb_based)
+            nb_exact += len(exact_keys)
+            nb_found += len(np.intersect1d(exact_keys, approximate_keys, assume_unique=True))
+        return nb_found / nb_exact if nb_exact else 1.0
+
+    def _get_visit_ranks(self, partition_codes, sampled_codes, duplicate_keys=()):
+        """Row number of each sample in its partition, in a pseudo-random but deterministic order of sampled codes
+
+        The samples with the same sampled code are ordered by the duplicate_keys, the first key being the major one.
+        """
+        hashes = _hash_codes(sampled_codes, self.downsampling_seed)
+        order = np.lexsort((*reversed(duplicate_keys), sampled_codes, hashes, partition_codes))
+        return _get_ranks_in_sorted_groups(partition_codes, order)
+
+    def _get_recent(self, based_codes, pivot_codes, timestamps):
+        """Mask of the samples in the recency window (start included, end excluded), or of the most recent ones"""
+        if self.recency_window:
+            start, end = self.recency_window
+            recent = timestamps >= start
+            if end is not None:
+                recent &= timestamps < end
+            return recent
+        return self._get_most_recent(based_codes, pivot_codes, timestamps)
+
+    def _get_most_recent(self, based_codes, pivot_codes, timestamps):
+        """Mask of the top_n_most_recent samples of each based entity, by timestamp then pivot descending"""
+        timestamp_ranks = np.unique(timestamps, return_inverse=True)[1].reshape(-1)
+        order = np.lexsort((-pivot_codes, -timestamp_ranks, based_codes))
+        return _get_ranks_in_sorted_groups(based_codes, order) <= self.top_n_most_recent
+
+
+def _compute_block(start, stop):
+    based = np.arange(start, stop)
+    if _BLOCK_MATRICES["use_projection"]:
+        rows, cols, values = _get_projected_similarity(based)
+    else:
+        rows, cols, values = _get_exact_similarity(based)
+    top_n = _get_top_n(rows, cols, values)
+
+    if _BLOCK_MATRICES["use_projection"]:
+        similarity_block = SimilarityBlock(rows[top_n] + start, cols[top_n], values[top_n])
+    elif _BLOCK_MATRICES["half_similarity_matrix"]:
+        half = rows + start < cols
+        similarity_block = SimilarityBlock(rows[half] + start, cols[half], values[half])
+    else:
+        similarity_block = SimilarityBlock(rows + start, cols, values)
+
+    top_n_similarity = sp.csr_matrix(
+        (values[top_n], (rows[top_n], cols[top_n])), shape=(stop - start, _BLOCK_MATRICES["normalized"].shape[0])
+    )
+    return similarity_block, _compute_scores(top_n_similarity, start)
+
+
+def _get_exact_similarity(based):
+    """(row in based, neighbour, similarity) of all the neighbours sharing a pivot with the based entities"""
+    similarity = _get_aligned_product(
+        _BLOCK_MATRICES["normalized"][based],
+        _BLOCK_MATRICES["normalized_t"],
+        _BLOCK_MATRICES["samples_count"][based],
+        _BLOCK_MATRICES["samples_count_t"],
+    )
+    rows, cols = _get_rows(similarity), similarity.indices.astype(np.int64)
+    values = np.round(similarity.data * SIMILARITY_ROUNDING) / SIMILARITY_ROUNDING
+    not_diagonal = based[rows] != cols
+    return rows[not_diagonal], cols[not_diagonal], values[not_diagonal]
+
+
+def _get_projected_similarity(based):
+    """Same as _get_exact_similarity, restricted to the candidate neighbours with the best projected dot products"""
+    embedding = _BLOCK_MATRICES["embedding"]
+    nb_candidates = min(CANDIDATES_PER_NEIGHBOUR * _BLOCK_MATRICES["top_n_most_similar"], len(embedding) - 1)
+    if nb_candidates <= 0 or len(based) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.float64)
+    products = embedding[based] @ embedding.T
+    products[np.arange(len(based)), based] = -np.inf
+    candidates = np.argpartition(-products, nb_candidates - 1, axis=1)[:, :nb_candidates]
+    rows, cols = np.repeat(np.arange(len(based)), nb_candidates), candidates.reshape(-1).astype(np.int64)
+
+    # only the pairs sharing a pivot have a similarity, as with the exact computation
+    normalized, samples_count = _BLOCK_MATRICES["normalized"], _BLOCK_MATRICES["samples_count"]
+    nb_common = np.asarray(samples_count[based[rows]].multiply(samples_count[cols]).sum(axis=1)).reshape(-1)
+    values = np.asarray(normalized[based[rows]].multiply(normalized[cols]).sum(axis=1)).reshape(-1)
+    values = np.round(values * SIMILARITY_ROUNDING) / SIMILARITY_ROUNDING
+    shared = nb_common > 0
+    return rows[shared], cols[shared], values[shared]
+
+
+def _get_top_n(rows, cols, values):
+    """Mask of the top N neighbours of each row, by similarity then neighbour descending"""
+    order = np.lexsort((-cols, -values, rows))
+    return _get_ranks_in_sorted_groups(rows, order) <= _BLOCK_MATRICES["top_n_most_similar"]
+
+
+def _get_top_n_keys(rows, cols, values, nb_based):
+    top_n = _get_top_n(rows, cols, values)
+    return np.unique(rows[top_n] * nb_based + cols[top_n])
+
+
+def _compute_scores(top_n_similarity, start):
+    samples_count = _BLOCK_MATRICES["samples_count"]
+    null_similarity = np.isnan(top_n_similarity.data)
+    # NULL similarities are skipped by the sums, a score with only NULL similarities is NULL
+    non_null_similarity = _with_data(top_n_similarity, np.where(null_similarity, 0.0, top_n_similarity.data))
+    nb_non_null = _get_aligned_product(
+        _with_data(top_n_similarity, (~null_similarity).astype(np.float64)),
+        samples_count,
+        top_n_similarity,
+        samples_count,
+    )
+    if _BLOCK_MATRICES["use_explicit"]:
+        numerator = _get_aligned_product(
+            non_null_similarity, _BLOCK_MATRICES["centered_ratings"], top_n_similarity, samples_count
+        )
+        denominator = _get_aligned_product(
+            _with_data(non_null_similarity, np.abs(non_null_similarity.data)),
+            samples_count,
+            top_n_similarity,
+            samples_count,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = numerator.data / denominator.data
+    else:
+        numerator = _get_aligned_product(non_null_similarity, samples_count, top_n_similarity, samples_count)
+        scores = numerator.data / _BLOCK_MATRICES["top_n_most_similar"]
+    scores = np.where(nb_non_null.data > 0, scores, np.nan)
+
+    rows, pivots = _get_rows(numerator), numerator.indices.astype(np.int64)
+    order = np.lexsort((-scores, rows))
+    return ScoresBlock(rows[order] + start, pivots[order], scores[order])
+
+
+def _get_aligned_product(left, right, left_structure, right_structure):
+    """Product left @ right keeping an explicit value for each pair of the product of the structures
+
+    Sparse products drop the values summing to 0 (or NaN), while SQL joins output a row for each joined pair.
+    """
+    structure = (_get_structure(left_structure) @ _get_structure(right_structure)).tocsr()
+    structure.sort_indices()
+    values = (left @ right).tocsr()
+    values.sort_indices()
+    data = np.zeros(structure.nnz)
+    nb_cols = structure.shape[1]
+    structure_keys = _get_rows(structure) * nb_cols + structure.indices
+    values_keys = _get_rows(values) * nb_cols + values.indices
+    data[np.searchsorted(structure_keys, values_keys)] = values.data
+    return sp.csr_matrix((data, structure.indices, structure.indptr), shape=structure.shape)
+
+
+def _get_structure(matrix):
+    return _with_data(matrix, np.ones(matrix.nnz))
+
+
+def _with_data(matrix, data):
+    return sp.csr_matrix((data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+
+def _get_rows(matrix):
+    return np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+
+
+def _get_ranks_in_sorted_groups(groups, order):
+    """Rank (starting at 1) of each element in its group, following the given order sorted by group first"""
+    sorted_groups = groups[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]) if len(order) else order
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.repeat(group_starts, group_sizes) + 1
+    return ranks
+
+
+def _hash_codes(codes, seed):
+    """Deterministic pseudo-random 64 bits hash of integer codes (splitmix64)"""
+    with np.errstate(over="ignore"):
+        hashes = codes.astype(np.uint64) + np.uint64(seed % 2 ** 64) * np.uint64(0x9E3779B97F4A7C15)
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return hashes ^ (hashes >> np.uint64(31))
+
+
+def _init_shared_block_matrices(shared_matrices, block_parameters):
+    _init_block_matrices(attach_matrices(shared_matrices), block_parameters)
+
+
+def _init_block_matrices(matrices, block_parameters):
+    _BLOCK_MATRICES.clear()
+    _BLOCK_MATRICES.update(matrices)
+    _BLOCK_MATRICES.update(block_parameters)
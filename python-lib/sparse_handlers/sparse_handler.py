@@ -0,0 +1,122 @@
+from sparse_handlers.id_encoder import IdEncoder
+from sparse_handlers.interaction_matrix import InteractionMatrixBuilder
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+Samples = namedtuple("Samples", ["user_codes", "item_codes", "ratings", "timestamps", "user_ids", "item_ids"])
+
+
+class SparseHandler:
+    """Base of the handlers computing in the recipe on the samples encoded as integer codes, for datasets of any type
+
+    The samples are read by chunks and their ids encoded as integer codes in the order of the ids. Out of core, the
+    samples are first streamed into an InteractionMatrix on disk, which the computation reads instead of the dataset.
+    """
+
+    CHUNK_SIZE = 100000
+
+    def __init__(self, dku_config, file_manager):
+        self.dku_config = dku_config
+        self.file_manager = file_manager
+        self.use_explicit = bool(self.dku_config.ratings_column_name)
+        self.timestamp_filtering = bool(
+            self.dku_config.get("timestamp_filtering") and self.dku_config.get("timestamps_column_name")
+        )
+
+    def build(self):
+        if self.dku_config.out_of_core:
+            with self._get_interaction_matrix_directory() as directory:
+                self._compute(self._build_interaction_matrix(directory))
+        else:
+            self._compute(self._read_samples())
+
+    def _compute(self, samples):
+        raise NotImplementedError()
+
+    def _read_samples(self):
+        """Read all the samples in memory, with their ids encoded as integer codes in the order of the ids"""
+        users_encoder, items_encoder = IdEncoder(), IdEncoder()
+        samples = {"user_codes": [], "item_codes": [], "ratings": [], "timestamps": []}
+        for chunk in self._iter_sample_chunks(self.CHUNK_SIZE):
+            samples["user_codes"].append(users_encoder.encode(chunk[self.dku_config.users_column_name]))
+            samples["item_codes"].append(items_encoder.encode(chunk[self.dku_config.items_column_name]))
+            if self.use_explicit:
+                samples["ratings"].append(chunk[self.dku_config.ratings_column_name].values)
+            if self.timestamp_filtering:
+                samples["timestamps"].append(chunk[self.dku_config.timestamps_column_name].values)
+        samples = {name: np.concatenate(arrays) if arrays else np.empty(0) for name, arrays in samples.items()}
+        user_ids, user_codes = users_encoder.get_sorted_codes(samples["user_codes"].astype(np.int64))
+        item_ids, item_codes = items_encoder.get_sorted_codes(samples["item_codes"].astype(np.int64))
+        ratings = samples["ratings"] if self.use_explicit else None
+        timestamps = samples["timestamps"] if self.timestamp_filtering else None
+        logger.info(f"Read {len(user_codes)} samples of {len(user_ids)} users and {len(item_ids)} items")
+        return Samples(user_codes, item_codes, ratings, timestamps, user_ids, item_ids)
+
+    def _build_interaction_matrix(self, directory):
+        """Stream the samples into an InteractionMatrix on disk and return its memory-mapped samples"""
+        builder = InteractionMatrixBuilder(
+            directory,
+            max_memory_mb=self.dku_config.max_memory_mb,
+            with_ratings=self.use_explicit,
+            with_timestamps=self.timestamp_filtering,
+        )
+        for chunk in self._iter_sample_chunks(builder.chunk_size):
+            builder.add_chunk(
+                chunk[self.dku_config.users_column_name],
+                chunk[self.dku_config.items_column_name],
+                ratings=chunk[self.dku_config.ratings_column_name].values if self.use_explicit else None,
+                timestamps=chunk[self.dku_config.timestamps_column_name].values if self.timestamp_filtering else None,
+            )
+        interaction_matrix = builder.build()
+        return Samples(
+            interaction_matrix.get_user_codes(),
+            interaction_matrix.indices,
+            interaction_matrix.ratings,
+            interaction_matrix.timestamps,
+            interaction_matrix.user_ids,
+            interaction_matrix.item_ids,
+        )
+
+    @contextmanager
+    def _get_interaction_matrix_directory(self):
+        """Local path of the output folder of the interaction matrix if any, a temporary directory otherwise"""
+        interaction_matrix_folder = self.file_manager.get("interaction_matrix_folder")
+        if interaction_matrix_folder is not None:
+            yield interaction_matrix_folder.get_path()
+        else:
+            with tempfile.TemporaryDirectory(prefix="interaction_matrix_", dir=os.getcwd()) as directory:
+                yield directory
+
+    def _iter_sample_chunks(self, chunk_size):
+        """Read the samples dataset by chunks of chunk_size rows, with string ids and without unusable samples"""
+        samples_dataset = self.file_manager.samples_dataset
+        users_column, items_column = self.dku_config.users_column_name, self.dku_config.items_column_name
+        dtypes = {users_column: str, items_column: str}
+        required_columns = [users_column, items_column]
+        parse_date_columns = []
+        if self.use_explicit:
+            dtypes[self.dku_config.ratings_column_name] = np.float64
+            required_columns.append(self.dku_config.ratings_column_name)
+        if self.timestamp_filtering:
+            timestamps_column = self.dku_config.timestamps_column_name
+            if self._get_column_type(samples_dataset, timestamps_column) == "date":
+                dtypes[timestamps_column] = str
+                parse_date_columns.append(timestamps_column)
+            else:
+                dtypes[timestamps_column] = np.float64
+
+        for chunk in samples_dataset.iter_dataframes_forced_types(
+            names=list(dtypes), dtypes=dtypes, parse_date_columns=parse_date_columns, chunksize=chunk_size
+        ):
+            # samples without user or item can't be joined in SQL, samples without rating have no similarity
+            yield chunk.dropna(subset=required_columns)
+
+    def _get_column_type(self, dataset, column_name):
+        return next((column["type"] for column in dataset.read_schema() if column["name"] == column_name), "string")
+
@@ -0,0 +1,141 @@
+from sparse_handlers.sparse_handler import SparseHandler
+from sparse_handlers.sparse_collaborative_filtering import SparseCollaborativeFiltering
+from dku_utils import set_column_description
+import dku_constants as constants
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SparseScoringHandler(SparseHandler):
+    """Auto collaborative filtering computed in the recipe with sparse matrices, for datasets of any type
+
+    Produces the same outputs as the AutoScoringHandler: the samples are read by chunks, their ids encoded as integer
+    codes, and the similarities and scores are computed and written by blocks of based entities. With visit caps, the
+    downsampled samples differ from the SQL ones, the codes being hashed with another function than the SQL ids.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_user_based = self.dku_config.collaborative_filtering_method == constants.CF_METHOD.USER_BASED
+        if self.is_user_based:
+            self.based_column = self.dku_config.users_column_name
+            self.pivot_column = self.dku_config.items_column_name
+        else:
+            self.based_column = self.dku_config.items_column_name
+            self.pivot_column = self.dku_config.users_column_name
+        self.output_similarity_matrix = self.file_manager.similarity_scores_dataset is not None
+        self.use_projection = self.dku_config.similarity_computation in constants.PROJECTION_SIMILARITY_COMPUTATIONS
+        self.estimated_recall = None
+
+    def _compute(self, samples):
+        nb_users, nb_items = len(samples.user_ids), len(samples.item_ids)
+        collaborative_filtering = SparseCollaborativeFiltering(
+            top_n_most_similar=self.dku_config.top_n_most_similar,
+            user_visit_threshold=self.dku_config.user_visit_threshold,
+            item_visit_threshold=self.dku_config.item_visit_threshold,
+            is_user_based=self.is_user_based,
+            user_visit_cap=self.dku_config.user_visit_cap,
+            item_visit_cap=self.dku_config.item_visit_cap,
+            downsampling_seed=self.dku_config.downsampling_seed,
+            top_n_most_recent=self.dku_config.get("top_n_most_recent") if self.timestamp_filtering else None,
+            recency_window=self._get_recency_window(),
+            recency_filter_first=bool(self.timestamp_filtering and self.dku_config.get("recency_filter_first")),
+            block_size=self.dku_config.block_size,
+            nb_workers=self.dku_config.nb_workers,
+            projection=self.dku_config.similarity_computation.value if self.use_projection else None,
+            projection_dimension=self.dku_config.get("projection_dimension"),
+            recall_sample_size=self.dku_config.get("recall_sample_size"),
+        ).fit(
+            samples.user_codes,
+            samples.item_codes,
+            ratings=samples.ratings,
+            timestamps=samples.timestamps,
+            nb_users=nb_users,
+            nb_items=nb_items,
+        )
+        self.estimated_recall = collaborative_filtering.estimated_recall
+        if self.is_user_based:
+            based_ids, pivot_ids = samples.user_ids, samples.item_ids
+        else:
+            based_ids, pivot_ids = samples.item_ids, samples.user_ids
+        self._write_blocks(collaborative_filtering, based_ids, pivot_ids)
+
+    def _get_recency_window(self):
+        """Start and end of the date window, as nanoseconds since the epoch for date columns (as their timestamps)"""
+        if not self.timestamp_filtering or self.dku_config.recency_filter != constants.RECENCY_FILTER.DATE_WINDOW:
+            return None
+        bounds = [self.dku_config.recency_window_start, self.dku_config.get("recency_window_end")]
+        timestamps_column = self.dku_config.timestamps_column_name
+        if self._get_column_type(self.file_manager.samples_dataset, timestamps_column) == "date":
+            bounds = [None if bound is None else pd.Timestamp(bound).value for bound in bounds]
+        return tuple(bounds)
+
+    def _write_blocks(self, collaborative_filtering, based_ids, pivot_ids):
+        similarity_dataset = self.file_manager.similarity_scores_dataset
+        scored_samples_dataset = self.file_manager.scored_samples_dataset
+        scored_samples_dataset.write_schema(
+            [
+                {"name": self.based_column, "type": "string"},
+                {"name": self.pivot_column, "type": "string"},
+                {"name": constants.SCORE_COLUMN_NAME, "type": "double"},
+            ]
+        )
+        if self.output_similarity_matrix:
+            similarity_dataset.write_schema(
+                [
+                    {"name": f"{self.based_column}_1", "type": "string"},
+                    {"name": f"{self.based_column}_2", "type": "string"},
+                    {"name": constants.SIMILARITY_COLUMN_NAME, "type": "double"},
+                ]
+            )
+
+        blocks = collaborative_filtering.iter_blocks(half_similarity_matrix=not self.dku_config.full_similarity_matrix)
+        nb_similarity_rows, nb_score_rows = 0, 0
+        with scored_samples_dataset.get_writer() as scores_writer:
+            similarity_writer = similarity_dataset.get_writer() if self.output_similarity_matrix else None
+            try:
+                for similarity_block, scores_block in blocks:
+                    scores_df = pd.DataFrame(
+                        {
+                            self.based_column: based_ids[scores_block.based],
+                            self.pivot_column: pivot_ids[scores_block.pivot],
+                            constants.SCORE_COLUMN_NAME: scores_block.score,
+                        }
+                    )
+                    scores_writer.write_dataframe(scores_df)
+                    nb_score_rows += len(scores_df)
+                    if similarity_writer:
+                        similarity_df = pd.DataFrame(
+                            {
+                                f"{self.based_column}_1": based_ids[similarity_block.based_1],
+                                f"{self.based_column}_2": based_ids[similarity_block.based_2],
+                                constants.SIMILARITY_COLUMN_NAME: similarity_block.similarity,
+                            }
+                        )
+                        similarity_writer.write_dataframe(similarity_df)
+                        nb_similarity_rows += len(similarity_df)
+            finally:
+                if similarity_writer:
+                    similarity_writer.close()
+        logger.info(f"Wrote {nb_score_rows} scores and {nb_similarity_rows} similarities")
+
+        if self.output_similarity_matrix:
+            self._set_column_description(similarity_dataset, constants.SIMILARITY_COLUMN_NAME)
+        self._set_column_description(scored_samples_dataset, constants.SCORE_COLUMN_NAME)
+
+    def _set_column_description(self, output_dataset, column_name):
+        cf_based_on = "user" if self.is_user_based else "item"
+        if column_name == constants.SCORE_COLUMN_NAME:
+            description = f"User-item affinity scores (using {cf_based_on}-based collaborative filtering)"
+        else:
+            description = f"Similarity between {cf_based_on}s (higher means more similar)"
+            if self.use_projection:
+                description += (
+                    f", top {self.dku_config.top_n_most_similar} neighbors of each {cf_based_on} found by projection"
+                    f" (estimated recall {self.estimated_recall:.3f})"
+                )
+            elif not self.dku_config.full_similarity_matrix:
+                description += f", each pair is stored once with {cf_based_on} 1 < {cf_based_on} 2"
+        set_column_description(output_dataset, {column_name: description})
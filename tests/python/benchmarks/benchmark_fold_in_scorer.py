@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Latency and memory footprint of the FoldInScorer on a synthetic item neighbours table
+
+Usage: PYTHONPATH=python-lib python tests/python/benchmarks/benchmark_fold_in_scorer.py [--nb-pairs 10000000]
+
+The target for a 10M pairs table is a neighbour index under 160 MB (about 12 bytes per pair, plus the item
+averages and offsets) and a scoring latency under 10 ms for a single user with 20 recent items.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from sparse_handlers.fold_in_scorer import FoldInScorer
+
+TARGET_BYTES_PER_PAIR = 16
+TARGET_SINGLE_USER_LATENCY_MS = 10
+
+
+def generate_neighbours(nb_pairs, top_n, seed):
+    rng = np.random.default_rng(seed)
+    nb_items = nb_pairs // top_n
+    items_1 = np.repeat(np.arange(nb_items), top_n)
+    items_2 = (items_1 + rng.integers(1, nb_items, nb_pairs)) % nb_items
+    return items_1.astype(str), items_2.astype(str), rng.random(nb_pairs), nb_items
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-pairs", type=int, default=10 ** 7)
+    parser.add_argument("--top-n", type=int, default=10)
+    parser.add_argument("--items-per-user", type=int, default=20)
+    parser.add_argument("--nb-repeats", type=int, default=20)
+    arguments = parser.parse_args()
+
+    items_1, items_2, similarity, nb_items = generate_neighbours(arguments.nb_pairs, arguments.top_n, seed=0)
+    start = time.perf_counter()
+    scorer = FoldInScorer(top_n_most_similar=arguments.top_n).fit(items_1, items_2, similarity)
+    print(f"fit: {time.perf_counter() - start:.1f}s for {scorer.neighbours.nnz} pairs of {nb_items} items")
+    target_mb = TARGET_BYTES_PER_PAIR * arguments.nb_pairs / 2 ** 20
+    print(f"memory: {scorer.nbytes / 2 ** 20:.1f} MB (target {target_mb:.1f} MB)")
+
+    rng = np.random.default_rng(1)
+    for batch_size in [1, 100, 1000]:
+        users = np.repeat(np.arange(batch_size), arguments.items_per_user)
+        items = pd.Series(rng.integers(0, nb_items, len(users)).astype(str))
+        latencies = []
+        for _ in range(arguments.nb_repeats):
+            start = time.perf_counter()
+            scorer.score(users, items)
+            latencies.append(time.perf_counter() - start)
+        print(
+            f"batch of {batch_size} users: median {np.median(latencies) * 1000:.2f} ms, "
+            f"p95 {np.percentile(latencies, 95) * 1000:.2f} ms"
+        )
+    print(f"single user latency target: {TARGET_SINGLE_USER_LATENCY_MS} ms")
+
+
+if __name__ == "__main__":
+    main()
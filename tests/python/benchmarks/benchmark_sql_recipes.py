@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""Runtime, peak memory and output cardinality of the SQL recipes on synthetic power-law interactions
+
+Usage: PYTHONPATH=python-lib python tests/python/benchmarks/benchmark_sql_recipes.py [--sizes 2000x1000 8000x4000]
+           [--entity-statistics grouped] [--uuid-ids] [--encode-ids] [--baseline sql_recipes_baseline.json]
+           [--save-baseline]
+
+The queries of the AutoScoringHandler, CustomScoringHandler and SamplingHandler are run on a local DuckDB database
+through the dataiku stand-in of sql_stand_in (see requirements.txt). The custom scoring reads the similarity of the
+auto scoring and the sampling its scores. Each recipe runs in its own process so that its peak memory (the resident
+set size of the process, DuckDB included) is measured alone.
+
+The interactions are generated from a seed, so the output rows of a size never change without a change of the
+queries: they must match the baseline exactly, while runtime and peak memory may exceed it by --tolerance. Compare
+runs on the same machine only, the script exits with status 1 when a regression is found.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql_stand_in"))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import dataiku  # noqa: E402
+from config_handler import create_dku_config  # noqa: E402
+from dku_constants import RECIPE, ENTITY_STATISTICS  # noqa: E402
+from duckdb_dialect import register_duckdb_dialect  # noqa: E402
+from query_handlers import AutoScoringHandler, CustomScoringHandler, SamplingHandler  # noqa: E402
+from dataiku.sql import Dialects  # noqa: E402
+from stand_in_recipes import create_file_manager  # noqa: E402
+
+RECIPES = ["auto_scoring", "custom_scoring", "sampling"]
+DEFAULT_SIZES = ["1000x500", "2000x1000", "4000x2000"]
+RATING_DISTRIBUTIONS = ["none", "uniform", "power_law"]
+START_TIMESTAMP = 1577836800  # 2020-01-01
+TRAINING_QUANTILE = 0.8  # the most recent samples are the training samples of the sampling, the others its history
+
+SAMPLES_COLUMNS = {"users_column_name": "user_id", "items_column_name": "item_id"}
+
+
+def get_power_law_weights(nb_values, exponent):
+    weights = 1 / np.arange(1, nb_values + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_interactions(nb_users, nb_items, density, exponent, ratings, timestamp_days, seed, uuid_ids=False):
+    """Interactions of users and items whose activity and popularity follow a power law of the given exponent
+
+    With uuid_ids, the IDs are strings of 36 characters formatted as UUIDs instead of short strings like u42.
+    """
+    rng = np.random.default_rng(seed)
+    nb_samples = max(int(density * nb_users * nb_items), 1)
+    users = rng.choice(nb_users, nb_samples, p=get_power_law_weights(nb_users, exponent))
+    items = rng.choice(nb_items, nb_samples, p=get_power_law_weights(nb_items, exponent))
+    users, items = users.astype(str), items.astype(str)
+    if uuid_ids:
+        users = np.char.add("00000000-0000-4000-8000-", np.char.zfill(users, 12))
+        items = np.char.add("00000000-0000-4000-9000-", np.char.zfill(items, 12))
+    else:
+        users, items = np.char.add("u", users), np.char.add("i", items)
+    samples_df = pd.DataFrame({"user_id": users, "item_id": items})
+    if ratings == "uniform":
+        samples_df["rating"] = rng.integers(1, 6, nb_samples).astype(float)
+    elif ratings == "power_law":
+        samples_df["rating"] = 5.0 - rng.choice(5, nb_samples, p=get_power_law_weights(5, exponent))
+    samples_df["timestamp"] = START_TIMESTAMP + rng.integers(0, timestamp_days * 24 * 3600, nb_samples)
+    return samples_df
+
+
+def create_tables(database_path, samples_df):
+    """Samples table of the scorings, and the training and historical samples tables of the sampling"""
+    dataiku.connect(database_path)
+    connection = dataiku.get_connection()
+    connection.register("_samples_df", samples_df)
+    connection.execute("CREATE OR REPLACE TABLE samples AS SELECT * FROM _samples_df")
+    connection.unregister("_samples_df")
+    cutoff = int(samples_df["timestamp"].quantile(TRAINING_QUANTILE))
+    for table, condition in [("training_samples", f">= {cutoff}"), ("historical_samples", f"< {cutoff}")]:
+        connection.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM samples WHERE timestamp {condition}")
+    dataiku.connect(":memory:")
+
+
+def get_scoring_config(arguments):
+    config = {
+        **SAMPLES_COLUMNS,
+        "top_n_most_similar": arguments.top_n_most_similar,
+        "user_visit_threshold": arguments.visit_threshold,
+        "item_visit_threshold": arguments.visit_threshold,
+        "entity_statistics": arguments.entity_statistics,
+        "encode_ids": arguments.encode_ids,
+    }
+    if arguments.ratings != "none":
+        config["ratings_column_name"] = "rating"
+    if arguments.top_n_most_recent:
+        config.update(
+            timestamp_filtering=True,
+            timestamps_column_name="timestamp",
+            top_n_most_recent=arguments.top_n_most_recent,
+            recency_filter_first=not arguments.recency_filter_last,
+        )
+    return config
+
+
+def run_auto_scoring(arguments):
+    file_manager = create_file_manager(
+        samples_dataset="samples",
+        scored_samples_dataset="auto_scored_samples",
+        similarity_scores_dataset="auto_similarity_scores",
+    )
+    config = {**get_scoring_config(arguments), "collaborative_filtering_method": "user_based"}
+    dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, config, file_manager=file_manager)
+    AutoScoringHandler(dku_config, file_manager).build()
+    return ["auto_scored_samples", "auto_similarity_scores"]
+
+
+def run_custom_scoring(arguments):
+    file_manager = create_file_manager(
+        samples_dataset="samples",
+        similarity_scores_dataset="auto_similarity_scores",
+        scored_samples_dataset="custom_scored_samples",
+    )
+    config = {
+        **get_scoring_config(arguments),
+        "similarity_scores_type": "user_similarity",
+        "similarity_users_column_1_name": "user_id_1",
+        "similarity_users_column_2_name": "user_id_2",
+        "similarity_score_column_name": "similarity",
+        "half_similarity_matrix": True,
+    }
+    dku_config = create_dku_config(RECIPE.AFFINITY_SCORE, config, file_manager=file_manager)
+    CustomScoringHandler(dku_config, file_manager).build()
+    return ["custom_scored_samples"]
+
+
+def run_sampling(arguments):
+    file_manager = create_file_manager(
+        scored_samples_dataset="auto_scored_samples",
+        training_samples_dataset="training_samples",
+        historical_samples_dataset="historical_samples",
+        positive_negative_samples_dataset="positive_negative_samples",
+    )
+    config = {
+        **SAMPLES_COLUMNS,
+        "scored_samples_users_column_name": "user_id",
+        "scored_samples_items_column_name": "item_id",
+        "score_column_names": ["score"],
+        "training_samples_users_column_name": "user_id",
+        "training_samples_items_column_name": "item_id",
+        "historical_samples": True,
+        "historical_samples_users_column_name": "user_id",
+        "historical_samples_items_column_name": "item_id",
+        "sampling_method": "negative_samples_percentage",
+        "negative_samples_percentage": arguments.negative_samples_percentage,
+        "encode_ids": arguments.encode_ids,
+    }
+    dku_config = create_dku_config(RECIPE.SAMPLING, config, file_manager=file_manager)
+    SamplingHandler(dku_config, file_manager).build()
+    return ["positive_negative_samples"]
+
+
+RECIPE_RUNNERS = {"auto_scoring": run_auto_scoring, "custom_scoring": run_custom_scoring, "sampling": run_sampling}
+
+
+def measure_recipe(recipe, database_path, arguments):
+    """Runtime, peak memory and output rows of a recipe, run in a process of its own"""
+    register_duckdb_dialect(arguments.emulated_dialect)
+    dataiku.connect(database_path)
+    start = time.perf_counter()
+    output_tables = RECIPE_RUNNERS[recipe](arguments)
+    runtime = time.perf_counter() - start
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+    connection = dataiku.get_connection()
+    output_rows = {
+        table: connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in output_tables
+    }
+    dataiku.connect(":memory:")
+    return {"runtime_s": round(runtime, 3), "peak_memory_mb": round(peak_memory_mb, 1), "output_rows": output_rows}
+
+
+def run_benchmarks(arguments):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in arguments.sizes:
+            nb_users, nb_items = (int(value) for value in size.split("x"))
+            samples_df = generate_interactions(
+                nb_users,
+                nb_items,
+                arguments.density,
+                arguments.exponent,
+                arguments.ratings,
+                arguments.timestamp_days,
+                arguments.seed,
+                uuid_ids=arguments.uuid_ids,
+            )
+            database_path = os.path.join(directory, f"{size}.duckdb")
+            create_tables(database_path, samples_df)
+            print(f"{size}: {len(samples_df)} samples")
+            for recipe in RECIPES:
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_recipe, (recipe, database_path, arguments))
+                results[f"{recipe}:{size}"] = result
+                rows = ", ".join(f"{table} {nb_rows}" for table, nb_rows in result["output_rows"].items())
+                print(f"  {recipe}: {result['runtime_s']:.2f}s, {result['peak_memory_mb']:.0f} MB peak, {rows} rows")
+    return results
+
+
+def get_parameters(arguments):
+    """Parameters of the generated data and of the recipes, a baseline is only comparable with the same ones"""
+    return {
+        name: getattr(arguments, name)
+        for name in [
+            "density",
+            "exponent",
+            "ratings",
+            "timestamp_days",
+            "seed",
+            "visit_threshold",
+            "top_n_most_similar",
+            "top_n_most_recent",
+            "recency_filter_last",
+            "entity_statistics",
+            "uuid_ids",
+            "encode_ids",
+            "negative_samples_percentage",
+            "emulated_dialect",
+        ]
+    }
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        baseline_result = baseline[case]
+        if result["output_rows"] != baseline_result["output_rows"]:
+            regressions.append(
+                f"{case}: output rows {result['output_rows']} instead of {baseline_result['output_rows']}"
+            )
+        for measure in ["runtime_s", "peak_memory_mb"]:
+            if result[measure] > baseline_result[measure] * (1 + tolerance):
+                regressions.append(f"{case}: {measure} {result[measure]} instead of {baseline_result[measure]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="numbers of users and items, as 1000x500")
+    parser.add_argument("--density", type=float, default=0.005, help="ratio of the user-item pairs in the samples")
+    parser.add_argument("--exponent", type=float, default=0.8, help="exponent of the power laws of the interactions")
+    parser.add_argument("--ratings", choices=RATING_DISTRIBUTIONS, default="none")
+    parser.add_argument("--timestamp-days", type=int, default=365)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--visit-threshold", type=int, default=10, help="minimum visits per user and per item")
+    parser.add_argument("--top-n-most-similar", type=int, default=20)
+    parser.add_argument("--top-n-most-recent", type=int, default=None, help="timestamp filtering of the scorings")
+    parser.add_argument(
+        "--recency-filter-last", action="store_true", help="filter the most recent samples after the visit counts"
+    )
+    parser.add_argument(
+        "--entity-statistics",
+        choices=[entity_statistics.value for entity_statistics in ENTITY_STATISTICS],
+        default=ENTITY_STATISTICS.AUTO.value,
+        help="visit counts and normalization factors computed with windows or grouped by entity and joined back",
+    )
+    parser.add_argument("--uuid-ids", action="store_true", help="generate IDs of 36 characters formatted as UUIDs")
+    parser.add_argument(
+        "--encode-ids", action="store_true", help="join, group and rank the users and items on integer codes"
+    )
+    parser.add_argument("--negative-samples-percentage", type=int, default=50)
+    parser.add_argument(
+        "--emulated-dialect",
+        choices=[Dialects.POSTGRES, Dialects.SNOWFLAKE, Dialects.BIGQUERY, Dialects.SQLSERVER, Dialects.SYNAPSE],
+        default=None,
+        help="build the queries with the constructs selected for this dialect, DuckDB's by default",
+    )
+    parser.add_argument("--baseline", default=None, help="JSON file of the results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed increase of runtime and peak memory")
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments)
+    parameters = get_parameters(arguments)
+    if arguments.baseline is None:
+        return
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump({"parameters": parameters, "results": results}, baseline_file, indent=2)
+        print(f"baseline saved to {arguments.baseline}")
+        return
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["parameters"] != parameters:
+        print(f"the baseline was run with other parameters: {baseline['parameters']}")
+        sys.exit(1)
+    regressions = find_regressions(results, baseline["results"], arguments.tolerance)
+    for regression in regressions:
+        print(f"regression of {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"no regression against {arguments.baseline}")
+
+
+if __name__ == "__main__":
+    main()
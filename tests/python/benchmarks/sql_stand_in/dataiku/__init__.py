@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Stand-in of the dataiku package running the SQL recipes of the plugin on a local DuckDB database
+
+Only the subset of the API used by the query handlers is implemented: SQL datasets are DuckDB tables of the same
+name, of connection type DUCKDB_CONNECTION_TYPE (registered in dku_dialects by the benchmarks).
+"""
+import os
+
+import duckdb
+
+DUCKDB_CONNECTION_TYPE = "DuckDB"
+
+_DATABASE = {"path": ":memory:", "connection": None}
+
+_DUCKDB_TO_DSS_TYPES = {
+    "VARCHAR": "string",
+    "DOUBLE": "double",
+    "FLOAT": "float",
+    "BIGINT": "bigint",
+    "INTEGER": "int",
+    "DATE": "date",
+}
+_DSS_TO_DUCKDB_TYPES = {value: key for key, value in _DUCKDB_TO_DSS_TYPES.items()}
+
+
+def connect(path=":memory:"):
+    """Use the database file at path for the next queries"""
+    if _DATABASE["connection"] is not None:
+        _DATABASE["connection"].close()
+    _DATABASE.update(path=path, connection=None)
+
+
+def get_connection():
+    if _DATABASE["connection"] is None:
+        _DATABASE["connection"] = duckdb.connect(_DATABASE["path"])
+    return _DATABASE["connection"]
+
+
+class Dataset:
+    def __init__(self, name):
+        self.name = name
+        self.full_name = f"BENCHMARKS.{name}"
+        self.metric_values = {}
+        self._schema = None
+
+    def get_config(self):
+        return {"type": DUCKDB_CONNECTION_TYPE, "params": {"connection": "benchmarks"}}
+
+    def get_location_info(self, sensitive_info=False):
+        return {"locationInfoType": "SQL", "info": {"table": self.name, "quotedResolvedTableName": f'"{self.name}"'}}
+
+    def read_schema(self):
+        columns = get_connection().execute(f'DESCRIBE "{self.name}"').fetchall()
+        return [{"name": column[0], "type": _DUCKDB_TO_DSS_TYPES.get(column[1], "string")} for column in columns]
+
+    def write_schema(self, schema):
+        self._schema = schema
+
+    def get_dataframe(self, columns=None):
+        selected_columns = ", ".join(f'"{column}"' for column in columns) if columns else "*"
+        return get_connection().execute(f'SELECT {selected_columns} FROM "{self.name}"').df()
+
+    def get_writer(self):
+        return _DatasetWriter(self.name, self._schema)
+
+    def save_external_metric_values(self, values_dict):
+        self.metric_values.update(values_dict)
+
+
+class _DatasetWriter:
+    def __init__(self, table_name, schema):
+        self.table_name = table_name
+        columns = ", ".join(f'"{column["name"]}" {_DSS_TO_DUCKDB_TYPES[column["type"]]}' for column in schema)
+        get_connection().execute(f'CREATE OR REPLACE TABLE "{table_name}" ({columns})')
+
+    def write_dataframe(self, df):
+        connection = get_connection()
+        connection.register("_written_dataframe", df)
+        connection.execute(f'INSERT INTO "{self.table_name}" SELECT * FROM _written_dataframe')
+        connection.unregister("_written_dataframe")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class Folder:
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self.path
+
+    def get_writer(self, file_path):
+        full_path = os.path.join(self.get_path(), file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        return open(full_path, "wb")
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from dataiku import get_connection
+
+
+class SQLExecutor2:
+    """Statements of a call run in their own cursor, as the queries of a DSS call run in their own session"""
+
+    def __init__(self, dataset=None, connection=None):
+        self.dataset = dataset
+
+    def exec_recipe_fragment(self, output_dataset, query, pre_queries=None, post_queries=None, **kwargs):
+        cursor = get_connection().cursor()
+        for pre_query in pre_queries or []:
+            cursor.execute(pre_query)
+        cursor.execute(f'CREATE OR REPLACE TABLE "{output_dataset.name}" AS {query}')
+        for post_query in post_queries or []:
+            cursor.execute(post_query)
+
+    def query_to_df(self, query, pre_queries=None, post_queries=None, **kwargs):
+        cursor = get_connection().cursor()
+        for pre_query in pre_queries or []:
+            cursor.execute(pre_query)
+        df = cursor.execute(query).df()
+        for post_query in post_queries or []:
+            if post_query != "COMMIT":  # the statements of a cursor are auto-committed
+                cursor.execute(post_query)
+        return df
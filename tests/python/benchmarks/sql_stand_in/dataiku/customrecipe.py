@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""The benchmarks build the file managers themselves, recipes have no roles nor config outside of DSS"""
+
+
+def get_input_names_for_role(role):
+    return []
+
+
+def get_output_names_for_role(role):
+    return []
+
+
+def get_recipe_config():
+    return {}
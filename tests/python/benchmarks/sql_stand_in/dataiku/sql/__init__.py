@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Stand-in of the dataiku.sql query builder rendering the queries of the plugin in the PostgreSQL syntax of DuckDB"""
+
+
+class Dialects:
+    POSTGRES = "PostgreSQL"
+    SNOWFLAKE = "Snowflake"
+    BIGQUERY = "BigQuery"
+    SQLSERVER = "SQLServer"
+    SYNAPSE = "Synapse"
+
+
+class JoinTypes:
+    INNER = "INNER"
+    LEFT = "LEFT"
+    RIGHT = "RIGHT"
+    FULL = "FULL"
+    CROSS = "CROSS"
+
+
+_CAST_TYPES = {"string": "VARCHAR", "double": "DOUBLE", "int": "BIGINT", "bigint": "BIGINT", "date": "DATE"}
+
+
+def _quote(identifier):
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def _to_expression(value):
+    return value if isinstance(value, Expression) else Constant(value)
+
+
+class Expression:
+    def __init__(self, render=None):
+        self._render = render
+
+    def render(self):
+        return self._render()
+
+    def _operator(self, operator, other):
+        other = _to_expression(other)
+        return Expression(lambda: f"({self.render()} {operator} {other.render()})")
+
+    def _function(self, function):
+        return Expression(lambda: f"{function}({self.render()})")
+
+    def plus(self, other):
+        return self._operator("+", other)
+
+    def minus(self, other):
+        return self._operator("-", other)
+
+    def times(self, other):
+        return self._operator("*", other)
+
+    def div(self, other):
+        return self._operator("/", other)
+
+    def eq(self, other):
+        return self._operator("=", other)
+
+    def ne(self, other):
+        return self._operator("<>", other)
+
+    def lt(self, other):
+        return self._operator("<", other)
+
+    def le(self, other):
+        return self._operator("<=", other)
+
+    def gt(self, other):
+        return self._operator(">", other)
+
+    def ge(self, other):
+        return self._operator(">=", other)
+
+    def eq_null_unsafe(self, other):
+        return self._operator("IS NOT DISTINCT FROM", other)
+
+    def and_(self, other):
+        return self._operator("AND", other)
+
+    def or_(self, other):
+        return self._operator("OR", other)
+
+    def is_null(self):
+        return Expression(lambda: f"({self.render()} IS NULL)")
+
+    def is_not_null(self):
+        return Expression(lambda: f"({self.render()} IS NOT NULL)")
+
+    def sqrt(self):
+        return self._function("SQRT")
+
+    def abs(self):
+        return self._function("ABS")
+
+    def ceil(self):
+        return self._function("CEIL")
+
+    def floor(self):
+        return self._function("FLOOR")
+
+    def round(self):
+        return self._function("ROUND")
+
+    def sum(self):
+        return self._function("SUM")
+
+    def avg(self):
+        return self._function("AVG")
+
+    def min(self):
+        return self._function("MIN")
+
+    def max(self):
+        return self._function("MAX")
+
+    def count(self):
+        return self._function("COUNT")
+
+    def countDistinct(self):
+        return Expression(lambda: f"COUNT(DISTINCT {self.render()})")
+
+    def rowNumber(self):
+        return Expression(lambda: "ROW_NUMBER()")
+
+    def coalesce(self, other):
+        other = _to_expression(other)
+        return Expression(lambda: f"COALESCE({self.render()}, {other.render()})")
+
+    def cast(self, target_type):
+        return Expression(lambda: f"CAST({self.render()} AS {_CAST_TYPES.get(target_type, target_type)})")
+
+    def over(self, window):
+        return Expression(lambda: f"{self.render()} OVER ({window.render()})")
+
+
+class Column(Expression):
+    def __init__(self, name, table_name=None):
+        super().__init__(self._render_column)
+        self.name = name
+        self.table_name = table_name
+
+    def _render_column(self):
+        if self.name == "*":
+            return "*"
+        if self.table_name:
+            return f"{_quote(self.table_name)}.{_quote(self.name)}"
+        return _quote(self.name)
+
+
+class Constant(Expression):
+    def __init__(self, value):
+        super().__init__(self._render_constant)
+        self.value = value
+
+    def _render_constant(self):
+        if isinstance(self.value, bool):
+            return "TRUE" if self.value else "FALSE"
+        if isinstance(self.value, (int, float)):
+            return repr(self.value)
+        return "'" + str(self.value).replace("'", "''") + "'"
+
+
+class InlineSQL(Expression):
+    def __init__(self, sql):
+        super().__init__(lambda: sql)
+
+
+class Window:
+    def __init__(self, partition_by=None, order_by=None, order_types=None, **kwargs):
+        self.partition_by = partition_by or []
+        self.order_by = order_by or []
+        self.order_types = order_types or ["ASC"] * len(self.order_by)
+
+    def render(self):
+        clauses = []
+        if self.partition_by:
+            clauses.append("PARTITION BY " + ", ".join(column.render() for column in self.partition_by))
+        if self.order_by:
+            orders = zip(self.order_by, self.order_types)
+            clauses.append("ORDER BY " + ", ".join(f"{column.render()} {order}" for column, order in orders))
+        return " ".join(clauses)
+
+
+def _render_from(select_from):
+    if isinstance(select_from, SelectQuery):
+        return f"({select_from.render()})"
+    if isinstance(select_from, str):
+        return _quote(select_from)
+    return _quote(select_from.name)  # dataiku.Dataset
+
+
+class SelectQuery:
+    def __init__(self):
+        self._select = []
+        self._from = None
+        self._joins = []
+        self._where = []
+        self._group_by = []
+        self._order_by = []
+
+    def select_from(self, select_from, alias=None):
+        self._from = (select_from, alias)
+        return self
+
+    def select(self, expression, alias=None):
+        self._select.append((_to_expression(expression), alias))
+        return self
+
+    def join(self, table, join_type, condition, alias=None):
+        conditions = list(condition) if isinstance(condition, (list, tuple)) else [condition]
+        self._joins.append((table, join_type, conditions, alias))
+        return self
+
+    def where(self, condition):
+        self._where.append(condition)
+        return self
+
+    def group_by(self, expression):
+        self._group_by.append(expression)
+        return self
+
+    def order_by(self, expression, direction="ASC"):
+        self._order_by.append((expression, direction))
+        return self
+
+    def render(self):
+        columns = ", ".join(
+            expression.render() + (f" AS {_quote(alias)}" if alias else "") for expression, alias in self._select
+        )
+        sql = f"SELECT {columns or '*'}"
+        if self._from is not None:
+            select_from, alias = self._from
+            sql += f" FROM {_render_from(select_from)}" + (f" {_quote(alias)}" if alias else "")
+        for table, join_type, conditions, alias in self._joins:
+            sql += f" {join_type} JOIN {_render_from(table)}" + (f" {_quote(alias)}" if alias else "")
+            if join_type != JoinTypes.CROSS:
+                sql += " ON " + " AND ".join(condition.render() for condition in conditions)
+        if self._where:
+            sql += " WHERE " + " AND ".join(condition.render() for condition in self._where)
+        if self._group_by:
+            sql += " GROUP BY " + ", ".join(expression.render() for expression in self._group_by)
+        if self._order_by:
+            sql += " ORDER BY " + ", ".join(f"{expression.render()} {order}" for expression, order in self._order_by)
+        return sql
+
+
+def toSQL(query, dataset=None, dialect=None):
+    return query.render()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Capabilities of the DuckDB connection type of the dataiku stand-in, registered in dku_dialects"""
+from dataiku import DUCKDB_CONNECTION_TYPE
+from dataiku.sql import Dialects
+from dku_constants import ENTITY_STATISTICS
+from dku_dialects import (
+    SUPPORTED_DIALECTS,
+    SUPPORTS_FULL_OUTER_JOIN,
+    SUPPORTS_WITH_CLAUSE,
+    SUPPORTS_UNION_ALL,
+    DEFAULT_MATERIALIZATION,
+    TEMP_TABLE_PREFIX,
+    DEFAULT_ENTITY_STATISTICS,
+    HASH_FUNCTION,
+    JSON_ARRAY_AGG_STRINGS,
+    JSON_ARRAY_AGG_NUMBERS,
+    TABLE_BYTES,
+    EXPLAIN,
+    QUERY_PLAN_FORMAT,
+    QUALIFY,
+    CREATE_CLUSTERED_TEMP_TABLE,
+)
+
+# DuckDB runs the PostgreSQL syntax, but for the hash function and the JSON aggregates, and has QUALIFY
+DUCKDB_CAPABILITIES = {
+    **SUPPORTED_DIALECTS[Dialects.POSTGRES],
+    HASH_FUNCTION: "CAST(HASH(CONCAT({expression}, {seed})) % 9223372036854775807 AS BIGINT)",
+    JSON_ARRAY_AGG_STRINGS: "CAST(TO_JSON(LIST({expression} ORDER BY {order})) AS VARCHAR)",
+    JSON_ARRAY_AGG_NUMBERS: "CAST(TO_JSON(LIST({expression} ORDER BY {order})) AS VARCHAR)",
+    TABLE_BYTES: None,
+    EXPLAIN: None,
+    QUERY_PLAN_FORMAT: None,
+    QUALIFY: "{query} QUALIFY {condition}",
+    CREATE_CLUSTERED_TEMP_TABLE: None,
+    DEFAULT_ENTITY_STATISTICS: ENTITY_STATISTICS.GROUPED,  # hash aggregates, twice as fast as the windows
+}
+
+# capabilities choosing between equivalent constructs, rather than giving the SQL of a construct
+CONSTRUCT_CAPABILITIES = [
+    SUPPORTS_FULL_OUTER_JOIN,
+    SUPPORTS_WITH_CLAUSE,
+    SUPPORTS_UNION_ALL,
+    DEFAULT_MATERIALIZATION,
+    TEMP_TABLE_PREFIX,
+    DEFAULT_ENTITY_STATISTICS,
+]
+
+
+def register_duckdb_dialect(emulated_dialect=None):
+    """Register the DuckDB connection type, selecting the same constructs as emulated_dialect when given
+
+    The SQL of each construct stays DuckDB's, so that the queries built for any dialect can run on DuckDB.
+    """
+    capabilities = dict(DUCKDB_CAPABILITIES)
+    if emulated_dialect is not None:
+        emulated_capabilities = SUPPORTED_DIALECTS[emulated_dialect]
+        capabilities.update((key, emulated_capabilities[key]) for key in CONSTRUCT_CAPABILITIES)
+        if not emulated_capabilities[QUALIFY]:
+            capabilities[QUALIFY] = None
+    SUPPORTED_DIALECTS[DUCKDB_CONNECTION_TYPE] = capabilities
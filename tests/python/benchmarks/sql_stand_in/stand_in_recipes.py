@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Samples, file managers and runs of the recipe handlers on the DuckDB stand-in, shared by the tests and benchmarks"""
+import json
+import math
+import random
+
+import dataiku
+from config_handler import create_dku_config
+from dku_constants import RECIPE
+from dku_file_manager import DkuFileManager
+
+SCORING_CONFIG = {
+    "users_column_name": "user_id",
+    "items_column_name": "item_id",
+    "top_n_most_similar": 5,
+    "user_visit_threshold": 2,
+    "item_visit_threshold": 2,
+}
+
+
+def create_samples(nb_samples=1500, seed=0):
+    """Table "samples" of power-law users and items with a rating and a timestamp, the same for a given seed"""
+    rng = random.Random(seed)
+    rows = [
+        (
+            f"u{int(60 * rng.random() ** 2)}",
+            f"i{int(40 * rng.random() ** 1.5)}",
+            rng.randint(1, 5),
+            rng.randint(0, 9999),
+        )
+        for _ in range(nb_samples)
+    ]
+    connection = dataiku.get_connection()
+    connection.execute("CREATE TABLE samples (user_id VARCHAR, item_id VARCHAR, rating DOUBLE, timestamp BIGINT)")
+    connection.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", rows)
+
+
+def create_file_manager(**roles):
+    """File manager of the given roles (role name: dataset name), the other optional roles being unset"""
+    file_manager = DkuFileManager()
+    for role in ["metrics_dataset", "query_plans_folder", "score_store_folder", "interaction_matrix_folder"]:
+        file_manager.add_param(name=role, value=None)
+    for role in ["samples_delta_dataset", "previous_pair_statistics_dataset", "pair_statistics_dataset"]:
+        file_manager.add_param(name=role, value=None)
+    for role, dataset_name in roles.items():
+        file_manager.add_param(name=role, value=dataiku.Dataset(dataset_name))
+    return file_manager
+
+
+def round_value(value):
+    """Floats rounded, also in the JSON arrays of the nested arrays, as sums depend on the order of their terms
+
+    NaN, the score of the samples rated as their rating average, is read as None so that it compares equal.
+    """
+    if isinstance(value, float):
+        return None if math.isnan(value) else round(value, 9)
+    if isinstance(value, str) and value.startswith("["):
+        return tuple(round_value(element) for element in json.loads(value))
+    return value
+
+
+def read_table(table_name):
+    rows = dataiku.get_connection().execute(f'SELECT * FROM "{table_name}"').fetchall()
+    return sorted(tuple(round_value(value) for value in row) for row in rows)
+
+
+def run_auto_scoring_handler(handler_class, samples_dataset="samples", **config):
+    """Scores and similarity of the samples computed by an auto collaborative filtering handler"""
+    file_manager = create_file_manager(
+        samples_dataset=samples_dataset, scored_samples_dataset="scores", similarity_scores_dataset="similarity"
+    )
+    dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, {**SCORING_CONFIG, **config}, file_manager)
+    handler_class(dku_config, file_manager).build()
+    return {"scores": read_table("scores"), "similarity": read_table("similarity")}
+
+
+def run_custom_scoring_handler(handler_class, samples_dataset="samples", **config):
+    """Scores of the samples computed by a custom collaborative filtering handler from the user similarity table"""
+    file_manager = create_file_manager(
+        samples_dataset=samples_dataset, similarity_scores_dataset="similarity", scored_samples_dataset="custom_scores"
+    )
+    config = {
+        **SCORING_CONFIG,
+        "similarity_scores_type": "user_similarity",
+        "similarity_users_column_1_name": "user_id_1",
+        "similarity_users_column_2_name": "user_id_2",
+        "similarity_score_column_name": "similarity",
+        **config,
+    }
+    dku_config = create_dku_config(RECIPE.AFFINITY_SCORE, config, file_manager=file_manager)
+    handler_class(dku_config, file_manager).build()
+    return read_table("custom_scores")
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""The Spark engine writes the same outputs as the SQL path, run on DuckDB, on the same samples"""
+from collections import Counter
+
+import pytest
+
+pyspark = pytest.importorskip("pyspark")
+
+import dataiku
+from config_handler import create_dku_config
+from dataiku.sql import Dialects
+from dku_constants import RECIPE
+from duckdb_dialect import register_duckdb_dialect
+from pyspark.sql import SparkSession
+from query_handlers import AutoScoringHandler, CustomScoringHandler, SamplingHandler
+from spark_handlers import SparkAutoScoringHandler, SparkCustomScoringHandler, SparkSamplingHandler
+from stand_in_recipes import (
+    create_file_manager,
+    create_samples,
+    read_table,
+    run_auto_scoring_handler,
+    run_custom_scoring_handler,
+)
+
+SPARK_MASTER = "local[2]"
+
+SPARK_CONFIG = {"computation_engine": "spark", "spark_master": SPARK_MASTER}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def spark():
+    spark = SparkSession.builder.master(SPARK_MASTER).config("spark.sql.shuffle.partitions", 4).getOrCreate()
+    yield spark
+    spark.stop()
+
+
+@pytest.fixture(autouse=True)
+def samples():
+    dataiku.connect(":memory:")
+    register_duckdb_dialect(Dialects.POSTGRES)
+    create_samples()
+    yield
+    dataiku.connect(":memory:")
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based"},
+        {"collaborative_filtering_method": "item_based", "full_similarity_matrix": True},
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+            "scores_output": "top_k_unseen",
+            "top_k": 3,
+        },
+        {
+            "collaborative_filtering_method": "item_based",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+            "recency_filter_first": False,
+        },
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "recency_filter": "date_window",
+            "recency_window_start": "3000",
+            "recency_window_end": "8000",
+        },
+        {
+            "collaborative_filtering_method": "item_based",
+            "ratings_column_name": "rating",
+            "timestamps_column_name": "timestamp",
+            "duplicates_reducer": "last",
+        },
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "duplicates_reducer": "mean",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+        },
+        {"collaborative_filtering_method": "user_based", "duplicates_reducer": "presence"},
+    ],
+)
+def test_auto_scoring(config):
+    assert run_auto_scoring_handler(SparkAutoScoringHandler, **SPARK_CONFIG, **config) == run_auto_scoring_handler(
+        AutoScoringHandler, **config
+    )
+
+
+def test_auto_scoring_with_salted_skewed_pivots_and_without_broadcast():
+    config = {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"}
+    spark_config = {**SPARK_CONFIG, "skewed_pivot_threshold": 10, "nb_salts": 4, "broadcast_max_rows": 0}
+    assert run_auto_scoring_handler(SparkAutoScoringHandler, **spark_config, **config) == run_auto_scoring_handler(
+        AutoScoringHandler, **config
+    )
+
+
+def run_custom_scoring(handler_class, **config):
+    run_auto_scoring_handler(AutoScoringHandler, collaborative_filtering_method="user_based")
+    return run_custom_scoring_handler(handler_class, **config)
+
+
+@pytest.mark.parametrize("half_similarity_matrix", [False, True])
+def test_custom_scoring_of_a_half_similarity_matrix(half_similarity_matrix):
+    # unchecked, the half matrix written by default by the auto recipe is detected
+    custom_scores = run_custom_scoring(
+        SparkCustomScoringHandler, **SPARK_CONFIG, half_similarity_matrix=half_similarity_matrix
+    )
+    assert custom_scores == read_table("scores")
+    assert custom_scores == run_custom_scoring(CustomScoringHandler, half_similarity_matrix=half_similarity_matrix)
+
+
+def run_sampling(handler_class, **config):
+    """Positive samples and number of negative samples per user, the negative samples drawn are not deterministic"""
+    connection = dataiku.get_connection()
+    connection.execute(
+        """CREATE OR REPLACE TABLE scored_samples AS
+        SELECT user_id, item_id, HASH(CONCAT(user_id, item_id)) % 1000 / 1000.0 AS score
+        FROM (SELECT DISTINCT user_id FROM samples) CROSS JOIN (SELECT DISTINCT item_id FROM samples)"""
+    )
+    for table, condition in [("training_samples", ">= 5000"), ("historical_samples", "< 5000")]:
+        connection.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM samples WHERE timestamp {condition}")
+    file_manager = create_file_manager(
+        scored_samples_dataset="scored_samples",
+        training_samples_dataset="training_samples",
+        historical_samples_dataset="historical_samples",
+        positive_negative_samples_dataset="positive_negative_samples",
+    )
+    config = {
+        "users_column_name": "user_id",
+        "items_column_name": "item_id",
+        "scored_samples_users_column_name": "user_id",
+        "scored_samples_items_column_name": "item_id",
+        "score_column_names": ["score"],
+        "training_samples_users_column_name": "user_id",
+        "training_samples_items_column_name": "item_id",
+        "historical_samples": True,
+        "historical_samples_users_column_name": "user_id",
+        "historical_samples_items_column_name": "item_id",
+        "sampling_method": "negative_samples_percentage",
+        "negative_samples_percentage": 40,
+        **config,
+    }
+    dku_config = create_dku_config(RECIPE.SAMPLING, config, file_manager=file_manager)
+    handler_class(dku_config, file_manager).build()
+    rows = read_table("positive_negative_samples")
+    return [row for row in rows if row[-1] == 1], Counter(row[0] for row in rows if row[-1] == 0)
+
+
+def test_negative_sampling():
+    assert run_sampling(SparkSamplingHandler, **SPARK_CONFIG) == run_sampling(SamplingHandler)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# the plugin library, and the dataiku stand-in running its queries on DuckDB
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "..", "python-lib"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks", "sql_stand_in"))
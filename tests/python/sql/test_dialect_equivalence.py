@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+"""The queries built for each dialect, with the constructs it selects, return the same rows on DuckDB"""
+import json
+import logging
+import math
+from collections import Counter
+
+import pytest
+
+import dataiku
+from config_handler import create_dku_config
+from dataiku.sql import Column, Dialects, SelectQuery
+from dku_constants import RECIPE
+from duckdb_dialect import register_duckdb_dialect
+from query_handlers import AutoScoringHandler, CustomScoringHandler, IncrementalScoringHandler, SamplingHandler
+from stand_in_recipes import (
+    SCORING_CONFIG,
+    create_file_manager,
+    create_samples,
+    read_table,
+    round_value,
+    run_auto_scoring_handler,
+    run_custom_scoring_handler,
+)
+
+DIALECTS = [Dialects.POSTGRES, Dialects.SNOWFLAKE, Dialects.BIGQUERY, Dialects.SQLSERVER, Dialects.SYNAPSE]
+REFERENCE_DIALECT = Dialects.POSTGRES
+
+
+@pytest.fixture(autouse=True)
+def samples():
+    dataiku.connect(":memory:")
+    create_samples()
+    yield
+    dataiku.connect(":memory:")
+
+
+def run_auto_scoring(dialect, samples_dataset="samples", **config):
+    register_duckdb_dialect(dialect)
+    return run_auto_scoring_handler(AutoScoringHandler, samples_dataset, **config)
+
+
+@pytest.mark.parametrize("recency_filter_first", [True, False])
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_auto_scoring_with_timestamp_filtering_and_top_k_unseen(dialect, recency_filter_first):
+    config = {
+        "collaborative_filtering_method": "user_based",
+        "ratings_column_name": "rating",
+        "timestamp_filtering": True,
+        "timestamps_column_name": "timestamp",
+        "top_n_most_recent": 8,
+        "recency_filter_first": recency_filter_first,
+        "scores_output": "top_k_unseen",
+        "top_k": 3,
+    }
+    assert run_auto_scoring(dialect, **config) == run_auto_scoring(REFERENCE_DIALECT, **config)
+
+
+TOP_K_SCORES = """SELECT user_id, item_id, score FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY score DESC, item_id) AS score_rank FROM all_scores
+    WHERE score IS NOT NULL {condition}
+) AS ranked_scores WHERE score_rank <= {top_k}"""
+
+SEEN_ITEMS_CONDITION = "AND (user_id, item_id) NOT IN (SELECT user_id, item_id FROM samples)"
+
+
+def rank_all_scores(dialect, top_k, condition="", **config):
+    """Top K of the scores output with all the scores, by score then item, filtered by the SQL condition"""
+    run_auto_scoring(dialect, **config)
+    connection = dataiku.get_connection()
+    connection.execute("CREATE OR REPLACE TABLE all_scores AS SELECT * FROM scores")
+    return connection.execute(TOP_K_SCORES.format(condition=condition, top_k=top_k)).df()
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based"},
+        {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"},
+    ],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_top_k_unseen_scores(dialect, config):
+    top_k_scores = rank_all_scores(dialect, 3, SEEN_ITEMS_CONDITION, **config)
+    run_auto_scoring(dialect, scores_output="top_k_unseen", top_k=3, **config)
+    scores = dataiku.get_connection().execute("SELECT user_id, item_id, score FROM scores").df()
+    assert scores.groupby("user_id").size().max() <= 3
+    seen_items = dataiku.get_connection().execute("SELECT DISTINCT user_id, item_id FROM samples").df()
+    assert scores.merge(seen_items, on=["user_id", "item_id"]).empty
+    # the K highest scores of each user among its unseen items
+    assert sorted(tuple(round_value(value) for value in row) for row in scores.values) == sorted(
+        tuple(round_value(value) for value in row) for row in top_k_scores.values
+    )
+
+
+@pytest.mark.parametrize(
+    "timestamps,window_start,window_end",
+    [("timestamp", "3000", "8000"), ("DATE '2000-01-01' + CAST(timestamp AS INTEGER)", "2008-03-18", "2021-11-26")],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_date_window_filtered_first_is_computed_on_the_samples_of_the_window(
+    dialect, timestamps, window_start, window_end
+):
+    connection = dataiku.get_connection()
+    connection.execute(
+        f"CREATE TABLE timed_samples AS SELECT user_id, item_id, rating, {timestamps} AS timestamp FROM samples"
+    )
+    connection.execute(
+        f"""CREATE TABLE window_samples AS SELECT * FROM timed_samples
+        WHERE timestamp >= '{window_start}' AND timestamp < '{window_end}'"""
+    )
+    config = {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"}
+    date_window_config = {
+        "timestamp_filtering": True,
+        "timestamps_column_name": "timestamp",
+        "recency_filter": "date_window",
+        "recency_window_start": window_start,
+        "recency_window_end": window_end,
+    }
+    assert run_auto_scoring(dialect, samples_dataset="timed_samples", **config, **date_window_config) == (
+        run_auto_scoring(REFERENCE_DIALECT, samples_dataset="window_samples", **config)
+    )
+
+
+def read_prepared_samples(dialect, samples_dataset="samples", **config):
+    """Samples left after the visit thresholds and caps, as read by the similarity"""
+    register_duckdb_dialect(dialect)
+    file_manager = create_file_manager(
+        samples_dataset=samples_dataset, scored_samples_dataset="scores", similarity_scores_dataset="similarity"
+    )
+    dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, {**SCORING_CONFIG, **config}, file_manager)
+    scoring_handler = AutoScoringHandler(dku_config, file_manager)
+    prepared_samples = SelectQuery()
+    prepared_samples.select_from(scoring_handler._prepare_samples(), alias="_prepared_samples")
+    prepared_samples.select(Column("*"))
+    return scoring_handler._query_to_df(prepared_samples, file_manager.scored_samples_dataset)
+
+
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_visit_caps_of_the_prepared_samples(dialect):
+    config = {"collaborative_filtering_method": "user_based", "user_visit_threshold": 1, "item_visit_threshold": 1}
+    prepared_samples = read_prepared_samples(dialect, user_visit_cap=10, item_visit_cap=30, **config)
+    assert prepared_samples.groupby("user_id").size().max() <= 10
+    assert prepared_samples.groupby("item_id").size().max() <= 30
+    # with a single cap, each user keeps min(visits, cap) samples whatever the hash function of the dialect
+    expected_nb_samples = dataiku.get_connection().execute(
+        "SELECT SUM(LEAST(nb_visit, 10)) FROM (SELECT COUNT(*) AS nb_visit FROM samples GROUP BY user_id)"
+    ).fetchone()[0]
+    assert len(read_prepared_samples(dialect, user_visit_cap=10, **config)) == expected_nb_samples
+
+
+@pytest.mark.parametrize("timestamp_filtering", [False, True])
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_visit_caps_keep_the_most_recent_then_highest_rated_duplicate(dialect, timestamp_filtering):
+    dataiku.get_connection().execute(
+        """CREATE TABLE duplicated_samples AS SELECT * FROM (VALUES
+        ('u1', 'i1', 2.0, 3), ('u1', 'i1', 5.0, 1), ('u1', 'i1', 4.0, 3), ('u2', 'i1', 1.0, 1), ('u2', 'i2', 3.0, 2)
+        ) AS samples(user_id, item_id, rating, timestamp)"""
+    )
+    config = {
+        "collaborative_filtering_method": "user_based",
+        "ratings_column_name": "rating",
+        "user_visit_threshold": 1,
+        "item_visit_threshold": 1,
+        "user_visit_cap": 1,
+    }
+    if timestamp_filtering:
+        config.update(
+            timestamp_filtering=True,
+            timestamps_column_name="timestamp",
+            top_n_most_recent=10,
+            recency_filter_first=False,
+        )
+    prepared_samples = read_prepared_samples(dialect, samples_dataset="duplicated_samples", **config)
+    [rating] = prepared_samples.loc[prepared_samples["user_id"] == "u1", "rating"]
+    assert rating == (4.0 if timestamp_filtering else 5.0)
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based", "user_visit_cap": 10, "item_visit_cap": 30},
+        {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"},
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+        },
+        {
+            "collaborative_filtering_method": "item_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+            "recency_filter_first": False,
+        },
+    ],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_grouped_entity_statistics(dialect, config):
+    assert run_auto_scoring(dialect, entity_statistics="grouped", **config) == run_auto_scoring(
+        REFERENCE_DIALECT, entity_statistics="windows", **config
+    )
+
+
+@pytest.mark.parametrize("collaborative_filtering_method", ["user_based", "item_based"])
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_minhash_lsh_similarity_is_a_subset_of_the_exact_similarity(dialect, collaborative_filtering_method):
+    config = {"collaborative_filtering_method": collaborative_filtering_method, "ratings_column_name": "rating"}
+    minhash_lsh_config = {"similarity_computation": "minhash_lsh", "minhash_nb_hashes": 32, "lsh_nb_bands": 32}
+    candidate_similarity = run_auto_scoring(dialect, **minhash_lsh_config, **config)["similarity"]
+    exact_similarity = run_auto_scoring(REFERENCE_DIALECT, **config)["similarity"]
+    # the candidate pairs are approximate, the similarity of each candidate pair is exact
+    assert set(candidate_similarity) <= set(exact_similarity)
+    assert len(candidate_similarity) >= 0.9 * len(exact_similarity)
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "item_based", "full_similarity_matrix": True},
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+            "recency_filter_first": False,
+        },
+    ],
+)
+@pytest.mark.parametrize("materialization_mode", ["inline", "cte", "temp_table"])
+@pytest.mark.parametrize("dialect", [Dialects.POSTGRES, Dialects.SNOWFLAKE, Dialects.SQLSERVER])
+def test_materialization_modes(dialect, materialization_mode, config):
+    assert run_auto_scoring(dialect, materialization_mode=materialization_mode, **config) == run_auto_scoring(
+        REFERENCE_DIALECT, **config
+    )
+
+
+THRESHOLDED_JOINED_ROWS = """SELECT SUM(nb_visit * nb_visit) FROM (
+    SELECT {pivot}, COUNT(*) AS nb_visit FROM samples
+    WHERE user_id IN (SELECT user_id FROM samples GROUP BY user_id HAVING COUNT(*) >= 2)
+    AND item_id IN (SELECT item_id FROM samples GROUP BY item_id HAVING COUNT(*) >= 2)
+    GROUP BY {pivot}
+)"""
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based"},
+        {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"},
+        {"collaborative_filtering_method": "item_based", "full_similarity_matrix": True},
+        {"collaborative_filtering_method": "user_based", "output_format": "nested_arrays", "top_k": 3},
+        {"collaborative_filtering_method": "item_based", "scores_output": "top_k_unseen", "top_k": 3},
+    ],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_auto_scoring_in_execution_buckets(dialect, config, caplog):
+    caplog.set_level(logging.INFO, logger="query_handlers.scoring_handler")
+    # the joined rows are counted on the samples left after the visit thresholds
+    pivot = "item_id" if config["collaborative_filtering_method"] == "user_based" else "user_id"
+    joined_rows = dataiku.get_connection().execute(THRESHOLDED_JOINED_ROWS.format(pivot=pivot)).fetchone()[0]
+    bucketing_config = {"execution_bucketing": "auto", "max_joined_rows_per_bucket": math.ceil(joined_rows / 4)}
+    assert run_auto_scoring(dialect, **bucketing_config, **config) == run_auto_scoring(REFERENCE_DIALECT, **config)
+    assert f"Estimated {joined_rows} joined rows, using 4 execution buckets" in caplog.messages
+    assert run_auto_scoring(dialect, execution_bucketing="fixed", nb_execution_buckets=3, **config) == (
+        run_auto_scoring(REFERENCE_DIALECT, **config)
+    )
+
+
+@pytest.mark.parametrize("profile_stages, has_metrics_dataset", [(False, False), (True, False), (False, True)])
+def test_output_metrics_collected_only_when_written(profile_stages, has_metrics_dataset):
+    register_duckdb_dialect(REFERENCE_DIALECT)
+    roles = {"samples_dataset": "samples", "scored_samples_dataset": "scores"}
+    roles["similarity_scores_dataset"] = "similarity"
+    if has_metrics_dataset:
+        roles["metrics_dataset"] = "metrics"
+    file_manager = create_file_manager(**roles)
+    config = {**SCORING_CONFIG, "collaborative_filtering_method": "user_based", "profile_stages": profile_stages}
+    dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, config, file_manager)
+    scoring_handler = AutoScoringHandler(dku_config, file_manager)
+    scoring_handler.build()
+    scoring_handler.write_metrics(file_manager.scored_samples_dataset)
+    rows_out = {metrics.stage: metrics.rows_out for metrics in scoring_handler.run_metrics.stages}
+    metric_values = file_manager.scored_samples_dataset.metric_values
+    if profile_stages or has_metrics_dataset:
+        assert rows_out["scored_samples_dataset"] == len(read_table("scores"))
+        assert rows_out["similarity_scores_dataset"] == len(read_table("similarity"))
+        assert metric_values["reco_scored_samples_dataset_rows_out"] == rows_out["scored_samples_dataset"]
+    else:
+        # only the wall times are recorded, without counting the outputs nor saving metrics
+        assert set(rows_out) == {"similarity_scores_dataset", "scored_samples_dataset"}
+        assert set(rows_out.values()) == {None}
+        assert not metric_values
+    tables = [table_name for (table_name,) in dataiku.get_connection().execute("SHOW TABLES").fetchall()]
+    assert ("metrics" in tables) == has_metrics_dataset
+
+
+def list_staging_tables():
+    tables = dataiku.get_connection().execute("SELECT table_name FROM information_schema.tables").fetchall()
+    return [table_name for (table_name,) in tables if table_name.startswith("_reco_")]
+
+
+@pytest.mark.parametrize("join_budget_action", ["abort", "execution_buckets"])
+@pytest.mark.parametrize("materialization_mode", ["inline", "temp_table"])
+@pytest.mark.parametrize("collaborative_filtering_method", ["user_based", "item_based"])
+@pytest.mark.parametrize("dialect", [Dialects.POSTGRES, Dialects.SNOWFLAKE, Dialects.SQLSERVER])
+def test_auto_scoring_over_the_join_row_budget(
+    dialect, collaborative_filtering_method, materialization_mode, join_budget_action, caplog
+):
+    caplog.set_level(logging.INFO)
+    pivot = "item_id" if collaborative_filtering_method == "user_based" else "user_id"
+    joined_rows = dataiku.get_connection().execute(THRESHOLDED_JOINED_ROWS.format(pivot=pivot)).fetchone()[0]
+    config = {
+        "collaborative_filtering_method": collaborative_filtering_method,
+        "materialization_mode": materialization_mode,
+        "execution_bucketing": "auto",
+        "max_joined_rows_per_bucket": joined_rows,
+        "join_row_budget": math.ceil(joined_rows / 3),
+        "join_budget_action": join_budget_action,
+    }
+    if join_budget_action == "abort":
+        with pytest.raises(ValueError, match="over the budget"):
+            run_auto_scoring(dialect, **config)
+    else:
+        reference_config = {"collaborative_filtering_method": collaborative_filtering_method}
+        assert run_auto_scoring(dialect, **config) == run_auto_scoring(REFERENCE_DIALECT, **reference_config)
+        assert "Over the joined rows budget, using 3 execution buckets" in caplog.messages
+    # the join cost is estimated once, on the staged prepared samples dropped at the end of the run
+    assert len([message for message in caplog.messages if message.startswith("Prepared samples:")]) == 1
+    assert f"Estimated {joined_rows} joined rows, using 1 execution buckets" in caplog.messages
+    assert not list_staging_tables()
+
+
+DEDUPLICATED_SAMPLES = {
+    "presence": "SELECT user_id, item_id, MAX(timestamp) AS timestamp FROM samples GROUP BY user_id, item_id",
+    "count": """SELECT user_id, item_id, CAST(COUNT(*) AS DOUBLE) AS rating, MAX(timestamp) AS timestamp
+        FROM samples GROUP BY user_id, item_id""",
+    "sum": """SELECT user_id, item_id, SUM(rating) AS rating, MAX(timestamp) AS timestamp
+        FROM samples GROUP BY user_id, item_id""",
+    "mean": """SELECT user_id, item_id, AVG(rating) AS rating, MAX(timestamp) AS timestamp
+        FROM samples GROUP BY user_id, item_id""",
+    "last": """SELECT user_id, item_id, rating, timestamp FROM samples
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY user_id, item_id ORDER BY timestamp DESC, rating DESC) = 1""",
+}
+
+
+@pytest.mark.parametrize("timestamp_filtering", [False, True])
+@pytest.mark.parametrize("duplicates_reducer", list(DEDUPLICATED_SAMPLES))
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_duplicates_reduced_as_the_deduplicated_samples(dialect, duplicates_reducer, timestamp_filtering):
+    connection = dataiku.get_connection()
+    connection.execute(f"CREATE TABLE deduplicated_samples AS {DEDUPLICATED_SAMPLES[duplicates_reducer]}")
+    config = {"collaborative_filtering_method": "user_based", "timestamps_column_name": "timestamp"}
+    if timestamp_filtering:
+        config.update({"timestamp_filtering": True, "top_n_most_recent": 8})
+    ratings_config = {"ratings_column_name": "rating"}
+    # the ratings of the samples are ignored by the presence of their pairs
+    reference_ratings_config = ratings_config if duplicates_reducer != "presence" else {}
+    assert run_auto_scoring(dialect, duplicates_reducer=duplicates_reducer, **ratings_config, **config) == (
+        run_auto_scoring(
+            REFERENCE_DIALECT, samples_dataset="deduplicated_samples", **reference_ratings_config, **config
+        )
+    )
+
+
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_auto_scoring_with_full_similarity_matrix_and_nested_arrays(dialect):
+    config = {"collaborative_filtering_method": "item_based", "full_similarity_matrix": True}
+    assert run_auto_scoring(dialect, **config) == run_auto_scoring(REFERENCE_DIALECT, **config)
+    config = {"collaborative_filtering_method": "item_based", "output_format": "nested_arrays", "top_k": 3}
+    assert run_auto_scoring(dialect, **config) == run_auto_scoring(REFERENCE_DIALECT, **config)
+
+
+@pytest.mark.parametrize("collaborative_filtering_method", ["user_based", "item_based"])
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_nested_arrays_of_the_long_scores(dialect, collaborative_filtering_method):
+    top_k_scores = rank_all_scores(dialect, 3, collaborative_filtering_method=collaborative_filtering_method)
+    config = {"collaborative_filtering_method": collaborative_filtering_method, "output_format": "nested_arrays"}
+    run_auto_scoring(dialect, top_k=3, **config)
+    nested_arrays = {}
+    nested_scores = dataiku.get_connection().execute("SELECT user_id, item_id, score FROM scores").fetchall()
+    for user_id, item_ids, scores in nested_scores:
+        item_ids, scores = json.loads(item_ids), json.loads(scores)
+        assert len(item_ids) == len(scores) <= 3
+        assert scores == sorted(scores, reverse=True)
+        nested_arrays[user_id] = list(zip(item_ids, [round_value(score) for score in scores]))
+    # the long scores re-aggregated per user, in rank order
+    long_arrays = {}
+    for user_id, item_id, score in top_k_scores.values:
+        long_arrays.setdefault(user_id, []).append((item_id, round_value(score)))
+    assert nested_arrays == long_arrays
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based", "user_visit_threshold": 1},
+        {
+            "collaborative_filtering_method": "item_based",
+            "ratings_column_name": "rating",
+            "full_similarity_matrix": True,
+        },
+        {"collaborative_filtering_method": "item_based", "output_format": "nested_arrays", "top_k": 3},
+        {
+            "collaborative_filtering_method": "user_based",
+            "ratings_column_name": "rating",
+            "timestamp_filtering": True,
+            "timestamps_column_name": "timestamp",
+            "top_n_most_recent": 8,
+            "scores_output": "top_k_unseen",
+            "top_k": 3,
+        },
+        {
+            "collaborative_filtering_method": "user_based",
+            "execution_bucketing": "fixed",
+            "nb_execution_buckets": 3,
+            "max_concurrency": 2,
+        },
+    ],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_auto_scoring_of_encoded_ids(dialect, config):
+    assert run_auto_scoring(dialect, encode_ids=True, **config) == run_auto_scoring(REFERENCE_DIALECT, **config)
+
+
+def run_incremental_scoring(dialect, samples_dataset, samples_delta_dataset=None, **config):
+    """Incremental scoring updating the pair statistics of the previous run, when there is one"""
+    register_duckdb_dialect(dialect)
+    connection = dataiku.get_connection()
+    has_previous_statistics = bool(
+        connection.execute("SELECT * FROM duckdb_tables() WHERE table_name = 'pair_statistics'").fetchall()
+    )
+    if has_previous_statistics:
+        connection.execute("CREATE OR REPLACE TABLE previous_pair_statistics AS SELECT * FROM pair_statistics")
+    roles = {
+        "samples_dataset": samples_dataset,
+        "scored_samples_dataset": "scores",
+        "similarity_scores_dataset": "similarity",
+        "pair_statistics_dataset": "pair_statistics",
+    }
+    if samples_delta_dataset:
+        roles["samples_delta_dataset"] = samples_delta_dataset
+    if has_previous_statistics:
+        roles["previous_pair_statistics_dataset"] = "previous_pair_statistics"
+    file_manager = create_file_manager(**roles)
+    config = {**SCORING_CONFIG, "incremental_similarity": True, **config}
+    dku_config = create_dku_config(RECIPE.COLLABORATIVE_FILTERING, config, file_manager)
+    IncrementalScoringHandler(dku_config, file_manager).build()
+    return {"scores": read_table("scores"), "similarity": read_table("similarity")}
+
+
+@pytest.mark.parametrize("visit_threshold", [1, 2, 20])
+@pytest.mark.parametrize(
+    "config",
+    [
+        {"collaborative_filtering_method": "user_based"},
+        {"collaborative_filtering_method": "item_based"},
+        {"collaborative_filtering_method": "user_based", "ratings_column_name": "rating"},
+        {"collaborative_filtering_method": "item_based", "ratings_column_name": "rating"},
+    ],
+)
+@pytest.mark.parametrize("dialect", [Dialects.POSTGRES, Dialects.SNOWFLAKE])
+def test_incremental_scoring_of_deltas_as_the_full_computation(dialect, config, visit_threshold):
+    connection = dataiku.get_connection()
+    for table, condition in [
+        ("history_samples", "timestamp < 5000"),
+        ("first_delta_samples", "timestamp >= 5000 AND timestamp < 7500"),
+        ("first_samples", "timestamp < 7500"),
+        ("second_delta_samples", "timestamp >= 7500"),
+    ]:
+        connection.execute(f"CREATE TABLE {table} AS SELECT * FROM samples WHERE {condition}")
+    # the users and items reaching the thresholds with a delta have history samples to join
+    config = {**config, "user_visit_threshold": visit_threshold, "item_visit_threshold": visit_threshold}
+    run_incremental_scoring(dialect, "history_samples", **config)
+    assert run_incremental_scoring(dialect, "history_samples", "first_delta_samples", **config) == (
+        run_auto_scoring(REFERENCE_DIALECT, samples_dataset="first_samples", **config)
+    )
+    assert run_incremental_scoring(dialect, "first_samples", "second_delta_samples", **config) == (
+        run_auto_scoring(REFERENCE_DIALECT, **config)
+    )
+
+
+def run_custom_scoring(dialect, samples_dataset="samples", auto_config=None, **config):
+    """Custom scores of the similarity output by the auto recipe on the samples, which also writes the scores table"""
+    run_auto_scoring(REFERENCE_DIALECT, collaborative_filtering_method="user_based", **(auto_config or {}))
+    register_duckdb_dialect(dialect)
+    return run_custom_scoring_handler(CustomScoringHandler, samples_dataset, **config)
+
+
+@pytest.mark.parametrize(
+    "auto_config, config",
+    [
+        ({}, {}),
+        ({}, {"half_similarity_matrix": True}),
+        ({"full_similarity_matrix": True}, {}),
+    ],
+)
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_custom_scoring_of_the_auto_similarity(dialect, auto_config, config):
+    # the half matrix written by default by the auto recipe is detected, its mirrored pairs are scored too
+    assert run_custom_scoring(dialect, auto_config=auto_config, **config) == read_table("scores")
+
+
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_custom_scoring_of_encoded_ids(dialect):
+    # the users of the similarity without samples are scored too
+    dataiku.get_connection().execute(
+        "CREATE TABLE custom_samples AS SELECT * FROM samples WHERE user_id NOT IN ('u1', 'u7')"
+    )
+    assert run_custom_scoring(dialect, samples_dataset="custom_samples", encode_ids=True) == run_custom_scoring(
+        REFERENCE_DIALECT, samples_dataset="custom_samples"
+    )
+
+
+def run_sampling(dialect, **config):
+    """Positive samples and number of negative samples per user, the negative samples drawn are not deterministic"""
+    connection = dataiku.get_connection()
+    connection.execute(
+        """CREATE OR REPLACE TABLE scored_samples AS
+        SELECT user_id, item_id, HASH(CONCAT(user_id, item_id)) % 1000 / 1000.0 AS score
+        FROM (SELECT DISTINCT user_id FROM samples) CROSS JOIN (SELECT DISTINCT item_id FROM samples)"""
+    )
+    for table, condition in [("training_samples", ">= 5000"), ("historical_samples", "< 5000")]:
+        connection.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM samples WHERE timestamp {condition}")
+    register_duckdb_dialect(dialect)
+    file_manager = create_file_manager(
+        scored_samples_dataset="scored_samples",
+        training_samples_dataset="training_samples",
+        historical_samples_dataset="historical_samples",
+        positive_negative_samples_dataset="positive_negative_samples",
+    )
+    config = {
+        "users_column_name": "user_id",
+        "items_column_name": "item_id",
+        "scored_samples_users_column_name": "user_id",
+        "scored_samples_items_column_name": "item_id",
+        "score_column_names": ["score"],
+        "training_samples_users_column_name": "user_id",
+        "training_samples_items_column_name": "item_id",
+        "historical_samples": True,
+        "historical_samples_users_column_name": "user_id",
+        "historical_samples_items_column_name": "item_id",
+        "sampling_method": "negative_samples_percentage",
+        "negative_samples_percentage": 40,
+        **config,
+    }
+    dku_config = create_dku_config(RECIPE.SAMPLING, config, file_manager=file_manager)
+    SamplingHandler(dku_config, file_manager).build()
+    rows = read_table("positive_negative_samples")
+    return [row for row in rows if row[-1] == 1], Counter(row[0] for row in rows if row[-1] == 0)
+
+
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_negative_sampling(dialect):
+    assert run_sampling(dialect) == run_sampling(REFERENCE_DIALECT)
+
+
+@pytest.mark.parametrize("sampling_method", ["negative_samples_percentage", "no_sampling"])
+@pytest.mark.parametrize("dialect", DIALECTS)
+def test_sampling_of_encoded_ids(dialect, sampling_method):
+    config = {"sampling_method": sampling_method}
+    assert run_sampling(dialect, encode_ids=True, **config) == run_sampling(REFERENCE_DIALECT, **config)
+
+
+@pytest.mark.parametrize("dialect, uses_qualify", [(Dialects.POSTGRES, False), (Dialects.SNOWFLAKE, True)])
+def test_top_n_filtered_with_qualify(dialect, uses_qualify, caplog):
+    caplog.set_level(logging.INFO, logger="query_handlers.query_handler")
+    run_auto_scoring(dialect, collaborative_filtering_method="user_based", scores_output="top_k_unseen", top_k=3)
+    messages = [record.getMessage() for record in caplog.records]
+    statements = "\n".join(message for message in messages if message.startswith("Executing"))
+    assert ("QUALIFY" in statements) == uses_qualify
+    assert '"_row_number" <= 5' in statements and '"_score_rank" <= 3' in statements
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Samples and row by row reference of the auto collaborative filtering, shared by the sparse scoring tests"""
+from collections import defaultdict
+import math
+import random
+
+import pytest
+
+
+def generate_samples(nb_samples=400, nb_users=25, nb_items=15, seed=0):
+    rng = random.Random(seed)
+    users = [int(nb_users * rng.random() ** 2) for _ in range(nb_samples)]
+    items = [int(nb_items * rng.random() ** 1.5) for _ in range(nb_samples)]
+    ratings = [float(rng.randint(1, 5)) for _ in range(nb_samples)]
+    timestamps = [rng.randint(0, 50) for _ in range(nb_samples)]
+    return users, items, ratings, timestamps
+
+
+def reference_collaborative_filtering(users, items, ratings, timestamps, top_n, threshold, is_user_based, recent):
+    """Row by row implementation of the SQL queries of the auto collaborative filtering"""
+    based, pivots = (users, items) if is_user_based else (items, users)
+    samples = list(zip(based, pivots, ratings if ratings else [None] * len(users), timestamps))
+    nb_visit_user, nb_visit_item = defaultdict(int), defaultdict(int)
+    for user, item in zip(users, items):
+        nb_visit_user[user] += 1
+        nb_visit_item[item] += 1
+    ratings_by_based = defaultdict(list)
+    for based_entity, _, rating, _ in samples:
+        ratings_by_based[based_entity].append(rating)
+    average = {key: sum(values) / len(values) for key, values in ratings_by_based.items()} if ratings else None
+
+    kept = [
+        sample
+        for sample, user, item in zip(samples, users, items)
+        if nb_visit_user[user] >= threshold and nb_visit_item[item] >= threshold
+    ]
+    centered = lambda sample: sample[2] - average[sample[0]] if ratings else 1.0
+    squared_norm = defaultdict(float)
+    for sample in kept:
+        squared_norm[sample[0]] += centered(sample) ** 2
+    factor = {key: 1 / math.sqrt(value) if value > 0 else float("nan") for key, value in squared_norm.items()}
+    if recent:
+        by_based = defaultdict(list)
+        for sample in kept:
+            by_based[sample[0]].append(sample)
+        kept = [s for values in by_based.values() for s in sorted(values, key=lambda s: (-s[3], -s[1]))[:recent]]
+
+    by_pivot = defaultdict(list)
+    for sample in kept:
+        by_pivot[sample[1]].append(sample)
+    similarity = defaultdict(float)
+    for pivot_samples in by_pivot.values():
+        for left in pivot_samples:
+            for right in pivot_samples:
+                if left[0] != right[0]:
+                    value = centered(left) * factor[left[0]] * centered(right) * factor[right[0]]
+                    similarity[(left[0], right[0])] += value
+    similarity = {
+        pair: round(value * 10 ** 15) / 10 ** 15 if value == value else value for pair, value in similarity.items()
+    }
+
+    neighbours = defaultdict(list)
+    for (left, right), value in similarity.items():
+        neighbours[left].append((right, value))
+    scores = defaultdict(lambda: [0.0, 0.0, 0])
+    for left, values in neighbours.items():
+        ordered = sorted(values, key=lambda v: (math.isnan(v[1]), -v[1] if v[1] == v[1] else 0, -v[0]))[:top_n]
+        for right, value in ordered:
+            for sample in kept:
+                if sample[0] == right:
+                    score = scores[(left, sample[1])]
+                    if value == value:
+                        score[0] += value * (centered(sample) if ratings else 1)
+                        score[1] += abs(value)
+                        score[2] += 1
+    final_scores = {}
+    for key, (numerator, denominator, nb_non_null) in scores.items():
+        if nb_non_null == 0:
+            final_scores[key] = float("nan")
+        elif ratings:
+            final_scores[key] = numerator / denominator if denominator else float("nan")
+        else:
+            final_scores[key] = numerator / top_n
+    return similarity, final_scores
+
+
+def assert_close(expected, actual):
+    assert set(expected) == set(actual)
+    for key, value in expected.items():
+        if math.isnan(value):
+            assert math.isnan(actual[key]), key
+        else:
+            assert actual[key] == pytest.approx(value, abs=1e-9), key
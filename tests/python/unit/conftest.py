@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+import pytest
+
+# same as the PYTHONPATH set by "make unit-tests"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "..", "python-lib"))
+
+# detailed assertion messages in the shared reference helpers, as in the test modules
+pytest.register_assert_rewrite("collaborative_filtering_reference")
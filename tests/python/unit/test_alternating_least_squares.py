@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from sparse_handlers.alternating_least_squares import AlternatingLeastSquares
+
+
+def generate_low_rank_samples(nb_users=300, nb_items=100, nb_factors=4, nb_samples=6000, seed=0):
+    rng = np.random.default_rng(seed)
+    user_factors = rng.standard_normal((nb_users, nb_factors))
+    item_factors = rng.standard_normal((nb_items, nb_factors))
+    users = rng.integers(0, nb_users, nb_samples)
+    items = rng.integers(0, nb_items, nb_samples)
+    ratings = np.einsum("ij,ij->i", user_factors[users], item_factors[items])
+    return users, items, ratings
+
+
+def test_explicit_fits_low_rank_ratings():
+    users, items, ratings = generate_low_rank_samples()
+    als = AlternatingLeastSquares(nb_factors=4, regularization=0.01, nb_iterations=15, use_explicit=True)
+    als.fit(users, items, ratings=ratings, nb_users=300, nb_items=100)
+    assert als.user_factors.dtype == np.float32
+    predictions = np.einsum("ij,ij->i", als.user_factors[users], als.item_factors[items])
+    assert np.sqrt(np.mean((predictions - ratings) ** 2)) < 0.1
+
+
+def test_implicit_solves_normal_equations():
+    users, items, _ = generate_low_rank_samples()
+    alpha, regularization = 2.0, 0.1
+    als = AlternatingLeastSquares(
+        nb_factors=4, regularization=regularization, nb_iterations=3, cg_steps=4, confidence_alpha=alpha, block_size=17
+    ).fit(users, items, nb_users=300, nb_items=100)
+    # the last half iteration solved the item factors given the user factors, 4 CG steps are exact in dimension 4
+    counts = np.zeros((300, 100))
+    np.add.at(counts, (users, items), 1)
+    user_factors = als.user_factors.astype(np.float64)
+    for item in range(0, 100, 9):
+        confidence = 1 + alpha * counts[:, item]
+        preference = (counts[:, item] > 0).astype(np.float64)
+        normal_matrix = user_factors.T @ (confidence[:, None] * user_factors) + regularization * np.eye(4)
+        expected = np.linalg.solve(normal_matrix, user_factors.T @ (confidence * preference))
+        assert np.allclose(als.item_factors[item], expected, atol=1e-3)
+
+
+def test_workers_and_top_k():
+    users, items, _ = generate_low_rank_samples()
+    parameters = dict(nb_factors=4, nb_iterations=3, block_size=40)
+    als = AlternatingLeastSquares(**parameters).fit(users, items, nb_users=300, nb_items=100)
+    parallel_als = AlternatingLeastSquares(nb_workers=2, **parameters).fit(users, items, nb_users=300, nb_items=100)
+    assert np.array_equal(als.user_factors, parallel_als.user_factors)
+
+    blocks = list(parallel_als.iter_top_k(5))
+    top_users = np.concatenate([block.based for block in blocks])
+    top_items = np.concatenate([block.pivot for block in blocks])
+    scores = als.user_factors @ als.item_factors.T
+    assert np.array_equal(top_users, np.repeat(np.arange(300), 5))
+    expected_items = np.argsort(-scores, axis=1, kind="stable")[:, :5].reshape(-1)
+    assert np.array_equal(top_items, expected_items)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from execution_scheduler import ExecutionScheduler, FragmentExecutionError
+
+
+def test_results_by_fragment_name():
+    scheduler = ExecutionScheduler(max_concurrency=2)
+    scheduler.add_fragment("first", lambda: 1)
+    scheduler.add_fragment("second", lambda: 2)
+    assert scheduler.run() == {"first": 1, "second": 2}
+
+
+def test_max_concurrency_is_respected():
+    lock = threading.Lock()
+    concurrency = {"current": 0, "max": 0}
+
+    def fragment():
+        with lock:
+            concurrency["current"] += 1
+            concurrency["max"] = max(concurrency["max"], concurrency["current"])
+        time.sleep(0.02)
+        with lock:
+            concurrency["current"] -= 1
+
+    scheduler = ExecutionScheduler(max_concurrency=3)
+    for index in range(9):
+        scheduler.add_fragment(f"fragment_{index}", fragment)
+    scheduler.run()
+    assert concurrency["max"] == 3
+
+
+def test_dependencies_run_first():
+    order = []
+    scheduler = ExecutionScheduler(max_concurrency=4)
+    scheduler.add_fragment("stage", lambda: order.append("stage"))
+    scheduler.add_fragment("bucket_0", lambda: order.append("bucket_0"), dependencies=["stage"])
+    scheduler.add_fragment("bucket_1", lambda: order.append("bucket_1"), dependencies=["stage"])
+    scheduler.run()
+    assert order[0] == "stage"
+    assert sorted(order[1:]) == ["bucket_0", "bucket_1"]
+
+
+def test_failure_cancels_pending_fragments():
+    def failing_fragment():
+        raise RuntimeError("query failed")
+
+    ran = []
+    scheduler = ExecutionScheduler(max_concurrency=1)
+    scheduler.add_fragment("failing", failing_fragment)
+    scheduler.add_fragment("sibling", lambda: ran.append("sibling"))
+    scheduler.add_fragment("dependent", lambda: ran.append("dependent"), dependencies=["failing"])
+    with pytest.raises(FragmentExecutionError) as error:
+        scheduler.run()
+    assert list(error.value.errors) == ["failing"]
+    assert error.value.cancelled == ["sibling", "dependent"]
+    assert ran == []
+
+
+def test_running_fragments_errors_are_all_collected():
+    barrier = threading.Barrier(2)
+
+    def failing_fragment():
+        barrier.wait()
+        raise RuntimeError("query failed")
+
+    scheduler = ExecutionScheduler(max_concurrency=2)
+    scheduler.add_fragment("first", failing_fragment)
+    scheduler.add_fragment("second", failing_fragment)
+    with pytest.raises(FragmentExecutionError) as error:
+        scheduler.run()
+    assert sorted(error.value.errors) == ["first", "second"]
+
+
+def test_invalid_fragments():
+    scheduler = ExecutionScheduler()
+    scheduler.add_fragment("first", lambda: 1)
+    with pytest.raises(ValueError):
+        scheduler.add_fragment("first", lambda: 1)
+    with pytest.raises(ValueError):
+        scheduler.add_fragment("second", lambda: 1, dependencies=["unknown"])
+    with pytest.raises(ValueError):
+        ExecutionScheduler(max_concurrency=0)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from collaborative_filtering_reference import assert_close, generate_samples, reference_collaborative_filtering
+from sparse_handlers.fold_in_scorer import FoldInScorer
+
+
+@pytest.mark.parametrize("use_explicit", [False, True])
+@pytest.mark.parametrize("is_half_matrix", [False, True])
+def test_same_scores_as_item_based_collaborative_filtering(use_explicit, is_half_matrix):
+    users, items, ratings, timestamps = generate_samples()
+    ratings = [3.0 if item == 2 else rating for item, rating in zip(items, ratings)] if use_explicit else None
+    similarity, expected_scores = reference_collaborative_filtering(
+        users, items, ratings, timestamps, top_n=4, threshold=1, is_user_based=False, recent=None
+    )
+    pairs = [pair for pair in similarity if pair[0] < pair[1]] if is_half_matrix else list(similarity)
+    item_ids = lambda codes: [f"{code:03d}" for code in codes]
+
+    samples = pd.DataFrame({"user": users, "item": item_ids(items), "rating": ratings or 0.0})
+    scorer = FoldInScorer(top_n_most_similar=4, use_explicit=use_explicit).fit(
+        item_ids([pair[0] for pair in pairs]),
+        item_ids([pair[1] for pair in pairs]),
+        [similarity[pair] for pair in pairs],
+        is_half_matrix=is_half_matrix,
+        item_rating_average=samples.groupby("item")["rating"].mean(),
+    )
+    assert scorer.nbytes < 16 * scorer.neighbours.nnz + 8 * (2 * len(scorer.item_index) + 1)
+
+    scores_df = scorer.score(samples["user"], samples["item"], ratings=samples["rating"])
+    assert all((group["score"].diff().dropna() <= 0).all() for _, group in scores_df.dropna().groupby("user"))
+    scores = {(int(item), user): score for user, item, score in scores_df.itertuples(index=False)}
+    assert_close(expected_scores, scores)
+
+
+def test_unknown_items_are_ignored():
+    scorer = FoldInScorer(top_n_most_similar=1).fit(["a", "b"], ["b", "a"], [0.5, 0.5])
+    scores_df = scorer.score(["u", "u", "v"], ["a", "z", "z"])
+    assert scores_df.values.tolist() == [["u", "b", 0.5]]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+
+from sparse_handlers import interaction_matrix
+from sparse_handlers.id_encoder import IdEncoder
+from sparse_handlers.interaction_matrix import InteractionMatrix, InteractionMatrixBuilder
+
+
+def test_same_samples_as_in_memory_encoding(tmp_path, monkeypatch):
+    # small chunks and fan-in to go through several levels of merges
+    monkeypatch.setattr(interaction_matrix, "MAX_MERGE_FAN_IN", 3)
+    rng = np.random.default_rng(0)
+    nb_samples = 3000
+    users = pd.Series([f"u{code}" for code in rng.integers(0, 200, nb_samples)])
+    items = pd.Series([f"é{code}" for code in rng.integers(0, 80, nb_samples)])
+    ratings = rng.random(nb_samples)
+    timestamps = pd.to_datetime(rng.integers(0, 10 ** 9, nb_samples), unit="s").values
+
+    builder = InteractionMatrixBuilder(str(tmp_path), with_ratings=True, with_timestamps=True)
+    builder.chunk_size = 211
+    for start in range(0, nb_samples, builder.chunk_size):
+        chunk = slice(start, start + builder.chunk_size)
+        builder.add_chunk(users[chunk], items[chunk], ratings=ratings[chunk], timestamps=timestamps[chunk])
+    matrix = builder.build()
+
+    users_encoder, items_encoder = IdEncoder(), IdEncoder()
+    user_ids, user_codes = users_encoder.get_sorted_codes(users_encoder.encode(users))
+    item_ids, item_codes = items_encoder.get_sorted_codes(items_encoder.encode(items))
+    assert matrix.user_ids[np.arange(len(matrix.user_ids))].tolist() == user_ids.tolist()
+    assert matrix.item_ids[np.arange(len(matrix.item_ids))].tolist() == item_ids.tolist()
+
+    assert np.all(np.diff(matrix.get_user_codes() * matrix.nb_items + matrix.indices) >= 0)
+    expected = sorted(zip(user_codes, item_codes, ratings, timestamps.astype("datetime64[ns]").view(np.int64)))
+    assert sorted(zip(matrix.get_user_codes(), matrix.indices, matrix.ratings, matrix.timestamps)) == expected
+    assert "_spill" not in os.listdir(str(tmp_path))
+
+    reloaded = InteractionMatrix(str(tmp_path))
+    assert np.array_equal(reloaded.indptr, matrix.indptr)
+    assert reloaded.ratings is not None and reloaded.timestamps is not None
+
+
+def test_without_ratings_nor_timestamps(tmp_path):
+    builder = InteractionMatrixBuilder(str(tmp_path))
+    builder.add_chunk(pd.Series(["b", "a", "b"]), pd.Series(["x", "y", "x"]))
+    matrix = builder.build()
+    assert matrix.indptr.tolist() == [0, 1, 3]
+    assert matrix.indices.tolist() == [1, 0, 0]
+    assert matrix.ratings is None and matrix.timestamps is None
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+
+from dku_constants import PLAN_FORMAT, PLAN_ANTI_PATTERN
+from query_plans import QueryPlans, find_anti_patterns, parse_plan
+
+
+def postgres_node(node_type, rows, children=(), **keys):
+    node = {"Node Type": node_type, "Plan Rows": rows, **keys}
+    if children:
+        node["Plans"] = list(children)
+    return node
+
+
+def postgres_plan(root):
+    return json.dumps([{"Plan": root}])
+
+
+def get_anti_patterns(plan, plan_format=PLAN_FORMAT.POSTGRES_JSON):
+    return [finding.anti_pattern for finding in find_anti_patterns(parse_plan(plan, plan_format))]
+
+
+def test_postgres_null_safe_nested_loop():
+    scans = [postgres_node("Seq Scan", 100, **{"Relation Name": name}) for name in ("samples", "similarity")]
+    join = postgres_node(
+        "Nested Loop", 500, scans, **{"Join Filter": "(NOT (samples.item_id IS DISTINCT FROM similarity.item_id))"}
+    )
+    assert get_anti_patterns(postgres_plan(join)) == [PLAN_ANTI_PATTERN.NULL_SAFE_NESTED_LOOP]
+
+
+def test_postgres_cartesian_product_without_single_row_inputs():
+    scans = [postgres_node("Seq Scan", 100, **{"Relation Name": name}) for name in ("samples", "similarity")]
+    assert get_anti_patterns(postgres_plan(postgres_node("Nested Loop", 10000, scans))) == [
+        PLAN_ANTI_PATTERN.CARTESIAN_PRODUCT
+    ]
+    single_row = [scans[0], postgres_node("Aggregate", 1, [scans[1]])]
+    assert get_anti_patterns(postgres_plan(postgres_node("Nested Loop", 100, single_row))) == []
+    index_scan = postgres_node("Index Scan", 1, **{"Relation Name": "similarity", "Index Cond": "(item_id = 1)"})
+    assert get_anti_patterns(postgres_plan(postgres_node("Nested Loop", 100, [scans[0], index_scan]))) == []
+
+
+def test_postgres_repeated_scans_and_full_matrix_sort():
+    scans = [postgres_node("Seq Scan", 100, **{"Relation Name": "samples", "Schema": "public"}) for _ in range(3)]
+    self_join = postgres_node("Hash Join", 2000, scans[:2], **{"Hash Cond": "(l.item_id = r.item_id)"})
+    window = postgres_node("WindowAgg", 2000, [postgres_node("Sort", 2000, [self_join])])
+    root = postgres_node("Hash Join", 200, [window, scans[2]], **{"Hash Cond": "(l.user_id = r.user_id)"})
+    findings = find_anti_patterns(parse_plan(postgres_plan(root), PLAN_FORMAT.POSTGRES_JSON))
+    assert [finding.anti_pattern for finding in findings] == [
+        PLAN_ANTI_PATTERN.REPEATED_SCAN,
+        PLAN_ANTI_PATTERN.FULL_MATRIX_SORT,
+    ]
+    assert "public.samples is scanned 3 times" in findings[0].detail
+
+
+def test_snowflake_cartesian_join():
+    plan = {
+        "Operations": [
+            [
+                {"id": 0, "operation": "Result"},
+                {"id": 1, "operation": "CartesianJoin", "parentOperators": [0]},
+                {"id": 2, "operation": "TableScan", "objects": ["DB.PUBLIC.SAMPLES"], "parentOperators": [1]},
+                {"id": 3, "operation": "TableScan", "objects": ["DB.PUBLIC.SIMILARITY"], "parentOperators": [1]},
+                {"id": 4, "operation": "InnerJoin", "expressions": ["joinKey: (A = B)"], "parentOperators": [0]},
+            ]
+        ]
+    }
+    roots = parse_plan(json.dumps(plan), PLAN_FORMAT.SNOWFLAKE_JSON)
+    assert [child.operation for child in roots[0].children] == ["cartesian_join", "join"]
+    assert get_anti_patterns(json.dumps(plan), PLAN_FORMAT.SNOWFLAKE_JSON) == [PLAN_ANTI_PATTERN.CARTESIAN_PRODUCT]
+
+
+def test_showplan_null_safe_nested_loop():
+    plan = """<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan"><BatchSequence><Batch>
+    <Statements><StmtSimple><QueryPlan>
+      <RelOp PhysicalOp="Nested Loops" LogicalOp="Inner Join" EstimateRows="500">
+        <NestedLoops>
+          <Predicate><ScalarOperator ScalarString="[a].[item_id]=[b].[item_id] OR [a].[item_id] IS NULL"/></Predicate>
+          <RelOp PhysicalOp="Table Scan" LogicalOp="Table Scan" EstimateRows="100">
+            <TableScan><Object Schema="[dbo]" Table="[samples]"/></TableScan>
+          </RelOp>
+          <RelOp PhysicalOp="Table Scan" LogicalOp="Table Scan" EstimateRows="100">
+            <TableScan><Object Schema="[dbo]" Table="[similarity]"/></TableScan>
+          </RelOp>
+        </NestedLoops>
+      </RelOp>
+    </QueryPlan></StmtSimple></Statements></Batch></BatchSequence></ShowPlanXML>"""
+    roots = parse_plan(plan, PLAN_FORMAT.SHOWPLAN_XML)
+    assert [child.relation for child in roots[0].children] == ["[dbo].[samples]", "[dbo].[similarity]"]
+    assert get_anti_patterns(plan, PLAN_FORMAT.SHOWPLAN_XML) == [PLAN_ANTI_PATTERN.NULL_SAFE_NESTED_LOOP]
+
+
+def test_query_plans_files():
+    query_plans = QueryPlans("run", "hash", PLAN_FORMAT.POSTGRES_JSON)
+    scans = [postgres_node("Seq Scan", 100, **{"Relation Name": name}) for name in ("samples", "similarity")]
+    query_plans.add_plan("scores", "SELECT 1", plan=postgres_plan(postgres_node("Nested Loop", 10000, scans)), bucket=1)
+    query_plans.add_plan("similarity", "SELECT 2", error="permission denied")
+    query_plans.add_plan("top_n", "SELECT 3", plan="not a plan")
+    files = query_plans.get_files()
+    assert sorted(files) == [
+        "run/000_scores_b1.plan.json",
+        "run/000_scores_b1.sql",
+        "run/001_similarity.sql",
+        "run/002_top_n.plan.json",
+        "run/002_top_n.sql",
+        "run/summary.json",
+    ]
+    summary = json.loads(files["run/summary.json"])
+    assert summary["config_hash"] == "hash"
+    assert [query["findings"] for query in summary["queries"]][0][0]["anti_pattern"] == "cartesian_product"
+    assert summary["queries"][1]["error"] == "permission denied"
+    assert summary["queries"][2]["findings"] == []
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from run_metrics import RunMetrics, get_config_hash, METRICS_SCHEMA
+
+
+def test_config_hash_is_deterministic():
+    assert get_config_hash({"a": 1, "b": "x"}) == get_config_hash({"b": "x", "a": 1})
+    assert get_config_hash({"a": 1}) != get_config_hash({"a": 2})
+    assert len(get_config_hash({})) == 12
+
+
+def test_rows_in_and_stage_wall_time_from_input_stage():
+    run_metrics = RunMetrics("recipe", {"top_n": 10})
+    run_metrics.add_stage("visit_count", 1.0, rows_out=100)
+    run_metrics.add_stage("similarity", 3.0, rows_out=40, bucket=0, input_stage="visit_count")
+    run_metrics.add_stage("similarity", 2.5, rows_out=60, bucket=1, input_stage="visit_count")
+    run_metrics.add_stage("top_n", 3.5, rows_out=10, bucket=0, input_stage="similarity")
+    metrics_df = run_metrics.to_dataframe()
+    assert list(metrics_df.columns) == [column["name"] for column in METRICS_SCHEMA]
+    assert metrics_df["rows_in"].tolist()[1:] == [100, 100, 40]
+    assert metrics_df["rows_in"].isna().tolist()[0]
+    assert metrics_df["stage_wall_time_s"].tolist() == [1.0, 2.0, 1.5, 0.5]
+    assert metrics_df["bytes"].isna().all()
+
+
+def test_metric_values_are_summed_over_buckets():
+    run_metrics = RunMetrics("recipe", {})
+    run_metrics.add_stage("scores", 1.0, rows_out=5, nb_bytes=100, bucket=0)
+    run_metrics.add_stage("scores", 2.0, rows_out=7, bucket=1)
+    metric_values = run_metrics.get_metric_values()
+    assert metric_values["reco_run_id"] == run_metrics.run_id
+    assert metric_values["reco_scores_wall_time_s"] == 3.0
+    assert metric_values["reco_scores_rows_out"] == 12
+    assert metric_values["reco_scores_bytes"] == 100
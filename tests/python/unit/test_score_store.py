@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from sparse_handlers.score_store import ScoreStore, ScoreStoreWriter
+
+
+def write_version(directory, users, items, scores, chunk_size=None):
+    writer = ScoreStoreWriter(str(directory))
+    chunk_size = chunk_size or max(len(users), 1)
+    for start in range(0, len(users), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        writer.add_chunk(pd.Series(users[chunk]), pd.Series(items[chunk]), np.asarray(scores[chunk]))
+    return writer.build()
+
+
+def test_top_k_sorted_by_score(tmp_path):
+    rng = np.random.default_rng(0)
+    users = [f"u{code}" for code in rng.integers(0, 50, 2000)]
+    items = [f"é{code}" for code in rng.integers(0, 300, 2000)]
+    scores = rng.random(2000).round(3)
+    scores[::97] = np.nan
+    write_version(tmp_path, users, items, scores, chunk_size=300)
+
+    expected = {}
+    for user, item, score in zip(users, items, scores):
+        if not np.isnan(score):
+            expected.setdefault(user, []).append((item, float(np.float32(score))))
+    store = ScoreStore(str(tmp_path), cache_size=5)
+    for user, user_scores in expected.items():
+        user_scores = sorted(user_scores, key=lambda item_score: (-item_score[1], item_score[0]))
+        assert store.top_k(user, 4) == user_scores[:4]
+        excluded = {item for item, _ in user_scores[:2]}
+        assert store.top_k(user, 3, exclude=excluded) == [s for s in user_scores if s[0] not in excluded][:3]
+    assert len(store._state[1]) == 5
+    assert store.top_k("unknown", 3) == []
+    assert store.top_k("u1_longer_than_any_user_id", 3) == []
+
+
+def test_reload_new_version(tmp_path):
+    write_version(tmp_path, ["a", "a", "b"], ["x", "y", "x"], [1.0, 2.0, 3.0])
+    store = ScoreStore(str(tmp_path))
+    assert store.top_k("a", 5) == [("y", 2.0), ("x", 1.0)]
+    assert not store.reload()
+
+    write_version(tmp_path, ["a", "c"], ["z", "x"], [0.5, 1.5])
+    assert store.top_k("a", 5) == [("y", 2.0), ("x", 1.0)]
+    assert store.reload()
+    assert store.top_k("a", 5) == [("z", 0.5)]
+    assert store.top_k("b", 5) == []
+
+    # only the current and the previous versions are kept
+    write_version(tmp_path, [], [], [])
+    assert store.reload()
+    assert store.top_k("a", 5) == []
+    assert len([path for path in tmp_path.iterdir() if path.is_dir()]) == 2
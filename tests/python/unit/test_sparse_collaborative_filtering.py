@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from collaborative_filtering_reference import assert_close, generate_samples, reference_collaborative_filtering
+from sparse_handlers.id_encoder import IdEncoder
+from sparse_handlers.sparse_collaborative_filtering import SparseCollaborativeFiltering
+
+
+@pytest.mark.parametrize(
+    "use_explicit,is_user_based,recent,nb_workers",
+    [(False, True, None, 1), (True, False, None, 1), (False, False, 6, 1), (True, True, 6, 1), (True, True, None, 2)],
+)
+def test_same_results_as_sql_semantics(use_explicit, is_user_based, recent, nb_workers):
+    users, items, ratings, timestamps = generate_samples()
+    # entities whose ratings all equal their average have NULL similarities
+    ratings = [3.0 if user == 1 or item == 2 else rating for user, item, rating in zip(users, items, ratings)]
+    ratings = ratings if use_explicit else None
+    expected_similarity, expected_scores = reference_collaborative_filtering(
+        users, items, ratings, timestamps, top_n=4, threshold=2, is_user_based=is_user_based, recent=recent
+    )
+    collaborative_filtering = SparseCollaborativeFiltering(
+        top_n_most_similar=4,
+        user_visit_threshold=2,
+        item_visit_threshold=2,
+        is_user_based=is_user_based,
+        top_n_most_recent=recent,
+        block_size=7,
+        nb_workers=nb_workers,
+    ).fit(users, items, ratings=ratings, timestamps=timestamps)
+
+    similarity, scores = {}, {}
+    for similarity_block, scores_block in collaborative_filtering.iter_blocks(half_similarity_matrix=False):
+        similarity.update(zip(zip(similarity_block.based_1, similarity_block.based_2), similarity_block.similarity))
+        scores.update(zip(zip(scores_block.based, scores_block.pivot), scores_block.score))
+    assert_close(expected_similarity, similarity)
+    assert_close(expected_scores, scores)
+
+
+def test_half_similarity_matrix():
+    users, items, _, _ = generate_samples()
+    collaborative_filtering = SparseCollaborativeFiltering(top_n_most_similar=3, block_size=5).fit(users, items)
+    full, half = {}, {}
+    for similarity_block, _ in collaborative_filtering.iter_blocks(half_similarity_matrix=False):
+        full.update(zip(zip(similarity_block.based_1, similarity_block.based_2), similarity_block.similarity))
+    for similarity_block, _ in collaborative_filtering.iter_blocks(half_similarity_matrix=True):
+        half.update(zip(zip(similarity_block.based_1, similarity_block.based_2), similarity_block.similarity))
+    assert half == {pair: value for pair, value in full.items() if pair[0] < pair[1]}
+
+
+def test_visit_caps():
+    users, items, _, _ = generate_samples()
+    collaborative_filtering = SparseCollaborativeFiltering(top_n_most_similar=3, user_visit_cap=5, item_visit_cap=20)
+    collaborative_filtering.fit(users, items)
+    samples_count = collaborative_filtering.matrices["samples_count"]
+    assert samples_count.sum(axis=1).max() <= 5
+    assert samples_count.sum(axis=0).max() <= 20
+    assert np.array_equal(
+        samples_count.toarray(),
+        SparseCollaborativeFiltering(top_n_most_similar=3, user_visit_cap=5, item_visit_cap=20)
+        .fit(users, items)
+        .matrices["samples_count"]
+        .toarray(),
+    )
+
+
+@pytest.mark.parametrize("recency, kept_rating", [({}, 5.0), ({"top_n_most_recent": 10}, 4.0)])
+def test_visit_caps_keep_the_most_recent_then_highest_rated_duplicate(recency, kept_rating):
+    users, items, ratings, timestamps = [0, 0, 0, 1, 1], [0, 0, 0, 0, 1], [2.0, 5.0, 4.0, 1.0, 3.0], [3, 1, 3, 1, 2]
+    collaborative_filtering = SparseCollaborativeFiltering(top_n_most_similar=3, user_visit_cap=1, **recency)
+    collaborative_filtering.fit(users, items, ratings=ratings, timestamps=timestamps)
+    # the ratings are centered on the average rating of the user before the caps
+    assert collaborative_filtering.matrices["centered_ratings"][0, 0] == pytest.approx(kept_rating - 11 / 3)
+
+
+@pytest.mark.parametrize("recency", [{"top_n_most_recent": 6}, {"recency_window": (10, 40)}])
+def test_recency_filter_first(recency):
+    users, items, ratings, timestamps = generate_samples()
+    users, items, ratings, timestamps = np.array(users), np.array(items), np.array(ratings), np.array(timestamps)
+    parameters = dict(top_n_most_similar=4, user_visit_threshold=2, item_visit_threshold=2)
+    filtered_first = SparseCollaborativeFiltering(recency_filter_first=True, **parameters, **recency)
+    filtered_first.fit(users, items, ratings=ratings, timestamps=timestamps, nb_users=25, nb_items=15)
+    # same matrices as without timestamp filtering on the recent samples only
+    recent = filtered_first._get_recent(users, items, timestamps)
+    expected = SparseCollaborativeFiltering(**parameters)
+    expected.fit(users[recent], items[recent], ratings=ratings[recent], nb_users=25, nb_items=15)
+    assert 0 < np.count_nonzero(recent) < len(users)
+    for name in ["normalized", "samples_count"]:
+        assert np.allclose(filtered_first.matrices[name].toarray(), expected.matrices[name].toarray())
+
+    filtered_last = SparseCollaborativeFiltering(**parameters, **recency)
+    filtered_last.fit(users, items, ratings=ratings, timestamps=timestamps, nb_users=25, nb_items=15)
+    assert not np.allclose(filtered_last.matrices["normalized"].toarray(), expected.matrices["normalized"].toarray())
+
+
+def test_recency_window_of_dates():
+    users, items, _, timestamps = generate_samples()
+    dates = np.datetime64("2020-01-01") + np.array(timestamps).astype("timedelta64[D]")
+    date_window = (pd.Timestamp("2020-01-11").value, pd.Timestamp("2020-02-10").value)
+    collaborative_filtering = SparseCollaborativeFiltering(top_n_most_similar=3, recency_window=date_window)
+    expected = SparseCollaborativeFiltering(top_n_most_similar=3, recency_window=(10, 40))
+    assert np.array_equal(
+        collaborative_filtering.fit(users, items, timestamps=dates).matrices["samples_count"].toarray(),
+        expected.fit(users, items, timestamps=timestamps).matrices["samples_count"].toarray(),
+    )
+
+
+@pytest.mark.parametrize("projection", ["randomized_svd", "random_projection"])
+def test_projected_neighbours(projection):
+    users, items, ratings, timestamps = generate_samples()
+    expected_similarity, _ = reference_collaborative_filtering(
+        users, items, ratings, timestamps, top_n=4, threshold=1, is_user_based=False, recent=None
+    )
+    parameters = dict(top_n_most_similar=4, is_user_based=False, block_size=4, projection=projection)
+    # with as many dimensions as users the projection is exact (randomized SVD) or close to it (random projection)
+    collaborative_filtering = SparseCollaborativeFiltering(projection_dimension=25, **parameters)
+    collaborative_filtering.fit(users, items, ratings=ratings)
+    assert 0 <= collaborative_filtering.estimated_recall <= 1
+    if projection == "randomized_svd":
+        assert collaborative_filtering.estimated_recall == 1
+
+    found = {}
+    for similarity_block, _ in collaborative_filtering.iter_blocks():
+        found.update(zip(zip(similarity_block.based_1, similarity_block.based_2), similarity_block.similarity))
+    assert all(np.bincount([pair[0] for pair in found]) <= 4)
+    # the similarities of the neighbours found are exact
+    assert_close({pair: expected_similarity[pair] for pair in found}, found)
+
+    low_dimension = SparseCollaborativeFiltering(projection_dimension=2, recall_sample_size=5, **parameters)
+    assert 0 <= low_dimension.fit(users, items, ratings=ratings).estimated_recall <= 1
+
+
+def test_id_encoder_sorted_codes():
+    encoder = IdEncoder()
+    codes = np.concatenate([encoder.encode(pd.Series(["b", "a", "b"])), encoder.encode(pd.Series(["c", "a"]))])
+    assert codes.tolist() == [0, 1, 0, 2, 1]
+    ids, sorted_codes = encoder.get_sorted_codes(codes)
+    assert ids.tolist() == ["a", "b", "c"]
+    assert sorted_codes.tolist() == [1, 0, 1, 2, 0]